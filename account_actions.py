@@ -15,8 +15,15 @@ import time
 import logging
 import re
 
-from account_util import AccountUtil
+from account_util import AccountUtil, AccountRecord
+from account_summary import SummaryTotals
+from account_history import KIND_TRANSFER_OUT, KIND_TRANSFER_IN
 from atomic_write import AtomicWrite
+from write_ahead_log import get_wal
+from binary_store import get_binary_store
+from recovery_catalog import RecoveryCatalog
+from lock_set import LockSet
+from bank_metrics import timed, observe_step
 from collections import namedtuple
 
 class AccountActions(AccountUtil):
@@ -28,6 +35,7 @@ class AccountActions(AccountUtil):
     # transfers money from one account to another.
     # returns True on success False on failue
     # error string can be retrieved using get_error_string
+    @timed('transfer', lambda done: done is False)
     def transfer_money(self, from_id, to_id, amount):
         error = False
         self.clear_errors()
@@ -60,6 +68,11 @@ class AccountActions(AccountUtil):
             self.add_error(err)
             logging.warning("XFER0046: to account number %s is not known", to_id)
             error = True
+        elif int(from_id) == int(to_id):
+            err = "can't transfer money from an account to itself: %s" % from_id
+            self.add_error(err)
+            logging.warning("XFER0068: transfer from account %s to itself", from_id)
+            error = True
 
         # this method returns the new balance and -1 on error
         if error is True:
@@ -95,76 +108,117 @@ class AccountActions(AccountUtil):
         from_aw.set_file_name(from_file)
         to_aw.set_file_name(to_file)
 
-        from_aw.lock_file()
-        to_aw.lock_file()
+        # both locks are taken in the same order by everyone so a transfer
+        # the other way between the same accounts can't deadlock with us
+        locks = LockSet([from_aw, to_aw])
+        locks.acquire()
+
+        # the locks are released whatever happens below
+        try:
+            # the files may have moved while we waited for the locks
+            from_file = from_aw.filename
+            to_file = to_aw.filename
+            from_info = self.read_account_file(from_file)
+            to_info = self.read_account_file(to_file)
+
+            from_balance = from_info.balance - amount
+            if from_balance < 0:
+                logging.warning("XFER0044 not enough money in source account")
+                self.add_error("not enough money in source account")
+                return False
+
+            to_balance = to_info.balance + amount
+
+            from_content = "%s,%s,%s\n" % (from_info.fname, from_info.lname, from_balance)
+            to_content = "%s,%s,%s\n" % (to_info.fname, to_info.lname, to_balance)
+
+            from_id = self.account_id_from_path(from_file)
+            to_id = self.account_id_from_path(to_file)
+            history = self.record_history([(from_id, KIND_TRANSFER_OUT, to_id, amount, from_balance),
+                                           (to_id, KIND_TRANSFER_IN, from_id, amount, to_balance)])
+            self.commit_transaction([(from_aw, from_content), (to_aw, to_content)])
+            self.finish_history(history)
+            self.__update_transfer_summary(from_file, from_info, from_balance,
+                                           to_file, to_info, to_balance)
+            return True
+        finally:
+            locks.release()
 
+    # public
+    # writes new content to several files as one transaction. members is
+    # a list of (AtomicWrite, content), every one locked and sharing a
+    # transid and the xtmp/xold suffixes. if we die half way recover.py
+    # finds the files by the transid and finishes or drops all of them.
+    def commit_transaction(self, members):
+        # with the write ahead log every file goes in one record so there
+        # is nothing to recover but the log itself.
+        if self.get_storage() == 'wal':
+            get_wal(self.dbdir).commit([(aw.filename, content) for aw, content in members])
+            return
+        # the binary store journals the whole commit the same way
+        if self.get_storage() == 'binary':
+            get_binary_store(self.dbdir).commit([(aw.filename, content) for aw, content in members])
+            return
 
         #step 1 copy old files to tmp files
-        shutil.copy2(from_file, from_aw.get_tmpfile())
-        shutil.copy2(to_file, to_aw.get_tmpfile())
-
-        from_info = self.__read_account_info(from_file)
-        to_info = self.__read_account_info(to_file)
-
-        from_balance = from_info.balance - amount
-        if from_balance < 0:
-            logging.warning("XFER0044 not enough money in source account")
-            self.add_error("not enough money in source account")
-            return False
-
-        to_balance = to_info.balance + amount
+        start = time.time()
+        for aw, content in members:
+            shutil.copy2(aw.filename, aw.get_tmpfile())
+        start = observe_step('copy', start)
 
         # step 2 write new values to tmp file
-        from_content = "%s,%s,%s\n" % (from_info.fname, from_info.lname, from_balance)
-        self.__write_content(from_aw.get_tmpfile(), from_content);
-        to_content = "%s,%s,%s\n" % (to_info.fname, to_info.lname, to_balance)
-        self.__write_content(to_aw.get_tmpfile(), to_content);
+        for aw, content in members:
+            self.__write_content(aw.get_tmpfile(), content)
+        start = observe_step('write', start)
 
         #step 3 move orig file to old file
-        shutil.move(from_file, from_aw.get_oldfile())
-        shutil.move(to_file, to_aw.get_oldfile())
+        for aw, content in members:
+            shutil.move(aw.filename, aw.get_oldfile())
 
         # step 4 rename tmp file to orig file
-        shutil.move(from_aw.get_tmpfile(), from_file)
-        shutil.move(to_aw.get_tmpfile(), to_file)
+        for aw, content in members:
+            shutil.move(aw.get_tmpfile(), aw.filename)
+        start = observe_step('rename', start)
 
-        # step 4 we cant delete the old file now.
+        # step 5 we cant delete the old file now.
         # if it fails it will get cleaned up on recovery
-        os.remove(from_aw.get_oldfile())
-        os.remove(to_aw.get_oldfile())
-
-        from_aw.unlock_file()
-        to_aw.unlock_file()
-        return True
-
-    def __get_tmp_files(self, lockfile):
-        # get the db txt files for the two lockfiles
-        basename = lockfile[:-5]
-        filename = basename + ".txt"
-        transid = None
-        #p = re.compile('(^\d+\w)(\w{8})')
-
-        # find the files
-        basename = os.path.basename(filename)
-        prefix, suffix = os.path.splitext(basename)
+        for aw, content in members:
+            os.remove(aw.get_oldfile())
+        observe_step('unlink', start)
 
+    # private
+    # both sides of a transfer go in the summary as one update so the
+    # totals never show the money in neither or both accounts
+    def __update_transfer_summary(self, from_file, from_info, from_balance,
+                                  to_file, to_info, to_balance):
+        self.update_summary([
+            (self.account_id_from_path(from_file), from_info.fname, from_info.lname, from_balance),
+            (self.account_id_from_path(to_file), to_info.fname, to_info.lname, to_balance)])
+
+    def __get_tmp_files(self, lockfile, catalog, transid=None):
+        # get the db txt file for the lockfile
+        filename = self.get_lock_data_files(lockfile)[0]
+        key = catalog.key_for(lockfile)
+
+        # find the files. they sit next to the data file they were made
+        # from
         tmpfile = None
-        tmpfiletest = prefix + "_*" + suffix + "." + self.tmpsuffix
-        for tfile in self.ffind(tmpfiletest, self.dbdir):
-            logging.debug("AA0155 found tmpfile %s", tfile)
-            tmpfile = tfile
+        oldfile = None
+        for entry in catalog.get_intermediates(key, self.tmpsuffix, transid):
+            logging.debug("AA0155 found tmpfile %s", entry.path)
+            tmpfile = entry.path
+            filename = entry.datafile
 
         # if we didn't find any tmp files look for old files
         # else use the matching old file
-        oldfile = None
         if tmpfile is None:
-            oldfiletest = prefix + "_*" + suffix + "." + self.oldsuffix
-            for ofile in self.ffind(oldfiletest, self.dbdir):
-                logging.debug("AA0169 found oldfile %s", ofile)
-                oldfile = ofile
-                tmpfile = oldfile.replace(self.oldsuffix, self.tmpsuffix)
+            for entry in catalog.get_intermediates(key, self.oldsuffix, transid):
+                logging.debug("AA0169 found oldfile %s", entry.path)
+                oldfile = entry.path
+                tmpfile = oldfile[:-len(self.oldsuffix)] + self.tmpsuffix
+                filename = entry.datafile
         else:
-            oldfile = tmpfile.replace(self.tmpsuffix, self.oldsuffix)
+            oldfile = tmpfile[:-len(self.tmpsuffix)] + self.oldsuffix
 
         Filelist = namedtuple('filelist', 'lockfile tmpfile oldfile filename')
         files = Filelist(lockfile, tmpfile, oldfile, filename)
@@ -180,40 +234,36 @@ class AccountActions(AccountUtil):
     #  state: the server has crashed and the caller found the
     # two lockfiles involved in a transfer. this will only
     # happen is we have matching IDs in xtmp or xold files.
-    def recover_transfer(self, lockfile_1, lockfile_2):
+    # the files are looked up in catalog (a RecoveryCatalog), the dbdir
+    # is catalogued if there isn't one. transid limits it to one transfer.
+    def recover_transfer(self, lockfile_1, lockfile_2, catalog=None, transid=None):
+        self.recover_transaction([lockfile_1, lockfile_2], catalog, transid)
+
+    # public
+    # recover_transfer for a commit_transaction of any number of files.
+    # keep_locks leaves the lock files to the caller
+    def recover_transaction(self, lockfiles, catalog=None, transid=None, keep_locks=False):
 
         # since this is a transfer we need to set the suffix
         self.set_old_suffix("xold")
         self.set_tmp_suffix("xtmp")
 
-        files_1 = self.__get_tmp_files(lockfile_1)
-        files_2 = self.__get_tmp_files(lockfile_2)
-
-        xtmp1_exists = self.__file_exists(files_1.tmpfile)
-        xtmp2_exists = self.__file_exists(files_2.tmpfile)
-
-        xold1_exists = self.__file_exists(files_1.oldfile)
-        xold2_exists = self.__file_exists(files_2.oldfile)
-
-        file1_exists = self.__file_exists(files_1.filename)
-        file2_exists = self.__file_exists(files_2.filename)
+        if catalog is None:
+            catalog = RecoveryCatalog(self.dbdir).scan()
+        filelists = [self.__get_tmp_files(lockfile, catalog, transid) for lockfile in lockfiles]
 
         # first case
         # assumes moves are atomic
         # if we die during steps 3 and 4 we will have
-        # either none or one actual files. In all cases
+        # some actual files missing. In all cases
         # we would have finished step 2 so the tmp files
         # have good data. mv the tmp files to the actual files
-        if file1_exists is False or file2_exists is False:
+        missing = [files for files in filelists if self.__file_exists(files.filename) is False]
+        if len(missing) > 0:
             logging.info("AA0214:RECOVER case 1. Moving tmp files to actual files")
-            if xtmp1_exists is True:
-                shutil.move(files_1.tmpfile, files_1.filename)
-                xtmp1_exists = False
-                file1_exists = True
-            if xtmp2_exists is True:
-                shutil.move(files_2.tmpfile, files_2.filename)
-                xtmp1_exists = False
-                file1_exists = True
+            for files in filelists:
+                if self.__file_exists(files.tmpfile) is True:
+                    shutil.move(files.tmpfile, files.filename)
 
         # in all other cases if the server has died what is
         # in the actual file is correct. it may be before or
@@ -222,8 +272,10 @@ class AccountActions(AccountUtil):
         # the user but out of scope of the specification
 
         # cleanup
-        self.__delete_filelist(files_1)
-        self.__delete_filelist(files_2)
+        for files in filelists:
+            if keep_locks is True:
+                files = files._replace(lockfile=None)
+            self.__delete_filelist(files)
 
     def __delete_filelist(self, flist, includefilename=False):
 
@@ -247,33 +299,80 @@ class AccountActions(AccountUtil):
         f.flush()
         f.close()
 
-    # private
-    # function that reads account info
-    # no arg checking
-    def __read_account_info(self, filename):
-        # read in file
-        file = open(filename, 'r')
-        file_contents = file.readline()
-        file.close()
-
-        vals = file_contents.split(',')
-        balance = float(vals[2].strip())
-        Account = namedtuple('Account', 'fname lname balance')
-        account = Account(vals[0], vals[1], balance)
-        return account
-
+    # public
+    # returns the list of formatted account lines with a header line.
+    # builds the whole list, the UI pages through list_accounts instead.
     def print_accounts(self):
         account_list = []
         str = "ID\tName\tBalance"
         account_list.append(str)
-        for dfile in self.ffind("*.txt", self.dbdir):
-            logging.debug("AA0271 found data file %s", dfile)
-            basename = os.path.basename(dfile)
-            prefix, suffix = os.path.splitext(basename)
-            ac_id = int(prefix)
-
-            ac_info = self.__read_account_info(dfile)
-            ac = '%d\t%s %s\t%8.2f' % (ac_id, ac_info.fname,
-                                       ac_info.lname, float(ac_info.balance))
-            account_list.append(ac)
+        for record in self.iter_accounts():
+            account_list.append(self.format_account(record))
         return account_list
+
+    def format_account(self, record):
+        return '%d\t%s %s\t%8.2f' % (record.id, record.fname,
+                                      record.lname, float(record.balance))
+
+    # public
+    # returns one page of accounts in id order: (records, cursor). pass
+    # the cursor back to get the next page, it is None after the last.
+    def list_accounts(self, cursor=None, page_size=20):
+        if cursor is None:
+            cursor = 0
+        records = []
+        for record in self.iter_accounts(cursor):
+            if len(records) == page_size:
+                return records, record.id
+            records.append(record)
+        return records, None
+
+    # public
+    # generator of AccountRecords in id order starting at start_id. read
+    # from a snapshot of the summary file, so the balances are the ones
+    # after one commit and add up however long the scan takes, or from
+    # the account files if summary = off.
+    def iter_accounts(self, start_id=0):
+        summary = self.get_account_summary()
+        if summary is None:
+            for record in self.iter_account_files(start_id):
+                yield record
+            return
+        snapshot = summary.snapshot()
+        if snapshot is None:
+            return
+        try:
+            for record in snapshot.records(start_id):
+                if record.long_name:
+                    # the summary only has the start of the name
+                    ac_info = self.read_account_file(self.get_account_filename(record.id))
+                    yield AccountRecord(record.id, ac_info.fname, ac_info.lname, record.balance)
+                else:
+                    yield AccountRecord(record.id, record.fname, record.lname, record.balance)
+        finally:
+            snapshot.close()
+
+    # public
+    # a SummarySnapshot of every account as of the last commit, its
+    # records() and totals() don't move while commits go on. close it
+    # when done. None if summary = off.
+    def snapshot(self):
+        summary = self.get_account_summary()
+        if summary is None:
+            return None
+        return summary.snapshot()
+
+    # public
+    # the number of accounts and the money in the bank, a SummaryTotals
+    def get_bank_totals(self):
+        summary = self.get_account_summary()
+        if summary is not None:
+            totals = summary.totals()
+            if totals is not None:
+                return totals
+        count = 0
+        balance = 0.0
+        for record in self.iter_account_files():
+            count += 1
+            balance += record.balance
+        return SummaryTotals(count, balance)
@@ -7,6 +7,7 @@ import unittest
 import os
 import time
 import shutil
+import tempfile
 
 from account_actions import AccountActions
 from account_create import AccountCreate
@@ -17,8 +18,8 @@ class AccountActions_Test(unittest.TestCase):
     # setup
     def setUp(self):
 
-        #unit tests run in the current directory
-        self.dir  = os.getcwd()
+        # a dbdir of its own, the commits leave a summary and history in it
+        self.dir  = tempfile.mkdtemp()
         # make a test index file.
         fname = 'index.idx'
         self.indexfile = os.path.join(self.dir, fname)
@@ -44,9 +45,7 @@ class AccountActions_Test(unittest.TestCase):
         self.two_file = ac.get_account_file()
 
     def tearDown(self):
-        os.remove(self.two_file)
-        os.remove(self.one_file)
-        os.remove(self.indexfile)
+        shutil.rmtree(self.dir)
 
     def test_transfer_money(self):
 
@@ -62,6 +61,33 @@ class AccountActions_Test(unittest.TestCase):
         self.assertEqual(one_info.balance, 50.00)
         self.assertEqual(two_info.balance, 150.00)
 
+    def test_transfer_failure_unlocks(self):
+        aa = AccountActions(self.dir)
+        def fail(changes):
+            raise IOError("disk full")
+        aa.record_history = fail
+        self.assertRaises(IOError, aa.transfer_money, self.one_id, self.two_id, 50.00)
+        self.assertEqual([name for name in os.listdir(self.dir) if name.endswith('.lock')], [])
+        self.assertTrue(AccountActions(self.dir).transfer_money(self.one_id, self.two_id, 50.00))
+
+    def test_list_accounts(self):
+        aa = AccountActions(self.dir)
+
+        # one per page
+        records, cursor = aa.list_accounts(None, 1)
+        self.assertEqual([r.id for r in records], [self.one_id])
+        self.assertEqual(cursor, self.two_id)
+        records, cursor = aa.list_accounts(cursor, 1)
+        self.assertEqual([r.id for r in records], [self.two_id])
+        self.assertEqual(records[0].fname, 'Bob')
+        self.assertEqual(records[0].balance, 100.0)
+        self.assertEqual(cursor, None)
+
+        # the old full listing still works and is in id order
+        lines = aa.print_accounts()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('%d\t' % self.one_id))
+
     def __write_data_to_file(self, fname, content):
         f = open(fname, 'w')
         f.write(content)
@@ -0,0 +1,94 @@
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# process wide LRU cache of parsed account records.
+#
+# every entry carries the token of the file it was read from, the
+# (inode, mtime in ns, size) from os.stat. a lookup stats the file and
+# only uses the entry if the token still matches, so a commit by another
+# process (which renames a new file into place) is never missed. a stat
+# is a lot cheaper than an open/read/close and a parse.
+#
+import os
+import threading
+from collections import OrderedDict
+
+# size -> AccountCache. one per process
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_account_cache(size):
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AccountCache(size)
+        elif _cache.capacity != size:
+            _cache.resize(size)
+        return _cache
+
+# the validation token of a file. raises OSError if it is gone
+def file_token(filename):
+    st = os.stat(filename)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_ino, mtime_ns, st.st_size)
+
+class AccountCache(object):
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # public
+    # returns the cached value for key if it was stored with token,
+    # None otherwise
+    def get(self, key, token):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != token:
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    # public
+    # stores value for key, evicting the least recently used entries
+    def put(self, key, token, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (token, value)
+            self.__evict()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def resize(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            self.__evict()
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self.entries),
+                    'capacity': self.capacity}
+
+    def __evict(self):
+        while len(self.entries) > max(self.capacity, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
@@ -1,17 +1,62 @@
 # -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
 #
 # Sub classes AtomicWrite. Creates an account file.
+#
+# ids come from index.idx. one id per create is one index update (lock,
+# read, write, unlock) per account, so a bulk load or a process with
+# id_block_size > 1 reserves a block of ids in one update instead:
+#
+#   1. lock index.idx, read the last id
+#   2. write the reservation, <dbdir>/index_<lo>_<hi>.rsv
+#   3. write hi back to index.idx and unlock
+#
+# the block belongs to the process until its reservation is closed. a
+# closed block whose unused ids are at the top of the index gives them
+# back (index.idx goes down to the highest id that has an account file),
+# otherwise the unused ids are skipped for good. recover.py closes the
+# reservations of processes that died the same way, so what happens to
+# an unused id only depends on the files in the dbdir.
+#
 import os
+import re
+import errno
+import atexit
 import logging
 import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+from atomic_write import AtomicWrite, pid_alive
+from account_util import AccountUtil
+from binary_store import get_binary_store
+from account_history import KIND_CREATE
+from bank_metrics import timed
+
+# index_<lo>_<hi>.rsv
+RESERVATION_PATTERN = re.compile('^index_(\d+)_(\d+)\.rsv$')
+
+# accounts per reserved block when creating in bulk
+BULK_BLOCK_SIZE = 1000
+
+# the per process block of ids (id_block_size > 1).
+# dbdir -> [pid, next id, hi, lo]
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
 
-from atomic_write import AtomicWrite
+def _close_id_blocks():
+    with _id_blocks_lock:
+        for dbdir, block in _id_blocks.items():
+            # a forked child doesn't own its parent's block
+            if block[0] == os.getpid():
+                AccountCreate(dbdir).close_reservation(block[3], block[2], block[1] - 1)
+        _id_blocks.clear()
+
+atexit.register(_close_id_blocks)
 
 class AccountCreate(AtomicWrite):
 
     def __init__(self, dir=None):
         AtomicWrite.__init__(self, dir)
-        logging.basicConfig(filename='drovebank.log', level=logging.DEBUG)
         self.set_file_name(self.get_index_filename())
 
     # this will
@@ -19,18 +64,203 @@ class AccountCreate(AtomicWrite):
     #   2. read the latest (highest) account number
     #   3  increment it
     #   4  write it back to the file
+    # with id_block_size > 1 the number comes from the block of the process
     def get_account_number(self):
+        if self.get_config_int('id_block_size') > 1:
+            return self.__next_block_id()
         self.lock_file()
         # read index file.
-        file = open(self.filename, 'r')
-        last_id = file.readline()
-        file.close()
+        last_id = self.read_content()
         next_id = int(last_id.strip()) + 1
         content = "%s\n" % (next_id)
         self.write_content(content)
         self.unlock_file()
         return next_id
 
+    # public
+    # reserves count ids in one index update. returns (lo, hi), the ids
+    # lo to hi are the caller's until it calls close_reservation.
+    def reserve_ids(self, count):
+        if count < 1:
+            raise ValueError("can't reserve %s ids" % count)
+        self.lock_file()
+        try:
+            last_id = int(self.read_content().strip())
+            lo = last_id + 1
+            hi = last_id + count
+            # the reservation is on disk before the index moves past it
+            f = open(self.get_reservation_filename(lo, hi), 'w')
+            f.write("%d\n" % os.getpid())
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self.write_content("%s\n" % hi)
+        finally:
+            self.unlock_file()
+        logging.debug("AC0093 reserved ids %d to %d", lo, hi)
+        return (lo, hi)
+
+    # public
+    # closes the reservation of lo to hi. used is the highest id the
+    # process handed out, those are taken even if their account isn't
+    # there yet. None (the process died) means every id without an account
+    # file is unused. if the index is still at hi the unused ids at the
+    # top of the block go back, if not they are skipped. a reservation
+    # whose process is still alive is left alone when used is None.
+    # returns the last id of the index.
+    def close_reservation(self, lo, hi, used=None):
+        rsvname = self.get_reservation_filename(lo, hi)
+        self.lock_file()
+        try:
+            last_id = int(self.read_content().strip())
+            if used is None:
+                pid = self.get_reservation_pid(rsvname)
+                if pid is not None and pid_alive(pid):
+                    logging.info("AC0113 ids %d to %d are still reserved by %d", lo, hi, pid)
+                    return last_id
+                used = lo - 1
+                util = AccountUtil(self.dbdir)
+                for ac_id in range(hi, lo - 1, -1):
+                    if util.check_account_file(ac_id):
+                        used = ac_id
+                        break
+            if used < hi and last_id == hi:
+                logging.info("AC0118 ids %d to %d go back to the index", used + 1, hi)
+                self.write_content("%s\n" % used)
+                last_id = used
+            elif used < hi:
+                logging.info("AC0122 ids %d to %d are skipped", used + 1, hi)
+            if os.path.exists(rsvname):
+                os.remove(rsvname)
+        finally:
+            self.unlock_file()
+        return last_id
+
+    # public
+    # closes the reservation file of a process that died, for recover.py.
+    # returns False if it isn't a reservation or its process is alive.
+    def recover_reservation(self, rsvname):
+        m = RESERVATION_PATTERN.match(os.path.basename(rsvname))
+        if m is None:
+            return False
+        pid = self.get_reservation_pid(rsvname)
+        if pid is not None and pid_alive(pid):
+            logging.info("AC0136 reservation %s belongs to running process %d", rsvname, pid)
+            return False
+        lo, hi = int(m.group(1)), int(m.group(2))
+        logging.info("AC0133 closing reservation of ids %d to %d", lo, hi)
+        self.close_reservation(lo, hi)
+        return not os.path.exists(rsvname)
+
+    # public
+    # the pid written into a reservation file, None if it is gone or was
+    # cut short
+    def get_reservation_pid(self, rsvname):
+        try:
+            f = open(rsvname)
+            try:
+                return int(f.read().strip())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_reservation_filename(self, lo, hi):
+        return os.path.join(self.dbdir, "index_%d_%d.rsv" % (lo, hi))
+
+    # public
+    # creates an account for every (fname, lname, starting balance) of
+    # records. the ids are reserved BULK_BLOCK_SIZE at a time and the
+    # account files of a block are written by worker threads. returns the
+    # ids in the order of records, -1 for a bad record.
+    def create_accounts(self, records, workers=4):
+        ids = []
+        block = []
+        pool = ThreadPool(workers)
+        try:
+            for record in records:
+                if self.__check_account(*record) is False:
+                    ids.append(-1)
+                    continue
+                ids.append(None)
+                block.append((len(ids) - 1, record))
+                if len(block) == BULK_BLOCK_SIZE:
+                    self.__create_block(pool, block, ids)
+                    block = []
+            if len(block) > 0:
+                self.__create_block(pool, block, ids)
+        finally:
+            pool.close()
+            pool.join()
+        return ids
+
+    # private
+    # creates the accounts of one reserved block
+    def __create_block(self, pool, block, ids):
+        lo, hi = self.reserve_ids(len(block))
+        accounts = []
+        shard_dirs = set()
+        for n, (pos, (fname, lname, starting_balance)) in enumerate(block):
+            ac_id = lo + n
+            if self.get_layout() == 'flat':
+                filename = self.flat_account_path(ac_id)
+            else:
+                filename = self.sharded_account_path(ac_id)
+                shard_dirs.add(os.path.dirname(filename))
+            accounts.append((ac_id, filename, fname, lname, starting_balance))
+            ids[pos] = ac_id
+        for shard_dir in shard_dirs:
+            self.__make_shard_dir(shard_dir)
+
+        util = AccountUtil(self.dbdir)
+        summary = [(ac_id, fname, lname, float(balance))
+                   for ac_id, filename, fname, lname, balance in accounts]
+        history = util.record_history([(ac_id, KIND_CREATE, 0, balance, balance)
+                                       for ac_id, fname, lname, balance in summary])
+        if self.get_storage() == 'binary':
+            # the whole block is one commit of the store
+            util.update_summary(summary)
+            get_binary_store(self.dbdir).commit(
+                [(filename, "%s,%s,%s\n" % (fname, lname, balance))
+                 for ac_id, filename, fname, lname, balance in accounts])
+        else:
+            pool.map(self.__write_atmp, accounts)
+            # as with one account the summary goes before the renames
+            util.update_summary(summary)
+            pool.map(self.__rename_atmp, accounts)
+        util.finish_history(history)
+
+        self.close_reservation(lo, hi, hi)
+        logging.debug("AC0185 created accounts %d to %d", lo, hi)
+
+    def __write_atmp(self, account):
+        ac_id, filename, fname, lname, starting_balance = account
+        f = open("%s.atmp" % filename, 'w')
+        f.write("%s,%s,%s\n" % (fname, lname, starting_balance))
+        f.close()
+
+    def __rename_atmp(self, account):
+        os.rename("%s.atmp" % account[1], account[1])
+
+    # private
+    # the next id of the process's block, a new block is reserved when it
+    # runs out
+    def __next_block_id(self):
+        key = os.path.abspath(self.dbdir)
+        with _id_blocks_lock:
+            block = _id_blocks.get(key)
+            if block is not None and block[0] != os.getpid():
+                block = None
+            if block is None or block[1] > block[2]:
+                if block is not None:
+                    self.close_reservation(block[3], block[2], block[2])
+                lo, hi = self.reserve_ids(self.get_config_int('id_block_size'))
+                block = [os.getpid(), lo, hi, lo]
+                _id_blocks[key] = block
+            next_id = block[1]
+            block[1] += 1
+            return next_id
+
 
     # if lock file is there and only self.filename then we either crashed before
     # step 1 or after step 5. Either way just delete the lock file and move on.
@@ -112,28 +342,11 @@ class AccountCreate(AtomicWrite):
     #    3. format csv file: fname,lname,balance
     #    4. write to tmp file
     #    5. do atomic rename to account file.
+    @timed('create', lambda ac_id: ac_id == -1)
     def create_account(self, fname, lname, starting_balance=0.0):
 
-        # validate
-        error = False
-        if fname is None or len(fname) == 0:
-            logging.warning("AC0050 fname is null or empty")
-            error = True
-        if lname is None or len(lname) == 0:
-            logging.warning("AC0053 lname is null or empty")
-            error = True
-
-        # test float
-        if self.isfloat(starting_balance) == False:
-            logging.warning("AC0127 starting balance is not a float: %s", starting_balance)
-            error = True
-        elif float(starting_balance) < 0.0:
-            logging.warning("AC0055 starting balance is negative: %s", starting_balance)
-            error = True
-
-
         # returns -1 on error
-        if error is True:
+        if self.__check_account(fname, lname, starting_balance) is False:
             return -1
 
         self.account_id = self.get_account_number()
@@ -145,23 +358,73 @@ class AccountCreate(AtomicWrite):
         # putting a mutex around this operation. However writes
         # are not atomic so we will write to a tmp file then do
         # an atomic rename
-        fname = "%s.txt.atmp" % (self.account_id)
-        # make it canonical
-        fname = os.path.join(self.dbdir, fname)
-        # create the true name
-        afile = "%s.txt" % (self.account_id)
-        self.account_file = os.path.join(self.dbdir, afile)
+        # create the true name. new accounts go straight into the sharded
+        # layout while the dbdir is being migrated
+        if self.get_layout() == 'flat':
+            self.account_file = self.flat_account_path(self.account_id)
+        else:
+            self.account_file = self.sharded_account_path(self.account_id)
+            self.__make_shard_dir(os.path.dirname(self.account_file))
+
+        util = AccountUtil(self.dbdir)
+        history = util.record_history([(self.account_id, KIND_CREATE, 0,
+                                        float(starting_balance), float(starting_balance))])
+
+        # the binary store has no account file, the commit writes the record
+        if self.get_storage() == 'binary':
+            util.update_summary([(self.account_id, fname, lname, float(starting_balance))])
+            get_binary_store(self.dbdir).commit([(self.account_file, csv)])
+            util.finish_history(history)
+            logging.debug("AC0086 create account %s completed in the binary store", self.account_id)
+            return self.account_id
+
+        atmpname = "%s.atmp" % (self.account_file)
 
         # write out the tmp file
-        f = open(fname, 'w')
+        f = open(atmpname, 'w')
         f.write(csv)
         f.close()
 
+        # the summary goes first. once the account file is there someone
+        # can deposit to it and their update must land after this one.
+        util.update_summary([(self.account_id, fname, lname, float(starting_balance))])
+
         # now do atomic rename
-        shutil.move(fname, self.account_file)
+        shutil.move(atmpname, self.account_file)
+        util.finish_history(history)
         logging.debug("AC0086 create account %s completed. File: %s", self.account_id, self.account_file)
         return self.account_id
 
+    # private
+    # validates a new account, logs what is wrong with it
+    def __check_account(self, fname, lname, starting_balance=0.0):
+        error = False
+        if fname is None or len(fname) == 0:
+            logging.warning("AC0050 fname is null or empty")
+            error = True
+        if lname is None or len(lname) == 0:
+            logging.warning("AC0053 lname is null or empty")
+            error = True
+
+        # test float
+        if self.isfloat(starting_balance) == False:
+            logging.warning("AC0127 starting balance is not a float: %s", starting_balance)
+            error = True
+        elif float(starting_balance) < 0.0:
+            logging.warning("AC0055 starting balance is negative: %s", starting_balance)
+            error = True
+        return error is False
+
+    # private
+    # makes the shard directories. another process may be making the
+    # same ones.
+    def __make_shard_dir(self, shard_dir):
+        try:
+            os.makedirs(shard_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
     def get_account_file(self):
         return self.account_file
 
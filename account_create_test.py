@@ -2,8 +2,13 @@
 import unittest
 import os
 import time
+import shutil
+import tempfile
 
-from account_create import AccountCreate
+from account_create import AccountCreate, _close_id_blocks
+from account_summary import get_summary
+from drove_bank_constants import write_config, clear_config_cache
+from recover import Recover
 
 class AccountCreate_Test(unittest.TestCase):
 
@@ -11,7 +16,8 @@ class AccountCreate_Test(unittest.TestCase):
     def setUp(self):
         # make a test index file.
         fname = 'index.idx'
-        self.dir  = os.getcwd()
+        # a dbdir of its own, the accounts leave a summary and history in it
+        self.dir  = tempfile.mkdtemp()
         self.filename = os.path.join(self.dir, fname)
 
         # write out some stuff
@@ -23,7 +29,7 @@ class AccountCreate_Test(unittest.TestCase):
 
 
     def tearDown(self):
-        os.remove(self.filename)
+        shutil.rmtree(self.dir)
 
     def test_get_account_number(self):
         ac = AccountCreate(self.dir)
@@ -51,5 +57,129 @@ class AccountCreate_Test(unittest.TestCase):
         # should be -1 because of bad input
         self.assertEqual(id, -1)
 
+class AccountCreateBlock_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'create_block_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+        self.index = os.path.join(self.dir, 'index.idx')
+        f = open(self.index, 'w')
+        f.write('69\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __last_id(self):
+        return int(open(self.index).read().strip())
+
+    def __reservations(self):
+        return [name for name in os.listdir(self.dir) if name.endswith('.rsv')]
+
+    def test_create_accounts(self):
+        ac = AccountCreate(self.dir)
+        records = [('John', 'Doe', 100.0), ('Bob', 'Smith', 50.0),
+                   ('Bad', 'Balance', -1.0), ('Sue', 'Jones', 25.5)]
+        ids = ac.create_accounts(records)
+        self.assertEqual(ids, [70, 71, -1, 72])
+        self.assertEqual(self.__last_id(), 72)
+        self.assertEqual(self.__reservations(), [])
+        self.assertEqual(open(os.path.join(self.dir, '72.txt')).read(), 'Sue,Jones,25.5\n')
+        totals = get_summary(self.dir).totals()
+        self.assertEqual(totals.count, 3)
+        self.assertEqual(totals.balance, 175.5)
+
+    def test_process_block(self):
+        write_config(self.dir, {'id_block_size': 10})
+        ac = AccountCreate(self.dir)
+        self.assertEqual(ac.create_account('John', 'Doe', 1.0), 70)
+        self.assertEqual(ac.create_account('Bob', 'Smith', 2.0), 71)
+        # one index update for the block
+        self.assertEqual(self.__last_id(), 79)
+        self.assertEqual(self.__reservations(), ['index_70_79.rsv'])
+
+        # what is left of the block goes back at exit
+        _close_id_blocks()
+        self.assertEqual(self.__last_id(), 71)
+        self.assertEqual(self.__reservations(), [])
+        self.assertEqual(ac.create_account('Sue', 'Jones', 3.0), 72)
+        _close_id_blocks()
+
+    def __dead_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def __reserved_by(self, rsvname, pid):
+        f = open(os.path.join(self.dir, rsvname), 'w')
+        f.write("%d\n" % pid)
+        f.close()
+
+    def test_recover_reservation(self):
+        ac = AccountCreate(self.dir)
+        # died after writing two accounts and half of a third
+        self.assertEqual(ac.reserve_ids(5), (70, 74))
+        self.__reserved_by('index_70_74.rsv', self.__dead_pid())
+        for ac_id in (70, 71):
+            f = open(os.path.join(self.dir, '%d.txt' % ac_id), 'w')
+            f.write('John,Doe,1.0\n')
+            f.close()
+        f = open(os.path.join(self.dir, '72.txt.atmp'), 'w')
+        f.write('John,Do')
+        f.close()
+
+        Recover(self.dir).recover()
+        self.assertEqual(self.__last_id(), 71)
+        self.assertEqual(self.__reservations(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, '72.txt.atmp')))
+
+        # a block with a later one above it can't give its ids back
+        self.assertEqual(ac.reserve_ids(3), (72, 74))
+        self.__reserved_by('index_72_74.rsv', self.__dead_pid())
+        self.assertEqual(ac.create_accounts([('Bob', 'Smith', 2.0)]), [75])
+        Recover(self.dir).recover()
+        self.assertEqual(self.__last_id(), 75)
+        self.assertEqual(self.__reservations(), [])
+
+    def test_live_reservation(self):
+        # another process holds a block and is still handing its ids out
+        ready_r, ready_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            os.close(done_w)
+            AccountCreate(self.dir).reserve_ids(5)
+            os.write(ready_w, 'r')
+            os.read(done_r, 1)
+            os._exit(0)
+        os.close(ready_w)
+        os.close(done_r)
+        try:
+            self.assertEqual(os.read(ready_r, 1), 'r')
+            ac = AccountCreate(self.dir)
+            self.assertFalse(ac.recover_reservation(os.path.join(self.dir, 'index_70_74.rsv')))
+            Recover(self.dir).recover()
+            # its ids aren't handed out again
+            self.assertEqual(self.__last_id(), 74)
+            self.assertEqual(self.__reservations(), ['index_70_74.rsv'])
+            self.assertEqual(ac.create_account('John', 'Doe', 1.0), 75)
+        finally:
+            os.write(done_w, 'd')
+            os.waitpid(pid, 0)
+            os.close(ready_r)
+            os.close(done_w)
+
+        # once it is gone its unused ids are skipped
+        Recover(self.dir).recover()
+        self.assertEqual(self.__last_id(), 75)
+        self.assertEqual(self.__reservations(), [])
+
 if __name__ == '__main__':
     unittest.main()
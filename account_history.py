@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of DroveBankConstants
+#
+# the transaction history of the accounts. every create, deposit,
+# withdraw and both sides of a transfer add a fixed size record
+#
+#   seq, time, account, kind, flags, crc, other account, amount, balance
+#
+# to the history of the shard the account is in, history_shard_size
+# accounts to a shard:
+#
+#   <dbdir>/history/<shard>/<first seq>.seg   the records, in seq order
+#   <dbdir>/history/<shard>/<first seq>.idx   seq and time of every
+#                                             INDEX_EVERYth record
+#
+# seq goes up by one for every record of a shard and time never goes
+# back, so a lookup of an account between two times (or seqs) is a
+# bisect of the sparse index and a read of the records from there. only
+# the last segment is appended to, it is sealed once it has
+# history_segment_records records and a new one is started.
+#
+# the records go in as part of the commit:
+#   1. with the account locks held the records are appended PENDING
+#   2. the data files are committed
+#   3. the PENDING flag is cleared in place
+# a reader skips PENDING records. after a crash recover.py looks at the
+# PENDING records of the accounts that were being changed: if the
+# balance of the last one is the balance the account has now the commit
+# went through and they are kept, if not they are marked VOID.
+#
+# compact() rewrites runs of sealed segments into one without the VOID
+# records. start_compactor() does that every history_compact_interval
+# seconds from a background thread.
+#
+import os
+import time
+import zlib
+import errno
+import fcntl
+import struct
+import logging
+import argparse
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+
+from drove_bank_constants import DroveBankConstants
+
+HISTORY_DIRNAME = 'history'
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+# appends, the seal of a segment and the swap of a compaction
+SHARD_LOCK_FILENAME = 'shard.lock'
+# one compaction of a shard at a time
+COMPACT_LOCK_FILENAME = 'compact.lock'
+
+KIND_CREATE = 1
+KIND_DEPOSIT = 2
+KIND_WITHDRAW = 3
+KIND_TRANSFER_OUT = 4
+KIND_TRANSFER_IN = 5
+KIND_NAMES = {KIND_CREATE: 'create', KIND_DEPOSIT: 'deposit', KIND_WITHDRAW: 'withdraw',
+              KIND_TRANSFER_OUT: 'transfer out', KIND_TRANSFER_IN: 'transfer in'}
+
+# record flags. they are not in the crc so they can be changed in place
+FLAG_PENDING = 1
+FLAG_VOID = 2
+
+# seq, time, account, kind, flags, crc, other, amount, balance
+RECORD = struct.Struct('<QdQBB2xIQdd')
+RECORD_SIZE = RECORD.size
+FLAGS_OFFSET = 25
+# seq, time of record n * INDEX_EVERY
+INDEX = struct.Struct('<Qd')
+INDEX_EVERY = 64
+
+# records read per system call
+READ_CHUNK = 1024
+# a compacted segment holds up to this many segments worth of records
+COMPACT_SEGMENTS = 16
+
+HistoryRecord = namedtuple('HistoryRecord', 'seq time account kind other amount balance')
+
+# dbdir -> AccountHistory
+_histories = {}
+_histories_lock = threading.Lock()
+
+def get_history(dbdir):
+    key = os.path.abspath(dbdir)
+    with _histories_lock:
+        history = _histories.get(key)
+        if history is None:
+            history = AccountHistory(key)
+            _histories[key] = history
+        return history
+
+class AccountHistory(DroveBankConstants):
+
+    def __init__(self, dir=None):
+        DroveBankConstants.__init__(self, dir)
+        self.history_dir = os.path.join(self.dbdir, HISTORY_DIRNAME)
+        self.compactor = None
+
+    # public
+    # appends PENDING records for entries, a list of (account, kind, other
+    # account, amount, balance after). returns what finish() needs.
+    def append(self, entries):
+        shards = {}
+        for entry in entries:
+            shards.setdefault(self.shard_of(entry[0]), []).append(entry)
+        pending = []
+        for shard in sorted(shards):
+            pending.append(self.__append_shard(shard, shards[shard]))
+        return pending
+
+    # public
+    # clears the PENDING flag of the records of an append, the commit is
+    # done
+    def finish(self, pending):
+        self.__set_flags(pending, 0)
+
+    # public
+    # marks the records of an append VOID, the commit never happened
+    def void(self, pending):
+        self.__set_flags(pending, FLAG_VOID)
+
+    # public
+    # the records of an account from start to end (both included, None is
+    # open), by time or by seq, oldest first
+    def query(self, account, start=None, end=None, by='time'):
+        key = 0 if by == 'seq' else 1
+        shard_dir = self.__shard_dir(self.shard_of(account))
+        tries = 0
+        while True:
+            try:
+                return self.__query(shard_dir, account, start, end, key)
+            except (IOError, OSError) as e:
+                # a compaction took a segment away, look again
+                tries += 1
+                if e.errno != errno.ENOENT or tries >= 10:
+                    raise
+
+    # public
+    # decides the PENDING records of accounts after a crash. balance_of
+    # gives the balance an account has now, None if it doesn't exist.
+    # accounts None looks at every account of every shard. returns the
+    # number of records voided.
+    def recover(self, accounts, balance_of):
+        shards = {}
+        if accounts is None:
+            if os.path.isdir(self.history_dir):
+                for name in os.listdir(self.history_dir):
+                    if name.isdigit():
+                        shards[int(name)] = None
+        else:
+            for account in accounts:
+                shards.setdefault(self.shard_of(account), set()).add(account)
+        voided = 0
+        for shard in sorted(shards):
+            shard_dir = self.__shard_dir(shard)
+            if os.path.isdir(shard_dir) is False:
+                continue
+            lockfd = self.__lock_shard(shard_dir)
+            try:
+                voided += self.__recover_shard(shard_dir, shards[shard], balance_of)
+            finally:
+                self.__unlock(lockfd)
+        return voided
+
+    # public
+    # merges runs of sealed segments (and drops VOID records). returns the
+    # number of segments removed.
+    def compact(self, shards=None):
+        if os.path.isdir(self.history_dir) is False:
+            return 0
+        if shards is None:
+            shards = sorted(int(name) for name in os.listdir(self.history_dir) if name.isdigit())
+        removed = 0
+        for shard in shards:
+            removed += self.__compact_shard(self.__shard_dir(shard))
+        return removed
+
+    # public
+    # runs compact() every interval seconds in a daemon thread
+    def start_compactor(self, interval=None):
+        if interval is None:
+            interval = self.get_config_float('history_compact_interval')
+        if interval is None or interval <= 0 or self.compactor is not None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    logging.error("AH0167 history compaction failed: %s", e)
+        self.compactor = threading.Thread(target=run, name='history-compactor')
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def shard_of(self, account):
+        return int(account) // self.get_config_int('history_shard_size')
+
+    # private
+    # appends the entries of one shard. returns (segment, first record,
+    # count)
+    def __append_shard(self, shard, entries):
+        shard_dir = self.__shard_dir(shard)
+        self.__make_dir(shard_dir)
+        lockfd = self.__lock_shard(shard_dir)
+        try:
+            segments = self.__segments(shard_dir)
+            if len(segments) == 0:
+                segments = [self.__new_segment(shard_dir, 1)]
+            path = self.__segment_path(shard_dir, segments[-1])
+            fd = os.open(path, os.O_RDWR | os.O_APPEND)
+            try:
+                size = os.fstat(fd).st_size
+                count = size // RECORD_SIZE
+                if size % RECORD_SIZE != 0:
+                    # an append that died half way
+                    os.ftruncate(fd, count * RECORD_SIZE)
+                last_seq, last_time = segments[-1] - 1, 0.0
+                if count > 0:
+                    last = self.__read_records(fd, count - 1, 1)[0]
+                    last_seq, last_time = last[0], last[1]
+                now = max(time.time(), last_time)
+
+                data = []
+                index = []
+                for n, (account, kind, other, amount, balance) in enumerate(entries):
+                    seq = last_seq + 1 + n
+                    data.append(self.__pack(seq, now, account, kind, FLAG_PENDING,
+                                            other, amount, balance))
+                    if (count + n) % INDEX_EVERY == 0:
+                        index.append(INDEX.pack(seq, now))
+                os.write(fd, b''.join(data))
+                if len(index) > 0:
+                    self.__append_index(path, fd, count, b''.join(index))
+                if self.get_storage() != 'files':
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            if count + len(entries) >= self.get_config_int('history_segment_records'):
+                self.__new_segment(shard_dir, last_seq + len(entries) + 1)
+        finally:
+            self.__unlock(lockfd)
+        return (path, count, len(entries))
+
+    # private
+    # appends to the index of a segment that had count records. an index
+    # that is behind (a crash between the two appends) is made again.
+    def __append_index(self, path, fd, count, data):
+        index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        expected = (count + INDEX_EVERY - 1) // INDEX_EVERY
+        try:
+            have = os.path.getsize(index_path) // INDEX.size
+        except OSError:
+            have = 0
+        if have != expected:
+            logging.warning("AH0233 index %s is out of step, making it again", index_path)
+            self.__write_file(index_path, self.__make_index(fd, count))
+        f = open(index_path, 'ab')
+        f.write(data)
+        f.close()
+
+    # private
+    # the index of the first count records of a segment
+    def __make_index(self, fd, count):
+        data = []
+        for pos in range(0, count, INDEX_EVERY):
+            rec = self.__read_records(fd, pos, 1)[0]
+            data.append(INDEX.pack(rec[0], rec[1]))
+        return b''.join(data)
+
+    # private
+    # the index of a segment as a list of (seq, time). checked against the
+    # segment, made from it if it doesn't match
+    def __load_index(self, path, fd, count):
+        index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        try:
+            f = open(index_path, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            data = b''
+        expected = (count + INDEX_EVERY - 1) // INDEX_EVERY
+        entries = [INDEX.unpack_from(data, i * INDEX.size)
+                   for i in range(min(len(data) // INDEX.size, expected))]
+        if len(entries) != expected or (expected > 0 and
+                                        self.__read_records(fd, (expected - 1) * INDEX_EVERY, 1)[0][0]
+                                        != entries[-1][0]):
+            data = self.__make_index(fd, count)
+            entries = [INDEX.unpack_from(data, i * INDEX.size) for i in range(expected)]
+        return entries
+
+    def __query(self, shard_dir, account, start, end, key):
+        segments = self.__segments(shard_dir)
+        result = {}
+        for i, first in enumerate(segments):
+            path = self.__segment_path(shard_dir, first)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                count = os.fstat(fd).st_size // RECORD_SIZE
+                if count == 0:
+                    continue
+                index = self.__load_index(path, fd, count)
+                if end is not None and index[0][key] > end:
+                    break
+                if start is not None and self.__read_records(fd, count - 1, 1)[0][key] < start:
+                    continue
+                pos = 0
+                if start is not None:
+                    # the last indexed record before start
+                    keys = [entry[key] for entry in index]
+                    pos = max(bisect_right(keys, start) - 1, 0) * INDEX_EVERY
+                done = False
+                while pos < count and done is False:
+                    for rec in self.__read_records(fd, pos, min(READ_CHUNK, count - pos)):
+                        if start is not None and rec[key] < start:
+                            continue
+                        if end is not None and rec[key] > end:
+                            done = True
+                            break
+                        if rec[2] == account and rec[4] == 0 and self.__check(rec):
+                            result[rec[0]] = rec
+                    pos += READ_CHUNK
+                if done:
+                    break
+            finally:
+                os.close(fd)
+        # a compaction can make a reader see a record twice, the seq is
+        # the same
+        return [HistoryRecord(r[0], r[1], r[2], r[3], r[6], r[7], r[8])
+                for seq, r in sorted(result.items())]
+
+    # private
+    # PENDING records are only in the last segments, the ones a crash can
+    # have been appending to
+    def __recover_shard(self, shard_dir, accounts, balance_of):
+        pending = {}
+        for first in self.__segments(shard_dir)[-2:]:
+            path = self.__segment_path(shard_dir, first)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                count = os.fstat(fd).st_size // RECORD_SIZE
+                for pos in range(0, count, READ_CHUNK):
+                    for n, rec in enumerate(self.__read_records(fd, pos, min(READ_CHUNK, count - pos))):
+                        if rec[4] & FLAG_PENDING and (accounts is None or rec[2] in accounts):
+                            pending.setdefault(rec[2], []).append((path, pos + n, rec))
+            finally:
+                os.close(fd)
+
+        voided = 0
+        for account in sorted(pending):
+            records = pending[account]
+            balance = balance_of(account)
+            # the commit went through if the account ended up where the
+            # last record says
+            flag = 0
+            if balance is None or records[-1][2][8] != balance:
+                flag = FLAG_VOID
+                voided += len(records)
+            logging.info("AH0339 %s %d pending history records of account %s",
+                         "voiding" if flag else "keeping", len(records), account)
+            for path, pos, rec in records:
+                fd = os.open(path, os.O_RDWR)
+                try:
+                    os.lseek(fd, pos * RECORD_SIZE + FLAGS_OFFSET, os.SEEK_SET)
+                    os.write(fd, chr(flag))
+                finally:
+                    os.close(fd)
+        return voided
+
+    # private
+    # merges runs of sealed segments, up to COMPACT_SEGMENTS segments
+    # worth of live records into one. a segment with PENDING records is
+    # left alone.
+    def __compact_shard(self, shard_dir):
+        compactfd = self.__lock_shard(shard_dir, COMPACT_LOCK_FILENAME, fcntl.LOCK_NB)
+        if compactfd is None:
+            return 0
+        try:
+            limit = self.get_config_int('history_segment_records') * COMPACT_SEGMENTS
+            sealed = self.__segments(shard_dir)[:-1]
+            runs = []
+            run = []
+            run_records = 0
+            for first in sealed:
+                records, count, busy = self.__live_records(shard_dir, first)
+                if busy or (len(run) > 0 and run_records + len(records) > limit):
+                    if len(run) > 0:
+                        runs.append(run)
+                    run, run_records = [], 0
+                    if busy:
+                        continue
+                run.append((first, records, count))
+                run_records += len(records)
+            if len(run) > 0:
+                runs.append(run)
+
+            removed = 0
+            for run in runs:
+                dropped = sum(count - len(records) for first, records, count in run)
+                if len(run) == 1 and dropped == 0:
+                    continue
+                removed += self.__rewrite_run(shard_dir, run)
+            return removed
+        finally:
+            self.__unlock(compactfd)
+
+    # private
+    # the records of a sealed segment without the VOID ones, its record
+    # count and True if it has PENDING records
+    def __live_records(self, shard_dir, first):
+        fd = os.open(self.__segment_path(shard_dir, first), os.O_RDONLY)
+        try:
+            count = os.fstat(fd).st_size // RECORD_SIZE
+            records = []
+            for pos in range(0, count, READ_CHUNK):
+                for rec in self.__read_records(fd, pos, min(READ_CHUNK, count - pos)):
+                    if rec[4] & FLAG_PENDING:
+                        return records, count, True
+                    if rec[4] & FLAG_VOID == 0:
+                        records.append(rec)
+            return records, count, False
+        finally:
+            os.close(fd)
+
+    # private
+    # writes the live records of a run into the first segment of the run
+    # and removes the others
+    def __rewrite_run(self, shard_dir, run):
+        first = run[0][0]
+        data = []
+        index = []
+        n = 0
+        for seg_first, records, count in run:
+            for rec in records:
+                data.append(self.__pack(*(rec[:5] + rec[6:])))
+                if n % INDEX_EVERY == 0:
+                    index.append(INDEX.pack(rec[0], rec[1]))
+                n += 1
+        path = self.__segment_path(shard_dir, first)
+        index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.__write_file(path + '.ctmp', b''.join(data), False)
+        self.__write_file(index_path + '.ctmp', b''.join(index), False)
+
+        lockfd = self.__lock_shard(shard_dir)
+        try:
+            os.rename(index_path + '.ctmp', index_path)
+            os.rename(path + '.ctmp', path)
+            for seg_first, records, count in run[1:]:
+                other = self.__segment_path(shard_dir, seg_first)
+                os.remove(other[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+                os.remove(other)
+        finally:
+            self.__unlock(lockfd)
+        logging.info("AH0418 compacted %d segments of %s into %s, %d records",
+                     len(run), shard_dir, path, n)
+        return len(run) - 1
+
+    # private
+    # sets the flags of the records of an append in place
+    def __set_flags(self, pending, flag):
+        for path, first, count in pending:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                for pos in range(first, first + count):
+                    os.lseek(fd, pos * RECORD_SIZE + FLAGS_OFFSET, os.SEEK_SET)
+                    os.write(fd, chr(flag))
+            finally:
+                os.close(fd)
+
+    def __pack(self, seq, when, account, kind, flags, other, amount, balance):
+        crc = zlib.crc32(RECORD.pack(seq, when, account, kind, 0, 0, other, amount, balance)) & 0xffffffff
+        return RECORD.pack(seq, when, account, kind, flags, crc, other, amount, balance)
+
+    # private
+    # True if the record is whole. a record torn by a crash is skipped
+    def __check(self, rec):
+        data = RECORD.pack(rec[0], rec[1], rec[2], rec[3], 0, 0, rec[6], rec[7], rec[8])
+        return zlib.crc32(data) & 0xffffffff == rec[5]
+
+    def __read_records(self, fd, pos, count):
+        os.lseek(fd, pos * RECORD_SIZE, os.SEEK_SET)
+        data = os.read(fd, count * RECORD_SIZE)
+        return [RECORD.unpack_from(data, i * RECORD_SIZE) for i in range(len(data) // RECORD_SIZE)]
+
+    # private
+    # the first seqs of the segments of a shard, in order
+    def __segments(self, shard_dir):
+        try:
+            names = os.listdir(shard_dir)
+        except OSError:
+            return []
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in names
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def __new_segment(self, shard_dir, first):
+        os.close(os.open(self.__segment_path(shard_dir, first), os.O_RDWR | os.O_CREAT, 0o644))
+        return first
+
+    def __segment_path(self, shard_dir, first):
+        return os.path.join(shard_dir, "%012d%s" % (first, SEGMENT_SUFFIX))
+
+    def __shard_dir(self, shard):
+        return os.path.join(self.history_dir, "%06d" % shard)
+
+    def __write_file(self, filename, data, rename=True):
+        tmpname = filename + '.tmp' if rename else filename
+        f = open(tmpname, 'wb')
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if rename:
+            os.rename(tmpname, filename)
+
+    # private
+    # flock on a lock file of the shard. None if flags has LOCK_NB and it
+    # is busy
+    def __lock_shard(self, shard_dir, name=SHARD_LOCK_FILENAME, flags=0):
+        fd = os.open(os.path.join(shard_dir, name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | flags)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return fd
+
+    def __unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __make_dir(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+# YYYY-MM-DD or YYYY-MM-DD HH:MM[:SS] in local time
+def parse_time(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("not a time: %s" % value)
+
+def format_record(record):
+    other = ''
+    if record.kind in (KIND_TRANSFER_OUT, KIND_TRANSFER_IN):
+        other = record.other
+    return "%d\t%s\t%-12s\t%s\t%10.2f\t%10.2f" % (
+        record.seq, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.time)),
+        KIND_NAMES.get(record.kind, record.kind), other, record.amount, record.balance)
+
+def main():
+  parser = argparse.ArgumentParser(description='transaction history of an account')
+  parser.add_argument('-d', '--dir', help='data directory', default=None)
+  parser.add_argument('-a', '--account', help='account id', type=int, default=None)
+  parser.add_argument('-s', '--since', help='from this time, YYYY-MM-DD [HH:MM[:SS]]', default=None)
+  parser.add_argument('-u', '--until', help='up to this time, YYYY-MM-DD [HH:MM[:SS]]', default=None)
+  parser.add_argument('-c', '--compact', help='compact the history segments', action='store_true')
+  args = parser.parse_args()
+
+  history = get_history(args.dir or DroveBankConstants().get_dbdir())
+  if args.compact:
+    print "%d segments merged away" % history.compact()
+  if args.account is not None:
+    start = parse_time(args.since) if args.since else None
+    end = parse_time(args.until) if args.until else None
+    print "Seq\tTime\t\t\tWhat\t\tOther\t    Amount\t   Balance"
+    for record in history.query(args.account, start, end):
+      print format_record(record)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for AccountHistory
+#
+import unittest
+import os
+import shutil
+
+import account_history
+from account_history import get_history, KIND_CREATE, KIND_DEPOSIT, KIND_WITHDRAW, \
+    KIND_TRANSFER_OUT, KIND_TRANSFER_IN, RECORD_SIZE
+from account_actions import AccountActions
+from account_create import AccountCreate
+from batch_transfer import BatchTransfer
+from recover import Recover
+from drove_bank_constants import write_config, clear_config_cache
+
+class AccountHistory_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'history_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+        account_history._histories.clear()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __segments(self, shard=0):
+        shard_dir = os.path.join(self.dir, 'history', "%06d" % shard)
+        return sorted(name for name in os.listdir(shard_dir) if name.endswith('.seg'))
+
+    def test_commits_are_recorded(self):
+        ac = AccountCreate(self.dir)
+        a = ac.create_account('First', 'Last', 100.0)
+        b = ac.create_account('Second', 'Last', 10.0)
+        aa = AccountActions(self.dir)
+        aa.deposit(a, 50.0)
+        aa.withdraw(a, 20.0)
+        self.assertTrue(aa.transfer_money(a, b, 30.0))
+        # a failed withdraw leaves no record
+        self.assertEqual(aa.withdraw(b, 1000.0), -1)
+
+        history = get_history(self.dir)
+        records = [(r.kind, r.other, r.amount, r.balance) for r in history.query(a)]
+        self.assertEqual(records, [(KIND_CREATE, 0, 100.0, 100.0),
+                                   (KIND_DEPOSIT, 0, 50.0, 150.0),
+                                   (KIND_WITHDRAW, 0, 20.0, 130.0),
+                                   (KIND_TRANSFER_OUT, b, 30.0, 100.0)])
+        records = [(r.kind, r.other, r.amount, r.balance) for r in history.query(b)]
+        self.assertEqual(records, [(KIND_CREATE, 0, 10.0, 10.0),
+                                   (KIND_TRANSFER_IN, a, 30.0, 40.0)])
+
+    def test_bulk_create_and_batch(self):
+        ids = AccountCreate(self.dir).create_accounts([('First', 'Last', 100.0)] * 3)
+        bt = BatchTransfer(self.dir, 'test', chunk_size=10)
+        bt.run(["%d,%d,10.0" % (ids[0], ids[1]), "%d,%d,500.0" % (ids[1], ids[2]),
+                "%d,%d,5.0" % (ids[0], ids[2])])
+        records = get_history(self.dir).query(ids[0])
+        self.assertEqual([(r.kind, r.balance) for r in records],
+                         [(KIND_CREATE, 100.0), (KIND_TRANSFER_OUT, 90.0), (KIND_TRANSFER_OUT, 85.0)])
+        self.assertEqual([r.balance for r in get_history(self.dir).query(ids[2])], [100.0, 105.0])
+
+    def test_range_query(self):
+        write_config(self.dir, {'history_segment_records': '300'})
+        history = get_history(self.dir)
+        # two accounts of the same shard, interleaved over several segments
+        for n in range(1000):
+            history.finish(history.append([(n % 2, KIND_DEPOSIT, 0, 1.0, float(n))]))
+        self.assertEqual(self.__segments(), ['000000000001.seg', '000000000301.seg',
+                                             '000000000601.seg', '000000000901.seg'])
+
+        records = history.query(0)
+        self.assertEqual(len(records), 500)
+        self.assertEqual([r.seq for r in records], range(1, 1000, 2))
+
+        records = history.query(1, 250, 700, by='seq')
+        self.assertEqual([r.seq for r in records], range(250, 701, 2))
+        self.assertEqual(records[0].balance, 249.0)
+
+        # time never goes back and is the same for records of one append
+        times = [r.time for r in history.query(1)]
+        self.assertEqual(times, sorted(times))
+        middle = times[200]
+        records = history.query(1, start=middle)
+        self.assertTrue(all(r.time >= middle for r in records))
+        self.assertEqual(len(records), len([t for t in times if t >= middle]))
+        self.assertEqual(history.query(1, end=times[0] - 1.0), [])
+
+    def test_pending_records(self):
+        history = get_history(self.dir)
+        history.finish(history.append([(1, KIND_CREATE, 0, 10.0, 10.0),
+                                       (2, KIND_CREATE, 0, 10.0, 10.0)]))
+        history.append([(1, KIND_DEPOSIT, 0, 5.0, 15.0),
+                        (2, KIND_DEPOSIT, 0, 5.0, 15.0)])
+        # not committed yet so nobody sees them
+        self.assertEqual(len(history.query(1)), 1)
+
+        # account 1 made it, account 2 didn't
+        balances = {1: 15.0, 2: 10.0}
+        self.assertEqual(history.recover([1, 2], balances.get), 1)
+        self.assertEqual([r.balance for r in history.query(1)], [10.0, 15.0])
+        self.assertEqual([r.balance for r in history.query(2)], [10.0])
+
+    def test_recover_crashed_deposit(self):
+        ac = AccountCreate(self.dir)
+        a = ac.create_account('First', 'Last', 100.0)
+        aa = AccountActions(self.dir)
+        aa.deposit(a, 10.0)
+
+        # a deposit that died after its history record went in, before
+        # the commit
+        aa.set_account_id(a)
+        aa.lock_file()
+        aa.record_history([(a, KIND_DEPOSIT, 0, 25.0, 135.0)])
+
+        stats = Recover(self.dir).recover()
+        self.assertEqual(stats['history_voided'], 1)
+        self.assertEqual([r.balance for r in get_history(self.dir).query(a)], [100.0, 110.0])
+
+    def test_torn_append(self):
+        history = get_history(self.dir)
+        history.finish(history.append([(7, KIND_CREATE, 0, 1.0, 1.0)]))
+        segment = os.path.join(self.dir, 'history', '000000', self.__segments()[0])
+        f = open(segment, 'ab')
+        f.write('x' * (RECORD_SIZE // 2))
+        f.close()
+        history.finish(history.append([(7, KIND_DEPOSIT, 0, 1.0, 2.0)]))
+        self.assertEqual(os.path.getsize(segment), 2 * RECORD_SIZE)
+        self.assertEqual([r.seq for r in history.query(7)], [1, 2])
+
+    def test_compact(self):
+        write_config(self.dir, {'history_segment_records': '100'})
+        history = get_history(self.dir)
+        for n in range(350):
+            pending = history.append([(n % 5, KIND_DEPOSIT, 0, 1.0, float(n))])
+            if n < 200 or n % 5 != 4:
+                history.finish(pending)
+        # the last 30 commits of account 4 never went through
+        self.assertEqual(history.recover([4], {4: 199.0}.get), 30)
+        before = dict((ac_id, history.query(ac_id)) for ac_id in range(5))
+        self.assertEqual(len(before[4]), 40)
+        self.assertEqual(len(self.__segments()), 4)
+
+        # the three sealed segments go into the first one
+        self.assertEqual(history.compact(), 2)
+        self.assertEqual(self.__segments(), ['000000000001.seg', '000000000301.seg'])
+        for ac_id in range(5):
+            self.assertEqual(history.query(ac_id), before[ac_id])
+        records = history.query(0, 150, 260, by='seq')
+        self.assertEqual([r.seq for r in records], range(151, 261, 5))
+
+        # nothing left to do
+        self.assertEqual(history.compact(), 0)
+        history.finish(history.append([(0, KIND_DEPOSIT, 0, 1.0, 1.0)]))
+        self.assertEqual(history.query(0)[-1].seq, 351)
+
+    def test_history_off(self):
+        write_config(self.dir, {'history': 'off'})
+        a = AccountCreate(self.dir).create_account('First', 'Last', 1.0)
+        AccountActions(self.dir).deposit(a, 1.0)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'history')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of AccountActions
+#
+# a long lived handle on a dbdir for a process that does many account
+# operations (drovebank.py --batch, bench_session.py). AccountActions
+# makes new AtomicWrites for every operation, and set_file_name looks
+# the file and the dbdir up on disk before every write. a session
+#   - checks the dbdir once
+#   - makes the data and lock paths of an account from templates made
+#     once, without looking at the disk. the read under the lock finds
+#     out if the account is there
+#   - takes AtomicWrites from a pool and gives them back after the call
+#   - keeps the state of a call in its own AtomicWrites and the errors
+#     per thread, so any number of threads can share one session
+#
+# deposit, withdraw, transfer_money, get_account_info and create_account
+# return what the AccountActions and AccountCreate ones do.
+#
+import os
+import errno
+import random
+import string
+import logging
+import threading
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from atomic_write import AtomicWrite
+from account_history import KIND_DEPOSIT, KIND_WITHDRAW, KIND_TRANSFER_OUT, KIND_TRANSFER_IN
+from lock_set import LockSet
+from bank_metrics import timed
+
+# AtomicWrites kept for reuse
+POOL_SIZE = 64
+
+TRANSID_CHARS = string.ascii_uppercase + string.digits
+
+class AccountSession(AccountActions):
+
+    def __init__(self, dir=None):
+        AccountActions.__init__(self, dir)
+        if os.path.isdir(self.dbdir) is False:
+            logging.critical("AS0043 DB file directory %s doesn't exist!", self.dbdir)
+            raise IOError(errno.ENOENT, "no such data directory", self.dbdir)
+        # <dbdir>/ for the flat paths
+        self.flat_prefix = os.path.join(self.dbdir, '')
+        self.pool = []
+        self.pool_mutex = threading.Lock()
+        self.local = threading.local()
+
+    # the errors are kept per thread
+    def clear_errors(self):
+        self.local.errors = []
+
+    def add_error(self, errorstring):
+        self.__errors().append(errorstring)
+
+    def get_error_string(self):
+        errorstring = ""
+        for err in self.__errors():
+            errorstring = "%s\n%s" % (errorstring, err)
+        return errorstring
+
+    # public
+    # makes a deposit to account. returns balance or -1 on error
+    @timed('deposit', lambda balance: balance == -1)
+    def deposit(self, account_id, amount):
+        self.clear_errors()
+        if self.__check_amount(amount, 'deposit') is False or self.__check_id(account_id) is False:
+            return -1
+        if self.__known(int(account_id)) is False:
+            return -1
+        return self.__change(int(account_id), float(amount), KIND_DEPOSIT)
+
+    # public
+    # withdraws from account. returns balance or -1 on error
+    @timed('withdraw', lambda balance: balance == -1)
+    def withdraw(self, account_id, amount):
+        self.clear_errors()
+        if self.__check_amount(amount, 'withdraw') is False or self.__check_id(account_id) is False:
+            return -1
+        if self.__known(int(account_id)) is False:
+            return -1
+        return self.__change(int(account_id), float(amount), KIND_WITHDRAW)
+
+    # public
+    # transfers money from one account to another. returns True on
+    # success False on failure
+    @timed('transfer', lambda done: done is False)
+    def transfer_money(self, from_id, to_id, amount):
+        self.clear_errors()
+        if self.__check_amount(amount, 'transfer') is False or self.__check_id(from_id) is False \
+                or self.__check_id(to_id) is False:
+            return False
+        from_id, to_id, amount = int(from_id), int(to_id), float(amount)
+        if from_id == to_id:
+            self.add_error("can't transfer money from an account to itself: %s" % from_id)
+            return False
+        if self.__known(from_id) is False or self.__known(to_id) is False:
+            return False
+
+        transid = ''.join(random.choice(TRANSID_CHARS) for _ in range(8))
+        from_aw = self.__writer(from_id, transid, "xtmp", "xold")
+        to_aw = self.__writer(to_id, transid, "xtmp", "xold")
+        try:
+            locks = LockSet([from_aw, to_aw])
+            locks.acquire()
+            # no AtomicWrite goes back to the pool still locked
+            try:
+                from_info = self.__read_locked(from_aw, from_id)
+                to_info = self.__read_locked(to_aw, to_id)
+                if from_info is None or to_info is None:
+                    return False
+
+                from_balance = from_info.balance - amount
+                if from_balance < 0:
+                    logging.warning("AS0104 not enough money in source account %s", from_id)
+                    self.add_error("not enough money in source account")
+                    return False
+                to_balance = to_info.balance + amount
+
+                history = self.record_history([(from_id, KIND_TRANSFER_OUT, to_id, amount, from_balance),
+                                               (to_id, KIND_TRANSFER_IN, from_id, amount, to_balance)])
+                self.commit_transaction(
+                    [(from_aw, "%s,%s,%s\n" % (from_info.fname, from_info.lname, from_balance)),
+                     (to_aw, "%s,%s,%s\n" % (to_info.fname, to_info.lname, to_balance))])
+                self.finish_history(history)
+                self.update_summary([(from_id, from_info.fname, from_info.lname, from_balance),
+                                     (to_id, to_info.fname, to_info.lname, to_balance)])
+                return True
+            finally:
+                locks.release()
+        finally:
+            self.__release(from_aw)
+            self.__release(to_aw)
+
+    # public
+    # gets the account information, an Account or None on error
+    @timed('get', lambda info: info is None)
+    def get_account_info(self, account_id):
+        self.clear_errors()
+        if self.__check_id(account_id) is False:
+            return None
+        filename, lockfilename = self.__paths(int(account_id))
+        try:
+            return self.read_account_file(filename)
+        except (IOError, OSError):
+            self.add_error("account id is not valid: %s" % account_id)
+            return None
+
+    # public
+    # creates an account with the AccountCreate of the thread. returns the
+    # id or -1
+    def create_account(self, fname, lname, starting_balance=0.0):
+        self.clear_errors()
+        creator = getattr(self.local, 'creator', None)
+        if creator is None:
+            creator = AccountCreate(self.dbdir)
+            self.local.creator = creator
+        creator.clear_errors()
+        ac_id = creator.create_account(fname, lname, starting_balance)
+        if ac_id == -1:
+            self.add_error("There was a problem creating the account")
+        return ac_id
+
+    # private
+    # a deposit or withdraw on an account
+    def __change(self, ac_id, amount, kind):
+        if self.use_optimistic():
+            balance = self.optimistic_change(ac_id, self.__paths(ac_id)[0], amount, kind)
+            if balance is not None:
+                return balance
+        aw = self.__writer(ac_id)
+        try:
+            aw.lock_file()
+            # no AtomicWrite goes back to the pool still locked
+            try:
+                info = self.__read_locked(aw, ac_id)
+                if info is None:
+                    return -1
+                if kind == KIND_WITHDRAW:
+                    balance = info.balance - amount
+                    if balance < 0:
+                        self.add_error("You can't withdraw more than your balance")
+                        logging.warning("AS0168 account %s trying to withdraw %s more than the balance %s",
+                                        ac_id, amount, info.balance)
+                        return -1
+                else:
+                    balance = info.balance + amount
+
+                history = self.record_history([(ac_id, kind, 0, amount, balance)])
+                aw.write_content("%s,%s,%s\n" % (info.fname, info.lname, balance))
+                self.finish_history(history)
+                self.update_summary([(ac_id, info.fname, info.lname, balance)])
+                return balance
+            finally:
+                aw.unlock_file()
+        finally:
+            self.__release(aw)
+
+    # private
+    # reads a locked account. None (and the error) if it isn't there
+    def __read_locked(self, aw, ac_id):
+        try:
+            return self.read_account_file(aw.filename, False)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        logging.warning("AS0190 unknown account number %s", ac_id)
+        self.add_error("account id is not valid: %s" % ac_id)
+        return None
+
+    # private
+    # a flat account is looked for by the read under the lock. in a shard
+    # dir that may not be there the lock file can't even be made, so
+    # look first
+    def __known(self, ac_id):
+        if self.get_layout() == 'flat':
+            return True
+        if self.data_file_exists(self.__paths(ac_id)[0]):
+            return True
+        logging.warning("AS0196 unknown account number %s", ac_id)
+        self.add_error("account id is not valid: %s" % ac_id)
+        return False
+
+    # private
+    # the data and lock paths of an account. only a migrating layout has
+    # to look at the disk, the file can be in either place
+    def __paths(self, ac_id):
+        layout = self.get_layout()
+        if layout == 'flat':
+            base = self.flat_prefix + str(ac_id)
+            return base + '.txt', base + '.lock'
+        if layout == 'sharded':
+            filename = self.sharded_account_path(ac_id)
+            return filename, filename[:-4] + '.lock'
+        return self.get_account_filename(ac_id), None
+
+    # private
+    # an AtomicWrite from the pool set up for an account
+    def __writer(self, ac_id, transid=None, tmpsuffix="tmp", oldsuffix="old"):
+        aw = None
+        with self.pool_mutex:
+            if len(self.pool) > 0:
+                aw = self.pool.pop()
+        if aw is None:
+            aw = AtomicWrite(self.dbdir)
+        filename, lockfilename = self.__paths(ac_id)
+        aw.reset(filename, lockfilename, transid, tmpsuffix, oldsuffix)
+        return aw
+
+    def __release(self, aw):
+        with self.pool_mutex:
+            if len(self.pool) < POOL_SIZE:
+                self.pool.append(aw)
+
+    def __errors(self):
+        errors = getattr(self.local, 'errors', None)
+        if errors is None:
+            errors = []
+            self.local.errors = errors
+        return errors
+
+    def __check_id(self, account_id):
+        if self.isint(account_id) is False:
+            self.add_error("account id is not a valid number: %s" % account_id)
+            return False
+        return True
+
+    def __check_amount(self, amount, what):
+        if self.isfloat(amount) is False:
+            self.add_error("amount to %s is not a valid number: %s" % (what, amount))
+            return False
+        if float(amount) < 0.0:
+            self.add_error("amount to %s cannot be a negative number: %s" % (what, amount))
+            return False
+        return True
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for AccountSession
+#
+import unittest
+import os
+import shutil
+import threading
+
+from account_session import AccountSession, POOL_SIZE
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import write_config, clear_config_cache
+
+class AccountSession_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'session_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __make_accounts(self, count, balance=100.0):
+        ac = AccountCreate(self.dir)
+        return [ac.create_account('John', 'Doe%d' % i, balance) for i in range(count)]
+
+    def __leftovers(self):
+        return [name for name in os.listdir(self.dir)
+                if name.endswith('.lock') or 'tmp' in name or 'old' in name]
+
+    def test_no_dbdir(self):
+        self.assertRaises(IOError, AccountSession, os.path.join(self.dir, 'nothere'))
+
+    def test_actions(self):
+        one, two = self.__make_accounts(2)
+        session = AccountSession(self.dir)
+        self.assertEqual(session.deposit(one, 50.0), 150.0)
+        self.assertEqual(session.withdraw(one, 25.0), 125.0)
+        self.assertTrue(session.transfer_money(one, two, 100.0))
+        self.assertEqual(session.get_account_info(one).balance, 25.0)
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(one).balance, 25.0)
+        self.assertEqual(aa.get_account_info(two).balance, 200.0)
+        self.assertEqual(self.__leftovers(), [])
+        self.assertEqual(session.create_account('Ann', 'Lee', 5.0), 3)
+
+    def test_errors(self):
+        one, two = self.__make_accounts(2)
+        session = AccountSession(self.dir)
+        self.assertEqual(session.withdraw(one, 500.0), -1)
+        self.assertTrue('more than your balance' in session.get_error_string())
+        self.assertFalse(session.transfer_money(one, two, 500.0))
+        self.assertTrue('not enough money' in session.get_error_string())
+        self.assertEqual(session.deposit(one, -1.0), -1)
+        self.assertEqual(session.deposit('x', 1.0), -1)
+        self.assertFalse(session.transfer_money(one, one, 1.0))
+
+        # an unknown account fails without leaving a lock behind
+        self.assertEqual(session.deposit(99, 1.0), -1)
+        self.assertTrue('not valid: 99' in session.get_error_string())
+        self.assertFalse(session.transfer_money(one, 99, 1.0))
+        self.assertEqual(session.get_account_info(99), None)
+        self.assertEqual(self.__leftovers(), [])
+        self.assertEqual(session.get_account_info(one).balance, 100.0)
+
+    def test_failed_commit(self):
+        one, two = self.__make_accounts(2)
+        session = AccountSession(self.dir)
+        def fail(changes):
+            raise IOError("disk full")
+        session.record_history = fail
+        self.assertRaises(IOError, session.deposit, one, 1.0)
+        self.assertRaises(IOError, session.transfer_money, one, two, 1.0)
+        # the accounts aren't left locked, for the pool or anyone else
+        self.assertEqual(self.__leftovers(), [])
+        del session.record_history
+        self.assertEqual(session.deposit(one, 1.0), 101.0)
+        self.assertTrue(session.transfer_money(one, two, 1.0))
+
+    def test_sharded(self):
+        write_config(self.dir, {'layout': 'sharded'})
+        one, two = self.__make_accounts(2)
+        session = AccountSession(self.dir)
+        self.assertEqual(session.deposit(one, 10.0), 110.0)
+        self.assertTrue(session.transfer_money(one, two, 60.0))
+        self.assertEqual(session.deposit(5000, 1.0), -1)
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(one).balance, 50.0)
+        self.assertEqual(aa.get_account_info(two).balance, 160.0)
+
+    def test_threads(self):
+        ids = self.__make_accounts(4, 1000.0)
+        session = AccountSession(self.dir)
+        failures = []
+        def work(n):
+            for i in range(25):
+                if session.transfer_money(ids[(n + i) % 4], ids[(n + i + 1) % 4], 1.0) is False:
+                    failures.append(session.get_error_string())
+                if session.deposit(ids[n], 1.0) == -1:
+                    failures.append(session.get_error_string())
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        total = sum([session.get_account_info(ac_id).balance for ac_id in ids])
+        self.assertEqual(total, 4000.0 + 100.0)
+        self.assertTrue(len(session.pool) <= POOL_SIZE)
+        self.assertEqual(self.__leftovers(), [])
+
+if __name__ == '__main__':
+    unittest.main()
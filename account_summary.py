@@ -0,0 +1,504 @@
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# the account summary file, <dbdir>/summary.dat.
+#
+# one fixed size record per account (name, balance and a version that
+# goes up with every commit) and the running totals in the header. every
+# commit updates it so listing the accounts or totalling the bank is a
+# sequential read of this one file instead of opening every account file.
+#
+#   header (64 bytes): magic, number of accounts, lowest id, highest id,
+#                      total balance, commit sequence number
+#   record of account n at HEADER_SIZE + (n * RECORD_SIZE): flags,
+#                      version, balance, fname, lname, csn
+#
+# every update is one commit: it takes the next commit sequence number
+# (csn) and the records it writes carry it. before a record is
+# overwritten its old bytes go on the end of summary.undo with the new
+# csn. a snapshot() is the csn and the end of summary.undo at one moment,
+# read under the header lock so no commit is half in. its records() are
+# the ones in the file with a csn up to its own, and for the others the
+# bytes of the first undo entry after its start, the record as it was
+# when the snapshot was taken. a scan of a snapshot never blocks a commit
+# and always adds up, a transfer is in it on both sides or on neither.
+#
+# an open snapshot holds a shared flock on summary.snap. summary.undo is
+# cut back to nothing by a commit that finds it over UNDO_TRIM_SIZE and
+# can get that flock exclusive, when no snapshot is open.
+#
+# ids are handed out in order from index.idx so the records are dense.
+# the slots below the lowest id are never written and stay a hole.
+#
+# a record is only written by the process that holds the account lock,
+# after the account file is committed, and the values written are the
+# new ones not a delta, so an update is safe to repeat. the totals are
+# changed under an fcntl lock on the header. readers take a shared lock
+# on the bytes they read. a crash between the commit and the update
+# leaves the record behind the account file, recover.py rebuilds the
+# file from the account files. a rebuild gives the records it changes a
+# new csn too, but accounts it takes out are gone from open snapshots.
+#
+import os
+import fcntl
+import struct
+import logging
+import threading
+from collections import namedtuple
+
+SUMMARY_FILENAME = 'summary.dat'
+UNDO_FILENAME = 'summary.undo'
+SNAPSHOT_FILENAME = 'summary.snap'
+# DSUM1 records had no csn, such a file is built again
+SUMMARY_MAGIC = b'DSUM2\0\0\0'
+
+HEADER = struct.Struct('<8sQQQdQ')
+HEADER_SIZE = 64
+# the csn goes last, the balance is where it always was
+RECORD = struct.Struct('<B7xQd40s40sQ')
+RECORD_SIZE = RECORD.size
+CSN_OFFSET = RECORD_SIZE - 8
+NAME_SIZE = 40
+
+# an undo entry: account id, csn of the commit that replaced the record,
+# the old record bytes
+UNDO = struct.Struct('<QQ')
+UNDO_SIZE = UNDO.size + RECORD_SIZE
+# summary.undo is emptied once it gets this big and no snapshot is open,
+# looked at by every UNDO_TRIM_CHECKth commit of the dbdir, by csn, so
+# processes that only commit a few times each trim it too
+UNDO_TRIM_SIZE = 4 * 1024 * 1024
+UNDO_TRIM_CHECK = 256
+
+# record flags
+FLAG_USED = 1
+# a name was cut to NAME_SIZE, the account file has the whole one
+FLAG_LONG_NAME = 2
+
+# records read per system call when listing
+READ_CHUNK = 256
+
+SummaryRecord = namedtuple('SummaryRecord', 'id fname lname balance version long_name csn')
+SummaryTotals = namedtuple('SummaryTotals', 'count balance')
+
+# dbdir -> AccountSummary. one per process, fcntl locks belong to the
+# process and closing any fd of the file drops all of them.
+_summaries = {}
+_summaries_lock = threading.Lock()
+
+def get_summary(dbdir):
+    key = os.path.abspath(dbdir)
+    with _summaries_lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            summary = AccountSummary(dbdir)
+            _summaries[key] = summary
+        return summary
+
+class AccountSummary(object):
+
+    def __init__(self, dbdir):
+        self.dbdir = dbdir
+        self.filename = os.path.join(dbdir, SUMMARY_FILENAME)
+        self.undo_filename = os.path.join(dbdir, UNDO_FILENAME)
+        self.snapshot_filename = os.path.join(dbdir, SNAPSHOT_FILENAME)
+        # fcntl locks don't keep the threads of one process apart
+        self.mutex = threading.RLock()
+        self.fd = None
+        self.undo_fd = None
+        self.snapshot_fd = None
+        self.pid = None
+        self.ino = None
+
+    # public
+    # writes the new state of accounts, a list of (id, fname, lname,
+    # balance), and moves the totals. the caller holds the account locks.
+    # loader is a generator function of the AccountRecords in the account
+    # files, used when the summary has to be built first.
+    def update(self, records, loader=None):
+        with self.mutex:
+            fd = self.__open()
+            fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                header = self.__read_header(fd)
+                if header is None:
+                    header = self.__build(fd, loader)
+                count, min_id, max_id, total, csn = header
+                csn += 1
+                # the old records go in the undo log first, all in one
+                # write, so a reader that sees a new csn finds them
+                olds = {}
+                for ac_id, fname, lname, balance in records:
+                    if ac_id not in olds:
+                        olds[ac_id] = self.__read_raw(fd, ac_id)
+                self.__save_undo(csn, olds)
+                for ac_id, fname, lname, balance in records:
+                    old = unpack_record(ac_id, olds[ac_id])
+                    version = 1
+                    if old is not None:
+                        count -= 1
+                        total -= old.balance
+                        version = old.version + 1
+                    olds[ac_id] = self.__write_slot(fd, ac_id, fname, lname, balance, version, csn)
+                    if count == 0 or ac_id < min_id:
+                        min_id = ac_id
+                    count += 1
+                    total += balance
+                    max_id = max(max_id, ac_id)
+                self.__write_header(fd, count, min_id, max_id, total, csn)
+                if csn % UNDO_TRIM_CHECK == 0:
+                    self.__trim_undo()
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    # public
+    # builds the summary if it doesn't exist or a build never finished
+    def ensure(self, loader):
+        if self.is_ready() is False:
+            self.update([], loader)
+
+    # public
+    # throws away the records and totals and reads them back from the
+    # account files. versions of accounts already in the file are kept.
+    def rebuild(self, loader):
+        with self.mutex:
+            fd = self.__open()
+            fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                self.__build(fd, loader)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+    # public
+    # True if the file exists and its header is good
+    def is_ready(self):
+        if os.path.exists(self.filename) is False:
+            return False
+        return self.totals() is not None
+
+    # public
+    # the number of accounts and the money in the bank. None if the
+    # summary isn't built.
+    def totals(self):
+        with self.mutex:
+            fd = self.__open()
+            fcntl.lockf(fd, fcntl.LOCK_SH, HEADER_SIZE, 0)
+            try:
+                header = self.__read_header(fd)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        if header is None:
+            return None
+        return SummaryTotals(header[0], header[3])
+
+    # public
+    # a SummarySnapshot of every account as of the last commit, None if
+    # the summary isn't built. close it when done, until then the undo
+    # log keeps growing.
+    def snapshot(self):
+        lock_fd = os.open(self.snapshot_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self.mutex:
+                fd = self.__open()
+                fcntl.lockf(fd, fcntl.LOCK_SH, HEADER_SIZE, 0)
+                try:
+                    header = self.__read_header(fd)
+                    if header is None:
+                        os.close(lock_fd)
+                        return None
+                    # a commit trims the undo log with the header locked,
+                    # it can't be between our look at its end and this
+                    fcntl.flock(lock_fd, fcntl.LOCK_SH)
+                    undo_start = os.fstat(self.undo_fd).st_size
+                finally:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        except:
+            os.close(lock_fd)
+            raise
+        return SummarySnapshot(self, header[4], undo_start, lock_fd)
+
+    # public
+    # generator of SummaryRecords in id order from start_id. the file is
+    # read READ_CHUNK records at a time.
+    def records(self, start_id=0):
+        with self.mutex:
+            fd = self.__open()
+            fcntl.lockf(fd, fcntl.LOCK_SH, HEADER_SIZE, 0)
+            try:
+                header = self.__read_header(fd)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        if header is None or header[0] == 0:
+            return
+        ac_id = max(start_id, header[1])
+        while True:
+            # take a fresh look at the end, accounts may have been added
+            chunk = self.__read_chunk(ac_id, READ_CHUNK)
+            if len(chunk) == 0:
+                return
+            for record in chunk:
+                if record is not None:
+                    yield record
+            ac_id += len(chunk)
+
+    # private
+    # reads count slots from ac_id. a free slot is None. short at the end
+    # of the file.
+    def __read_chunk(self, ac_id, count):
+        with self.mutex:
+            fd = self.__open()
+            offset = HEADER_SIZE + ac_id * RECORD_SIZE
+            fcntl.lockf(fd, fcntl.LOCK_SH, count * RECORD_SIZE, offset)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, count * RECORD_SIZE)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, count * RECORD_SIZE, offset)
+        chunk = []
+        for i in range(len(data) // RECORD_SIZE):
+            chunk.append(unpack_record(ac_id + i, data[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]))
+        return chunk
+
+    # private
+    # writes every account from loader into the file, called with the
+    # header locked. the header is zeroed first so a build that dies half
+    # way is done again by the next process, all but the csn: the records
+    # a build changes get the one after the last commit's.
+    def __build(self, fd, loader):
+        logging.info("SUM0170 building account summary %s", self.filename)
+        csn = 0
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, HEADER.size)
+        if len(data) == HEADER.size:
+            magic = HEADER.unpack(data)[0]
+            if magic in (SUMMARY_MAGIC, b'\0' * len(magic)):
+                csn = HEADER.unpack(data)[5]
+            else:
+                # another layout, none of its records are any use
+                logging.info("SUM0283 summary %s has an old layout", self.filename)
+                os.ftruncate(fd, HEADER_SIZE)
+                os.ftruncate(self.undo_fd, 0)
+        csn += 1
+        self.__write_header(fd, 0, 0, 0, 0.0, csn, b'\0' * len(SUMMARY_MAGIC))
+        size = os.fstat(fd).st_size
+        count, min_id, max_id, total = 0, 0, 0, 0.0
+        next_id = 0
+        if loader is not None:
+            for record in loader():
+                # clear the slots of accounts that are gone
+                self.__clear_slots(fd, next_id, record.id, size)
+                raw = self.__read_raw(fd, record.id)
+                old = unpack_record(record.id, raw)
+                version = 1
+                if old is not None:
+                    version = old.version
+                    if old.balance != record.balance:
+                        version += 1
+                if old is not None and old.version == version:
+                    self.__write_slot(fd, record.id, record.fname, record.lname,
+                                      record.balance, version, old.csn)
+                else:
+                    self.__save_undo(csn, {record.id: raw})
+                    self.__write_slot(fd, record.id, record.fname, record.lname,
+                                      record.balance, version, csn)
+                if count == 0:
+                    min_id = record.id
+                count += 1
+                total += record.balance
+                max_id = record.id
+                next_id = record.id + 1
+        os.ftruncate(fd, HEADER_SIZE + next_id * RECORD_SIZE)
+        self.__write_header(fd, count, min_id, max_id, total, csn)
+        os.fsync(fd)
+        logging.info("SUM0194 account summary %s has %d accounts", self.filename, count)
+        return (count, min_id, max_id, total, csn)
+
+    def __clear_slots(self, fd, first_id, end_id, size):
+        # past the end of the file there is nothing to clear
+        end = min(HEADER_SIZE + end_id * RECORD_SIZE, size)
+        offset = HEADER_SIZE + first_id * RECORD_SIZE
+        if offset >= end:
+            return
+        os.lseek(fd, offset, os.SEEK_SET)
+        while offset < end:
+            n = min(end - offset, READ_CHUNK * RECORD_SIZE)
+            os.write(fd, b'\0' * n)
+            offset += n
+
+    def __read_header(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, HEADER.size)
+        if len(data) < HEADER.size:
+            return None
+        magic, count, min_id, max_id, total, csn = HEADER.unpack(data)
+        if magic != SUMMARY_MAGIC:
+            return None
+        return (count, min_id, max_id, total, csn)
+
+    def __write_header(self, fd, count, min_id, max_id, total, csn, magic=SUMMARY_MAGIC):
+        data = HEADER.pack(magic, count, min_id, max_id, total, csn)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, data + b'\0' * (HEADER_SIZE - len(data)))
+
+    # the bytes of a slot, zeros for one past the end of the file
+    def __read_raw(self, fd, ac_id):
+        os.lseek(fd, HEADER_SIZE + ac_id * RECORD_SIZE, os.SEEK_SET)
+        data = os.read(fd, RECORD_SIZE)
+        if len(data) < RECORD_SIZE:
+            return b'\0' * RECORD_SIZE
+        return data
+
+    # returns the bytes written
+    def __write_slot(self, fd, ac_id, fname, lname, balance, version, csn):
+        flags = FLAG_USED
+        if len(fname) > NAME_SIZE or len(lname) > NAME_SIZE:
+            flags |= FLAG_LONG_NAME
+        data = RECORD.pack(flags, version, balance, fname[:NAME_SIZE], lname[:NAME_SIZE], csn)
+        offset = HEADER_SIZE + ac_id * RECORD_SIZE
+        fcntl.lockf(fd, fcntl.LOCK_EX, RECORD_SIZE, offset)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, RECORD_SIZE, offset)
+        return data
+
+    # private
+    # appends the old bytes of the records in olds, id -> bytes, to the
+    # undo log as replaced by commit csn
+    def __save_undo(self, csn, olds):
+        if len(olds) == 0:
+            return
+        os.write(self.undo_fd, b''.join([UNDO.pack(ac_id, csn) + data for ac_id, data in olds.items()]))
+
+    # empties the undo log if it is big and no snapshot is open, called
+    # with the header locked so no snapshot can start meanwhile
+    def __trim_undo(self):
+        size = os.fstat(self.undo_fd).st_size
+        if size < UNDO_TRIM_SIZE:
+            return
+        if self.snapshot_fd is None:
+            self.snapshot_fd = os.open(self.snapshot_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.snapshot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # a snapshot is open
+            return
+        try:
+            os.ftruncate(self.undo_fd, 0)
+        finally:
+            fcntl.flock(self.snapshot_fd, fcntl.LOCK_UN)
+        logging.debug("SUM0381 trimmed %d bytes of undo log", size)
+
+    # private
+    # the fd of the summary file, called with the mutex held. it is
+    # opened again after a fork or if the file was removed or replaced,
+    # the undo log with it.
+    def __open(self):
+        if self.fd is not None and self.pid == os.getpid():
+            try:
+                # a removed file's inode can be reused by the next one
+                if os.stat(self.filename).st_ino == self.ino and os.fstat(self.fd).st_nlink > 0:
+                    return self.fd
+            except OSError:
+                pass
+        for fd in (self.fd, self.undo_fd, self.snapshot_fd):
+            if fd is not None:
+                os.close(fd)
+        self.snapshot_fd = None
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.undo_fd = os.open(self.undo_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+        self.ino = os.fstat(self.fd).st_ino
+        return self.fd
+
+# the SummaryRecord of the bytes of a slot, None for a free one
+def unpack_record(ac_id, data):
+    flags, version, balance, fname, lname, csn = RECORD.unpack(data)
+    if flags & FLAG_USED == 0:
+        return None
+    return SummaryRecord(ac_id, fname.rstrip(b'\0'), lname.rstrip(b'\0'),
+                         balance, version, flags & FLAG_LONG_NAME != 0, csn)
+
+class SummarySnapshot(object):
+
+    def __init__(self, summary, csn, undo_start, lock_fd):
+        self.summary = summary
+        self.csn = csn
+        self.lock_fd = lock_fd
+        # id -> the record as it was at csn, None for an account that
+        # didn't exist yet
+        self.before = {}
+        self.undo_pos = undo_start
+        self.undo_fd = None
+
+    # public
+    # generator of the SummaryRecords of the snapshot in id order from
+    # start_id
+    def records(self, start_id=0):
+        for record in self.summary.records(start_id):
+            if record.csn <= self.csn:
+                yield record
+                continue
+            record = self.version(record.id)
+            if record is not None:
+                yield record
+
+    # public
+    # the number of accounts and the money in the bank at the snapshot
+    def totals(self):
+        count = 0
+        balance = 0.0
+        for record in self.records():
+            count += 1
+            balance += record.balance
+        return SummaryTotals(count, balance)
+
+    # public
+    # the record of an account a commit after the snapshot has changed,
+    # as it was at the snapshot. None if it didn't exist then.
+    def version(self, ac_id):
+        if ac_id not in self.before:
+            self.__read_undo()
+        if ac_id not in self.before:
+            # the commit writes the undo log before the record
+            logging.error("SUM0448 no undo entry for account %d after csn %d", ac_id, self.csn)
+            return None
+        return self.before[ac_id]
+
+    # public
+    # lets commits trim the undo log again
+    def close(self):
+        if self.lock_fd is not None:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        if self.undo_fd is not None:
+            os.close(self.undo_fd)
+            self.undo_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    # private
+    # reads the undo log entries written since the last look. the first
+    # one of an account after the snapshot started has it as it was.
+    def __read_undo(self):
+        if self.undo_fd is None:
+            self.undo_fd = os.open(self.summary.undo_filename, os.O_RDONLY)
+        os.lseek(self.undo_fd, self.undo_pos, os.SEEK_SET)
+        while True:
+            data = os.read(self.undo_fd, READ_CHUNK * UNDO_SIZE)
+            # a commit may be writing the last one
+            n = len(data) // UNDO_SIZE
+            if n == 0:
+                return
+            for i in range(n):
+                offset = i * UNDO_SIZE
+                ac_id, csn = UNDO.unpack_from(data, offset)
+                if ac_id not in self.before:
+                    self.before[ac_id] = unpack_record(ac_id, data[offset + UNDO.size:offset + UNDO_SIZE])
+            self.undo_pos += n * UNDO_SIZE
+            os.lseek(self.undo_fd, self.undo_pos, os.SEEK_SET)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for AccountSummary
+#
+import unittest
+import os
+import shutil
+import struct
+import threading
+
+import account_summary
+from account_actions import AccountActions
+from account_create import AccountCreate
+from account_summary import get_summary, AccountSummary, UNDO_FILENAME, UNDO_SIZE
+from drove_bank_constants import write_config, clear_config_cache
+from recover import Recover
+
+class AccountSummary_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'summary_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        # a test turns the summary off, don't let the next one see it
+        clear_config_cache()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+        ac = AccountCreate(self.dir)
+        self.one_id = ac.create_account('John', 'Doe', 100.0)
+        self.one_file = ac.get_account_file()
+        self.two_id = ac.create_account('Bob', 'Smith', 50.0)
+        self.two_file = ac.get_account_file()
+        self.trim_size = account_summary.UNDO_TRIM_SIZE
+        self.trim_check = account_summary.UNDO_TRIM_CHECK
+        self.read_chunk = account_summary.READ_CHUNK
+
+    def tearDown(self):
+        account_summary.UNDO_TRIM_SIZE = self.trim_size
+        account_summary.UNDO_TRIM_CHECK = self.trim_check
+        account_summary.READ_CHUNK = self.read_chunk
+        shutil.rmtree(self.dir)
+
+    def __records(self):
+        return dict((r.id, r) for r in get_summary(self.dir).records())
+
+    def test_commits_update_summary(self):
+        aa = AccountActions(self.dir)
+        totals = aa.get_bank_totals()
+        self.assertEqual(totals.count, 2)
+        self.assertEqual(totals.balance, 150.0)
+
+        aa.deposit(self.one_id, 20.0)
+        aa.withdraw(self.two_id, 10.0)
+        self.assertTrue(aa.transfer_money(self.one_id, self.two_id, 5.0))
+        # a failed withdraw changes nothing
+        self.assertEqual(aa.withdraw(self.two_id, 1000.0), -1)
+
+        records = self.__records()
+        self.assertEqual(records[self.one_id].balance, 115.0)
+        self.assertEqual(records[self.one_id].version, 3)
+        self.assertEqual(records[self.two_id].balance, 45.0)
+        self.assertEqual(records[self.two_id].version, 3)
+        self.assertEqual(records[self.two_id].fname, 'Bob')
+        self.assertEqual(aa.get_bank_totals().balance, 160.0)
+
+    def test_listing_reads_summary(self):
+        ac = AccountCreate(self.dir)
+        long_id = ac.create_account('J' * 60, 'Long', 1.0)
+
+        # the account files aren't read for a listing
+        os.remove(self.two_file)
+        aa = AccountActions(self.dir)
+        records, cursor = aa.list_accounts(None, 10)
+        self.assertEqual([r.id for r in records], [self.one_id, self.two_id, long_id])
+        self.assertEqual(records[1].lname, 'Smith')
+        # except for a name too long for the summary
+        self.assertEqual(records[2].fname, 'J' * 60)
+
+        # off goes back to the account files
+        write_config(self.dir, {'summary': 'off'})
+        records, cursor = aa.list_accounts(None, 10)
+        self.assertEqual([r.id for r in records], [self.one_id, long_id])
+
+    def test_recover_rebuilds(self):
+        aa = AccountActions(self.dir)
+        aa.deposit(self.one_id, 1.0)
+
+        # a commit that never made it to the summary
+        f = open(self.one_file, 'w')
+        f.write('John,Doe,500.0\n')
+        f.close()
+        self.assertEqual(aa.get_bank_totals().balance, 151.0)
+
+        Recover(self.dir).recover()
+        records = self.__records()
+        self.assertEqual(records[self.one_id].balance, 500.0)
+        self.assertEqual(records[self.one_id].version, 3)
+        self.assertEqual(records[self.two_id].version, 1)
+        self.assertEqual(aa.get_bank_totals().balance, 550.0)
+
+    def test_built_for_existing_dbdir(self):
+        os.remove(os.path.join(self.dir, 'summary.dat'))
+        aa = AccountActions(self.dir)
+        totals = aa.get_bank_totals()
+        self.assertEqual(totals.count, 2)
+        self.assertEqual(totals.balance, 150.0)
+
+    def test_snapshot(self):
+        aa = AccountActions(self.dir)
+        snapshot = aa.snapshot()
+        aa.deposit(self.one_id, 20.0)
+        self.assertTrue(aa.transfer_money(self.one_id, self.two_id, 5.0))
+        three_id = AccountCreate(self.dir).create_account('Ann', 'Lee', 7.0)
+
+        # the snapshot is the bank before all that
+        records = dict((r.id, r) for r in snapshot.records())
+        self.assertEqual(sorted(records), [self.one_id, self.two_id])
+        self.assertEqual(records[self.one_id].balance, 100.0)
+        self.assertEqual(records[self.two_id].balance, 50.0)
+        self.assertEqual(snapshot.totals(), (2, 150.0))
+        snapshot.close()
+
+        # the commits are numbered, a transfer is one commit
+        records = self.__records()
+        self.assertEqual(records[self.one_id].csn, records[self.two_id].csn)
+        self.assertEqual(records[three_id].csn, records[self.one_id].csn + 1)
+        with aa.snapshot() as snapshot:
+            self.assertEqual(snapshot.csn, records[three_id].csn)
+            self.assertEqual(snapshot.totals(), (3, 177.0))
+
+    def test_scan_during_transfers(self):
+        ac = AccountCreate(self.dir)
+        ids = [self.one_id, self.two_id] + [ac.create_account('A', str(n), 100.0) for n in range(8)]
+        # a read of the file at a time is all one commit or the other
+        account_summary.READ_CHUNK = 2
+        stop = threading.Event()
+
+        def transfers(n):
+            aa = AccountActions(self.dir)
+            while stop.is_set() is False:
+                for i in range(len(ids)):
+                    aa.transfer_money(ids[(i + n) % len(ids)], ids[(i + n + 1) % len(ids)], 1.0)
+
+        workers = [threading.Thread(target=transfers, args=(n,)) for n in range(2)]
+        for worker in workers:
+            worker.start()
+        try:
+            aa = AccountActions(self.dir)
+            for n in range(20):
+                total = 0.0
+                for record in aa.iter_accounts():
+                    total += record.balance
+                    # let the transfers in between the records
+                    stop.wait(0.002)
+                self.assertEqual(total, 950.0)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        self.assertEqual(aa.get_bank_totals().balance, 950.0)
+
+    def test_undo_trim(self):
+        account_summary.UNDO_TRIM_SIZE = 0
+        account_summary.UNDO_TRIM_CHECK = 1
+        undo = os.path.join(self.dir, UNDO_FILENAME)
+        aa = AccountActions(self.dir)
+        snapshot = aa.snapshot()
+        aa.deposit(self.one_id, 1.0)
+        aa.deposit(self.one_id, 1.0)
+        # kept for the open snapshot
+        self.assertTrue(os.path.getsize(undo) > 0)
+        self.assertEqual(snapshot.version(self.one_id).balance, 100.0)
+        snapshot.close()
+        aa.deposit(self.one_id, 1.0)
+        self.assertEqual(os.path.getsize(undo), 0)
+
+    def test_undo_trim_short_processes(self):
+        # every commit from a process of its own, the check goes by csn
+        account_summary.UNDO_TRIM_SIZE = 1
+        account_summary.UNDO_TRIM_CHECK = 4
+        undo = os.path.join(self.dir, UNDO_FILENAME)
+        for n in range(8):
+            summary = AccountSummary(self.dir)
+            summary.update([(self.one_id, 'John', 'Doe', 100.0 + n)])
+            os.close(summary.fd)
+            os.close(summary.undo_fd)
+        self.assertTrue(os.path.getsize(undo) < 4 * UNDO_SIZE)
+
+    def test_old_layout_rebuilt(self):
+        # a summary from before the records had a csn
+        f = open(os.path.join(self.dir, 'summary.dat'), 'wb')
+        f.write(struct.pack('<8sQQQd', b'DSUM1\0\0\0', 2, 70, 71, 150.0) + b'\0' * 200)
+        f.close()
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_bank_totals(), (2, 150.0))
+        self.assertEqual(sorted(self.__records()), [self.one_id, self.two_id])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,16 +7,67 @@
 #
 #
 import os
+import time
+import errno
+import fcntl
 import logging
+import threading
 from collections import namedtuple
 
 from atomic_write import AtomicWrite
+from account_cache import get_account_cache, file_token
+from write_ahead_log import WAL_FILENAME
+from binary_store import get_binary_store
+from account_summary import get_summary
+from account_history import get_history, KIND_DEPOSIT, KIND_WITHDRAW
+from bank_metrics import timed
+
+# a parsed account file
+Account = namedtuple('Account', 'fname lname balance')
+
+# one account in a listing
+AccountRecord = namedtuple('AccountRecord', 'id fname lname balance')
+
+# iter_account_files gives up probing ids one by one after this many
+# misses in a row and lists the directories instead
+LIST_PROBE_LIMIT = 256
+
+# times read_account_file looks for a file that is missing because it is
+# in the middle of a commit, a millisecond apart
+READ_RETRIES = 100
+
+# the new version of an account file written by an optimistic commit,
+# <id>_<transid>.txt.otmp
+OPTIMISTIC_SUFFIX = 'otmp'
+# where the pending history records of an optimistic commit are, from
+# before its rename until they are finished, <id>_<transid>.txt.pend
+PENDING_SUFFIX = 'pend'
+
+# process wide counters of the optimistic commits
+#   attempts:   tries, a retry is another one
+#   done:       finished without the lock, committed or a withdraw of
+#               more than the balance
+#   conflicts:  tries that lost a race with another commit
+#   fallbacks:  went to the lock, the account was locked or the retries
+#               ran out
+_optimistic_stats = {'attempts': 0, 'done': 0, 'conflicts': 0, 'fallbacks': 0}
+_optimistic_lock = threading.Lock()
+
+def get_optimistic_stats():
+    with _optimistic_lock:
+        return dict(_optimistic_stats)
+
+def _count_optimistic(name):
+    with _optimistic_lock:
+        _optimistic_stats[name] += 1
+
+# a try of an optimistic commit lost a race
+_CONFLICT = object()
 
 class AccountUtil(AtomicWrite):
 
     def __init__(self, dir=None):
         AtomicWrite.__init__(self, dir)
-        logging.basicConfig(filename='drovebank.log', level=logging.DEBUG)
 
     # private: makes a deposit to an account. no eror checking
     # of inputs
@@ -25,17 +76,29 @@ class AccountUtil(AtomicWrite):
         # sets up the filenames
         self.set_account_id(account_id)
 
+        if self.use_optimistic():
+            balance = self.optimistic_change(account_id, self.filename, amount, KIND_DEPOSIT)
+            if balance is not None:
+                return balance
+
         # lock file
         self.lock_file()
 
         account_info = self.__read_account_info(account_id)
         logging.debug("AU0033 balance for account %s is %s\n", account_id, account_info.balance)
         balance = account_info.balance + amount
-        content = "%s,%s,%s\n'" % (account_info.fname, account_info.lname, balance)
+        content = "%s,%s,%s\n" % (account_info.fname, account_info.lname, balance)
+        history = self.record_history([(account_id, KIND_DEPOSIT, 0, float(amount), balance)])
         self.write_content(content)
 
-        #unlock file
-        self.unlock_file()
+        # the commit is done, the account is unlocked whatever happens to
+        # the history and summary
+        try:
+            self.finish_history(history)
+            self.update_summary([(account_id, account_info.fname, account_info.lname, balance)])
+        finally:
+            #unlock file
+            self.unlock_file()
 
         # write to log after done so if there is a failure we can see the unmatched
         # transaction
@@ -44,6 +107,7 @@ class AccountUtil(AtomicWrite):
 
     # makes a deposit to account. returns balance or -1 on error.
     # call getError to get error string
+    @timed('deposit', lambda balance: balance == -1)
     def deposit(self, account_id, amount):
         error = False
         self.clear_errors()
@@ -77,10 +141,12 @@ class AccountUtil(AtomicWrite):
             return -1
 
         # call make deposit.
-        balance = self.__make_deposit(account_id, amount)
+        # the id may be a string from the command line
+        balance = self.__make_deposit(int(account_id), amount)
         return balance
 
     # withdraw case from account
+    @timed('withdraw', lambda balance: balance == -1)
     def withdraw(self, account_id, amount):
         error = False
         self.clear_errors()
@@ -113,7 +179,8 @@ class AccountUtil(AtomicWrite):
             return -1
 
         # call make withdraw
-        balance = self.__make_withdraw(account_id, amount)
+        # the id may be a string from the command line
+        balance = self.__make_withdraw(int(account_id), amount)
         return balance
 
     # private
@@ -125,6 +192,11 @@ class AccountUtil(AtomicWrite):
         # sets up the filenames
         self.set_account_id(account_id)
 
+        if self.use_optimistic():
+            balance = self.optimistic_change(account_id, self.filename, amount, KIND_WITHDRAW)
+            if balance is not None:
+                return balance
+
         # lock file
         self.lock_file()
 
@@ -141,17 +213,163 @@ class AccountUtil(AtomicWrite):
             return -1
 
         content = "%s,%s,%s\n" % (account_info.fname, account_info.lname, balance)
+        history = self.record_history([(account_id, KIND_WITHDRAW, 0, float(amount), balance)])
         self.write_content(content)
 
-        #unlock file
-        self.unlock_file()
+        # the commit is done, the account is unlocked whatever happens to
+        # the history and summary
+        try:
+            self.finish_history(history)
+            self.update_summary([(account_id, account_info.fname, account_info.lname, balance)])
+        finally:
+            #unlock file
+            self.unlock_file()
 
         # write to log after done so if there is a failure we can see the unmatched
         # transaction
         logging.debug("AU0040 new balance for account %s is %s\n", account_id, balance)
         return balance
 
+    # public
+    # True if deposits and withdraws try an optimistic commit first. the
+    # write ahead log and the binary store don't replace the account
+    # file so they always lock, as does a layout on the move
+    def use_optimistic(self):
+        return (self.get_config_bool('optimistic') and self.get_storage() == 'files'
+                and self.get_layout() != 'migrating')
+
+    # public
+    # a deposit or withdraw (kind) of amount on the account in filename
+    # without taking its lock:
+    #   - read the file, its inode is the version
+    #   - write the new content to <id>_<transid>.txt.otmp
+    #   - compare and swap: take a flock on the file we read without
+    #     waiting, check the name still has that inode and there is no
+    #     lock file, then rename the new file over it
+    # the flock keeps two optimistic commits apart, lock_file goes
+    # through it too so a locked writer can't read the file half way
+    # through one. the new file is flocked before the rename so the next
+    # commit waits for the history and summary of this one.
+    # with no lock file for recover.py to find, a commit that dies after
+    # its rename is found by its .pend file, which says where its PENDING
+    # history records are. with the .otmp file still there the rename
+    # never happened and they are voided, without it they are kept.
+    # a lost race is tried again optimistic_retries times. returns the new
+    # balance, -1 (and the error) for a withdraw of more than the balance
+    # or None if the caller has to take the lock.
+    def optimistic_change(self, account_id, filename, amount, kind):
+        for attempt in range(self.get_config_int('optimistic_retries') + 1):
+            _count_optimistic('attempts')
+            result = self.__try_optimistic(int(account_id), filename, float(amount), kind)
+            if result is None:
+                break
+            if result is not _CONFLICT:
+                _count_optimistic('done')
+                return result
+            _count_optimistic('conflicts')
+            logging.debug("AU0206 optimistic commit on %s lost a race", filename)
+        _count_optimistic('fallbacks')
+        return None
+
+    # private
+    # one try of optimistic_change. _CONFLICT if another commit got there
+    # first, None if the account is locked or gone
+    def __try_optimistic(self, account_id, filename, amount, kind):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError as e:
+            # between the renames of a locked commit, or no such account
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        tmp_fd = None
+        tmpfile = None
+        pendfile = None
+        try:
+            version = os.fstat(fd).st_ino
+            vals = os.read(fd, 4096).split('\n')[0].split(',')
+            account_info = Account(vals[0], vals[1], float(vals[2].strip()))
+            if kind == KIND_WITHDRAW:
+                balance = account_info.balance - amount
+                if balance < 0:
+                    self.add_error("You can't withdraw more than your balance")
+                    logging.warning("AU0119 account %s trying to withdraw %s more than the balance %s",
+                                    account_id, amount, account_info.balance)
+                    return -1
+            else:
+                balance = account_info.balance + amount
+
+            prefix, suffix = os.path.splitext(filename)
+            tmpfile = "%s_%s%s.%s" % (prefix, self.id_generator(), suffix, OPTIMISTIC_SUFFIX)
+            tmp_fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(tmp_fd, "%s,%s,%s\n" % (account_info.fname, account_info.lname, balance))
+
+            # compare and swap
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return _CONFLICT
+            if os.path.exists(self.get_lock_path(filename)):
+                return None
+            try:
+                if os.stat(filename).st_ino != version:
+                    return _CONFLICT
+            except OSError:
+                return _CONFLICT
+            fcntl.flock(tmp_fd, fcntl.LOCK_EX)
+
+            history = self.record_history([(account_id, kind, 0, amount, balance)])
+            pendfile = self.__save_pending(tmpfile, history)
+            os.rename(tmpfile, filename)
+            tmpfile = None
+            if self.finish_history(history) and pendfile is not None:
+                os.remove(pendfile)
+            self.update_summary([(account_id, account_info.fname, account_info.lname, balance)])
+            logging.debug("AU0040 new balance for account %s is %s\n", account_id, balance)
+            return balance
+        finally:
+            if tmp_fd is not None:
+                os.close(tmp_fd)
+            os.close(fd)
+            # once there is a .pend file an unfinished commit is left to
+            # recover.py
+            if tmpfile is not None and tmp_fd is not None and pendfile is None:
+                os.remove(tmpfile)
+
+    # private
+    # writes the .pend file of the optimistic commit in tmpfile, one line
+    # per append of its history (segment, first record, count). None if
+    # there is no history.
+    def __save_pending(self, tmpfile, history):
+        if history is None:
+            return None
+        pendfile = tmpfile[:-len(OPTIMISTIC_SUFFIX)] + PENDING_SUFFIX
+        f = open(pendfile, 'w')
+        for path, first, count in history:
+            f.write("%s,%d,%d\n" % (path, first, count))
+        f.close()
+        return pendfile
+
+    # public
+    # what a .pend file says, the pending argument of finish_history
+    def load_pending(self, pendfile):
+        f = open(pendfile, 'r')
+        try:
+            pending = []
+            for line in f:
+                # a line without its newline was cut short by a crash
+                if line.endswith('\n') is False:
+                    raise ValueError("%s is cut short" % pendfile)
+                path, first, count = line.strip().rsplit(',', 2)
+                pending.append((path, int(first), int(count)))
+            return pending
+        finally:
+            f.close()
+
     # gets the account information. does not use locks
+    @timed('get', lambda info: info is None)
     def get_account_info(self, account_id):
         error = False
         self.clear_errors()
@@ -178,37 +396,234 @@ class AccountUtil(AtomicWrite):
     # checks
     def __read_account_info(self, account_id):
         filename = self.get_account_filename(account_id)
+        return self.read_account_file(filename)
+
+    # public
+    # reads and parses an account file. no error checks.
+    # the parsed record is cached and reused for as long as the file
+    # (and with the write ahead log, the log) hasn't changed.
+    # a read without the lock can land in the middle of a transfer when
+    # the file is gone for a moment, it waits for it to come back. a
+    # reader holding the lock passes wait=False, it has nothing to wait
+    # for.
+    def read_account_file(self, filename, wait=True):
+        tries = 0
+        while True:
+            try:
+                return self.__read_account_file(filename)
+            except (IOError, OSError) as e:
+                tries += 1
+                if e.errno != errno.ENOENT or tries >= READ_RETRIES or wait is False:
+                    raise
+                if os.path.exists(self.get_lock_path(filename)) is False:
+                    raise
+            time.sleep(0.001)
+
+    def __read_account_file(self, filename):
+        # a read of the binary store is a slice of its map, there is
+        # nothing to save by caching it
+        if self.get_storage() == 'binary':
+            store = get_binary_store(self.dbdir)
+            record = store.read(store.account_id(filename))
+            if record is None:
+                raise IOError(errno.ENOENT, "no such account", filename)
+            return Account(record.fname, record.lname, record.balance)
+
+        cache = get_account_cache(self.get_config_int('read_cache_size'))
+        token = self.cache_token(filename)
+        account = cache.get(filename, token)
+        if account is not None:
+            return account
+
         # read in file
-        file = open(filename, 'r')
-        file_contents = file.readline()
-        file.close()
+        file_contents = self.read_content(filename)
 
         vals = file_contents.split(',')
         balance = float(vals[2].strip())
-        Account = namedtuple('Account', 'fname lname balance')
         account = Account(vals[0], vals[1], balance)
+        cache.put(filename, token, account)
         return account
 
+    # public
+    # the token a cached read of filename is good for (account_cache.py).
+    # with the write ahead log the latest balance may only be in the log
+    # so any append to it has to invalidate the entry too. None with the
+    # binary store, its reads aren't cached. raises OSError if the file
+    # is gone
+    def cache_token(self, filename):
+        if self.get_storage() == 'binary':
+            return None
+        token = file_token(filename)
+        if self.get_storage() == 'wal':
+            try:
+                token = token + file_token(os.path.join(self.dbdir, WAL_FILENAME))
+            except OSError:
+                pass
+        return token
+
+    # public
+    # hit/miss/eviction counters of the process wide read cache
+    def get_cache_stats(self):
+        return get_account_cache(self.get_config_int('read_cache_size')).get_stats()
+
     # public
     # function that gets account filename
     # no error checking on args
     def get_account_filename(self, account_id):
-        fname = "%s.txt" % account_id
-        return os.path.join(self.dbdir, fname)
+        layout = self.get_layout()
+        if layout == 'sharded':
+            return self.sharded_account_path(account_id)
+        if layout == 'migrating':
+            # migrated files are never moved back so look there first
+            sharded = self.sharded_account_path(account_id)
+            if os.path.exists(sharded):
+                return sharded
+        return self.flat_account_path(account_id)
 
     # public
     # check if account file exists.
     # no error checking on args
     def check_account_file(self, account_id):
-        return os.path.exists(self.get_account_filename(account_id))
+        return self.data_file_exists(self.get_account_filename(account_id))
 
     # public
     # sets the filenames from the account id
     def set_account_id(self, account_id):
         self.id = account_id
-        fname = "%s.txt" % account_id
-        filename = os.path.join(self.dbdir, fname)
+        filename = self.get_account_filename(account_id)
         self.set_file_name(filename)
 
     def get_id(self):
         return self.id
+
+    # public
+    # the summary file of the dbdir, built from the account files if it
+    # isn't there yet. None if summary = off.
+    def get_account_summary(self):
+        if self.get_config_bool('summary') is False:
+            return None
+        summary = get_summary(self.dbdir)
+        summary.ensure(self.iter_account_files)
+        return summary
+
+    # public
+    # records the new state of accounts, a list of (id, fname, lname,
+    # balance), in the summary file. called after the commit with the
+    # account locks still held so updates of an account go in in order.
+    def update_summary(self, records):
+        if self.get_config_bool('summary') is False:
+            return
+        try:
+            get_summary(self.dbdir).update(records, self.iter_account_files)
+        except Exception as e:
+            # the commit is done, only the summary is behind. nothing that
+            # goes wrong here may leave the account locked
+            logging.exception("AU0290 account summary update failed, run recover.py: %s", e)
+
+    # public
+    # adds history records, a list of (id, kind, other id, amount,
+    # balance after), for a commit that is about to be written. called
+    # with the account locks held, before the commit. returns what
+    # finish_history needs, None if history = off.
+    def record_history(self, entries):
+        if self.get_config_bool('history') is False or len(entries) == 0:
+            return None
+        return get_history(self.dbdir).append(entries)
+
+    # public
+    # marks the records of record_history as committed. called after the
+    # commit, before the locks go. returns False if they are still
+    # PENDING.
+    def finish_history(self, pending):
+        if pending is None:
+            return True
+        try:
+            get_history(self.dbdir).finish(pending)
+        except (IOError, OSError) as e:
+            # the commit is done, recover.py keeps the records
+            logging.error("AU0330 history finish failed, run recover.py: %s", e)
+            return False
+        return True
+
+    # public
+    # the last account id handed out, None if there is no index file
+    def get_last_account_id(self):
+        try:
+            return int(self.read_content(self.get_index_filename()).strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    # public
+    # generator of AccountRecords in id order starting at start_id, read
+    # from the account files (or the binary store).
+    #
+    # ids are handed out in order from index.idx so this probes start_id,
+    # start_id + 1, ... up to the last id handed out and reads each file
+    # as it goes. if the ids turn out to be sparse (a long run of misses)
+    # it falls back to listing the directories.
+    def iter_account_files(self, start_id=0):
+        if self.get_storage() == 'binary':
+            for record in get_binary_store(self.dbdir).records(start_id):
+                yield AccountRecord(record.id, record.fname, record.lname, record.balance)
+            return
+
+        last_id = self.get_last_account_id()
+        ac_id = start_id
+        misses = 0
+        while last_id is not None and ac_id <= last_id:
+            if misses >= LIST_PROBE_LIMIT:
+                break
+            record = self.__read_record(ac_id, self.get_account_filename(ac_id))
+            ac_id += 1
+            if record is None:
+                misses += 1
+                continue
+            misses = 0
+            yield record
+
+        if last_id is not None and ac_id > last_id:
+            return
+        logging.debug("AU0330 listing %s from id %d by directory scan", self.dbdir, ac_id)
+        for scan_id, filename in self.__scan_account_files(self.dbdir, ac_id):
+            record = self.__read_record(scan_id, filename)
+            if record is not None:
+                yield record
+
+    # private
+    # reads a record, None if the account doesn't exist
+    def __read_record(self, ac_id, filename):
+        try:
+            ac_info = self.read_account_file(filename)
+        except (IOError, OSError):
+            return None
+        return AccountRecord(ac_id, ac_info.fname, ac_info.lname, ac_info.balance)
+
+    # private
+    # generator of (id, filename) for the account files with an id of at
+    # least start_id in id order. a sharded dbdir is walked a directory at
+    # a time in sorted order so only the directories that are needed get
+    # listed.
+    def __scan_account_files(self, path, start_id):
+        entries = []
+        subdirs = []
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if name.isdigit() and os.path.isdir(full):
+                subdirs.append(name)
+            elif name.endswith('.txt'):
+                ac_id = self.account_id_from_path(full)
+                if ac_id is not None and ac_id >= start_id:
+                    entries.append((ac_id, full))
+        # the flat files (and the files of this shard)
+        entries.sort()
+        for entry in entries:
+            yield entry
+        # then the shards, skipping the ones that are all below start_id
+        for name in sorted(subdirs):
+            sub = os.path.join(path, name)
+            prefix = ''.join(os.path.relpath(sub, self.dbdir).split(os.sep))
+            width = 8 - len(prefix)
+            if width > 0 and int(prefix + '9' * width) < start_id:
+                continue
+            for entry in self.__scan_account_files(sub, start_id):
+                yield entry
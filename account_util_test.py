@@ -6,16 +6,27 @@
 import unittest
 import os
 import time
+import glob
+import fcntl
+import shutil
+import threading
+import tempfile
 
-from account_util import AccountUtil
+from account_util import AccountUtil, get_optimistic_stats
 from account_create import AccountCreate
+from account_actions import AccountActions
+from account_session import AccountSession
+from recover import Recover
+from account_history import get_history, KIND_CREATE, KIND_DEPOSIT
+from drove_bank_constants import write_config, clear_config_cache
 
 class AccountUtil_Test(unittest.TestCase):
 
     # setup
     def setUp(self):
         fname = "index.idx"
-        self.dir  = os.getcwd()
+        # a dbdir of its own, the commits leave a summary and history in it
+        self.dir  = tempfile.mkdtemp()
         self.indexname = os.path.join(self.dir, fname)
         # name the account will create
         self.fname = os.path.join(self.dir, "70.txt")
@@ -33,9 +44,7 @@ class AccountUtil_Test(unittest.TestCase):
         id = ac.create_account(fname, lname, balance)
 
     def tearDown(self):
-        os.remove(self.indexname)
-        if (os.path.exists(self.fname)):
-            os.remove(self.fname)
+        shutil.rmtree(self.dir)
 
     def test_get_account_info(self):
         au = AccountUtil(self.dir)
@@ -79,5 +88,170 @@ class AccountUtil_Test(unittest.TestCase):
         balance = au.deposit(70, 500.00)
         self.assertEqual(balance, 600.00)
 
+    def test_string_account_id(self):
+        # drovebank.py passes the id as it was typed
+        au = AccountUtil(self.dir)
+        self.assertEqual(au.deposit("70", 25.00), 125.00)
+        self.assertEqual(au.withdraw("70", 50.00), 75.00)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "70.lock")))
+        summary = au.get_account_summary()
+        self.assertEqual([record.balance for record in summary.records(70)], [75.00])
+        self.assertEqual(au.deposit("70", 5.00), 80.00)
+
+    def test_read_cache(self):
+        au = AccountUtil(self.dir)
+        au.get_account_info(70)
+        stats = au.get_cache_stats()
+
+        # nothing changed so the second read is a hit
+        info = au.get_account_info(70)
+        self.assertEqual(info.balance, 100.00)
+        self.assertEqual(au.get_cache_stats()['hits'], stats['hits'] + 1)
+
+        # a commit from somewhere else invalidates the entry
+        other = AccountUtil(self.dir)
+        other.deposit(70, 25.00)
+        misses = au.get_cache_stats()['misses']
+        info = au.get_account_info(70)
+        self.assertEqual(info.balance, 125.00)
+        self.assertEqual(au.get_cache_stats()['misses'], misses + 1)
+
+class AccountUtilOptimistic_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'optimistic_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+        write_config(self.dir, {'optimistic': 'on'})
+        ac = AccountCreate(self.dir)
+        self.one = ac.create_account('John', 'Doe', 100.0)
+        self.two = ac.create_account('Jane', 'Doe', 100.0)
+        self.fname = os.path.join(self.dir, '%s.txt' % self.one)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        clear_config_cache()
+
+    def __delta(self, before):
+        after = get_optimistic_stats()
+        return dict((name, after[name] - before[name]) for name in after)
+
+    def __leftovers(self):
+        return glob.glob(os.path.join(self.dir, '*.otmp')) + glob.glob(os.path.join(self.dir, '*.lock'))
+
+    def test_optimistic(self):
+        au = AccountUtil(self.dir)
+        before = get_optimistic_stats()
+        self.assertEqual(au.deposit(self.one, 25.0), 125.0)
+        self.assertEqual(au.withdraw(self.one, 500.0), -1)
+        self.assertEqual(au.withdraw(self.one, 25.0), 100.0)
+        self.assertEqual(self.__delta(before), {'attempts': 3, 'done': 3, 'conflicts': 0, 'fallbacks': 0})
+        self.assertEqual(self.__leftovers(), [])
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(self.one).balance, 100.0)
+        self.assertEqual(aa.get_bank_totals().balance, 200.0)
+
+        # a session goes the same way
+        before = get_optimistic_stats()
+        session = AccountSession(self.dir)
+        self.assertEqual(session.deposit(self.two, 5.0), 105.0)
+        self.assertEqual(self.__delta(before)['done'], 1)
+
+        # a locked account is left to the lock
+        holder = AccountUtil(self.dir)
+        holder.set_account_id(self.one)
+        holder.lock_file()
+        timer = threading.Timer(0.1, holder.unlock_file)
+        timer.start()
+        before = get_optimistic_stats()
+        self.assertEqual(au.deposit(self.one, 1.0), 101.0)
+        timer.join()
+        self.assertEqual(self.__delta(before), {'attempts': 1, 'done': 0, 'conflicts': 0, 'fallbacks': 1})
+
+        # the flock of another optimistic commit is a conflict, the retries
+        # run out and the lock waits for it
+        fd = os.open(self.fname, os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        timer = threading.Timer(0.1, os.close, [fd])
+        timer.start()
+        before = get_optimistic_stats()
+        self.assertEqual(au.deposit(self.one, 1.0), 102.0)
+        timer.join()
+        self.assertEqual(self.__delta(before), {'attempts': 3, 'done': 0, 'conflicts': 3, 'fallbacks': 1})
+        self.assertEqual(self.__leftovers(), [])
+
+    def test_concurrent(self):
+        # optimistic deposits and locked transfers on the same account
+        def deposits():
+            au = AccountUtil(self.dir)
+            for n in range(25):
+                self.assertEqual(au.deposit(self.one, 1.0) > 0, True)
+        def transfers():
+            aa = AccountActions(self.dir)
+            for n in range(25):
+                aa.transfer_money(self.one, self.two, 1.0)
+        workers = [threading.Thread(target=deposits) for n in range(4)]
+        workers.append(threading.Thread(target=transfers))
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(self.one).balance, 175.0)
+        self.assertEqual(aa.get_account_info(self.two).balance, 125.0)
+        self.assertEqual(aa.get_bank_totals().balance, 300.0)
+        self.assertEqual(self.__leftovers(), [])
+
+    def test_recover(self):
+        # a crash before the rename leaves the new file behind
+        otmp = os.path.join(self.dir, '%s_ABCDEFGH.txt.otmp' % self.one)
+        f = open(otmp, 'w')
+        f.write('John,Doe,500.0\n')
+        f.close()
+        Recover(self.dir).recover()
+        self.assertFalse(os.path.exists(otmp))
+        self.assertEqual(AccountActions(self.dir).get_account_info(self.one).balance, 100.0)
+
+    def test_recover_after_rename(self):
+        # a crash between the rename and the end of the history leaves no
+        # lock file, the .pend file has the records
+        class Crash(Exception):
+            pass
+        def crash(pending):
+            raise Crash()
+        au = AccountUtil(self.dir)
+        au.finish_history = crash
+        self.assertRaises(Crash, au.deposit, self.one, 5.0)
+        pends = glob.glob(os.path.join(self.dir, '*.pend'))
+        self.assertEqual(len(pends), 1)
+        self.assertEqual(self.__leftovers(), [])
+        history = get_history(self.dir)
+        self.assertEqual([r.kind for r in history.query(self.one)], [KIND_CREATE])
+
+        # other commits go on before recover.py is run
+        self.assertEqual(AccountUtil(self.dir).deposit(self.one, 1.0), 106.0)
+        stats = Recover(self.dir).recover()
+        self.assertEqual(stats['history_pending'], 1)
+        self.assertEqual(glob.glob(os.path.join(self.dir, '*.pend')), [])
+        self.assertEqual([r.balance for r in history.query(self.one)], [100.0, 105.0, 106.0])
+
+        # with the .otmp file still there the rename never happened
+        otmp = os.path.join(self.dir, '%s_ABCDEFGH.txt.otmp' % self.two)
+        f = open(otmp, 'w')
+        f.write('Jane,Doe,500.0\n')
+        f.close()
+        pending = AccountUtil(self.dir).record_history([(self.two, KIND_DEPOSIT, 0, 400.0, 500.0)])
+        f = open(otmp[:-len('otmp')] + 'pend', 'w')
+        f.write(''.join("%s,%d,%d\n" % entry for entry in pending))
+        f.close()
+        Recover(self.dir).recover()
+        self.assertEqual([r.balance for r in history.query(self.two)], [100.0])
+        self.assertEqual(glob.glob(os.path.join(self.dir, '*.pend')) + self.__leftovers(), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -11,14 +11,80 @@ import string
 import random
 import time
 import logging
+import errno
+import fcntl
+import signal
+import socket
+import threading
+from collections import namedtuple
 
 from drove_bank_constants import DroveBankConstants
+from write_ahead_log import get_wal
+from binary_store import get_binary_store
+from recovery_catalog import RecoveryCatalog
+from bank_metrics import observe, observe_step, count
+
+# raised when a lock can't be had. the app catches these, anything
+# below it just lets them go.
+class LockError(Exception):
+    pass
+
+# waited longer than the lock timeout
+class LockTimeout(LockError):
+    pass
+
+# the lock was left by a process that died half way through a write and
+# what it left can't be put right from here
+class StaleLock(LockError):
+    pass
+
+# what a lock file says about its holder: pid and host of the process,
+# when it took the lock and when its lease runs out (None, no lease).
+# written as pid,host,start,expires
+LockOwner = namedtuple('LockOwner', 'pid host start expires')
+
+HOSTNAME = socket.gethostname()
+
+# the LockOwner of the content of a lock file, None if it is empty or
+# half written. a lock file from before the leases has just the pid.
+def parse_lock_owner(content):
+    vals = content.strip().split(',')
+    try:
+        if len(vals) == 1:
+            return LockOwner(int(vals[0]), None, None, None)
+        expires = None
+        if vals[3] != '':
+            expires = float(vals[3])
+        return LockOwner(int(vals[0]), vals[1], float(vals[2]), expires)
+    except (ValueError, IndexError):
+        return None
+
+# True if there is a process pid on this host
+def pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM is someone else's process
+        return e.errno != errno.ESRCH
+    return True
+
+# True if the holder of a lock is gone: its lease ran out, or it is on
+# this host and its process isn't
+def owner_is_stale(owner, now=None):
+    if now is None:
+        now = time.time()
+    if owner.expires is not None and now > owner.expires:
+        return True
+    if owner.host is None or owner.host == HOSTNAME:
+        return pid_alive(owner.pid) is False
+    return False
 
 class AtomicWrite(DroveBankConstants):
 
     def __init__(self, dir=None, filename=None):
         DroveBankConstants.__init__(self, dir)
-        logging.basicConfig(filename='drovebank.log', level=logging.DEBUG)
 
         self.oldsuffix  = "old"
         self.tmpsuffix  = "tmp"
@@ -45,16 +111,65 @@ class AtomicWrite(DroveBankConstants):
             logging.critical("AW0045 DB file directory %s doesn't exist!", self.dbdir)
             sys.exit(-1)
 
+        self.id = self.id_generator()
+        self.__make_tmp_paths()
+        self.lockfilename = self.get_lock_path(self.filename)
+
+    # private
+    # the tmp and old files live next to the data file
+    def __make_tmp_paths(self):
         # get the file without any preceding path
         basename = os.path.basename(self.filename)
         prefix, suffix = os.path.splitext(basename)
-        self.id = self.id_generator()
+        filedir = os.path.dirname(self.filename)
         tmpfile = prefix + "_" + self.id + suffix + "." + self.tmpsuffix
         oldfile = prefix + "_" + self.id + suffix + "." + self.oldsuffix
-        lockfile = prefix + "." + self.locksuffix
-        self.tmpfile = os.path.join(self.dbdir, tmpfile)
-        self.oldfile = os.path.join(self.dbdir, oldfile)
-        self.lockfilename = os.path.join(self.dbdir, lockfile)
+        self.tmpfile = os.path.join(filedir, tmpfile)
+        self.oldfile = os.path.join(filedir, oldfile)
+
+    # public
+    # the lock file for a data file. it sits next to the data file, but
+    # while the layout is migrating an account is always locked in its
+    # sharded dir so the lock doesn't move with the file.
+    def get_lock_path(self, filename):
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        if self.get_layout() == 'migrating' and os.path.dirname(filename) == self.dbdir:
+            ac_id = self.account_id_from_path(filename)
+            if ac_id is not None:
+                filename = self.sharded_account_path(ac_id)
+                prefix = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(os.path.dirname(filename), prefix + "." + self.locksuffix)
+
+    # public
+    # the data files a lock file can belong to. normally the one next to
+    # it but while the layout is migrating the data file may still be flat
+    def get_lock_data_files(self, lockfile):
+        # this assumes the suffix is txt probably should make
+        # this configurable
+        filename = lockfile[:-(len(self.locksuffix) + 1)] + ".txt"
+        result = [filename]
+        if self.get_layout() == 'migrating':
+            ac_id = self.account_id_from_path(filename)
+            if ac_id is not None and self.flat_account_path(ac_id) != filename:
+                result.append(self.flat_account_path(ac_id))
+        return result
+
+    # private
+    # migrate_layout.py may have moved the data file while we waited for
+    # the lock. the lock doesn't move so just follow the file.
+    def __follow_migration(self):
+        if self.filename is None or self.get_layout() != 'migrating':
+            return
+        if os.path.exists(self.filename):
+            return
+        ac_id = self.account_id_from_path(self.filename)
+        if ac_id is None:
+            return
+        sharded = self.sharded_account_path(ac_id)
+        if sharded != self.filename and os.path.exists(sharded):
+            logging.debug("AW0117 %s was migrated to %s", self.filename, sharded)
+            self.filename = sharded
+            self.__make_tmp_paths()
 
     # public
     # this will generate a random alpha numeric string 8 charaters
@@ -71,30 +186,362 @@ class AtomicWrite(DroveBankConstants):
         return ''.join(random.choice(chars) for _ in range(size))
 
     # public
-    # locks file
-    # todo: this needs a timeout
-    def lock_file(self):
-        loop = True
-        while(loop):
+    # locks file. waits at most timeout seconds (the lock_timeout config
+    # when not given, forever when that is none) then raises LockTimeout.
+    #
+    # lock_backend = lockfile creates the lock file with O_EXCL and polls
+    # every lock_poll_interval seconds. works on any filesystem where
+    # create is atomic.
+    # lock_backend = flock holds a kernel lock on the lock file. waiters
+    # block in the kernel and wake up as soon as it is released, and the
+    # kernel releases it if the holder dies.
+    #
+    # either way the lock file says who holds it (a LockOwner). a waiter
+    # that finds the holder died, or its lock_lease ran out, puts right
+    # what it left of the account (and of the other accounts of its
+    # transfer) and takes the lock, the rest of the bank doesn't stop.
+    def lock_file(self, timeout=None):
+        if timeout is None:
+            timeout = self.get_config_float('lock_timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.trying = timeout == 0
+
+        backend = self.get_config('lock_backend')
+        start = time.time()
+        try:
+            if backend == 'flock':
+                self.__flock_lock_file(deadline)
+            else:
+                self.__create_lock_file(deadline)
+        finally:
+            observe('drovebank_lock_wait_seconds', (('backend', backend),), time.time() - start)
+        self.__follow_migration()
+        if self.get_config_bool('optimistic'):
+            self.__wait_optimistic()
+
+    # private
+    # an optimistic commit (account_util.py) holds a flock on the data
+    # file from its last look for our lock file until its rename is
+    # done. going through that flock once we hold the lock means what we
+    # read next is after its commit.
+    def __wait_optimistic(self):
+        if self.filename is None:
+            return
+        try:
+            fd = os.open(self.filename, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        finally:
+            os.close(fd)
+
+    # public
+    # takes the lock if it is free right now. returns False if it isn't.
+    def try_lock_file(self):
+        try:
+            self.lock_file(0)
+        except LockTimeout:
+            return False
+        return True
+
+    # private
+    # the lock was not had by the deadline. a try that fails isn't worth
+    # a warning.
+    def __lock_timeout(self):
+        if self.trying is False:
+            logging.warning("AW0098 timed out waiting for lock %s", self.lockfilename)
+        return LockTimeout("timed out waiting for lock %s" % self.lockfilename)
+
+    # public
+    # pushes the lease of the lock out to lock_lease seconds from now, for
+    # a holder that keeps a lock longer than that
+    def renew_lock(self):
+        self.lockfile.seek(0)
+        self.lockfile.truncate()
+        self.lockfile.write(self.__owner_line())
+        self.lockfile.flush()
+
+    # private
+    # the LockOwner line of this process for a lock taken now
+    def __owner_line(self):
+        now = time.time()
+        lease = self.get_config_float('lock_lease')
+        expires = ''
+        if lease is not None:
+            expires = "%.3f" % (now + lease)
+        return "%d,%s,%.3f,%s\n" % (os.getpid(), HOSTNAME, now, expires)
+
+    # private
+    # the lock file backend. the lock is held while the file exists.
+    def __create_lock_file(self, deadline):
+        poll = self.get_config_float('lock_poll_interval')
+        while True:
             try:
                 self.lockfile = open(self.lockfilename, 'wx')
-                loop = False
-            except IOError:
-                logging.debug("AW0069 lock file exists. sleep 1 sec")
-                time.sleep(1)
+                self.lockfile.write(self.__owner_line())
+                self.lockfile.flush()
+                return
+            except IOError as e:
+                if e.errno == errno.EEXIST and self.__break_stale_lock():
+                    continue
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    raise self.__lock_timeout()
+                wait = poll
+                if deadline is not None:
+                    wait = min(poll, deadline - now)
+                logging.debug("AW0069 lock file exists. sleep %s sec", wait)
+                time.sleep(wait)
+
+    # private
+    # the flock backend. the lock file is created if needed and locked,
+    # unlock_file removes it before letting go of the lock.
+    def __flock_lock_file(self, deadline):
+        while True:
+            created = True
+            try:
+                fd = os.open(self.lockfilename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                created = False
+                try:
+                    fd = os.open(self.lockfilename, os.O_RDWR)
+                except OSError as e:
+                    # released between the two opens
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+
+            try:
+                self.__flock(fd, deadline)
+            except:
+                os.close(fd)
+                raise
+
+            # the holder removes the lock file before it lets go so if
+            # the file we locked is gone (or replaced) start again
+            try:
+                live_ino = os.stat(self.lockfilename).st_ino
+            except OSError:
+                live_ino = None
+            if live_ino != os.fstat(fd).st_ino:
+                os.close(fd)
+                continue
+
+            # a lock file that was already there and still has an owner
+            # written in it was left by a holder that died. recovering
+            # removes it, so start again
+            if created is False and os.fstat(fd).st_size > 0:
+                try:
+                    recovered = self.__recover_stale(fd)
+                finally:
+                    os.close(fd)
+                if recovered is False:
+                    if deadline is not None and time.time() >= deadline:
+                        raise self.__lock_timeout()
+                    time.sleep(0.001)
+                continue
+
+            self.lockfile = os.fdopen(fd, 'w')
+            self.renew_lock()
+            return
+
+    # private
+    # takes the flock on fd, waiting until deadline (None is forever)
+    def __flock(self, fd, deadline):
+        if deadline is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        # block in the kernel and let an alarm break us out. signals only
+        # go to the main thread, the other threads have to poll.
+        if threading.current_thread().name == 'MainThread' and hasattr(signal, 'setitimer'):
+            def on_alarm(signum, frame):
+                raise LockTimeout("timed out waiting for lock %s" % self.lockfilename)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise self.__lock_timeout()
+            old_handler = signal.signal(signal.SIGALRM, on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, remaining)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except LockTimeout:
+                logging.warning("AW0164 timed out waiting for lock %s", self.lockfilename)
+                raise
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, old_handler)
+            return
+
+        wait = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            now = time.time()
+            if now >= deadline:
+                raise self.__lock_timeout()
+            time.sleep(min(wait, deadline - now))
+            wait = min(wait * 2, 0.05)
+
+    # private
+    # with the lock file backend, looks at the holder of the lock we
+    # are waiting for. if it is stale the accounts are recovered and the
+    # lock removed. returns True if it was (or the lock went away on its
+    # own), time to try again.
+    def __break_stale_lock(self):
+        try:
+            fd = os.open(self.lockfilename, os.O_RDONLY)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return True
+            raise
+        try:
+            if self.__stale(fd) is False:
+                return False
+            # one waiter recovers, the others wait on as before
+            if self.__take_stale(fd, self.lockfilename) is False:
+                return False
+            return self.__recover_stale(fd)
+        finally:
+            os.close(fd)
+
+    # private
+    # True if the lock file open on fd was left by a holder that is gone.
+    # flocked is True when we hold the flock of the file, with the flock
+    # backend a live holder would have it.
+    def __stale(self, fd, flocked=False):
+        os.lseek(fd, 0, os.SEEK_SET)
+        owner = parse_lock_owner(os.read(fd, 512))
+        if owner is None:
+            # made but the holder died before it wrote itself in, or it is
+            # writing right now
+            lease = self.get_config_float('lock_lease')
+            return lease is not None and time.time() - os.fstat(fd).st_mtime > lease
+        if flocked and self.get_config('lock_backend') == 'flock':
+            return True
+        return owner_is_stale(owner)
+
+    # private
+    # takes the flock of the lock file open on fd without waiting, that
+    # is the right to recover it. False if another waiter has it, the
+    # file was removed or isn't stale after all.
+    def __take_stale(self, fd, lockfile):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        try:
+            if os.stat(lockfile).st_ino != os.fstat(fd).st_ino:
+                return False
+        except OSError:
+            return False
+        return self.__stale(fd, True)
+
+    # private
+    # recovers the account of our lock file, open on fd with its flock
+    # held, the way recover.py would: an unfinished write is finished or
+    # undone, the history records of the commit are kept or voided, the
+    # summary is brought up to date and the lock file removed. a transfer
+    # also has the lock files of its other accounts, those are taken too.
+    # returns False if one of them is busy.
+    def __recover_stale(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        owner = parse_lock_owner(os.read(fd, 512))
+        logging.warning("AW0264 lock %s held by %s was left behind, recovering it", self.lockfilename,
+                        "process %s on %s" % (owner.pid, owner.host) if owner is not None else "nobody")
+        start = time.time()
+
+        catalog = RecoveryCatalog(self.dbdir).scan_files(self.get_lock_data_files(self.lockfilename))
+        key = catalog.key_for(self.lockfilename)
+        keys = set([key])
+        transids = [entry.transid for entry in catalog.get_intermediates(key)
+                    if entry.suffix in ('xtmp', 'xold')]
+        if len(transids) > 0:
+            # the other accounts of a transfer can be anywhere
+            catalog = RecoveryCatalog(self.dbdir).scan()
+            transfers = catalog.get_transfers()
+            while len(transids) > 0:
+                for other in transfers.get(transids.pop(), set()) - keys:
+                    keys.add(other)
+                    transids.extend([entry.transid for entry in catalog.get_intermediates(other)
+                                     if entry.suffix in ('xtmp', 'xold')])
+            catalog = catalog.restrict(keys)
+
+        fds = []
+        try:
+            locked = set(other for other, lockfile in catalog.get_locks())
+            for other in sorted(keys - locked):
+                # the transfer went on without the lock, a process is
+                # still at it or the files are from something else
+                logging.critical("AW0292 %s has no lock but is part of the transfer of %s, run recover.py",
+                                 other, self.lockfilename)
+                count('drovebank_stale_locks_total', (('result', 'left'),))
+                raise StaleLock("lock %s was held by a process that died, run recover.py"
+                                % self.lockfilename)
+            for other, lockfile in catalog.get_locks():
+                if lockfile == self.lockfilename:
+                    continue
+                try:
+                    other_fd = os.open(lockfile, os.O_RDONLY)
+                except OSError:
+                    return False
+                fds.append(other_fd)
+                if self.__take_stale(other_fd, lockfile) is False:
+                    logging.info("AW0305 lock %s of the same transfer is busy", lockfile)
+                    return False
+
+            # recover.py imports this module
+            from recover import Recover
+            Recover(self.dbdir).recover_locks(catalog)
+        finally:
+            for other_fd in fds:
+                os.close(other_fd)
+        count('drovebank_stale_locks_total', (('result', 'recovered'),))
+        logging.warning("AW0313 recovered %d locks of %s in %.3f seconds", len(catalog.get_locks()),
+                        self.lockfilename, time.time() - start)
+        return True
 
     # public
-    # unlocks file
+    # unlocks file. the file goes first, with flock a waiter that gets
+    # the lock checks the file is still there.
     def unlock_file(self):
-        self.lockfile.close()
         os.remove(self.lockfilename)
+        self.lockfile.close()
 
     # public
     # writes content to file but assumes caller handles
     # file locking
     def write_content(self, content):
+        # with the write ahead log the commit is a single append. the
+        # data file catches up at the next checkpoint.
+        if self.get_storage() == 'wal':
+            get_wal(self.dbdir).commit([(self.filename, content)])
+            return
+        # with the binary store an account is a record written in place
+        if self.__in_binary_store(self.filename):
+            get_binary_store(self.dbdir).commit([(self.filename, content)])
+            return
+
         #step 1 copy old file to tmp file
+        start = time.time()
         shutil.copy2(self.filename, self.tmpfile)
+        start = observe_step('copy', start)
 
         # step 2 write new data to tmpfile
         f = open(self.tmpfile, 'w')
@@ -102,17 +549,59 @@ class AtomicWrite(DroveBankConstants):
         # don't forget to flush
         f.flush()
         f.close()
+        start = observe_step('write', start)
 
         #step 3 move orig file to old file
         shutil.move(self.filename, self.oldfile)
 
         # step 4 rename tmp file to orig file
         shutil.move(self.tmpfile, self.filename)
+        start = observe_step('rename', start)
 
         # step 5 we cant delete the old file now.
         # if it fails it will get cleaned up on recovery
         os.remove(self.oldfile)
+        observe_step('unlink', start)
+
+
+    # public
+    # reads the content of a data file (the first line). with the write
+    # ahead log the latest content may not have reached the file yet.
+    def read_content(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        if self.__in_binary_store(filename):
+            content = get_binary_store(self.dbdir).lookup(filename)
+            if content is None:
+                raise IOError(errno.ENOENT, "no such account", filename)
+            return content
+        if self.get_storage() == 'wal':
+            content = get_wal(self.dbdir).lookup(filename)
+            if content is not None:
+                return content.split('\n')[0] + '\n'
+        f = open(filename, 'r')
+        content = f.readline()
+        f.close()
+        return content
 
+    # public
+    # True if the data file exists. in the middle of a transfer (between
+    # steps 3 and 4) the file is gone for a moment, but its lock file is
+    # there.
+    def data_file_exists(self, filename):
+        if self.__in_binary_store(filename):
+            return get_binary_store(self.dbdir).exists(filename)
+        if os.path.exists(filename):
+            return True
+        if os.path.exists(self.get_lock_path(filename)):
+            return True
+        # the commit may have finished between the two looks
+        return os.path.exists(filename)
+
+    # private
+    # True if filename is an account kept in the binary store
+    def __in_binary_store(self, filename):
+        return self.get_storage() == 'binary' and get_binary_store(self.dbdir).handles(filename)
 
     #------------------------------------------------------------------------------
     # return a list of all matching files
@@ -124,6 +613,15 @@ class AtomicWrite(DroveBankConstants):
                     result.append( os.path.join( subdir, fn ))
         return result
 
+    # return a list of the matching files in path, not its sub dirs. with
+    # the sharded layout 01_*.txt.tmp matches in every shard.
+    def ffind_dir( self, pattern, path ):
+        try:
+            names = os.listdir( path )
+        except OSError:
+            return []
+        return [os.path.join( path, fn ) for fn in fnmatch.filter( names, pattern )]
+
     # if lock file is there and only self.filename then we either crashed before
     # step 1 or after step 5. Either way just delete the lock file and move on.
     #
@@ -134,39 +632,43 @@ class AtomicWrite(DroveBankConstants):
     # - if self.filename is present and tmp is present but not old we crashed before
     # step 3. remove tmp file. Transaction never happened.
     #
-    def recover_write(self):
+    # the files are looked up in catalog, a RecoveryCatalog of the dbdir.
+    # without one the dbdir is catalogued first. keep_locks leaves the
+    # lock files to the caller.
+    def recover_write(self, catalog=None, keep_locks=False):
+        if catalog is None:
+            catalog = RecoveryCatalog(self.dbdir).scan()
+
         # first lets look for lock files.
-        srchp = "*.%s" % self.locksuffix
-        for fn in self.ffind(srchp, self.dbdir):
+        for key, fn in catalog.get_locks():
+            if os.path.exists(fn) is False:
+                # an earlier step of the recovery cleaned it up
+                continue
             logging.info("AW0141:RECOVER found lock file %s", fn);
-            basename = fn[:-5]
-            # this assumes the suffix is txt probably should make
-            # this configurable
-            filename = basename + ".txt"
-
-            # for unit test has no affect on logic
-            self.filename = filename
-
-            # find the files
-            basename = os.path.basename(filename)
-            prefix, suffix = os.path.splitext(basename)
+            filename = self.get_lock_data_files(fn)[0]
 
+            # find the files. they sit next to the data file they were
+            # made from, which may still be flat while the layout is
+            # migrating
             tmpfile = None
-            tmpfiletest = prefix + "_*" + suffix + "." + self.tmpsuffix
-            for tfile in  self.ffind(tmpfiletest, self.dbdir):
-                logging.info("AW0134:RECOVER found tmpfile %s", tfile)
-                tmpfile = tfile
+            oldfile = None
+            for entry in catalog.get_intermediates(key, self.tmpsuffix):
+                logging.info("AW0134:RECOVER found tmpfile %s", entry.path)
+                tmpfile = entry.path
+                filename = entry.datafile
 
             # if we didn't find any tmp files look for old files
             # else use the matching old file
-            oldfile = None
             if tmpfile is None:
-                oldfiletest = prefix + "_*" + suffix + "." + self.oldsuffix
-                for ofile in self.ffind(oldfiletest, self.dbdir):
-                    logging.info("AW0139:RECOVER found oldfile %s", ofile)
-                    oldfile = ofile
+                for entry in catalog.get_intermediates(key, self.oldsuffix):
+                    logging.info("AW0139:RECOVER found oldfile %s", entry.path)
+                    oldfile = entry.path
+                    filename = entry.datafile
             else:
-                oldfile = tmpfile.replace(self.tmpsuffix, self.oldsuffix)
+                oldfile = tmpfile[:-len(self.tmpsuffix)] + self.oldsuffix
+
+            # for unit test has no affect on logic
+            self.filename = filename
 
             oldexists  = False
             if oldfile is not None and os.path.exists(oldfile):
@@ -201,8 +703,9 @@ class AtomicWrite(DroveBankConstants):
                 logging.info("AW0147:RECOVER removing tmp file %s", tmpfile)
                 os.remove(tmpfile)
             # delete the lock file
-            logging.info("AW0150:RECOVER removing lock file %s", fn)
-            os.remove(fn)
+            if keep_locks is False:
+                logging.info("AW0150:RECOVER removing lock file %s", fn)
+                os.remove(fn)
 
     # public
     # writes content to file with locks.
@@ -214,12 +717,28 @@ class AtomicWrite(DroveBankConstants):
     # public
     # sets the filename and calls make_tmp_filenames
     def set_file_name(self, filename):
-        if os.path.exists(filename) == False:
+        if self.data_file_exists(filename) == False:
             logging.critical("AW0086 input file %s doesn't exist!", filename)
             sys.exit(-1)
         self.filename = filename
         self.make_tmp_filenames()
 
+    # public
+    # points the object at another data file, for a pooled AtomicWrite
+    # (account_session.py). unlike set_file_name nothing is looked at on
+    # disk, the caller knows its paths. lockfilename is worked out from
+    # filename if not given.
+    def reset(self, filename, lockfilename=None, transid=None, tmpsuffix="tmp", oldsuffix="old"):
+        self.transid = transid
+        self.tmpsuffix = tmpsuffix
+        self.oldsuffix = oldsuffix
+        self.filename = filename
+        self.id = self.id_generator()
+        self.__make_tmp_paths()
+        if lockfilename is None:
+            lockfilename = self.get_lock_path(filename)
+        self.lockfilename = lockfilename
+
     def set_dbdir(self, dbdir):
         self.dbdir = dbdir
 
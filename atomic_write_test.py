@@ -5,7 +5,8 @@ from threading import Thread
 import time
 import shutil
 
-from atomic_write import AtomicWrite
+from atomic_write import AtomicWrite, LockTimeout, LockOwner, parse_lock_owner, HOSTNAME
+from drove_bank_constants import write_config
 
 class AtomicWrite_Test(unittest.TestCase):
 
@@ -322,5 +323,172 @@ class AtomicWrite_Test(unittest.TestCase):
         self.assertEquals(file_content, new_content)
         os.remove(filename)
 
+# the lock backends are picked in the dbdir config so these run in a
+# directory of their own
+class AtomicWriteLock_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'lock_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        self.filename = os.path.join(self.dir, '100.txt')
+        f = open(self.filename, 'w')
+        f.write('some stuff\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def worker(self, hold):
+        aw = AtomicWrite(self.dir, self.filename)
+        aw.lock_file()
+        time.sleep(hold)
+        aw.unlock_file()
+
+    # the waiter wakes up as soon as the lock is let go, not on the
+    # next poll
+    def test_flock_wakeup(self):
+        write_config(self.dir, {'lock_backend': 'flock'})
+        t = Thread(target=self.worker, args=(0.5,))
+        start = time.time()
+        t.start()
+        time.sleep(0.1)
+
+        aw = AtomicWrite(self.dir, self.filename)
+        aw.lock_file()
+        elapsed = time.time() - start
+        aw.unlock_file()
+        t.join()
+        self.assertTrue(elapsed >= 0.5)
+        self.assertTrue(elapsed < 0.9)
+        self.assertFalse(os.path.exists(aw.get_lockfilename()))
+
+    def test_flock_timeout(self):
+        write_config(self.dir, {'lock_backend': 'flock', 'lock_timeout': '0.2'})
+        t = Thread(target=self.worker, args=(1.0,))
+        t.start()
+        time.sleep(0.1)
+
+        aw = AtomicWrite(self.dir, self.filename)
+        start = time.time()
+        self.assertRaises(LockTimeout, aw.lock_file)
+        elapsed = time.time() - start
+        t.join()
+        self.assertTrue(elapsed < 0.5)
+
+        # the explicit timeout wins over the config
+        aw.lock_file(timeout=5)
+        aw.unlock_file()
+
+    def test_lockfile_timeout(self):
+        write_config(self.dir, {'lock_timeout': '0.3', 'lock_poll_interval': '0.05'})
+        aw = AtomicWrite(self.dir, self.filename)
+        aw.lock_file()
+        other = AtomicWrite(self.dir, self.filename)
+        start = time.time()
+        self.assertRaises(LockTimeout, other.lock_file)
+        self.assertTrue(time.time() - start < 1.0)
+        aw.unlock_file()
+
+    # lock in a child process and die without unlocking, after work
+    # (on the AtomicWrite) if given
+    def __die_holding_lock(self, work=None):
+        pid = os.fork()
+        if pid == 0:
+            aw = AtomicWrite(self.dir, self.filename)
+            aw.lock_file()
+            if work is not None:
+                work(aw)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    def __write_lock(self, owner):
+        f = open(os.path.join(self.dir, '100.lock'), 'w')
+        f.write("%d,%s,%.3f,%s\n" % owner)
+        f.close()
+
+    def test_lock_owner(self):
+        write_config(self.dir, {'lock_lease': '10'})
+        aw = AtomicWrite(self.dir, self.filename)
+        start = time.time()
+        aw.lock_file()
+        owner = parse_lock_owner(open(aw.get_lockfilename()).read())
+        self.assertEqual((owner.pid, owner.host), (os.getpid(), HOSTNAME))
+        self.assertTrue(start - 1 < owner.start < time.time() + 0.001)
+        self.assertAlmostEqual(owner.expires, owner.start + 10, 2)
+        aw.unlock_file()
+        self.assertEqual(parse_lock_owner("12\n"), LockOwner(12, None, None, None))
+        self.assertEqual(parse_lock_owner("12,box,1.5,\n"), LockOwner(12, 'box', 1.5, None))
+        self.assertEqual(parse_lock_owner(""), None)
+        self.assertEqual(parse_lock_owner("12,bo"), None)
+
+    # a holder somewhere else can't be looked at, only its lease says
+    # when it is gone
+    def test_lease(self):
+        write_config(self.dir, {'lock_timeout': '0.3', 'lock_poll_interval': '0.05'})
+        aw = AtomicWrite(self.dir, self.filename)
+        # no lease by default, a live holder keeps its lock
+        aw.lock_file()
+        self.assertEqual(parse_lock_owner(open(aw.get_lockfilename()).read()).expires, None)
+        aw.unlock_file()
+
+        write_config(self.dir, {'lock_timeout': '0.3', 'lock_poll_interval': '0.05', 'lock_lease': '30'})
+        now = time.time()
+        self.__write_lock((os.getpid(), 'elsewhere', now, '%.3f' % (now + 60)))
+        self.assertRaises(LockTimeout, aw.lock_file)
+        self.__write_lock((os.getpid(), 'elsewhere', now - 60, '%.3f' % (now - 1)))
+        aw.lock_file()
+        aw.unlock_file()
+
+        # a live holder here past its lease is taken over too
+        self.__write_lock((os.getpid(), HOSTNAME, now - 60, '%.3f' % (now - 1)))
+        aw.lock_file()
+        aw.renew_lock()
+        self.assertTrue(parse_lock_owner(open(aw.get_lockfilename()).read()).expires > now + 29)
+        aw.unlock_file()
+
+    # the waiter finishes the write the holder died in and goes on
+    def test_lockfile_dead_holder(self):
+        write_config(self.dir, {'lock_timeout': '5', 'lock_poll_interval': '0.05'})
+        def half_write(aw):
+            # died between steps 3 and 4
+            shutil.copy2(aw.filename, aw.get_tmpfile())
+            f = open(aw.get_tmpfile(), 'w')
+            f.write('new stuff\n')
+            f.close()
+            shutil.move(aw.filename, aw.get_oldfile())
+        self.__die_holding_lock(half_write)
+        self.assertFalse(os.path.exists(self.filename))
+
+        aw = AtomicWrite(self.dir)
+        aw.filename = self.filename
+        aw.make_tmp_filenames()
+        start = time.time()
+        aw.lock_file()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(open(self.filename).read(), 'new stuff\n')
+        aw.unlock_file()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['100.txt', 'drovebank.cfg'])
+
+    def test_flock_dead_holder(self):
+        write_config(self.dir, {'lock_backend': 'flock', 'lock_timeout': '1'})
+        self.__die_holding_lock()
+        aw = AtomicWrite(self.dir, self.filename)
+        self.assertTrue(os.path.exists(aw.get_lockfilename()))
+
+        # nothing was half written so the lock can be taken straight away
+        aw.lock_file()
+        aw.unlock_file()
+
+        # with a tmp file left behind the write is undone first
+        self.__die_holding_lock()
+        shutil.copy2(self.filename, aw.get_tmpfile())
+        aw.lock_file()
+        self.assertFalse(os.path.exists(aw.get_tmpfile()))
+        self.assertEqual(open(self.filename).read(), 'some stuff\n')
+        aw.unlock_file()
+        self.assertFalse(os.path.exists(aw.get_lockfilename()))
+
 if __name__ == '__main__':
     unittest.main()
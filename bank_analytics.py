@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of AccountUtil
+#
+# bank wide numbers over every balance: count, total, mean, min, max,
+# percentiles, a histogram and how many accounts are negative or zero.
+#
+# the balances are loaded into one array first, from the fastest place
+# that has them all:
+#   - storage = binary: accounts.dat
+#   - summary = on:     summary.dat, as of one commit (a snapshot)
+#   - otherwise:        the account files
+# the two record files are read in chunks of CHUNK_RECORDS records and
+# the account files in runs of CHUNK_IDS ids, the chunks are spread over
+# a pool of threads (the reads let go of the GIL) and put back together
+# in id order.
+#
+# with numpy the array is a numpy array and every number is one
+# vectorized call. without it the array is an array.array of doubles and
+# the numbers come from a sort and a pass over it.
+#
+import os
+import time
+import math
+import array
+import struct
+import logging
+import argparse
+from multiprocessing.pool import ThreadPool
+
+from account_util import AccountUtil
+import account_summary
+import binary_store
+
+# numpy is optional, everything works without it, only slower
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# records read by one worker at a time from a record file
+CHUNK_RECORDS = 65536
+# account files read by one worker at a time
+CHUNK_IDS = 1024
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+# where the balance is in the records of a file
+#   header size, record size, offset of the flags byte, offset and
+#   struct format of the balance, what the balance is divided by, offset
+#   of the commit sequence number (None if the records have none)
+SUMMARY_LAYOUT = (account_summary.HEADER_SIZE, account_summary.RECORD_SIZE, 0, 16, '<d', 1.0,
+                  account_summary.CSN_OFFSET)
+BINARY_LAYOUT = (binary_store.HEADER_SIZE, binary_store.RECORD_SIZE, 0, 16, '<d', 1.0, None)
+
+class BankAnalytics(AccountUtil):
+
+    def __init__(self, dir=None, workers=4, use_numpy=True):
+        AccountUtil.__init__(self, dir)
+        self.workers = workers
+        self.numpy = numpy if use_numpy else None
+        self.source = None
+
+    # public
+    # the balances of every account in id order, a numpy array or an
+    # array.array('d'). self.source says where they were read from.
+    def load_balances(self):
+        pool = ThreadPool(self.workers)
+        try:
+            if self.get_storage() == 'binary':
+                self.source = binary_store.STORE_FILENAME
+                # opening the store rewrites one from before the balances
+                # were doubles
+                binary_store.get_binary_store(self.dbdir).get_stats()
+                return self.__read_record_file(pool, os.path.join(self.dbdir, self.source),
+                                               BINARY_LAYOUT)
+            summary = self.get_account_summary()
+            if summary is not None:
+                self.source = account_summary.SUMMARY_FILENAME
+                # commits go on while we read, the snapshot has the
+                # accounts they change as they were
+                snapshot = summary.snapshot()
+                try:
+                    return self.__read_record_file(pool, os.path.join(self.dbdir, self.source),
+                                                   SUMMARY_LAYOUT, snapshot)
+                finally:
+                    if snapshot is not None:
+                        snapshot.close()
+            self.source = 'account files'
+            return self.__read_account_files(pool)
+        finally:
+            pool.close()
+            pool.join()
+
+    # public
+    # the report as a dict. percentiles and the histogram are lists of
+    # (percentile, balance) and (low, high, count), the last bin takes
+    # the max too.
+    def report(self, bins=10, percentiles=PERCENTILES):
+        start = time.time()
+        balances = self.load_balances()
+        load_seconds = time.time() - start
+        if self.numpy is not None:
+            report = self.__numpy_report(balances, bins, percentiles)
+        else:
+            report = self.__array_report(balances, bins, percentiles)
+        report['source'] = self.source
+        report['numpy'] = self.numpy is not None
+        report['load_seconds'] = load_seconds
+        report['seconds'] = time.time() - start
+        logging.info("BA0095 report of %d accounts from %s in %.3f seconds",
+                     report['count'], self.source, report['seconds'])
+        return report
+
+    # public
+    # the report as lines of text
+    def format_report(self, report):
+        lines = ["Accounts: %d (from %s)" % (report['count'], report['source'])]
+        if report['count'] == 0:
+            return lines
+        lines.append("Total:    %12.2f" % report['total'])
+        lines.append("Mean:     %12.2f" % report['mean'])
+        lines.append("Min:      %12.2f" % report['min'])
+        lines.append("Max:      %12.2f" % report['max'])
+        lines.append("Negative: %d" % report['negative'])
+        lines.append("Zero:     %d" % report['zero'])
+        lines.append("Percentiles")
+        for p, value in report['percentiles']:
+            lines.append("\tp%-3s %12.2f" % (p, value))
+        lines.append("Histogram")
+        width = max([count for low, high, count in report['histogram']])
+        for low, high, count in report['histogram']:
+            bar = '#' * int(round(40.0 * count / width)) if width > 0 else ''
+            lines.append("\t%12.2f - %12.2f %10d %s" % (low, high, count, bar))
+        lines.append("%.3f seconds (%.3f loading)" % (report['seconds'], report['load_seconds']))
+        return lines
+
+    # private
+    # the balances of the used records of a record file
+    # with a snapshot the records of a later commit are left out and the
+    # snapshot's versions of them put in
+    def __read_record_file(self, pool, filename, layout, snapshot=None):
+        header_size, record_size = layout[0], layout[1]
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return self.__empty()
+        records = max(size - header_size, 0) // record_size
+        csn = snapshot.csn if snapshot is not None else None
+        chunks = [(filename, layout, first, min(CHUNK_RECORDS, records - first), csn)
+                  for first in range(0, records, CHUNK_RECORDS)]
+        parts = pool.map(self.__read_record_chunk, chunks)
+        balances = [part[0] for part in parts]
+        newer = []
+        for part in parts:
+            newer.extend(part[1])
+        if len(newer) > 0:
+            before = [snapshot.version(ac_id) for ac_id in newer]
+            balances.append(array.array('d', [record.balance for record in before if record is not None]))
+        return self.__join(balances)
+
+    # the balances of a chunk and the ids of the records in it with a csn
+    # past csn
+    def __read_record_chunk(self, chunk):
+        filename, layout, first, count, csn = chunk
+        header_size, record_size, flags_offset, balance_offset, balance_format, divisor, csn_offset = layout
+        f = open(filename, 'rb')
+        try:
+            f.seek(header_size + first * record_size)
+            data = f.read(count * record_size)
+        finally:
+            f.close()
+        count = len(data) // record_size
+
+        if self.numpy is not None:
+            np = self.numpy
+            names, formats, offsets = ['flags', 'balance'], ['u1', balance_format], [flags_offset, balance_offset]
+            if csn is not None:
+                names.append('csn')
+                formats.append('<u8')
+                offsets.append(csn_offset)
+            dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                              'itemsize': record_size})
+            recs = np.frombuffer(data, dtype, count)
+            used = (recs['flags'] & 1) != 0
+            newer = []
+            if csn is not None:
+                later = used & (recs['csn'] > csn)
+                newer = (np.nonzero(later)[0] + first).tolist()
+                used &= ~later
+            balances = recs['balance'][used].astype('f8')
+            if divisor != 1.0:
+                balances /= divisor
+            return balances, newer
+
+        balances = array.array('d')
+        newer = []
+        fmt = struct.Struct(balance_format)
+        csn_fmt = struct.Struct('<Q')
+        for i in range(count):
+            offset = i * record_size
+            if ord(data[offset + flags_offset]) & 1 == 0:
+                continue
+            if csn is not None and csn_fmt.unpack_from(data, offset + csn_offset)[0] > csn:
+                newer.append(first + i)
+                continue
+            balances.append(fmt.unpack_from(data, offset + balance_offset)[0] / divisor)
+        return balances, newer
+
+    # private
+    # the balances of the account files, CHUNK_IDS ids to a worker
+    def __read_account_files(self, pool):
+        last_id = self.get_last_account_id()
+        if last_id is None:
+            # no index, all we can do is walk the dirs
+            balances = array.array('d', [r.balance for r in self.iter_account_files()])
+            return self.__join([balances])
+        chunks = [(first, min(first + CHUNK_IDS, last_id + 1))
+                  for first in range(0, last_id + 1, CHUNK_IDS)]
+        return self.__join(pool.map(self.__read_account_chunk, chunks))
+
+    def __read_account_chunk(self, chunk):
+        balances = array.array('d')
+        for ac_id in range(chunk[0], chunk[1]):
+            try:
+                balances.append(self.read_account_file(self.get_account_filename(ac_id)).balance)
+            except (IOError, OSError):
+                continue
+        if self.numpy is not None:
+            return self.numpy.frombuffer(balances, 'f8') if len(balances) > 0 else self.__empty()
+        return balances
+
+    def __join(self, parts):
+        if self.numpy is not None:
+            parts = [self.numpy.asarray(part, 'f8') for part in parts]
+            if len(parts) == 0:
+                return self.__empty()
+            return self.numpy.concatenate(parts)
+        balances = array.array('d')
+        for part in parts:
+            balances.extend(part)
+        return balances
+
+    def __empty(self):
+        if self.numpy is not None:
+            return self.numpy.zeros(0, 'f8')
+        return array.array('d')
+
+    # private
+    # the numbers with numpy
+    def __numpy_report(self, balances, bins, percentiles):
+        np = self.numpy
+        report = self.__empty_report(len(balances))
+        if len(balances) == 0:
+            return report
+        report['total'] = float(balances.sum())
+        report['mean'] = report['total'] / len(balances)
+        report['min'] = float(balances.min())
+        report['max'] = float(balances.max())
+        report['negative'] = int(np.count_nonzero(balances < 0))
+        report['zero'] = int(np.count_nonzero(balances == 0))
+        values = np.percentile(balances, percentiles)
+        report['percentiles'] = [(p, float(v)) for p, v in zip(percentiles, values)]
+        counts, edges = np.histogram(balances, bins)
+        report['histogram'] = [(float(edges[i]), float(edges[i + 1]), int(counts[i]))
+                               for i in range(len(counts))]
+        return report
+
+    # private
+    # the same numbers from a sorted array.array
+    def __array_report(self, balances, bins, percentiles):
+        report = self.__empty_report(len(balances))
+        n = len(balances)
+        if n == 0:
+            return report
+        ordered = array.array('d', sorted(balances))
+        report['total'] = math.fsum(ordered)
+        report['mean'] = report['total'] / n
+        report['min'] = ordered[0]
+        report['max'] = ordered[-1]
+        report['negative'] = self.__count_below(ordered, 0.0, False)
+        report['zero'] = self.__count_below(ordered, 0.0, True) - report['negative']
+
+        # linear between the closest ranks, what numpy.percentile does
+        result = []
+        for p in percentiles:
+            rank = (n - 1) * p / 100.0
+            low = int(math.floor(rank))
+            high = min(low + 1, n - 1)
+            result.append((p, ordered[low] + (ordered[high] - ordered[low]) * (rank - low)))
+        report['percentiles'] = result
+
+        # equal width bins from min to max. the edges of every bin are
+        # counted with the sorted array so no balance is looked at twice
+        low, high = ordered[0], ordered[-1]
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        width = (high - low) / bins
+        histogram = []
+        start = 0
+        for i in range(bins):
+            edge_low = low + i * width
+            edge_high = high if i == bins - 1 else low + (i + 1) * width
+            end = n if i == bins - 1 else self.__count_below(ordered, edge_high, False)
+            histogram.append((edge_low, edge_high, end - start))
+            start = end
+        report['histogram'] = histogram
+        return report
+
+    # private
+    # how many of the sorted balances are below value (or equal to it)
+    def __count_below(self, ordered, value, inclusive):
+        lo, hi = 0, len(ordered)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ordered[mid] < value or (inclusive and ordered[mid] == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __empty_report(self, count):
+        return {'count': count, 'total': 0.0, 'mean': None, 'min': None, 'max': None,
+                'negative': 0, 'zero': 0, 'percentiles': [], 'histogram': []}
+
+def main():
+  parser = argparse.ArgumentParser(description='bank wide report over every balance')
+  parser.add_argument('-d', '--dir', help='data directory', default=None)
+  parser.add_argument('-b', '--bins', help='histogram bins', type=int, default=10)
+  parser.add_argument('-w', '--workers', help='reader threads', type=int, default=4)
+  parser.add_argument('--no-numpy', help="don't use numpy even if it is there", action='store_true')
+  args = parser.parse_args()
+  analytics = BankAnalytics(args.dir, args.workers, args.no_numpy is False)
+  for line in analytics.format_report(analytics.report(args.bins)):
+    print line
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for BankAnalytics
+#
+import unittest
+import os
+import shutil
+
+import bank_analytics
+from bank_analytics import BankAnalytics
+from account_create import AccountCreate
+from drove_bank_constants import write_config, clear_config_cache
+
+BALANCES = [0.0, 10.0, 20.0, 30.0, 40.0, 0.0, 100.0, 55.5]
+
+class BankAnalytics_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'analytics_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __create(self):
+        ac = AccountCreate(self.dir)
+        ac.create_accounts([('First', 'Last', balance) for balance in BALANCES])
+
+    def __check(self, report):
+        self.assertEqual(report['count'], len(BALANCES))
+        self.assertEqual(report['total'], 255.5)
+        self.assertEqual(report['min'], 0.0)
+        self.assertEqual(report['max'], 100.0)
+        self.assertEqual(report['zero'], 2)
+        self.assertEqual(report['negative'], 0)
+        percentiles = dict(report['percentiles'])
+        # sorted: 0 0 10 20 30 40 55.5 100, p50 is between 20 and 30
+        self.assertEqual(percentiles[50], 25.0)
+        self.assertEqual(percentiles[1], 0.0)
+        self.assertAlmostEqual(percentiles[99], 96.885)
+        histogram = report['histogram']
+        self.assertEqual(len(histogram), 10)
+        self.assertEqual([count for low, high, count in histogram], [2, 1, 1, 1, 1, 1, 0, 0, 0, 1])
+        self.assertEqual(histogram[-1][1], 100.0)
+
+    def test_from_files(self):
+        write_config(self.dir, {'summary': 'off'})
+        self.__create()
+        analytics = BankAnalytics(self.dir, use_numpy=False)
+        report = analytics.report()
+        self.assertEqual(report['source'], 'account files')
+        self.__check(report)
+        lines = analytics.format_report(report)
+        self.assertEqual(lines[0], 'Accounts: 8 (from account files)')
+        self.assertTrue('Total:          255.50' in lines)
+
+    def test_from_summary(self):
+        self.__create()
+        # a negative balance only an old dbdir can have
+        f = open(os.path.join(self.dir, '70.txt'), 'w')
+        f.write('First,Last,-5.0\n')
+        f.close()
+        analytics = BankAnalytics(self.dir, use_numpy=False)
+        analytics.get_account_summary().rebuild(analytics.iter_account_files)
+        report = analytics.report()
+        self.assertEqual(report['source'], 'summary.dat')
+        self.assertEqual(report['negative'], 1)
+        self.assertEqual(report['zero'], 1)
+        self.assertEqual(report['min'], -5.0)
+
+    def test_from_binary_store(self):
+        write_config(self.dir, {'storage': 'binary'})
+        self.__create()
+        report = BankAnalytics(self.dir, use_numpy=False).report()
+        self.assertEqual(report['source'], 'accounts.dat')
+        self.__check(report)
+
+    def test_empty_bank(self):
+        analytics = BankAnalytics(self.dir, use_numpy=False)
+        report = analytics.report()
+        self.assertEqual(report['count'], 0)
+        self.assertEqual(analytics.format_report(report), ['Accounts: 0 (from summary.dat)'])
+
+    @unittest.skipIf(bank_analytics.numpy is None, "numpy isn't installed")
+    def test_numpy_matches(self):
+        self.__create()
+        report = BankAnalytics(self.dir).report()
+        self.assertTrue(report['numpy'])
+        self.__check(report)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of DroveBankConstants
+#
+# the client side of bank_server.py. it has the account calls drovebank.py
+# makes (create_account, get_account_info, deposit, withdraw,
+# transfer_money, list_accounts, get_bank_totals) with the same return
+# values, -1 or False and get_error_string on an error, but every call is
+# one request to the server instead of work on the files.
+#
+# a request is a JSON list on a line, the answer a JSON object on a line,
+# see bank_server.py.
+#
+import json
+import socket
+import logging
+
+from drove_bank_constants import DroveBankConstants
+from account_util import Account, AccountRecord
+from account_summary import SummaryTotals
+from account_history import HistoryRecord
+
+# the server is gone or said something we don't understand
+class ServerError(Exception):
+    pass
+
+# host:port for TCP, anything else is the path of a unix socket
+def parse_address(address):
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+class BankClient(DroveBankConstants):
+
+    def __init__(self, address, timeout=None):
+        DroveBankConstants.__init__(self)
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+
+    # public
+    # sends one request and returns the answer, a dict with ok and result
+    # or error. raises ServerError if the server can't be reached.
+    def call(self, op, *args):
+        try:
+            if self.sock is None:
+                self.__connect()
+            self.sock.sendall(json.dumps([op] + list(args)) + '\n')
+            line = self.rfile.readline()
+        except (socket.error, IOError) as e:
+            self.close()
+            raise ServerError("lost the server at %s: %s" % (self.address, e))
+        if line == '':
+            self.close()
+            raise ServerError("the server at %s closed the connection" % (self.address,))
+        try:
+            return json.loads(line)
+        except ValueError:
+            self.close()
+            raise ServerError("bad answer from the server: %r" % line)
+
+    # public
+    # returns the new account id or -1 on error
+    def create_account(self, fname, lname, starting_balance=0.0):
+        self.clear_errors()
+        return self.__result(self.call('create', fname, lname, float(starting_balance)), -1)
+
+    # public
+    # returns an Account or None on error
+    def get_account_info(self, account_id):
+        self.clear_errors()
+        result = self.__result(self.call('get', account_id), None)
+        if result is None:
+            return None
+        return Account(result['fname'], result['lname'], result['balance'])
+
+    # public
+    # returns the balance or -1 on error
+    def deposit(self, account_id, amount):
+        self.clear_errors()
+        return self.__result(self.call('deposit', account_id, amount), -1)
+
+    # public
+    # returns the balance or -1 on error
+    def withdraw(self, account_id, amount):
+        self.clear_errors()
+        return self.__result(self.call('withdraw', account_id, amount), -1)
+
+    # public
+    # returns True on success False on failure
+    def transfer_money(self, from_id, to_id, amount):
+        self.clear_errors()
+        return self.__result(self.call('transfer', from_id, to_id, amount), False) is not False
+
+    # public
+    # one page of AccountRecords and the cursor of the next page
+    def list_accounts(self, cursor=None, page_size=20):
+        result = self.__result(self.call('list', cursor, page_size), None)
+        if result is None:
+            return [], None
+        records, next_cursor = result
+        return [AccountRecord(*record) for record in records], next_cursor
+
+    # public
+    # the number of accounts and the money in the bank
+    def get_bank_totals(self):
+        result = self.__result(self.call('totals'), None)
+        if result is None:
+            return SummaryTotals(0, 0.0)
+        return SummaryTotals(*result)
+
+    # public
+    # the BankAnalytics report of the server's dbdir
+    def report(self, bins=10):
+        return self.__result(self.call('report', bins), None)
+
+    # public
+    # the HistoryRecords of an account
+    def query_history(self, account_id, start=None, end=None):
+        result = self.__result(self.call('history', account_id, start, end), None)
+        if result is None:
+            return []
+        return [HistoryRecord(*record) for record in result]
+
+    # public
+    # the server's metrics in the Prometheus text format
+    def get_metrics(self):
+        return self.__result(self.call('metrics'), None)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.rfile.close()
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.rfile = None
+
+    def __connect(self):
+        if isinstance(self.address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+
+    # private
+    # the result of an answer, or failed after adding the error
+    def __result(self, response, failed):
+        if response.get('ok'):
+            return response.get('result')
+        logging.warning("BC0139 server error: %s", response.get('error'))
+        self.add_error(response.get('error'))
+        return failed
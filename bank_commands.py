@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# runs account commands from lines of text, drovebank.py --batch. one
+# process does every line on the same AccountActions and AccountCreate
+# (or BankClient) instead of a drovebank.py run per operation.
+#
+#   deposit ID AMOUNT
+#   withdraw ID AMOUNT
+#   transfer FROM_ID TO_ID AMOUNT
+#   create FNAME LNAME BALANCE
+#   get ID
+#   list                            a result for every account
+#
+# blank lines and # comments are skipped, a name with spaces is quoted.
+# the results go out in the order of the commands, a JSON line each
+#   {"line": 3, "command": "deposit", "ok": true, "result": 105.0}
+#   {"line": 4, "command": "withdraw", "ok": false, "error": "..."}
+# or tab separated: line, command, ok and the result fields or line,
+# command, error and the message.
+#
+# with pipeline a second thread reads and checks the lines, up to
+# PIPELINE_DEPTH of them ahead of the one being committed. that an
+# account exists is left to the commit, a line before it can create it.
+#
+import json
+import shlex
+import logging
+import threading
+import Queue
+from collections import namedtuple
+
+from atomic_write import LockError
+
+# a parsed line. error is set if it is bad, then args is None
+Command = namedtuple('Command', 'line name args error')
+
+# command -> the types of its args
+COMMANDS = {
+    'deposit': (int, float),
+    'withdraw': (int, float),
+    'transfer': (int, int, float),
+    'create': (str, str, float),
+    'get': (int,),
+    'list': (),
+}
+
+FORMATS = ('jsonl', 'tsv')
+
+# commands read ahead with pipeline
+PIPELINE_DEPTH = 64
+
+# accounts asked for at a time by list
+LIST_PAGE = 1000
+
+class BatchCommands(object):
+
+    def __init__(self, bank, creator, out, fmt='jsonl'):
+        self.bank = bank
+        self.creator = creator
+        self.out = out
+        self.fmt = fmt
+        self.ok = 0
+        self.failed = 0
+        self.handlers = {'deposit': self.__deposit, 'withdraw': self.__withdraw,
+                         'transfer': self.__transfer, 'create': self.__create,
+                         'get': self.__get, 'list': self.__list}
+
+    # public
+    # runs the commands of lines, an iterable of text lines. returns the
+    # number of commands that worked and that failed
+    def run(self, lines, pipeline=False):
+        if pipeline:
+            commands = self.__read_ahead(lines)
+        else:
+            commands = (self.parse(number, line) for number, line in enumerate(lines, 1))
+        for command in commands:
+            if command is None:
+                continue
+            self.__execute(command)
+        self.out.flush()
+        logging.info("BC0078 batch done, %d commands ok, %d failed", self.ok, self.failed)
+        return self.ok, self.failed
+
+    # public
+    # a Command for a line, None for a blank or comment line
+    def parse(self, number, line):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            return Command(number, None, None, "can't read the line: %s" % e)
+        if len(words) == 0:
+            return None
+        name = words[0].lower()
+        types = COMMANDS.get(name)
+        if types is None:
+            return Command(number, name, None, "unknown command %s" % words[0])
+        if len(words) - 1 != len(types):
+            return Command(number, name, None, "%s takes %d arguments, not %d"
+                           % (name, len(types), len(words) - 1))
+        args = []
+        for word, kind in zip(words[1:], types):
+            try:
+                args.append(kind(word))
+            except ValueError:
+                what = "an account id" if kind is int else "a number"
+                return Command(number, name, None, "%s is not %s" % (word, what))
+        if len(types) > 0 and types[-1] is float and args[-1] < 0.0:
+            return Command(number, name, None, "the amount cannot be negative: %s" % words[-1])
+        return Command(number, name, args, None)
+
+    # private
+    # parses lines in a thread and hands the Commands over through a
+    # queue
+    def __read_ahead(self, lines):
+        queue = Queue.Queue(PIPELINE_DEPTH)
+        done = object()
+        def read():
+            try:
+                for number, line in enumerate(lines, 1):
+                    command = self.parse(number, line)
+                    if command is not None:
+                        queue.put(command)
+            except (IOError, OSError) as e:
+                logging.error("BC0121 batch input failed: %s", e)
+                queue.put(Command(0, None, None, "reading the input failed: %s" % e))
+            finally:
+                queue.put(done)
+        reader = threading.Thread(target=read, name='batch-reader')
+        reader.daemon = True
+        reader.start()
+        while True:
+            command = queue.get()
+            if command is done:
+                break
+            yield command
+        reader.join()
+
+    def __execute(self, command):
+        if command.error is not None:
+            self.__write(command, None, command.error)
+            return
+        try:
+            self.handlers[command.name](command, *command.args)
+        except LockError as e:
+            self.__write(command, None, "the account is locked: %s" % e)
+        except Exception as e:
+            logging.exception("BC0141 batch line %d failed", command.line)
+            self.__write(command, None, str(e))
+
+    def __deposit(self, command, ac_id, amount):
+        balance = self.bank.deposit(ac_id, amount)
+        self.__write(command, balance, self.__error(self.bank) if balance == -1 else None)
+
+    def __withdraw(self, command, ac_id, amount):
+        balance = self.bank.withdraw(ac_id, amount)
+        self.__write(command, balance, self.__error(self.bank) if balance == -1 else None)
+
+    def __transfer(self, command, from_id, to_id, amount):
+        done = self.bank.transfer_money(from_id, to_id, amount)
+        self.__write(command, True, self.__error(self.bank) if done is False else None)
+
+    def __create(self, command, fname, lname, balance):
+        self.creator.clear_errors()
+        ac_id = self.creator.create_account(fname, lname, balance)
+        error = None
+        if ac_id == -1:
+            error = self.__error(self.creator) or "There was a problem creating the account"
+        self.__write(command, ac_id, error)
+
+    def __get(self, command, ac_id):
+        self.bank.clear_errors()
+        info = self.bank.get_account_info(ac_id)
+        if info is None:
+            self.__write(command, None, self.__error(self.bank))
+            return
+        self.__write(command, {'id': ac_id, 'fname': info.fname, 'lname': info.lname,
+                               'balance': info.balance})
+
+    def __list(self, command):
+        cursor = None
+        while True:
+            records, cursor = self.bank.list_accounts(cursor, LIST_PAGE)
+            for record in records:
+                self.__write(command, {'id': record.id, 'fname': record.fname,
+                                       'lname': record.lname, 'balance': record.balance})
+            if cursor is None:
+                return
+
+    # private
+    # the errors of the last call as one line
+    def __error(self, source):
+        return '; '.join([err for err in source.get_error_string().split('\n') if err])
+
+    def __write(self, command, result, error=None):
+        if error is None:
+            self.ok += 1
+        else:
+            self.failed += 1
+        if self.fmt == 'tsv':
+            fields = [command.line, command.name or '']
+            if error is not None:
+                fields += ['error', error]
+            elif isinstance(result, dict):
+                fields += ['ok', result['id'], result['fname'], result['lname'], result['balance']]
+            else:
+                fields += ['ok', result]
+            line = '\t'.join([str(field).replace('\t', ' ') for field in fields])
+        else:
+            record = {'line': command.line, 'command': command.name, 'ok': error is None}
+            if error is None:
+                record['result'] = result
+            else:
+                record['error'] = error
+            line = json.dumps(record, sort_keys=True)
+        self.out.write(line + '\n')
+        self.out.flush()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for BatchCommands and drovebank.py --batch
+#
+import unittest
+import os
+import json
+import shutil
+from StringIO import StringIO
+
+from bank_commands import BatchCommands
+from drovebank import DroveBank
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import clear_config_cache
+
+COMMANDS = """# a comment
+create Ann Lee 100
+create 'Mary Ann' Smith 5.5
+
+deposit 1 50
+withdraw 1 500
+transfer 1 2 25
+get 2
+get 99
+deposit x 1
+fly 1 2
+withdraw 1 -5
+list
+"""
+
+class BatchCommands_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'commands_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __run(self, fmt, pipeline):
+        out = StringIO()
+        commands = BatchCommands(AccountActions(self.dir), AccountCreate(self.dir), out, fmt)
+        counts = commands.run(StringIO(COMMANDS), pipeline)
+        return counts, out.getvalue().splitlines()
+
+    def __check_jsonl(self, pipeline):
+        counts, lines = self.__run('jsonl', pipeline)
+        self.assertEqual(counts, (7, 5))
+        results = [json.loads(line) for line in lines]
+        self.assertEqual([(r['line'], r['ok']) for r in results],
+                         [(2, True), (3, True), (5, True), (6, False), (7, True), (8, True),
+                          (9, False), (10, False), (11, False), (12, False), (13, True), (13, True)])
+        self.assertEqual(results[1]['result'], 2)
+        self.assertEqual(results[2]['result'], 150.0)
+        self.assertTrue('more than your balance' in results[3]['error'])
+        self.assertEqual(results[5]['result'],
+                         {'id': 2, 'fname': 'Mary Ann', 'lname': 'Smith', 'balance': 30.5})
+        self.assertEqual(results[6]['error'], 'account id is not valid: 99')
+        self.assertEqual(results[7]['error'], 'x is not an account id')
+        self.assertEqual(results[8]['error'], 'unknown command fly')
+        self.assertEqual(results[9]['error'], 'the amount cannot be negative: -5')
+        self.assertEqual([r['result']['balance'] for r in results[10:]], [125.0, 30.5])
+
+    def test_jsonl(self):
+        self.__check_jsonl(False)
+
+    def test_pipeline(self):
+        self.__check_jsonl(True)
+
+    def test_tsv(self):
+        counts, lines = self.__run('tsv', False)
+        self.assertEqual(lines[0], '2\tcreate\tok\t1')
+        self.assertEqual(lines[5], '8\tget\tok\t2\tMary Ann\tSmith\t30.5')
+        self.assertEqual(lines[6], '9\tget\terror\taccount id is not valid: 99')
+        self.assertEqual(lines[-1], '13\tlist\tok\t2\tMary Ann\tSmith\t30.5')
+
+    def test_drovebank_batch(self):
+        out = StringIO()
+        failed = DroveBank(self.dir).run_batch(StringIO(COMMANDS), out, 'tsv', True)
+        self.assertEqual(failed, 5)
+        self.assertEqual(len(out.getvalue().splitlines()), 12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# process wide latency histograms and counters of the account work
+#   drovebank_op_seconds{op}              deposit, withdraw, transfer,
+#                                         get, create, recover
+#   drovebank_op_errors_total{op}         the ones that failed
+#   drovebank_lock_wait_seconds{backend}  time lock_file took to get a lock
+#   drovebank_write_step_seconds{step}    the copy, write, rename and
+#                                         unlink steps of a files commit
+#   drovebank_server_request_seconds{op}  bank_server.py requests
+#   drovebank_log_messages_total{level,code}  warnings and worse logged,
+#                                         by message code (AU0064, ...)
+#   drovebank_lockset_events_total{event} the lock_set.py counters
+#   drovebank_optimistic_events_total{event}  the optimistic commit
+#                                         counters of account_util.py
+#   drovebank_stale_locks_total{result}   locks of dead holders taken over,
+#                                         recovered or left for recover.py
+#
+# a histogram is a count per bucket of LATENCY_BUCKETS, a sum and a
+# count, updated under one mutex; that and two time.time() calls is all
+# an operation pays. snapshot() returns the numbers, render() the
+# Prometheus text format, and a MetricsExporter (get_exporter(dbdir))
+# rewrites <dbdir>/metrics.prom with it every metrics_interval seconds,
+# tmp file and rename so a scraper never reads half of it. only the long
+# lived processes (drovebank.py, bank_server.py) start one.
+#
+import os
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+
+from drove_bank_constants import DroveBankConstants
+from my_logger import CODE_RE
+import profiling
+
+METRICS_FILENAME = 'metrics.prom'
+
+# upper bounds of the histogram buckets, seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    'drovebank_op_seconds': ('histogram', 'time an account operation took'),
+    'drovebank_op_errors_total': ('counter', 'account operations that failed'),
+    'drovebank_lock_wait_seconds': ('histogram', 'time lock_file took to get an account lock'),
+    'drovebank_write_step_seconds': ('histogram', 'time of a step of a files storage commit'),
+    'drovebank_server_request_seconds': ('histogram', 'time bank_server.py took for a request'),
+    'drovebank_log_messages_total': ('counter', 'warnings and errors logged by message code'),
+    'drovebank_lockset_events_total': ('counter', 'lock set acquires, contentions and back offs'),
+    'drovebank_optimistic_events_total': ('counter', 'optimistic commit tries, conflicts and fallbacks'),
+    'drovebank_stale_locks_total': ('counter', 'locks left by dead holders that a waiter found'),
+}
+
+# (name, labels) -> Histogram or count. labels is a tuple of (label,
+# value) pairs
+_histograms = {}
+_counters = {}
+_mutex = threading.Lock()
+
+# dbdir -> MetricsExporter
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+def observe(name, labels, seconds):
+    key = (name, labels)
+    with _mutex:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            _histograms[key] = histogram
+        histogram.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram.sum += seconds
+        histogram.count += 1
+
+def count(name, labels, n=1):
+    key = (name, labels)
+    with _mutex:
+        _counters[key] = _counters.get(key, 0) + n
+
+# the time since start as a write step. returns now, the start of the
+# next step
+def observe_step(step, start):
+    now = time.time()
+    observe('drovebank_write_step_seconds', (('step', step),), now - start)
+    return now
+
+# times every call of the method as op. failed tells a failure from its
+# result, an exception is one too
+def timed(op, failed=None):
+    labels = (('op', op),)
+    def decorate(method):
+        @wraps(method)
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                # every Nth call under cProfile when profiling.py says so
+                profiler = profiling.op_profiler
+                if profiler is None:
+                    result = method(*args, **kwargs)
+                else:
+                    result = profiler.call(op, method, args, kwargs)
+            except:
+                observe('drovebank_op_seconds', labels, time.time() - start)
+                count('drovebank_op_errors_total', labels)
+                raise
+            observe('drovebank_op_seconds', labels, time.time() - start)
+            if failed is not None and failed(result):
+                count('drovebank_op_errors_total', labels)
+            return result
+        return call
+    return decorate
+
+# {'histograms': {name: {labels: {'buckets': [(le, cumulative count)],
+# 'sum': seconds, 'count': n}}}, 'counters': {name: {labels: n}}}
+def snapshot():
+    # lock_set and account_util import atomic_write which imports this
+    # module
+    from lock_set import get_lock_stats
+    from account_util import get_optimistic_stats
+    with _mutex:
+        histograms = [(key, list(h.buckets), h.sum, h.count) for key, h in _histograms.items()]
+        counters = dict(_counters)
+    for event, n in get_lock_stats().items():
+        counters[('drovebank_lockset_events_total', (('event', event),))] = n
+    for event, n in get_optimistic_stats().items():
+        counters[('drovebank_optimistic_events_total', (('event', event),))] = n
+
+    result = {'histograms': {}, 'counters': {}}
+    for (name, labels), buckets, total, n in histograms:
+        cumulative = []
+        running = 0
+        for le, bucket in zip(LATENCY_BUCKETS + (float('inf'),), buckets):
+            running += bucket
+            cumulative.append((le, running))
+        result['histograms'].setdefault(name, {})[labels] = \
+            {'buckets': cumulative, 'sum': total, 'count': n}
+    for (name, labels), n in counters.items():
+        result['counters'].setdefault(name, {})[labels] = n
+    return result
+
+# the snapshot in the Prometheus text format
+def render():
+    numbers = snapshot()
+    lines = []
+    for name in sorted(METRICS):
+        kind, text = METRICS[name]
+        series = numbers['histograms' if kind == 'histogram' else 'counters'].get(name)
+        if series is None:
+            continue
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels in sorted(series):
+            if kind == 'counter':
+                lines.append("%s%s %d" % (name, _labels(labels), series[labels]))
+                continue
+            histogram = series[labels]
+            for le, n in histogram['buckets']:
+                le = '+Inf' if le == float('inf') else repr(le)
+                lines.append("%s_bucket%s %d" % (name, _labels(labels + (('le', le),)), n))
+            lines.append("%s_sum%s %r" % (name, _labels(labels), histogram['sum']))
+            lines.append("%s_count%s %d" % (name, _labels(labels), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+def clear_metrics():
+    with _mutex:
+        _histograms.clear()
+        _counters.clear()
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for label, value in labels])
+
+def get_exporter(dbdir):
+    key = os.path.abspath(dbdir)
+    with _exporters_lock:
+        exporter = _exporters.get(key)
+        if exporter is None:
+            exporter = MetricsExporter(key)
+            _exporters[key] = exporter
+        return exporter
+
+class MetricsExporter(DroveBankConstants):
+
+    def __init__(self, dir=None):
+        DroveBankConstants.__init__(self, dir)
+        self.filename = os.path.join(self.dbdir, METRICS_FILENAME)
+        self.thread = None
+        self.stopping = threading.Event()
+
+    # public
+    # writes the metrics file now. returns its path
+    def write(self):
+        tmpname = "%s.%d.tmp" % (self.filename, os.getpid())
+        f = open(tmpname, 'w')
+        f.write(render())
+        f.close()
+        os.rename(tmpname, self.filename)
+        return self.filename
+
+    # public
+    # rewrites the file every interval seconds in a daemon thread
+    def start(self, interval=None):
+        if interval is None:
+            interval = self.get_config_float('metrics_interval')
+        if interval is None or interval <= 0 or self.thread is not None:
+            return
+        self.stopping.clear()
+        def run():
+            while self.stopping.wait(interval) is False:
+                try:
+                    self.write()
+                except (IOError, OSError) as e:
+                    logging.error("BM0196 can't write %s: %s", self.filename, e)
+        self.thread = threading.Thread(target=run, name='metrics-exporter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+# counts the warnings and worse by their message code
+class CodeCounter(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+
+    def emit(self, record):
+        match = CODE_RE.match(record.getMessage())
+        code = '-' if match is None else match.group(1)
+        count('drovebank_log_messages_total', (('level', record.levelname.lower()), ('code', code)))
+
+logging.getLogger().addHandler(CodeCounter())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for bank_metrics.py
+#
+import unittest
+import os
+import time
+import shutil
+import logging
+
+from bank_metrics import snapshot, render, clear_metrics, timed, get_exporter, METRICS_FILENAME
+from account_actions import AccountActions
+from account_create import AccountCreate
+from account_session import AccountSession
+from recover import Recover
+from drove_bank_constants import clear_config_cache
+
+class BankMetrics_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'metrics_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+        clear_metrics()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __count(self, numbers, name, **labels):
+        series = numbers['histograms'].get(name, {})
+        histogram = series.get(tuple(sorted(labels.items())))
+        return 0 if histogram is None else histogram['count']
+
+    def test_ops(self):
+        ac = AccountCreate(self.dir)
+        one = ac.create_account('John', 'Doe', 100.0)
+        two = ac.create_account('Jane', 'Doe', 100.0)
+        aa = AccountActions(self.dir)
+        aa.deposit(one, 10.0)
+        self.assertEqual(aa.withdraw(one, 1000.0), -1)
+        self.assertTrue(aa.transfer_money(one, two, 5.0))
+        self.assertEqual(aa.get_account_info(99), None)
+        session = AccountSession(self.dir)
+        session.deposit(two, 1.0)
+        Recover(self.dir).recover()
+
+        numbers = snapshot()
+        for op, n in (('create', 2), ('deposit', 2), ('withdraw', 1), ('transfer', 1),
+                      ('get', 1), ('recover', 1)):
+            self.assertEqual(self.__count(numbers, 'drovebank_op_seconds', op=op), n)
+        errors = numbers['counters']['drovebank_op_errors_total']
+        self.assertEqual(errors, {(('op', 'withdraw'),): 1, (('op', 'get'),): 1})
+
+        # two deposits, the transfer (a step covers both files) and the
+        # index of two creates
+        for step in ('copy', 'write', 'rename', 'unlink'):
+            self.assertEqual(self.__count(numbers, 'drovebank_write_step_seconds', step=step), 5)
+        self.assertTrue(self.__count(numbers, 'drovebank_lock_wait_seconds', backend='lockfile') >= 7)
+        self.assertTrue(numbers['counters']['drovebank_lockset_events_total'][(('event', 'acquires'),)] > 0)
+        codes = numbers['counters']['drovebank_log_messages_total']
+        self.assertEqual(codes[(('level', 'warning'), ('code', 'AU0064'))], 1)
+
+        histogram = numbers['histograms']['drovebank_op_seconds'][(('op', 'deposit'),)]
+        self.assertEqual(histogram['buckets'][-1], (float('inf'), 2))
+        self.assertTrue(histogram['sum'] > 0)
+
+    def test_timed(self):
+        @timed('test', lambda result: result < 0)
+        def op(value):
+            if value is None:
+                raise ValueError('no value')
+            return value
+        op(1)
+        op(-1)
+        self.assertRaises(ValueError, op, None)
+        numbers = snapshot()
+        self.assertEqual(self.__count(numbers, 'drovebank_op_seconds', op='test'), 3)
+        self.assertEqual(numbers['counters']['drovebank_op_errors_total'][(('op', 'test'),)], 2)
+
+    def test_render(self):
+        AccountCreate(self.dir).create_account('John', 'Doe', 100.0)
+        logging.error("ZZ0001 a \"quoted\" error")
+        text = render()
+        self.assertTrue('# TYPE drovebank_op_seconds histogram\n' in text)
+        self.assertTrue('drovebank_op_seconds_bucket{op="create",le="+Inf"} 1\n' in text)
+        self.assertTrue('drovebank_op_seconds_count{op="create"} 1\n' in text)
+        self.assertTrue('drovebank_log_messages_total{level="error",code="ZZ0001"} 1\n' in text)
+        for line in text.splitlines():
+            if line.startswith('#') is False:
+                name, value = line.rsplit(' ', 1)
+                float(value)
+
+    def test_exporter(self):
+        exporter = get_exporter(self.dir)
+        path = os.path.join(self.dir, METRICS_FILENAME)
+        self.assertEqual(exporter.write(), path)
+        AccountCreate(self.dir).create_account('John', 'Doe', 100.0)
+        exporter.start(0.05)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            f = open(path)
+            text = f.read()
+            f.close()
+            if 'op="create"' in text:
+                break
+            time.sleep(0.05)
+        exporter.stop()
+        self.assertTrue('drovebank_op_seconds_count{op="create"} 1\n' in text)
+        self.assertEqual([name for name in os.listdir(self.dir) if name.endswith('.tmp')], [])
+
+if __name__ == '__main__':
+    unittest.main()
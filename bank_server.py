@@ -0,0 +1,723 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of AccountActions
+#
+# a server that owns a dbdir and does the account work of any number of
+# clients (bank_client.py, drovebank.py -s) over TCP or a unix socket,
+# instead of every client process going to the files and their locks.
+#
+# a request is a JSON list on a line and gets a JSON object on a line
+#   ["deposit", 12, 5.0]   ->  {"ok": true, "result": 17.0}
+#   ["withdraw", 12, 99]   ->  {"ok": false, "error": "You can't ..."}
+# the requests of a connection are answered in the order they came in.
+#
+#   ping
+#   create   fname, lname, balance          -> id
+#   get      id                             -> {id, fname, lname, balance}
+#   deposit  id, amount                     -> balance
+#   withdraw id, amount                     -> balance
+#   transfer from id, to id, amount         -> [from balance, to balance]
+#   list     cursor, page size              -> [[[id, fname, lname, balance] ...], cursor]
+#   totals                                  -> [count, balance]
+#   report   bins                           -> the BankAnalytics report
+#   history  id, start time, end time       -> [[seq, time, id, kind, other, amount, balance] ...]
+#   metrics                                 -> the bank_metrics.py numbers, Prometheus text
+#
+# the sockets are run by an asyncore loop, the requests by a pool of
+# worker threads since a commit waits on the disk. the server holds a
+# flock on <dbdir>/server.pid for as long as it runs so no other server
+# takes the dbdir. the work on an account is serialized between the
+# threads of the server by an in-process lock per account; a transfer
+# takes its two in id order. drovebank.py, batch_transfer.py and the
+# load generator can still write the dbdir, so a change also takes the
+# lock files of its accounts (a LockSet) before it reads them, as every
+# other process does. the accounts the server has used are kept in
+# memory (server_cache_size of them) with the token of the file they
+# were read from, like account_cache.py, and read again when another
+# process has committed since. the commit is the same one every other
+# process makes (summary, history, storage engine) and is done before
+# the answer goes out. a commit that fails is put right the way a lock
+# takeover does it and its lock files removed, the account isn't left
+# locked.
+#
+# the server recovers the dbdir when it starts, including the history
+# records a server that died left pending. if a lock file, id block or
+# optimistic commit belongs to a process that is still running only the
+# locks and id blocks of the processes that died are recovered, the rest
+# is left to recover.py.
+#
+# python 2 has no asyncio, asyncore/asynchat are the event loop here.
+#
+import os
+import json
+import fcntl
+import errno
+import time
+import socket
+import signal
+import asyncore
+import asynchat
+import logging
+import argparse
+import threading
+import Queue
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from atomic_write import AtomicWrite, LockError, parse_lock_owner, owner_is_stale, pid_alive
+from lock_set import LockSet
+from recovery_catalog import RecoveryCatalog
+from account_history import get_history, KIND_DEPOSIT, KIND_WITHDRAW, \
+    KIND_TRANSFER_OUT, KIND_TRANSFER_IN
+from bank_analytics import BankAnalytics
+from bank_client import parse_address
+from recover import Recover
+from my_logger import setup_logging
+from profiling import add_profile_args, setup_profiling_args
+from bank_metrics import get_exporter, observe, render
+
+# held (flock) by the server that owns the dbdir. not a .lock file, the
+# recovery would take it for an account lock
+SERVER_PID_FILENAME = 'server.pid'
+
+# longest request line
+MAX_REQUEST = 65536
+
+DEFAULT_ADDRESS = '127.0.0.1:7070'
+
+# a request that can't be done, the message goes back to the client
+class RequestError(Exception):
+    pass
+
+# in-process locks on account ids. an entry lives while someone holds or
+# waits for it
+class AccountLocks(object):
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.locks = {}
+
+    # takes the locks of ids in id order, returns what release needs
+    def acquire(self, ids):
+        ids = sorted(set(ids))
+        entries = []
+        with self.mutex:
+            for ac_id in ids:
+                entry = self.locks.get(ac_id)
+                if entry is None:
+                    entry = [threading.Lock(), 0]
+                    self.locks[ac_id] = entry
+                entry[1] += 1
+                entries.append(entry)
+        for entry in entries:
+            entry[0].acquire()
+        return ids
+
+    def release(self, ids):
+        with self.mutex:
+            for ac_id in ids:
+                entry = self.locks[ac_id]
+                entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[ac_id]
+
+class BankServer(AccountActions):
+
+    def __init__(self, dir=None, workers=8):
+        AccountActions.__init__(self, dir)
+        self.workers = workers
+        # id -> (file token, Account), least recently used first
+        self.accounts = OrderedDict()
+        self.accounts_mutex = threading.Lock()
+        self.account_locks = AccountLocks()
+        self.map = {}
+        self.results = Queue.Queue()
+        self.pool = None
+        self.pidfile = None
+        self.listener = None
+        self.waker = None
+        self.running = False
+        self.ops = {'ping': self.ping, 'create': self.create, 'get': self.get,
+                    'deposit': self.deposit_op, 'withdraw': self.withdraw_op,
+                    'transfer': self.transfer, 'list': self.list_page,
+                    'totals': self.totals, 'report': self.report,
+                    'history': self.history, 'metrics': self.metrics}
+
+    # public
+    # takes the dbdir, recovers it and listens on address, host:port or
+    # the path of a unix socket. returns the address listened on.
+    def start(self, address=DEFAULT_ADDRESS):
+        self.__own_dbdir()
+        self.__recover()
+        if self.get_config_bool('history'):
+            get_history(self.dbdir).start_compactor()
+        get_exporter(self.dbdir).start()
+
+        self.pool = ThreadPool(self.workers)
+        self.waker = BankWaker(self)
+        self.listener = BankListener(self, parse_address(address))
+        self.running = True
+        logging.info("BS0139 serving %s on %s with %d workers",
+                     self.dbdir, self.listener.address, self.workers)
+        return self.listener.address
+
+    # public
+    # runs the loop until stop()
+    def serve_forever(self):
+        try:
+            while self.running:
+                asyncore.loop(timeout=1.0, map=self.map, count=1)
+        finally:
+            self.__close()
+
+    # public
+    # stops the loop, can be called from any thread
+    def stop(self):
+        self.running = False
+        if self.waker is not None:
+            self.waker.wake()
+
+    # public
+    # does one request, a list of op and args, and returns the answer.
+    # called by the worker threads.
+    def handle_request(self, request):
+        if isinstance(request, list) is False or len(request) == 0:
+            return {'ok': False, 'error': "a request is a list of op and args"}
+        if isinstance(request[0], basestring) is False:
+            return {'ok': False, 'error': "an op is a string: %s" % (request[0],)}
+        op = self.ops.get(request[0])
+        if op is None:
+            return {'ok': False, 'error': "unknown op %s" % request[0]}
+        args = [arg.encode('utf-8') if isinstance(arg, unicode) else arg for arg in request[1:]]
+        start = time.time()
+        try:
+            return {'ok': True, 'result': op(*args)}
+        except RequestError as e:
+            return {'ok': False, 'error': str(e)}
+        except LockError as e:
+            logging.error("BS0165 %s", e)
+            return {'ok': False, 'error': "The account is locked, try again later: %s" % e}
+        except TypeError as e:
+            return {'ok': False, 'error': "bad arguments for %s: %s" % (request[0], e)}
+        except Exception as e:
+            logging.exception("BS0171 %s failed", request)
+            return {'ok': False, 'error': "%s failed: %s" % (request[0], e)}
+        finally:
+            observe('drovebank_server_request_seconds', (('op', request[0]),), time.time() - start)
+
+    def ping(self):
+        return 'pong'
+
+    def create(self, fname, lname, starting_balance=0.0):
+        ac = AccountCreate(self.dbdir)
+        ac_id = ac.create_account(fname, lname, starting_balance)
+        if ac_id == -1:
+            raise RequestError("There was a problem creating your account")
+        ids = self.account_locks.acquire([ac_id])
+        try:
+            self.__load(ac_id)
+        finally:
+            self.account_locks.release(ids)
+        return ac_id
+
+    def get(self, ac_id):
+        ac_id = self.__account_id(ac_id)
+        ids = self.account_locks.acquire([ac_id])
+        try:
+            info = self.__load(ac_id)
+        finally:
+            self.account_locks.release(ids)
+        return {'id': ac_id, 'fname': info.fname, 'lname': info.lname, 'balance': info.balance}
+
+    def deposit_op(self, ac_id, amount):
+        ac_id = self.__account_id(ac_id)
+        amount = self.__amount(amount, 'deposit')
+        def change(info):
+            return [(ac_id, info, info.balance + amount, KIND_DEPOSIT, 0, amount)]
+        return self.__change([ac_id], change)[0]
+
+    def withdraw_op(self, ac_id, amount):
+        ac_id = self.__account_id(ac_id)
+        amount = self.__amount(amount, 'withdraw')
+        def change(info):
+            balance = info.balance - amount
+            if balance < 0:
+                raise RequestError("You can't withdraw more than your balance")
+            return [(ac_id, info, balance, KIND_WITHDRAW, 0, amount)]
+        return self.__change([ac_id], change)[0]
+
+    def transfer(self, from_id, to_id, amount):
+        from_id = self.__account_id(from_id)
+        to_id = self.__account_id(to_id)
+        amount = self.__amount(amount, 'transfer')
+        if from_id == to_id:
+            raise RequestError("can't transfer money from an account to itself: %s" % from_id)
+        def change(from_info, to_info):
+            from_balance = from_info.balance - amount
+            if from_balance < 0:
+                raise RequestError("not enough money in source account")
+            return [(from_id, from_info, from_balance, KIND_TRANSFER_OUT, to_id, amount),
+                    (to_id, to_info, to_info.balance + amount, KIND_TRANSFER_IN, from_id, amount)]
+        return self.__change([from_id, to_id], change)
+
+    def list_page(self, cursor=None, page_size=20):
+        records, next_cursor = self.list_accounts(cursor, page_size)
+        return [list(record) for record in records], next_cursor
+
+    def totals(self):
+        return list(self.get_bank_totals())
+
+    def report(self, bins=10):
+        return BankAnalytics(self.dbdir).report(bins)
+
+    def history(self, ac_id, start=None, end=None):
+        if self.get_config_bool('history') is False:
+            raise RequestError("The history is turned off for this bank")
+        return [list(record) for record in
+                get_history(self.dbdir).query(self.__account_id(ac_id), start, end)]
+
+    def metrics(self):
+        return render()
+
+    # called in the loop thread by a connection with a request line
+    def submit(self, conn, line):
+        self.pool.apply_async(self.__run, (conn, line))
+
+    # called in the loop thread when the waker went off. hands the
+    # answers to their connections
+    def deliver(self):
+        while True:
+            try:
+                conn, response = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            conn.answer(response)
+
+    # private
+    # a worker: does the request and wakes the loop up to send the answer.
+    # there is always an answer, the connection waits for it before it
+    # sends the next request
+    def __run(self, conn, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = {'ok': False, 'error': "a request is a JSON list"}
+        else:
+            try:
+                response = self.handle_request(request)
+            except Exception as e:
+                logging.exception("BS0312 %s failed", line)
+                response = {'ok': False, 'error': "the request failed: %s" % e}
+        self.results.put((conn, json.dumps(response)))
+        self.waker.wake()
+
+    # private
+    # a deposit, withdraw or transfer on the accounts ids: takes their
+    # account locks and lock files, reads them and commits what change
+    # makes of them. change gets the Accounts in the order of ids and
+    # returns the changes for __commit. returns the new balances.
+    def __change(self, ids, change):
+        held = self.account_locks.acquire(ids)
+        try:
+            for ac_id in ids:
+                if self.check_account_file(ac_id) is False:
+                    raise RequestError("account id is not valid: %s" % ac_id)
+            members = self.__writers(ids)
+            locks = LockSet(members.values())
+            locks.acquire()
+            try:
+                changes = change(*[self.__load(ac_id) for ac_id in ids])
+            except:
+                locks.release()
+                raise
+            try:
+                self.__commit(changes, members)
+            except:
+                self.__put_right(locks)
+                raise
+            locks.release()
+        finally:
+            self.account_locks.release(held)
+        return [entry[2] for entry in changes]
+
+    # private
+    # an AtomicWrite per account of ids, the transfer suffixes and one
+    # transid when there is more than one
+    def __writers(self, ids):
+        members = {}
+        transid = None
+        if len(ids) > 1:
+            transid = AtomicWrite(self.dbdir).id_generator()
+        for ac_id in ids:
+            aw = AtomicWrite(self.dbdir)
+            if transid is not None:
+                aw.set_transid(transid)
+                aw.set_old_suffix("xold")
+                aw.set_tmp_suffix("xtmp")
+            aw.set_file_name(self.get_account_filename(ac_id))
+            members[ac_id] = aw
+        return members
+
+    # private
+    # commits changes, a list of (id, Account, new balance, history kind,
+    # other id, amount), with the account locks and the lock files of
+    # members (id -> AtomicWrite) held
+    def __commit(self, changes, members):
+        writes = [(members[ac_id], "%s,%s,%s\n" % (info.fname, info.lname, balance))
+                  for ac_id, info, balance, kind, other, amount in changes]
+        try:
+            history = self.record_history([(ac_id, kind, other, amount, balance)
+                                           for ac_id, info, balance, kind, other, amount in changes])
+            if len(writes) == 1:
+                writes[0][0].write_content(writes[0][1])
+            else:
+                self.commit_transaction(writes)
+            self.finish_history(history)
+            self.update_summary([(ac_id, info.fname, info.lname, balance)
+                                 for ac_id, info, balance, kind, other, amount in changes])
+        except:
+            # the files are in an unknown state, read them again next time
+            self.__forget([entry[0] for entry in changes])
+            raise
+        # the token goes with the lock files still held, no one else can
+        # have committed since
+        for ac_id, info, balance, kind, other, amount in changes:
+            filename = members[ac_id].filename
+            self.__remember(ac_id, self.__token(filename), info._replace(balance=balance))
+
+    # private
+    # a commit failed with the lock files of locks held: finishes or
+    # undoes what it wrote the way a lock takeover would and removes the
+    # lock files. if that fails too they are left for recover.py, or for
+    # the next waiter to take over.
+    def __put_right(self, locks):
+        lockfiles = [aw.get_lockfilename() for aw in locks.held]
+        try:
+            filenames = []
+            for lockfile in lockfiles:
+                filenames.extend(self.get_lock_data_files(lockfile))
+            catalog = RecoveryCatalog(self.dbdir).scan_files(filenames)
+            Recover(self.dbdir).recover_locks(catalog)
+            logging.warning("BS0398 put right the failed commit on %s", lockfiles)
+        except Exception as e:
+            logging.critical("BS0402 failed commit on %s can't be put right, run recover.py: %s",
+                             lockfiles, e)
+        finally:
+            # the lock files are gone or have to stay, either way we
+            # are done with them
+            while len(locks.held) > 0:
+                locks.held.pop().lockfile.close()
+
+    # private
+    # the Account of an id, from memory or the files. called with the
+    # account lock held. the one in memory is only used if the file
+    # hasn't changed since it was read.
+    def __load(self, ac_id):
+        filename = self.get_account_filename(ac_id)
+        token = self.__token(filename)
+        with self.accounts_mutex:
+            entry = self.accounts.pop(ac_id, None)
+            if entry is not None:
+                self.accounts[ac_id] = entry
+                if token is not None and entry[0] == token:
+                    return entry[1]
+        try:
+            info = self.read_account_file(filename)
+        except (IOError, OSError):
+            raise RequestError("account id is not valid: %s" % ac_id)
+        self.__remember(ac_id, token, info)
+        return info
+
+    # private
+    # the token of an account file, None if there is none and what is in
+    # memory can't be used
+    def __token(self, filename):
+        try:
+            return self.cache_token(filename)
+        except OSError:
+            return None
+
+    def __remember(self, ac_id, token, info):
+        if token is None:
+            self.__forget([ac_id])
+            return
+        limit = self.get_config_int('server_cache_size')
+        with self.accounts_mutex:
+            self.accounts.pop(ac_id, None)
+            self.accounts[ac_id] = (token, info)
+            while len(self.accounts) > limit:
+                self.accounts.popitem(last=False)
+
+    def __forget(self, ids):
+        with self.accounts_mutex:
+            for ac_id in ids:
+                self.accounts.pop(ac_id, None)
+
+    def __account_id(self, ac_id):
+        if self.isint(ac_id) is False:
+            raise RequestError("account id is not a valid number: %s" % ac_id)
+        return int(ac_id)
+
+    def __amount(self, amount, what):
+        if self.isfloat(amount) is False:
+            raise RequestError("amount to %s is not a valid number: %s" % (what, amount))
+        if float(amount) < 0.0:
+            raise RequestError("amount to %s cannot be a negative number: %s" % (what, amount))
+        return float(amount)
+
+    def __current_balance(self, ac_id):
+        try:
+            return self.read_account_file(self.get_account_filename(ac_id)).balance
+        except (IOError, OSError):
+            return None
+
+    # private
+    # recovers the dbdir at start. a full recovery would take the lock
+    # files, tmp files and id blocks of the other writers from under
+    # them, so it is only run when none of them is running.
+    def __recover(self):
+        catalog = RecoveryCatalog(self.dbdir).scan()
+        live = self.__live_files(catalog)
+        if len(live) == 0:
+            Recover(self.dbdir).recover()
+            if self.get_config_bool('history'):
+                get_history(self.dbdir).recover(None, self.__current_balance)
+            return
+
+        logging.warning("BS0483 %d files of running processes in %s, only recovering what "
+                        "dead processes left, run recover.py for the rest", len(live), self.dbdir)
+        # taking the lock of a holder that died recovers its accounts
+        for key, lockfile in catalog.get_locks():
+            if isinstance(key, int) is False or lockfile in live:
+                continue
+            aw = AtomicWrite(self.dbdir)
+            aw.set_file_name(self.get_account_filename(key))
+            try:
+                aw.lock_file()
+            except LockError as e:
+                logging.warning("BS0494 lock %s is left: %s", lockfile, e)
+                continue
+            aw.unlock_file()
+        ac = AccountCreate(self.dbdir)
+        for rsv in catalog.get_reservations():
+            if rsv not in live:
+                ac.recover_reservation(rsv)
+
+    # private
+    # the files in catalog of processes that are still running: lock
+    # files whose holder is alive (or hasn't written itself in yet), id
+    # blocks whose process is alive and optimistic commits that hold
+    # their flock
+    def __live_files(self, catalog):
+        live = set()
+        for key, lockfile in catalog.get_locks():
+            try:
+                f = open(lockfile)
+                try:
+                    owner = parse_lock_owner(f.read(512))
+                finally:
+                    f.close()
+            except IOError:
+                continue
+            if owner is None or owner_is_stale(owner) is False:
+                live.add(lockfile)
+        ac = AccountCreate(self.dbdir)
+        for rsv in catalog.get_reservations():
+            pid = ac.get_reservation_pid(rsv)
+            if pid is not None and pid_alive(pid):
+                live.add(rsv)
+        # the .otmp file is flocked from its compare and swap on, after
+        # the rename the flock is on the account file
+        for entry in catalog.get_optimistic_files() + catalog.get_pending_files():
+            otmp = entry.path[:-len(entry.suffix)] + 'otmp'
+            if self.__flocked(otmp) or self.__flocked(entry.datafile):
+                live.add(entry.path)
+        return live
+
+    # private
+    # True if another open file has the flock of filename
+    def __flocked(self, filename):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    # private
+    # flock on server.pid, held until the server closes
+    def __own_dbdir(self):
+        fd = os.open(os.path.join(self.dbdir, SERVER_PID_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise LockError("another server owns %s" % self.dbdir)
+            raise
+        os.ftruncate(fd, 0)
+        os.write(fd, "%d\n" % os.getpid())
+        self.pidfile = fd
+
+    def __close(self):
+        asyncore.close_all(self.map)
+        if self.listener is not None and isinstance(self.listener.address, str):
+            try:
+                os.remove(self.listener.address)
+            except OSError:
+                pass
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.pidfile is not None:
+            os.remove(os.path.join(self.dbdir, SERVER_PID_FILENAME))
+            fcntl.flock(self.pidfile, fcntl.LOCK_UN)
+            os.close(self.pidfile)
+            self.pidfile = None
+        logging.info("BS0389 stopped serving %s", self.dbdir)
+
+class BankListener(asyncore.dispatcher):
+
+    def __init__(self, server, address):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        if isinstance(address, tuple):
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bind(address)
+        self.address = self.socket.getsockname()
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            BankConnection(self.server, pair[0])
+
+# one client. a request line goes to the workers once the answer to the
+# one before it is out
+class BankConnection(asynchat.async_chat):
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.set_terminator('\n')
+        self.buffer = []
+        self.buffered = 0
+        self.requests = deque()
+        self.busy = False
+        self.closed = False
+
+    def collect_incoming_data(self, data):
+        self.buffered += len(data)
+        if self.buffered > MAX_REQUEST:
+            logging.warning("BS0437 request longer than %d bytes, dropping the client", MAX_REQUEST)
+            self.handle_close()
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if line.strip() == '':
+            return
+        self.requests.append(line)
+        self.__next_request()
+
+    # the answer to the request that was out
+    def answer(self, response):
+        self.busy = False
+        if self.closed:
+            return
+        self.push(response + '\n')
+        self.__next_request()
+
+    def handle_close(self):
+        self.closed = True
+        self.close()
+
+    def __next_request(self):
+        if self.busy or len(self.requests) == 0:
+            return
+        self.busy = True
+        self.server.submit(self, self.requests.popleft())
+
+# a pipe the workers write to so the loop wakes up for their answers
+class BankWaker(asyncore.file_dispatcher):
+
+    def __init__(self, server):
+        rfd, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rfd, map=server.map)
+        # file_dispatcher works on a dup
+        os.close(rfd)
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL, fcntl.fcntl(self.wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.server = server
+        # stop() can wake the loop while the loop, done on its own,
+        # closes the pipe
+        self.wfd_mutex = threading.Lock()
+
+    def wake(self):
+        with self.wfd_mutex:
+            if self.wfd is None:
+                return
+            try:
+                os.write(self.wfd, 'x')
+            except OSError as e:
+                # a full pipe wakes the loop up as well, a broken one is a
+                # loop that is done already
+                if e.errno not in (errno.EAGAIN, errno.EPIPE):
+                    raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.deliver()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        with self.wfd_mutex:
+            if self.wfd is not None:
+                os.close(self.wfd)
+                self.wfd = None
+
+def main():
+  parser = argparse.ArgumentParser(description='Drove Bank server')
+  parser.add_argument('-d', '--dir', help='data directory', default=None)
+  parser.add_argument('-l', '--listen', help='host:port or unix socket path', default=DEFAULT_ADDRESS)
+  parser.add_argument('-w', '--workers', help='worker threads', type=int, default=8)
+  parser.add_argument('--log-level', help='DEBUG, INFO, WARNING, ERROR or CRITICAL', default=None)
+  parser.add_argument('--log-file', help="log file, '-' for stderr", default=None)
+  add_profile_args(parser)
+  args = parser.parse_args()
+  setup_logging(args.log_level, args.log_file)
+  setup_profiling_args(args)
+  server = BankServer(args.dir, args.workers)
+  print "serving %s on %s" % (server.dbdir, server.start(args.listen))
+  signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.stop()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for BankServer and BankClient
+#
+import unittest
+import os
+import json
+import shutil
+import time
+import socket
+import threading
+
+from bank_server import BankServer
+from bank_client import BankClient, parse_address
+from account_util import AccountUtil
+from account_create import AccountCreate
+from account_history import KIND_TRANSFER_IN
+from atomic_write import LockError, HOSTNAME
+from drove_bank_constants import write_config, clear_config_cache
+
+class BankServer_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'server_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        clear_config_cache()
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+        self.server = None
+        self.thread = None
+
+    def tearDown(self):
+        self.__stop()
+        shutil.rmtree(self.dir)
+
+    def __start(self, address=None):
+        if address is None:
+            address = os.path.join(self.dir, 'bank.sock')
+        self.server = BankServer(self.dir, workers=4)
+        address = self.server.start(address)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return address
+
+    def __stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.thread.join()
+            self.server = None
+
+    def __file_balance(self, ac_id):
+        util = AccountUtil(self.dir)
+        return util.read_account_file(util.get_account_filename(ac_id)).balance
+
+    def test_account_calls(self):
+        client = BankClient(self.__start())
+        a = client.create_account('First', 'Last', 100.0)
+        b = client.create_account('Second', 'Last', 0)
+        self.assertEqual((a, b), (1, 2))
+
+        self.assertEqual(client.deposit(a, 50.0), 150.0)
+        self.assertEqual(client.withdraw(a, 25.0), 125.0)
+        self.assertEqual(client.withdraw(a, 1000.0), -1)
+        self.assertTrue('more than your balance' in client.get_error_string())
+        self.assertTrue(client.transfer_money(a, b, 25.0))
+        self.assertFalse(client.transfer_money(b, a, 500.0))
+        self.assertFalse(client.transfer_money(a, a, 1.0))
+        self.assertEqual(client.deposit(99, 1.0), -1)
+        self.assertTrue('not valid' in client.get_error_string())
+
+        info = client.get_account_info(a)
+        self.assertEqual((info.fname, info.lname, info.balance), ('First', 'Last', 100.0))
+        self.assertEqual(client.get_account_info(99), None)
+        records, cursor = client.list_accounts(None, 1)
+        self.assertEqual(cursor, 2)
+        self.assertEqual(list(records[0]), [1, 'First', 'Last', 100.0])
+        self.assertEqual(tuple(client.get_bank_totals()), (2, 125.0))
+        self.assertEqual(client.report()['total'], 125.0)
+        history = client.query_history(b)
+        self.assertEqual([(r.kind, r.other, r.balance) for r in history][1:],
+                         [(KIND_TRANSFER_IN, a, 25.0)])
+        client.close()
+
+        # every commit is on disk when the answer comes back
+        self.assertEqual(self.__file_balance(a), 100.0)
+        self.assertEqual(self.__file_balance(b), 25.0)
+        self.assertEqual([name for name in os.listdir(self.dir) if name.endswith('.lock')], [])
+
+    def test_concurrent_clients(self):
+        address = self.__start()
+        setup = BankClient(address)
+        a = setup.create_account('First', 'Last', 1000.0)
+        b = setup.create_account('Second', 'Last', 1000.0)
+        errors = []
+        def work(n):
+            client = BankClient(address)
+            for i in range(25):
+                if client.deposit(a, 1.0) == -1 or client.transfer_money(a, b, 2.0) is False \
+                        or client.transfer_money(b, a, 1.0) is False:
+                    errors.append(client.get_error_string())
+            client.close()
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        # 150 deposits of 1 to a, a net 150 moved from a to b
+        self.assertEqual(setup.get_account_info(a).balance, 1000.0)
+        self.assertEqual(setup.get_account_info(b).balance, 1150.0)
+        self.__stop()
+        self.assertEqual(self.__file_balance(a), 1000.0)
+        self.assertEqual(self.__file_balance(b), 1150.0)
+
+    def test_tcp_and_binary_storage(self):
+        write_config(self.dir, {'storage': 'binary'})
+        address = self.__start('127.0.0.1:0')
+        client = BankClient("%s:%d" % address)
+        a = client.create_account('First', 'Last', 10.0)
+        self.assertEqual(client.deposit(a, 5.0), 15.0)
+        self.__stop()
+        self.assertEqual(self.__file_balance(a), 15.0)
+
+    def test_other_writers(self):
+        client = BankClient(self.__start())
+        a = client.create_account('First', 'Last', 100.0)
+        self.assertEqual(client.deposit(a, 10.0), 110.0)
+
+        # drovebank.py commits behind the server's back, nothing is lost
+        self.assertEqual(AccountUtil(self.dir).deposit(a, 5.0), 115.0)
+        self.assertEqual(client.get_account_info(a).balance, 115.0)
+        self.assertEqual(client.deposit(a, 1.0), 116.0)
+
+        # the server waits for the lock file of another writer
+        holder = AccountUtil(self.dir)
+        holder.set_account_id(a)
+        holder.lock_file()
+        timer = threading.Timer(0.1, holder.unlock_file)
+        timer.start()
+        self.assertEqual(client.deposit(a, 1.0), 117.0)
+        timer.join()
+
+        # a commit that fails half way is undone and the accounts aren't
+        # left locked
+        def fail(members):
+            aw, content = members[0]
+            shutil.copy2(aw.filename, aw.get_tmpfile())
+            raise IOError("disk full")
+        commit_transaction = self.server.commit_transaction
+        self.server.commit_transaction = fail
+        b = client.create_account('Second', 'Last', 0)
+        self.assertFalse(client.transfer_money(a, b, 7.0))
+        self.assertTrue('disk full' in client.get_error_string())
+        self.assertEqual([name for name in os.listdir(self.dir)
+                          if name.endswith('.lock') or name.endswith('.xtmp')], [])
+        self.server.commit_transaction = commit_transaction
+        self.assertTrue(client.transfer_money(a, b, 7.0))
+        self.assertEqual(self.__file_balance(a), 110.0)
+        self.assertEqual(self.__file_balance(b), 7.0)
+        client.close()
+
+    def test_live_writers(self):
+        ac = AccountCreate(self.dir)
+        a = ac.create_account('First', 'Last', 100.0)
+        b = ac.create_account('Second', 'Last', 100.0)
+        # this process is a writer that is still running, with a block of
+        # ids and the lock of a
+        self.assertEqual(ac.reserve_ids(5), (3, 7))
+        holder = AccountUtil(self.dir)
+        holder.set_account_id(a)
+        holder.lock_file()
+        # and one that died holding b
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        other = AccountUtil(self.dir)
+        other.set_account_id(b)
+        f = open(other.lockfilename, 'w')
+        f.write("%d,%s,%f,\n" % (pid, HOSTNAME, time.time()))
+        f.close()
+
+        client = BankClient(self.__start())
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'index_3_7.rsv')))
+        self.assertTrue(os.path.exists(holder.lockfilename))
+        self.assertFalse(os.path.exists(other.lockfilename))
+        self.assertEqual(client.deposit(b, 1.0), 101.0)
+        holder.unlock_file()
+        self.assertEqual(client.deposit(a, 1.0), 101.0)
+        # the reserved ids aren't handed out again
+        self.assertEqual(client.create_account('Third', 'Last', 0), 8)
+        client.close()
+
+    def test_one_server_a_dbdir(self):
+        self.__start()
+        self.assertRaises(LockError, BankServer(self.dir).start, os.path.join(self.dir, 'b.sock'))
+        self.__stop()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'server.pid')))
+
+    def test_bad_requests(self):
+        address = self.__start()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        rfile = sock.makefile('rb')
+        for line in ('not json', '{"op": "ping"}', '["nosuchop"]', '["deposit", 1]',
+                     '["deposit", "x", 1.0]', '[[1]]', '[{"a": 1}, 2]', '["ping"]'):
+            sock.sendall(line + '\n')
+        answers = [json.loads(rfile.readline()) for n in range(8)]
+        self.assertEqual([answer['ok'] for answer in answers], [False] * 7 + [True])
+        self.assertEqual(answers[-1]['result'], 'pong')
+        sock.close()
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('localhost:7070'), ('localhost', 7070))
+        self.assertEqual(parse_address(':7070'), ('127.0.0.1', 7070))
+        self.assertEqual(parse_address('/tmp/bank.sock'), '/tmp/bank.sock')
+
+if __name__ == '__main__':
+    unittest.main()
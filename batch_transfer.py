@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of AccountActions
+#
+# applies a settlement file of transfers (from,to,amount a line) a chunk
+# at a time instead of one transfer_money call per line.
+#
+# for each chunk
+#   1. every account the chunk touches is locked once (a LockSet)
+#   2. the transfers are applied in file order to the balances in
+#      memory. a bad line, an unknown account or not enough money sends
+#      the line to the reject file, <dbdir>/batch_<name>.rej
+#   3. the new balances and the checkpoint file, <dbdir>/batch_<name>.ckpt,
+#      are written as one commit_transaction. the checkpoint says how far
+#      into the input we are and how long the reject file was.
+#
+# a run that dies is started again with the same name. recover.py first
+# finishes or drops the chunk that was being written, then the run reads
+# the checkpoint, cuts the reject file back to what the checkpoint
+# covers and carries on from the line after the last committed chunk.
+#
+import os
+import re
+import time
+import logging
+import argparse
+from collections import namedtuple
+
+from account_actions import AccountActions
+from atomic_write import AtomicWrite, LockError
+from lock_set import LockSet
+from account_history import KIND_TRANSFER_OUT, KIND_TRANSFER_IN
+from profiling import add_profile_args, setup_profiling_args
+
+# records, input offset, applied, rejected, reject file offset
+Checkpoint = namedtuple('Checkpoint', 'records offset applied rejected reject_offset')
+
+class BatchTransfer(AccountActions):
+
+    def __init__(self, dir=None, name='batch', chunk_size=1000, reject_filename=None):
+        AccountActions.__init__(self, dir)
+        # the name is part of file names
+        self.name = re.sub('[^A-Za-z0-9-]', '-', name)
+        self.chunk_size = chunk_size
+        self.checkpoint_filename = os.path.join(self.dbdir, "batch_%s.ckpt" % self.name)
+        if reject_filename is None:
+            reject_filename = os.path.join(self.dbdir, "batch_%s.rej" % self.name)
+        self.reject_filename = reject_filename
+        self.chunks = 0
+
+    # public
+    # applies the transfers in the file. returns the stats of the run
+    def run_file(self, input_filename):
+        f = open(input_filename, 'r')
+        try:
+            return self.__run(self.__read_lines(f))
+        finally:
+            f.close()
+
+    # public
+    # applies an iterable of (from, to, amount). after a crash pass the
+    # same records again, the ones the checkpoint covers are skipped.
+    def run(self, records):
+        return self.__run(self.__number_records(records))
+
+    # public
+    # the checkpoint of the batch, all zeros if it hasn't started
+    def read_checkpoint(self):
+        if os.path.exists(self.checkpoint_filename) is False:
+            return Checkpoint(0, 0, 0, 0, 0)
+        vals = self.read_content(self.checkpoint_filename).strip().split(',')
+        return Checkpoint(*[int(val) for val in vals])
+
+    # private
+    # the loop over the chunks. stream gives (record number, input offset
+    # after the record, record) and is positioned by the checkpoint
+    def __run(self, make_stream):
+        start = time.time()
+        ckpt_aw = self.__lock_checkpoint()
+        try:
+            ckpt = self.read_checkpoint()
+            logging.info("BT0085 batch %s starts at record %d", self.name, ckpt.records)
+            reject = self.__open_reject_file(ckpt.reject_offset)
+            try:
+                chunk = []
+                for item in make_stream(ckpt):
+                    chunk.append(item)
+                    if len(chunk) == self.chunk_size:
+                        ckpt = self.__apply_chunk(chunk, ckpt, ckpt_aw, reject)
+                        chunk = []
+                if len(chunk) > 0:
+                    ckpt = self.__apply_chunk(chunk, ckpt, ckpt_aw, reject)
+            finally:
+                reject.close()
+        finally:
+            ckpt_aw.unlock_file()
+
+        seconds = time.time() - start
+        logging.info("BT0101 batch %s done: %d records, %d applied, %d rejected in %.3f seconds",
+                     self.name, ckpt.records, ckpt.applied, ckpt.rejected, seconds)
+        return {'records': ckpt.records, 'applied': ckpt.applied, 'rejected': ckpt.rejected,
+                'chunks': self.chunks, 'seconds': seconds}
+
+    # private
+    # the checkpoint lock is held for the whole run so two runs of the
+    # same batch can't interleave. makes the checkpoint file if needed.
+    def __lock_checkpoint(self):
+        if os.path.exists(self.checkpoint_filename) is False:
+            tmpname = "%s.%d.tmp" % (self.checkpoint_filename, os.getpid())
+            f = open(tmpname, 'w')
+            f.write("0,0,0,0,0\n")
+            f.close()
+            os.rename(tmpname, self.checkpoint_filename)
+        ckpt_aw = AtomicWrite(self.dbdir)
+        ckpt_aw.set_file_name(self.checkpoint_filename)
+        if ckpt_aw.try_lock_file() is False:
+            raise LockError("batch %s is already running or needs recover.py" % self.name)
+        return ckpt_aw
+
+    # private
+    # anything in the reject file past the checkpoint is from a chunk that
+    # never committed, it will be written again
+    def __open_reject_file(self, offset):
+        reject = open(self.reject_filename, 'a')
+        reject.truncate(offset)
+        reject.seek(0, os.SEEK_END)
+        return reject
+
+    # private
+    # applies one chunk and commits it with the new checkpoint. returns
+    # the new checkpoint
+    def __apply_chunk(self, chunk, ckpt, ckpt_aw, reject):
+        # the checkpoint lock is held for the whole run, longer than its
+        # lease
+        ckpt_aw.renew_lock()
+        transid = ckpt_aw.id_generator()
+        rejects = []
+        transfers = []
+        members = {}
+
+        # check the lines and set up the accounts
+        for number, offset, record in chunk:
+            transfer, err = self.__parse(record)
+            if err is not None:
+                rejects.append((number, record, err))
+                continue
+            for ac_id in transfer[:2]:
+                if ac_id not in members:
+                    aw = AtomicWrite(self.dbdir)
+                    aw.set_transid(transid)
+                    aw.set_old_suffix("xold")
+                    aw.set_tmp_suffix("xtmp")
+                    aw.set_file_name(self.get_account_filename(ac_id))
+                    members[ac_id] = aw
+            transfers.append((number, record, transfer))
+
+        locks = LockSet(members.values())
+        locks.acquire()
+        try:
+            # the files may have moved while we waited for the locks
+            infos = {}
+            balances = {}
+            for ac_id, aw in members.items():
+                infos[ac_id] = self.read_account_file(aw.filename)
+                balances[ac_id] = infos[ac_id].balance
+
+            applied = 0
+            history = []
+            for number, record, (from_id, to_id, amount) in transfers:
+                if balances[from_id] - amount < 0:
+                    rejects.append((number, record, "not enough money in source account"))
+                    continue
+                balances[from_id] -= amount
+                balances[to_id] += amount
+                history.append((from_id, KIND_TRANSFER_OUT, to_id, amount, balances[from_id]))
+                history.append((to_id, KIND_TRANSFER_IN, from_id, amount, balances[to_id]))
+                applied += 1
+
+            # the rejects go out before the commit, the checkpoint says
+            # how much of the file is good
+            rejects.sort()
+            for number, record, err in rejects:
+                reject.write("%d,%s,%s\n" % (number, self.__format_record(record), err))
+            reject.flush()
+
+            last = chunk[-1]
+            new_ckpt = Checkpoint(last[0], last[1], ckpt.applied + applied,
+                                  ckpt.rejected + len(rejects), reject.tell())
+
+            ckpt_aw.set_transid(transid)
+            ckpt_aw.set_old_suffix("xold")
+            ckpt_aw.set_tmp_suffix("xtmp")
+            ckpt_aw.make_tmp_filenames()
+            commit = [(ckpt_aw, "%d,%d,%d,%d,%d\n" % new_ckpt)]
+            summary = []
+            for ac_id in sorted(members):
+                if balances[ac_id] == infos[ac_id].balance:
+                    continue
+                info = infos[ac_id]
+                commit.append((members[ac_id], "%s,%s,%s\n" % (info.fname, info.lname, balances[ac_id])))
+                summary.append((ac_id, info.fname, info.lname, balances[ac_id]))
+            # a big chunk can hold its account locks for a while, a
+            # lease must not run out on them half way through the commit
+            locks.renew()
+            ckpt_aw.renew_lock()
+            pending = self.record_history(history)
+            self.commit_transaction(commit)
+            self.finish_history(pending)
+            self.update_summary(summary)
+        finally:
+            locks.release()
+
+        self.chunks += 1
+        logging.debug("BT0192 batch %s chunk to record %d: %d applied, %d rejected, %d accounts",
+                      self.name, new_ckpt.records, applied, len(rejects), len(members))
+        return new_ckpt
+
+    # private
+    # returns ((from, to, amount), None) or (None, the reason it is bad)
+    def __parse(self, record):
+        if isinstance(record, str):
+            record = record.strip().split(',')
+        if len(record) != 3:
+            return None, "not a from,to,amount record"
+        from_id, to_id, amount = record
+        if self.isint(from_id) is False or self.isint(to_id) is False:
+            return None, "account id is not a valid number"
+        if self.isfloat(amount) is False or float(amount) < 0.0:
+            return None, "amount is not a valid number"
+        from_id = int(from_id)
+        to_id = int(to_id)
+        if from_id == to_id:
+            return None, "can't transfer money from an account to itself"
+        for ac_id in (from_id, to_id):
+            if self.check_account_file(ac_id) is False:
+                return None, "unknown account %s" % ac_id
+        return (from_id, to_id, float(amount)), None
+
+    def __format_record(self, record):
+        if isinstance(record, str):
+            return record.strip()
+        return ','.join([str(val) for val in record])
+
+    # private
+    # stream of the lines of a file from the checkpoint offset. blank
+    # lines and # comments aren't records
+    def __read_lines(self, f):
+        def stream(ckpt):
+            f.seek(ckpt.offset)
+            number = ckpt.records
+            while True:
+                line = f.readline()
+                if line == '':
+                    return
+                number += 1
+                if line.strip() == '' or line.startswith('#'):
+                    continue
+                yield (number, f.tell(), line)
+        return stream
+
+    # private
+    # stream of an iterable of records, skipping the ones the checkpoint
+    # covers
+    def __number_records(self, records):
+        def stream(ckpt):
+            number = 0
+            for record in records:
+                number += 1
+                if number <= ckpt.records:
+                    continue
+                yield (number, 0, record)
+        return stream
+
+def main():
+  parser = argparse.ArgumentParser(description='apply a file of from,to,amount transfers')
+  parser.add_argument('-d', '--dir', help='data directory', default=None)
+  parser.add_argument('-f', '--file', help='transfer file', required=True)
+  parser.add_argument('-n', '--name', help='batch name, run again with the same name to resume', default=None)
+  parser.add_argument('-c', '--chunk', help='transfers per commit', type=int, default=1000)
+  parser.add_argument('-r', '--reject', help='reject file', default=None)
+  add_profile_args(parser)
+  args = parser.parse_args()
+  setup_profiling_args(args)
+  name = args.name
+  if name is None:
+    name = os.path.splitext(os.path.basename(args.file))[0]
+  bt = BatchTransfer(args.dir, name, args.chunk, args.reject)
+  stats = bt.run_file(args.file)
+  print "%d records, %d applied, %d rejected (%s) in %.3f seconds" % (
+    stats['records'], stats['applied'], stats['rejected'], bt.reject_filename, stats['seconds'])
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for BatchTransfer
+#
+import unittest
+import os
+import shutil
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from batch_transfer import BatchTransfer
+from recover import Recover
+
+# dies after step 3 of the second commit, the account files and the
+# checkpoint are all moved to xold
+class CrashingBatch(BatchTransfer):
+
+    def __init__(self, *args):
+        BatchTransfer.__init__(self, *args)
+        self.commits = 0
+
+    def commit_transaction(self, members):
+        self.commits += 1
+        if self.commits < 2:
+            return BatchTransfer.commit_transaction(self, members)
+        for aw, content in members:
+            f = open(aw.get_tmpfile(), 'w')
+            f.write(content)
+            f.close()
+        for aw, content in members:
+            os.rename(aw.filename, aw.get_oldfile())
+        raise KeyboardInterrupt()
+
+class BatchTransfer_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'batch_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+        ac = AccountCreate(self.dir)
+        self.ids = [ac.create_account('Member', str(i), 100.0) for i in range(3)]
+        a, b, c = self.ids
+        self.records = [(a, b, 10.0), (b, c, 20.0), (c, a, 5.0),
+                        (a, c, 500.0),           # not enough money
+                        (a, 9999, 1.0),          # unknown account
+                        (b, a, 1.0), (c, b, 2.5)]
+        self.balances = [96.0, 91.5, 112.5]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __balances(self):
+        aa = AccountActions(self.dir)
+        return [aa.get_account_info(ac_id).balance for ac_id in self.ids]
+
+    def __rejects(self, bt):
+        f = open(bt.reject_filename)
+        lines = f.readlines()
+        f.close()
+        return lines
+
+    def test_run_file(self):
+        a, b, c = self.ids
+        fname = os.path.join(self.dir, 'settle.csv')
+        f = open(fname, 'w')
+        f.write('# from,to,amount\n')
+        for record in self.records:
+            f.write('%s,%s,%s\n' % record)
+        f.write('%s,%s\n' % (a, b))
+        f.close()
+
+        bt = BatchTransfer(self.dir, 'settle', 3)
+        stats = bt.run_file(fname)
+        self.assertEqual(stats['applied'], 5)
+        self.assertEqual(stats['rejected'], 3)
+        self.assertEqual(stats['chunks'], 3)
+        self.assertEqual(self.__balances(), self.balances)
+        self.assertEqual(AccountActions(self.dir).get_bank_totals().balance, 300.0)
+
+        rejects = self.__rejects(bt)
+        self.assertEqual(len(rejects), 3)
+        self.assertTrue(rejects[0].startswith('5,%s,%s,500.0,not enough money' % (a, c)))
+        self.assertTrue(rejects[2].startswith('9,'))
+
+        # running it again finds nothing left to do
+        stats = BatchTransfer(self.dir, 'settle', 3).run_file(fname)
+        self.assertEqual(stats['chunks'], 0)
+        self.assertEqual(self.__balances(), self.balances)
+
+    def test_resume(self):
+        def dies_after(n):
+            for record in self.records[:n]:
+                yield record
+            raise KeyboardInterrupt()
+
+        bt = BatchTransfer(self.dir, 'resume', 2)
+        self.assertRaises(KeyboardInterrupt, bt.run, dies_after(5))
+        self.assertEqual(bt.read_checkpoint().records, 4)
+
+        # a reject that was written for a chunk that never committed
+        f = open(bt.reject_filename, 'a')
+        f.write('5,junk\n')
+        f.close()
+
+        stats = BatchTransfer(self.dir, 'resume', 2).run(self.records)
+        self.assertEqual(stats['records'], 7)
+        self.assertEqual(stats['rejected'], 2)
+        self.assertEqual(self.__balances(), self.balances)
+        self.assertEqual(len(self.__rejects(bt)), 2)
+
+    def test_recover_crashed_commit(self):
+        bt = CrashingBatch(self.dir, 'crash', 3)
+        self.assertRaises(KeyboardInterrupt, bt.run, self.records)
+
+        # the second chunk was past step 3 so recover.py finishes it
+        stats = Recover(self.dir).recover()
+        self.assertEqual(stats['transfers'], 1)
+        self.assertEqual(bt.read_checkpoint().records, 6)
+
+        BatchTransfer(self.dir, 'crash', 3).run(self.records)
+        self.assertEqual(self.__balances(), self.balances)
+        for fn in os.listdir(self.dir):
+            self.assertFalse(fn.endswith('xtmp') or fn.endswith('xold'))
+
+if __name__ == '__main__':
+    unittest.main()
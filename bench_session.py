@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# times deposits, withdraws and transfers done the old way, a new
+# AccountActions call each, against an AccountSession, and counts the
+# system calls each one makes.
+#
+# the calls are counted by wrapping the os functions the code makes them
+# through (stat, open, rename, ...), the builtin open and fcntl.flock for
+# the length of a run. the reads and writes of python file objects are
+# not in it, they are the same both ways.
+#
+import os
+import time
+import fcntl
+import random
+import shutil
+import argparse
+import __builtin__
+from collections import Counter
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from account_session import AccountSession
+from drove_bank_constants import write_config
+
+# the os functions that are a system call (or a few, like makedirs)
+OS_CALLS = ('stat', 'lstat', 'fstat', 'open', 'close', 'read', 'write', 'rename', 'remove',
+            'unlink', 'rmdir', 'mkdir', 'listdir', 'fsync', 'ftruncate', 'lseek', 'utime',
+            'chmod', 'access', 'fdopen', 'dup')
+
+OPS = ('deposit', 'withdraw', 'transfer')
+
+# counts the calls made through the wrapped functions while it is entered
+class SyscallCounter(object):
+
+    def __init__(self):
+        self.counts = Counter()
+        self.saved = []
+
+    def __enter__(self):
+        for name in OS_CALLS:
+            if hasattr(os, name):
+                self.__wrap(os, name, name)
+        self.__wrap(__builtin__, 'open', 'open')
+        self.__wrap(fcntl, 'flock', 'flock')
+        return self
+
+    def __exit__(self, *exc):
+        for module, name, func in self.saved:
+            setattr(module, name, func)
+        self.saved = []
+        return False
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def __wrap(self, module, name, label):
+        func = getattr(module, name)
+        counts = self.counts
+        def counted(*args, **kwargs):
+            counts[label] += 1
+            return func(*args, **kwargs)
+        self.saved.append((module, name, func))
+        setattr(module, name, counted)
+
+class SessionBench(object):
+
+    def __init__(self, dir, accounts=100, ops=1000, seed=None):
+        self.dir = dir
+        self.accounts = accounts
+        self.ops = ops
+        self.random = random.Random(seed)
+
+    # public
+    # returns {(way, op): (seconds, calls, Counter)}, way old or session
+    def run(self, storage='files'):
+        dbdir = os.path.join(self.dir, 'bench_session')
+        if os.path.exists(dbdir):
+            shutil.rmtree(dbdir)
+        os.makedirs(dbdir)
+        write_config(dbdir, {'storage': storage})
+        f = open(os.path.join(dbdir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+        ids = AccountCreate(dbdir).create_accounts(
+            [('First%d' % n, 'Last%d' % n, 1000000.0) for n in range(self.accounts)])
+        pairs = [tuple(self.random.sample(ids, 2)) for n in range(self.ops)]
+
+        session = AccountSession(dbdir)
+        ways = (('old', lambda: AccountActions(dbdir)), ('session', lambda: session))
+        results = {}
+        for op in OPS:
+            for way, make in ways:
+                results[(way, op)] = self.__time(make, op, pairs)
+        shutil.rmtree(dbdir)
+        return results
+
+    def __time(self, make, op, pairs):
+        with SyscallCounter() as counter:
+            start = time.time()
+            for from_id, to_id in pairs:
+                bank = make()
+                if op == 'deposit':
+                    bank.deposit(from_id, 1.0)
+                elif op == 'withdraw':
+                    bank.withdraw(from_id, 1.0)
+                else:
+                    bank.transfer_money(from_id, to_id, 1.0)
+            seconds = time.time() - start
+        return seconds, counter.total(), counter.counts
+
+def main():
+  parser = argparse.ArgumentParser(description='system calls and time of AccountSession')
+  parser.add_argument('-d', '--dir', help='dir for the bench dbdir', default='.')
+  parser.add_argument('-a', '--accounts', help='number of accounts', type=int, default=100)
+  parser.add_argument('-o', '--ops', help='operations of each kind', type=int, default=1000)
+  parser.add_argument('-s', '--storage', help='storage engine', default='files')
+  parser.add_argument('-v', '--verbose', help='show the calls by name', action='store_true')
+  parser.add_argument('--seed', help='seed of the account picks', type=int, default=None)
+  args = parser.parse_args()
+
+  results = SessionBench(args.dir, args.accounts, args.ops, args.seed).run(args.storage)
+  print "%d ops each, storage = %s" % (args.ops, args.storage)
+  print "%-10s %14s %14s %12s %12s" % ('op', 'calls/op old', 'calls/op new', 'us/op old', 'us/op new')
+  for op in OPS:
+    old = results[('old', op)]
+    new = results[('session', op)]
+    print "%-10s %14.1f %14.1f %12.1f %12.1f" % (op, float(old[1]) / args.ops, float(new[1]) / args.ops,
+                                                 old[0] * 1e6 / args.ops, new[0] * 1e6 / args.ops)
+    if args.verbose:
+      for name in sorted(set(old[2]) | set(new[2])):
+        print "    %-12s %12.1f %14.1f" % (name, float(old[2][name]) / args.ops,
+                                           float(new[2][name]) / args.ops)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# times the storage engines against each other on the same work.
+#
+# for every storage a fresh dbdir is made under --dir with --accounts
+# accounts, then it times
+#   create:   loading the accounts with create_accounts
+#   read:     --ops reads of random accounts
+#   deposit:  --ops deposits to random accounts
+#   transfer: --ops transfers between random accounts
+#   list:     reading every account in id order
+#
+# the read cache is turned off so a read is a read of the store.
+#
+import os
+import time
+import random
+import shutil
+import argparse
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import write_config
+
+STORAGES = ('files', 'binary')
+
+class StorageBench(object):
+
+    def __init__(self, dir, accounts=1000, ops=1000, seed=None):
+        self.dir = dir
+        self.accounts = accounts
+        self.ops = ops
+        self.random = random.Random(seed)
+
+    # public
+    # runs the bench for a storage. returns a dict of name -> seconds
+    def run(self, storage):
+        dbdir = os.path.join(self.dir, "bench_%s" % storage)
+        if os.path.exists(dbdir):
+            shutil.rmtree(dbdir)
+        os.makedirs(dbdir)
+        write_config(dbdir, {'storage': storage, 'read_cache_size': 0, 'summary': 'off'})
+        f = open(os.path.join(dbdir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+        times = {}
+        start = time.time()
+        ids = AccountCreate(dbdir).create_accounts(
+            [('First%d' % n, 'Last%d' % n, 1000.0) for n in range(self.accounts)])
+        times['create'] = time.time() - start
+
+        aa = AccountActions(dbdir)
+        picks = [self.random.choice(ids) for n in range(self.ops * 2)]
+
+        start = time.time()
+        for ac_id in picks[:self.ops]:
+            aa.get_account_info(ac_id)
+        times['read'] = time.time() - start
+
+        start = time.time()
+        for ac_id in picks[:self.ops]:
+            aa.deposit(ac_id, 1.0)
+        times['deposit'] = time.time() - start
+
+        start = time.time()
+        for n in range(self.ops):
+            from_id, to_id = picks[n], picks[self.ops + n]
+            if from_id != to_id:
+                aa.transfer_money(from_id, to_id, 1.0)
+        times['transfer'] = time.time() - start
+
+        start = time.time()
+        for record in aa.iter_account_files():
+            pass
+        times['list'] = time.time() - start
+
+        shutil.rmtree(dbdir)
+        return times
+
+def main():
+  parser = argparse.ArgumentParser(description='time the storage engines')
+  parser.add_argument('-d', '--dir', help='dir for the bench dbdirs', default='.')
+  parser.add_argument('-a', '--accounts', help='number of accounts', type=int, default=1000)
+  parser.add_argument('-o', '--ops', help='reads, deposits and transfers to time', type=int, default=1000)
+  parser.add_argument('-s', '--storage', help='storage to time, all of them if not given',
+                      choices=STORAGES, action='append')
+  parser.add_argument('--seed', help='seed of the account picks', type=int, default=None)
+  args = parser.parse_args()
+
+  steps = ('create', 'read', 'deposit', 'transfer', 'list')
+  print "%d accounts, %d ops" % (args.accounts, args.ops)
+  print "%-10s %s" % ('storage', ' '.join(["%10s" % step for step in steps]))
+  for storage in args.storage or STORAGES:
+    times = StorageBench(args.dir, args.accounts, args.ops, args.seed).run(storage)
+    print "%-10s %s" % (storage, ' '.join(["%9.3fs" % times[step] for step in steps]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# micro benchmarks of the storage primitives, written as JSON and
+# checked against a baseline run.
+#
+#   atomicwrite           AtomicWrite.atomicwrite of an account file
+#   lock                  lock_file and unlock_file
+#   deposit, withdraw     AccountUtil
+#   transfer              AccountActions.transfer_money
+#   create                AccountCreate.create_account
+#   print_accounts_<n>    print_accounts of a bank of n accounts, for
+#                         every --sizes
+#   recover_<n>           Recover.recover of a dbdir with n half done
+#                         deposits and transfers left behind, for every
+#                         --artifacts
+#   unblock_<backend>     from a kill -9 of a process half way through a
+#                         deposit (or a transfer) to the waiter for its
+#                         lock having it, for both lock backends
+#
+# every op is timed on its own and a result is the count, mean, median,
+# 95th percentile, min and max in microseconds. the dbdirs are made under
+# --dir, /dev/shm (tmpfs) by default when there is one; the JSON says
+# which filesystem it was.
+#
+#   ./benchmark.py -j base.json
+#   ... change the storage code ...
+#   ./benchmark.py --baseline base.json (--threshold 10)
+#
+# compares the medians and exits 1 if one got slower than the threshold
+# percent.
+#
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import threading
+import platform
+import argparse
+
+from atomic_write import AtomicWrite
+from account_util import AccountUtil
+from account_actions import AccountActions
+from account_create import AccountCreate
+from recover import Recover
+from drove_bank_constants import write_config
+
+BENCHMARKS = ('atomicwrite', 'lock', 'deposit', 'withdraw', 'transfer', 'create',
+              'print_accounts', 'recover', 'unblock')
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+DEFAULT_ARTIFACTS = (0, 100, 1000)
+
+# percent a median can grow before it is a regression
+DEFAULT_THRESHOLD = 10.0
+
+# the result compared with the baseline
+COMPARE_STAT = 'p50_us'
+
+class Benchmark(object):
+
+    def __init__(self, dir, accounts=1000, ops=1000, sizes=DEFAULT_SIZES,
+                 artifacts=DEFAULT_ARTIFACTS, storage='files', repeat=3, seed=None):
+        self.dir = dir
+        self.accounts = accounts
+        self.ops = ops
+        self.sizes = sizes
+        self.artifacts = artifacts
+        self.storage = storage
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        # the AtomicWrites __half_write leaves open
+        self.held = []
+
+    # public
+    # runs the benchmarks of names, every one if None. returns {'meta':
+    # how it was run, 'results': {name: stats}}
+    def run(self, names=None):
+        names = names or BENCHMARKS
+        results = {}
+        ops = [name for name in names if name not in ('print_accounts', 'recover', 'unblock')]
+        if len(ops) > 0:
+            dbdir, ids = self.__make_dbdir('ops', self.accounts)
+            for name in ops:
+                results[name] = getattr(self, '_bench_' + name)(dbdir, ids)
+            shutil.rmtree(dbdir)
+        if 'print_accounts' in names:
+            for size in self.sizes:
+                dbdir, ids = self.__make_dbdir('print', size)
+                aa = AccountActions(dbdir)
+                results['print_accounts_%d' % size] = self.__time([aa.print_accounts] * self.repeat)
+                shutil.rmtree(dbdir)
+        if 'recover' in names:
+            for count in self.artifacts:
+                results['recover_%d' % count] = self.__bench_recover(count)
+        if 'unblock' in names:
+            for backend in ('lockfile', 'flock'):
+                results['unblock_%s' % backend] = self.__bench_unblock(backend)
+        return {'meta': self.__meta(), 'results': results}
+
+    def _bench_atomicwrite(self, dbdir, ids):
+        writers = []
+        for ac_id in self.__picks(ids):
+            aw = AtomicWrite(dbdir, self.__filename(dbdir, ac_id))
+            writers.append(lambda aw=aw, ac_id=ac_id: aw.atomicwrite("First%d,Last%d,1000.0\n" % (ac_id, ac_id)))
+        return self.__time(writers)
+
+    def _bench_lock(self, dbdir, ids):
+        def lock(aw):
+            aw.lock_file()
+            aw.unlock_file()
+        return self.__time([lambda aw=AtomicWrite(dbdir, self.__filename(dbdir, ac_id)): lock(aw)
+                            for ac_id in self.__picks(ids)])
+
+    def _bench_deposit(self, dbdir, ids):
+        util = AccountUtil(dbdir)
+        return self.__time([lambda ac_id=ac_id: util.deposit(ac_id, 1.0) for ac_id in self.__picks(ids)])
+
+    def _bench_withdraw(self, dbdir, ids):
+        util = AccountUtil(dbdir)
+        return self.__time([lambda ac_id=ac_id: util.withdraw(ac_id, 1.0) for ac_id in self.__picks(ids)])
+
+    def _bench_transfer(self, dbdir, ids):
+        aa = AccountActions(dbdir)
+        calls = []
+        for n in range(self.ops):
+            from_id, to_id = self.random.sample(ids, 2)
+            calls.append(lambda from_id=from_id, to_id=to_id: aa.transfer_money(from_id, to_id, 1.0))
+        return self.__time(calls)
+
+    def _bench_create(self, dbdir, ids):
+        ac = AccountCreate(dbdir)
+        return self.__time([lambda n=n: ac.create_account('First%d' % n, 'Last%d' % n, 1000.0)
+                            for n in range(self.ops)])
+
+    # private
+    # recover of a dbdir with count artifacts, half deposits that died
+    # after the tmp copy and half transfers that died after both copies
+    def __bench_recover(self, count):
+        dbdir, ids = self.__make_dbdir('recover', max(count * 2, 10))
+        samples = []
+        for n in range(self.repeat):
+            self.__leave_artifacts(dbdir, ids, count)
+            start = time.time()
+            Recover(dbdir).recover()
+            samples.append(time.time() - start)
+        shutil.rmtree(dbdir)
+        return self.__stats(samples)
+
+    def __leave_artifacts(self, dbdir, ids, count):
+        ids = list(ids)
+        for n in range(count):
+            if n % 2 == 0:
+                self.__half_write(dbdir, [ids.pop()])
+            else:
+                self.__half_write(dbdir, [ids.pop(), ids.pop()])
+
+    # locks the accounts and copies them to tmp files, a deposit (one
+    # account) or transfer that stopped after step 1. close lets go of the
+    # files, with the flock backend that is the holder dying. otherwise
+    # they are kept in self.held so their files stay open. returns the
+    # AtomicWrites
+    def __half_write(self, dbdir, ac_ids, close=True):
+        transid = None
+        writers = []
+        for ac_id in ac_ids:
+            aw = AtomicWrite(dbdir)
+            if len(ac_ids) > 1:
+                transid = transid or aw.id_generator()
+                aw.set_transid(transid)
+                aw.set_tmp_suffix("xtmp")
+                aw.set_old_suffix("xold")
+            aw.set_file_name(self.__filename(dbdir, ac_id))
+            aw.lock_file()
+            shutil.copy2(aw.filename, aw.get_tmpfile())
+            if close:
+                aw.lockfile.close()
+            else:
+                self.held.append(aw)
+            writers.append(aw)
+        return writers
+
+    # private
+    # a child process stops half way through a deposit (even runs) or a
+    # transfer, a thread waits for the lock and the child is killed. the
+    # time is from the kill to the waiter having the lock
+    def __bench_unblock(self, backend):
+        dbdir, ids = self.__make_dbdir('unblock', 10)
+        write_config(dbdir, {'storage': self.storage, 'lock_backend': backend})
+        samples = []
+        for n in range(self.repeat):
+            ac_ids = self.random.sample(ids, 1 + n % 2)
+            ready, done = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(ready)
+                self.__half_write(dbdir, ac_ids, False)
+                os.write(done, 'x')
+                time.sleep(60)
+                os._exit(0)
+            os.close(done)
+            os.read(ready, 1)
+            os.close(ready)
+
+            aw = AtomicWrite(dbdir, self.__filename(dbdir, ac_ids[-1]))
+            unblocked = []
+            waiter = threading.Thread(target=lambda: unblocked.append(aw.lock_file() or time.time()))
+            waiter.start()
+            time.sleep(0.05)
+            killed = time.time()
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            waiter.join()
+            aw.unlock_file()
+            samples.append(unblocked[0] - killed)
+        shutil.rmtree(dbdir)
+        return self.__stats(samples)
+
+    # a fresh dbdir with count accounts. returns it and the ids
+    def __make_dbdir(self, name, count):
+        dbdir = os.path.join(self.dir, 'benchmark_%s' % name)
+        if os.path.exists(dbdir):
+            shutil.rmtree(dbdir)
+        os.makedirs(dbdir)
+        write_config(dbdir, {'storage': self.storage})
+        f = open(os.path.join(dbdir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+        ids = AccountCreate(dbdir).create_accounts(
+            [('First%d' % n, 'Last%d' % n, 1000000.0) for n in range(count)])
+        return dbdir, ids
+
+    def __filename(self, dbdir, ac_id):
+        return AccountUtil(dbdir).get_account_filename(ac_id)
+
+    def __picks(self, ids):
+        return [self.random.choice(ids) for n in range(self.ops)]
+
+    # runs the calls, timing each one
+    def __time(self, calls):
+        samples = []
+        for call in calls:
+            start = time.time()
+            call()
+            samples.append(time.time() - start)
+        return self.__stats(samples)
+
+    def __stats(self, samples):
+        samples = sorted(samples)
+        n = len(samples)
+        return {'n': n,
+                'mean_us': sum(samples) / n * 1e6,
+                'p50_us': samples[n // 2] * 1e6,
+                'p95_us': samples[min(n - 1, int(n * 0.95))] * 1e6,
+                'min_us': samples[0] * 1e6,
+                'max_us': samples[-1] * 1e6}
+
+    def __meta(self):
+        return {'time': time.time(), 'host': socket.gethostname(), 'python': platform.python_version(),
+                'platform': platform.platform(), 'dir': os.path.abspath(self.dir),
+                'fstype': fstype(self.dir), 'storage': self.storage, 'accounts': self.accounts,
+                'ops': self.ops, 'repeat': self.repeat}
+
+# the filesystem type of path from /proc/mounts, None if it can't be told
+def fstype(path):
+    path = os.path.realpath(path)
+    best = (None, None)
+    try:
+        f = open('/proc/mounts')
+        mounts = f.readlines()
+        f.close()
+    except IOError:
+        return None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount = fields[1]
+        if path == mount or path.startswith(mount.rstrip('/') + '/'):
+            if best[0] is None or len(mount) > len(best[0]):
+                best = (mount, fields[2])
+    return best[1]
+
+# the benchmarks of both runs side by side: a list of (name, baseline us,
+# us, percent change, regressed)
+def compare(run, baseline, threshold=DEFAULT_THRESHOLD):
+    rows = []
+    for name in sorted(run['results']):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        was = before[COMPARE_STAT]
+        now = run['results'][name][COMPARE_STAT]
+        change = (now - was) / was * 100.0 if was > 0 else 0.0
+        rows.append((name, was, now, change, change > threshold))
+    return rows
+
+def load_results(path):
+    f = open(path)
+    results = json.load(f)
+    f.close()
+    return results
+
+def save_results(results, path):
+    if path == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    tmppath = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmppath, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+    f.close()
+    os.rename(tmppath, path)
+
+def parse_counts(text):
+    return tuple(int(value) for value in text.split(',') if value.strip())
+
+def main():
+  default_dir = '/dev/shm' if os.path.isdir('/dev/shm') else '.'
+  parser = argparse.ArgumentParser(description='micro benchmarks of the storage primitives')
+  parser.add_argument('-d', '--dir', help='dir for the bench dbdirs (default %s)' % default_dir,
+                      default=default_dir)
+  parser.add_argument('-a', '--accounts', help='accounts in the dbdir of the op benchmarks', type=int,
+                      default=1000)
+  parser.add_argument('-o', '--ops', help='ops timed by each op benchmark', type=int, default=1000)
+  parser.add_argument('-s', '--sizes', help='bank sizes for print_accounts',
+                      default=','.join(map(str, DEFAULT_SIZES)))
+  parser.add_argument('-r', '--artifacts', help='half done writes for recover',
+                      default=','.join(map(str, DEFAULT_ARTIFACTS)))
+  parser.add_argument('-b', '--bench', help='a benchmark to run, all of them if not given',
+                      choices=BENCHMARKS, action='append')
+  parser.add_argument('--storage', help='storage engine', default='files')
+  parser.add_argument('--repeat', help='runs of print_accounts and recover', type=int, default=3)
+  parser.add_argument('--seed', help='seed of the account picks', type=int, default=None)
+  parser.add_argument('-j', '--json', help="write the results to this file ('-' for stdout)", default=None)
+  parser.add_argument('--baseline', help='results file to compare with', default=None)
+  parser.add_argument('--threshold', help='percent slower that is a regression', type=float,
+                      default=DEFAULT_THRESHOLD)
+  args = parser.parse_args()
+
+  bench = Benchmark(args.dir, args.accounts, args.ops, parse_counts(args.sizes),
+                    parse_counts(args.artifacts), args.storage, args.repeat, args.seed)
+  run = bench.run(args.bench)
+  if args.json is not None:
+    save_results(run, args.json)
+  out = sys.stderr if args.json == '-' else sys.stdout
+
+  meta = run['meta']
+  print >>out, "%s on %s (%s), storage = %s" % (meta['host'], meta['dir'], meta['fstype'], meta['storage'])
+  print >>out, "%-22s %8s %12s %12s %12s" % ('benchmark', 'n', 'mean us', 'p50 us', 'p95 us')
+  for name in sorted(run['results']):
+    stats = run['results'][name]
+    print >>out, "%-22s %8d %12.1f %12.1f %12.1f" % (name, stats['n'], stats['mean_us'],
+                                                     stats['p50_us'], stats['p95_us'])
+  if args.baseline is None:
+    return
+
+  baseline = load_results(args.baseline)
+  for key in ('fstype', 'storage', 'host'):
+    if baseline['meta'].get(key) != meta.get(key):
+      print >>out, "note: the baseline has %s %s, this run %s" % (key, baseline['meta'].get(key), meta.get(key))
+  regressions = 0
+  print >>out, "%-22s %12s %12s %9s" % ('benchmark', 'base p50', 'p50', 'change')
+  for name, was, now, change, regressed in compare(run, baseline, args.threshold):
+    print >>out, "%-22s %12.1f %12.1f %+8.1f%%%s" % (name, was, now, change,
+                                                     '  REGRESSION' if regressed else '')
+    if regressed:
+      regressions += 1
+  if regressions > 0:
+    print >>out, "%d regressions over %.1f%%" % (regressions, args.threshold)
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for benchmark.py
+#
+import unittest
+import os
+import shutil
+
+from benchmark import Benchmark, compare, save_results, load_results
+
+class Benchmark_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'benchmark_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_run(self):
+        bench = Benchmark(self.dir, accounts=20, ops=10, sizes=(5, 50), artifacts=(0, 6), repeat=2, seed=1)
+        run = bench.run()
+        self.assertEqual(sorted(run['results']),
+                         ['atomicwrite', 'create', 'deposit', 'lock', 'print_accounts_5',
+                          'print_accounts_50', 'recover_0', 'recover_6', 'transfer',
+                          'unblock_flock', 'unblock_lockfile', 'withdraw'])
+        self.assertEqual(run['results']['deposit']['n'], 10)
+        self.assertEqual(run['results']['recover_6']['n'], 2)
+        # the waiter has the lock after the kill, well before any timeout
+        self.assertEqual(run['results']['unblock_flock']['n'], 2)
+        self.assertTrue(0 < run['results']['unblock_flock']['min_us'])
+        self.assertTrue(run['results']['unblock_lockfile']['max_us'] < 5e6)
+        for stats in run['results'].values():
+            self.assertTrue(stats['min_us'] <= stats['p50_us'] <= stats['p95_us'] <= stats['max_us'])
+        self.assertEqual(run['meta']['storage'], 'files')
+        # the dbdirs are gone
+        self.assertEqual(os.listdir(self.dir), [])
+
+        path = os.path.join(self.dir, 'run.json')
+        save_results(run, path)
+        self.assertEqual(load_results(path)['results'], run['results'])
+
+    def test_compare(self):
+        baseline = {'meta': {}, 'results': {'deposit': {'p50_us': 100.0}, 'lock': {'p50_us': 10.0},
+                                            'gone': {'p50_us': 1.0}}}
+        run = {'meta': {}, 'results': {'deposit': {'p50_us': 125.0}, 'lock': {'p50_us': 10.5},
+                                       'new': {'p50_us': 1.0}}}
+        self.assertEqual(compare(run, baseline, 10.0),
+                         [('deposit', 100.0, 125.0, 25.0, True), ('lock', 10.0, 10.5, 5.0, False)])
+        self.assertEqual([row[4] for row in compare(run, baseline, 30.0)], [False, False])
+
+if __name__ == '__main__':
+    unittest.main()
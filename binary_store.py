@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of DroveBankConstants.
+#
+# Binary account store. Used when the dbdir config says storage = binary.
+#
+# Every account is a fixed size record in <dbdir>/accounts.dat instead of
+# a <id>.txt file, account n at HEADER_SIZE + (n * RECORD_SIZE):
+#
+#   flags, crc32, version, balance, offset of the name
+#
+# the names never change so they are appended once to <dbdir>/names.dat
+# as "fname,lname\n" and the record points at them. Both files are
+# mmap'd, a read is a slice of the map and a commit writes the records in
+# place.
+#
+# A commit writes what it is going to change to <dbdir>/accounts.jnl
+#
+#   DJNL2 <crc32 hex> <json list of changes>
+#
+# and fsyncs it, then writes the records (and any other files of the
+# commit, i.e. a batch checkpoint) and flushes the map. A commit that dies
+# before its journal line is complete never happened, one that dies after
+# is written again by the next commit or recover.py. The same values are
+# written again so that is safe. Commits of every process are serialized
+# with flock on the journal, a reader doesn't lock, a record it catches
+# half written fails its crc and is read again.
+#
+# The balance is the same double the account file would have. A store
+# from before that (DACC1, balances in cents) is rewritten when it is
+# opened, and a DJNL1 journal of it is read as cents.
+#
+# The store only knows account files, anything else (index.idx, the
+# summary) is still a file. The accounts keep their <id>.txt names, and
+# lock files, everywhere above this module. AtomicWrite and AccountUtil
+# hand the store the file name and it works out the id.
+#
+import os
+import json
+import zlib
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import logging
+import argparse
+import threading
+from collections import namedtuple
+
+from drove_bank_constants import DroveBankConstants, CONFIG_DEFAULTS, load_config, write_config
+
+STORE_FILENAME = 'accounts.dat'
+NAMES_FILENAME = 'names.dat'
+JOURNAL_FILENAME = 'accounts.jnl'
+STORE_MAGIC = b'DACC2\0\0\0'
+JOURNAL_MAGIC = 'DJNL2'
+CENTS_STORE_MAGIC = b'DACC1\0\0\0'
+CENTS_JOURNAL_MAGIC = 'DJNL1'
+
+# magic, record size
+HEADER = struct.Struct('<8sI')
+HEADER_SIZE = 64
+# flags, crc, version, balance, name offset
+RECORD = struct.Struct('<B3xIQdQ')
+RECORD_SIZE = RECORD.size
+# the record of a DACC1 store, the balance in cents
+CENTS_RECORD = struct.Struct('<B3xIQqQ')
+FLAG_USED = 1
+
+# the file grows this many records at a time
+GROW_RECORDS = 4096
+
+# times a read tries a record that fails its crc, a writer is in the
+# middle of it
+READ_RETRIES = 100
+
+StoreRecord = namedtuple('StoreRecord', 'id fname lname balance version')
+
+# dbdir -> BinaryStore. one map per dbdir per process.
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_binary_store(dbdir):
+    # every read comes through here, skip the abspath for a dbdir seen before
+    store = _stores.get(dbdir)
+    if store is not None:
+        return store
+    key = os.path.abspath(dbdir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = BinaryStore(key)
+            _stores[key] = store
+        _stores[dbdir] = store
+        return store
+
+def from_cents(cents):
+    return cents / 100.0
+
+# the crc of the raw fields of a record of ac_id, packed with record
+def record_crc(record, ac_id, raw):
+    data = struct.pack('<Q', ac_id) + record.pack(raw[0], 0, raw[2], raw[3], raw[4])
+    return zlib.crc32(data) & 0xffffffff
+
+class BinaryStore(DroveBankConstants):
+
+    def __init__(self, dir=None):
+        DroveBankConstants.__init__(self, dir)
+        self.store_filename = os.path.join(self.dbdir, STORE_FILENAME)
+        self.names_filename = os.path.join(self.dbdir, NAMES_FILENAME)
+        self.journal_filename = os.path.join(self.dbdir, JOURNAL_FILENAME)
+        # flock doesn't keep the threads of one process apart
+        self.mutex = threading.RLock()
+        self.pid = None
+        self.fd = None
+        self.map = None
+        self.names_fd = None
+        self.names_map = None
+        self.jfd = None
+
+    # public
+    # True for the file name of an account, the store has the account
+    def handles(self, filename):
+        return filename.endswith('.txt') and self.account_id(filename) is not None
+
+    # public
+    # the account id of a file name. the layout is always flat with the
+    # binary store so the name is the id.
+    def account_id(self, filename):
+        prefix = os.path.basename(filename).split('.')[0]
+        if prefix.isdigit() is False:
+            return None
+        return int(prefix)
+
+    # public
+    # True if the account of filename is in the store
+    def exists(self, filename):
+        return self.read(self.account_id(filename)) is not None
+
+    # public
+    # the content of an account file ("fname,lname,balance\n"), None if
+    # there is no such account
+    def lookup(self, filename):
+        record = self.read(self.account_id(filename))
+        if record is None:
+            return None
+        return "%s,%s,%s\n" % (record.fname, record.lname, record.balance)
+
+    # public
+    # the StoreRecord of an account, None if it doesn't exist
+    def read(self, ac_id):
+        with self.mutex:
+            self.__open()
+            tries = 0
+            while True:
+                raw = self.__read_raw(ac_id)
+                if raw is None or raw[0] & FLAG_USED == 0:
+                    return None
+                if self.__crc(ac_id, raw) == raw[1]:
+                    break
+                tries += 1
+                if tries >= READ_RETRIES:
+                    raise IOError(errno.EIO, "account %s is corrupt in %s" % (ac_id, self.store_filename))
+                time.sleep(0.0001)
+            flags, crc, version, balance, name_off = raw
+            fname, lname = self.__read_name(name_off)
+            return StoreRecord(ac_id, fname, lname, balance, version)
+
+    # public
+    # generator of StoreRecords in id order from start_id
+    def records(self, start_id=0):
+        ac_id = start_id
+        end = 0
+        while True:
+            if ac_id >= end:
+                # take a fresh look at the end, accounts may have been added
+                with self.mutex:
+                    self.__open()
+                    end = self.__record_count()
+                if ac_id >= end:
+                    return
+            record = self.read(ac_id)
+            if record is not None:
+                yield record
+            ac_id += 1
+
+    # public
+    # commits a list of (filename, content) as one change. account files
+    # go into the store, other files are written next to it. the caller
+    # holds the locks of the files.
+    def commit(self, changes):
+        with self.mutex:
+            self.__open()
+            fcntl.flock(self.jfd, fcntl.LOCK_EX)
+            try:
+                self.__replay()
+                entries = self.__make_entries(changes)
+                self.__write_journal(entries)
+                self.__apply(entries)
+                os.ftruncate(self.jfd, 0)
+            finally:
+                fcntl.flock(self.jfd, fcntl.LOCK_UN)
+
+    # public
+    # finishes the commit of a process that died. called by recover.py
+    def recover(self):
+        with self.mutex:
+            self.__open()
+            fcntl.flock(self.jfd, fcntl.LOCK_EX)
+            try:
+                return self.__replay()
+            finally:
+                fcntl.flock(self.jfd, fcntl.LOCK_UN)
+
+    def get_stats(self):
+        with self.mutex:
+            self.__open()
+            return {'records': self.__record_count(),
+                    'store_bytes': os.fstat(self.fd).st_size,
+                    'names_bytes': os.fstat(self.names_fd).st_size}
+
+    # private
+    # journal entries for the changes. an account keeps its name offset
+    # unless the name changed, a new name goes at the end of names.dat.
+    def __make_entries(self, changes):
+        entries = []
+        names_end = os.fstat(self.names_fd).st_size
+        for filename, content in changes:
+            if self.handles(filename) is False:
+                entries.append(['file', os.path.relpath(filename, self.dbdir), content])
+                continue
+            ac_id = self.account_id(filename)
+            vals = content.strip().split(',')
+            fname, lname, balance = vals[0], vals[1], vals[2]
+            old = self.read(ac_id)
+            version = 1
+            name_off = None
+            if old is not None:
+                version = old.version + 1
+                if old.fname == fname and old.lname == lname:
+                    name_off = self.__read_raw(ac_id)[4]
+            if name_off is None:
+                name_off = names_end
+                names_end += len("%s,%s\n" % (fname, lname))
+            entries.append(['account', ac_id, version, float(balance), name_off, fname, lname])
+        return entries
+
+    def __write_journal(self, entries):
+        data = json.dumps(entries)
+        line = "%s %08x %s\n" % (JOURNAL_MAGIC, zlib.crc32(data) & 0xffffffff, data)
+        os.ftruncate(self.jfd, 0)
+        os.lseek(self.jfd, 0, os.SEEK_SET)
+        os.write(self.jfd, line)
+        os.fsync(self.jfd)
+
+    # private
+    # writes the entries and makes them durable
+    def __apply(self, entries):
+        names_written = False
+        for entry in entries:
+            if entry[0] == 'file':
+                self.__write_file(os.path.join(self.dbdir, entry[1]), entry[2])
+                continue
+            kind, ac_id, version, balance, name_off, fname, lname = entry
+            name = "%s,%s\n" % (fname, lname)
+            if name_off + len(name) > os.fstat(self.names_fd).st_size or \
+               self.__read_name(name_off) != (fname, lname):
+                os.lseek(self.names_fd, name_off, os.SEEK_SET)
+                os.write(self.names_fd, name)
+                names_written = True
+            self.__write_record(ac_id, version, balance, name_off)
+        if names_written:
+            os.fsync(self.names_fd)
+        self.map.flush()
+
+    # private
+    # applies the journal if it holds a whole commit, called with the
+    # journal flock held. True if there was one.
+    def __replay(self):
+        if os.fstat(self.jfd).st_size == 0:
+            return False
+        os.lseek(self.jfd, 0, os.SEEK_SET)
+        line = ''
+        while True:
+            data = os.read(self.jfd, 65536)
+            if data == '':
+                break
+            line += data
+        entries = None
+        if line.endswith('\n'):
+            parts = line[:-1].split(' ', 2)
+            if len(parts) == 3 and parts[0] in (JOURNAL_MAGIC, CENTS_JOURNAL_MAGIC) and \
+               "%08x" % (zlib.crc32(parts[2]) & 0xffffffff) == parts[1]:
+                entries = json.loads(parts[2])
+                if parts[0] == CENTS_JOURNAL_MAGIC:
+                    for entry in entries:
+                        if entry[0] == 'account':
+                            entry[3] = from_cents(entry[3])
+        if entries is None:
+            logging.warning("BS0245 dropping unfinished commit in %s", self.journal_filename)
+        else:
+            logging.info("BS0247 replaying commit of %d changes from %s", len(entries), self.journal_filename)
+            for entry in entries:
+                for i in range(len(entry)):
+                    if isinstance(entry[i], unicode):
+                        entry[i] = entry[i].encode('utf-8')
+            self.__apply(entries)
+        os.ftruncate(self.jfd, 0)
+        return entries is not None
+
+    def __write_file(self, filename, content):
+        tmpname = "%s.%d.jtmp" % (filename, os.getpid())
+        f = open(tmpname, 'w')
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, filename)
+
+    def __write_record(self, ac_id, version, balance, name_off):
+        offset = HEADER_SIZE + ac_id * RECORD_SIZE
+        if offset + RECORD_SIZE > len(self.map):
+            self.__grow(ac_id)
+        raw = (FLAG_USED, 0, version, balance, name_off)
+        raw = (FLAG_USED, self.__crc(ac_id, raw), version, balance, name_off)
+        self.map[offset:offset + RECORD_SIZE] = RECORD.pack(*raw)
+
+    # private
+    # the raw fields of a record, None past the end of the file
+    def __read_raw(self, ac_id):
+        offset = HEADER_SIZE + ac_id * RECORD_SIZE
+        if offset + RECORD_SIZE > len(self.map):
+            # another process may have grown the file
+            self.__remap()
+            if offset + RECORD_SIZE > len(self.map):
+                return None
+        return RECORD.unpack(self.map[offset:offset + RECORD_SIZE])
+
+    def __read_name(self, name_off):
+        if self.names_map is None or name_off >= len(self.names_map):
+            self.__remap()
+        end = -1
+        if self.names_map is not None:
+            end = self.names_map.find(b'\n', name_off)
+        if end < 0:
+            return (None, None)
+        fname, lname = self.names_map[name_off:end].split(',', 1)
+        return (fname, lname)
+
+    def __crc(self, ac_id, raw):
+        return record_crc(RECORD, ac_id, raw)
+
+    def __record_count(self):
+        self.__remap()
+        return (len(self.map) - HEADER_SIZE) // RECORD_SIZE
+
+    # private
+    # makes the file big enough for ac_id, called with the journal flock
+    # held
+    def __grow(self, ac_id):
+        records = (ac_id // GROW_RECORDS + 1) * GROW_RECORDS
+        size = HEADER_SIZE + records * RECORD_SIZE
+        if os.fstat(self.fd).st_size < size:
+            logging.debug("BS0300 growing %s to %d records", self.store_filename, records)
+            os.ftruncate(self.fd, size)
+        self.__remap()
+
+    # private
+    # maps the files again if they grew
+    def __remap(self):
+        size = os.fstat(self.fd).st_size
+        if self.map is None or len(self.map) != size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, size)
+        size = os.fstat(self.names_fd).st_size
+        # an empty file can't be mapped
+        if size > 0 and (self.names_map is None or len(self.names_map) != size):
+            if self.names_map is not None:
+                self.names_map.close()
+            self.names_map = mmap.mmap(self.names_fd, size, access=mmap.ACCESS_READ)
+
+    # private
+    # opens the files, again after a fork or if they were removed. called
+    # with the mutex held.
+    def __open(self):
+        if self.fd is not None and self.pid == os.getpid():
+            if os.fstat(self.fd).st_nlink > 0:
+                return
+        for m in (self.map, self.names_map):
+            if m is not None:
+                m.close()
+        self.map = None
+        self.names_map = None
+        for fd in (self.fd, self.names_fd, self.jfd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = os.open(self.store_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.names_fd = os.open(self.names_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.jfd = os.open(self.journal_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+
+        fcntl.flock(self.jfd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < HEADER_SIZE:
+                header = HEADER.pack(STORE_MAGIC, RECORD_SIZE)
+                os.write(self.fd, header + b'\0' * (HEADER_SIZE - len(header)))
+                os.ftruncate(self.fd, HEADER_SIZE + GROW_RECORDS * RECORD_SIZE)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            magic, record_size = HEADER.unpack(os.read(self.fd, HEADER.size))
+            if magic == CENTS_STORE_MAGIC and record_size == RECORD_SIZE:
+                self.__upgrade()
+            elif magic != STORE_MAGIC or record_size != RECORD_SIZE:
+                raise IOError(errno.EINVAL, "%s is not an account store" % self.store_filename)
+        finally:
+            fcntl.flock(self.jfd, fcntl.LOCK_UN)
+        self.__remap()
+
+    # private
+    # rewrites a DACC1 store, balances in cents, with the balances as
+    # doubles. called from __open with the journal flock held. the new
+    # file is renamed over the old one, a process that has the old one
+    # open sees it was removed and opens the new one. a record that fails
+    # its crc is copied as it is, the journal has it.
+    def __upgrade(self):
+        logging.info("BS0421 rewriting %s with whole balances", self.store_filename)
+        size = os.fstat(self.fd).st_size
+        old = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        tmpname = "%s.%d.jtmp" % (self.store_filename, os.getpid())
+        f = open(tmpname, 'wb')
+        try:
+            header = HEADER.pack(STORE_MAGIC, RECORD_SIZE)
+            f.write(header + b'\0' * (HEADER_SIZE - len(header)))
+            for offset in range(HEADER_SIZE, size - RECORD_SIZE + 1, RECORD_SIZE):
+                ac_id = (offset - HEADER_SIZE) // RECORD_SIZE
+                raw = CENTS_RECORD.unpack(old[offset:offset + RECORD_SIZE])
+                if raw[0] & FLAG_USED == 0 or record_crc(CENTS_RECORD, ac_id, raw) != raw[1]:
+                    f.write(old[offset:offset + RECORD_SIZE])
+                    continue
+                raw = (raw[0], 0, raw[2], from_cents(raw[3]), raw[4])
+                f.write(RECORD.pack(raw[0], self.__crc(ac_id, raw), raw[2], raw[3], raw[4]))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+            old.close()
+        os.rename(tmpname, self.store_filename)
+        os.close(self.fd)
+        self.fd = os.open(self.store_filename, os.O_RDWR)
+
+def main():
+  parser = argparse.ArgumentParser(description='move the account files of a dbdir into the binary store')
+  parser.add_argument('-d', '--dir', help='data directory', required=True)
+  args = parser.parse_args()
+
+  # read with the storage the dbdir has now. account_util imports this
+  # module so it can't be imported at the top
+  from account_util import AccountUtil
+  util = AccountUtil(args.dir)
+  if util.get_storage() == 'binary':
+    print "%s already uses the binary store" % args.dir
+    return
+  if util.get_storage() == 'wal':
+    from write_ahead_log import get_wal
+    get_wal(args.dir).checkpoint()
+
+  store = get_binary_store(args.dir)
+  count = 0
+  changes = []
+  for record in util.iter_account_files():
+    changes.append((util.get_account_filename(record.id),
+                    "%s,%s,%s\n" % (record.fname, record.lname, record.balance)))
+    if len(changes) == 1000:
+      store.commit(changes)
+      count += len(changes)
+      changes = []
+  if len(changes) > 0:
+    store.commit(changes)
+    count += len(changes)
+
+  options = {}
+  for name, value in load_config(args.dir).items():
+    if CONFIG_DEFAULTS.get(name) != value:
+      options[name] = value
+  options['storage'] = 'binary'
+  write_config(args.dir, options)
+  print "%d accounts moved into %s. the account files can be removed" % (
+    count, os.path.join(args.dir, STORE_FILENAME))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for BinaryStore
+#
+import unittest
+import os
+import json
+import zlib
+import shutil
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from batch_transfer import BatchTransfer
+from binary_store import get_binary_store, record_crc, JOURNAL_FILENAME, STORE_FILENAME, \
+    HEADER, HEADER_SIZE, CENTS_RECORD, CENTS_STORE_MAGIC, FLAG_USED
+from drove_bank_constants import write_config
+from recover import Recover
+
+class BinaryStore_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'binary_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        write_config(self.dir, {'storage': 'binary'})
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+        ac = AccountCreate(self.dir)
+        self.one_id = ac.create_account('John', 'Doe', 100.0)
+        self.two_id = ac.create_account('Bob', 'Smith', 50.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __write_journal(self, entries, complete=True, magic='DJNL2'):
+        data = json.dumps(entries)
+        line = "%s %08x %s\n" % (magic, zlib.crc32(data) & 0xffffffff, data)
+        if complete is False:
+            line = line[:-10]
+        f = open(os.path.join(self.dir, JOURNAL_FILENAME), 'w')
+        f.write(line)
+        f.close()
+
+    def test_no_account_files(self):
+        names = os.listdir(self.dir)
+        self.assertTrue(STORE_FILENAME in names)
+        for name in names:
+            self.assertFalse(name.endswith('.txt'))
+
+        aa = AccountActions(self.dir)
+        info = aa.get_account_info(self.one_id)
+        self.assertEqual((info.fname, info.lname, info.balance), ('John', 'Doe', 100.0))
+        self.assertEqual(aa.get_account_info(72), None)
+
+    def test_commits(self):
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.deposit(self.one_id, 20.25), 120.25)
+        self.assertEqual(aa.withdraw(self.two_id, 10.0), 40.0)
+        self.assertTrue(aa.transfer_money(self.one_id, self.two_id, 5.0))
+        self.assertEqual(aa.withdraw(self.two_id, 1000.0), -1)
+
+        record = get_binary_store(self.dir).read(self.one_id)
+        self.assertEqual(record.balance, 115.25)
+        self.assertEqual(record.version, 3)
+        self.assertEqual([(r.id, r.balance) for r in aa.iter_accounts()],
+                         [(70, 115.25), (71, 45.0)])
+        totals = aa.get_bank_totals()
+        self.assertEqual(totals.balance, 160.25)
+
+    def test_create_accounts(self):
+        ac = AccountCreate(self.dir)
+        ids = ac.create_accounts([('Sue', 'Jones', 1.0), ('Al', 'Green', 2.0)])
+        self.assertEqual(ids, [72, 73])
+        self.assertEqual(get_binary_store(self.dir).read(73).fname, 'Al')
+        self.assertEqual(open(os.path.join(self.dir, 'index.idx')).read(), '73\n')
+
+    def test_batch_transfer(self):
+        bt = BatchTransfer(self.dir, 'bin', 2)
+        stats = bt.run([(70, 71, 10.0), (71, 70, 1.5), (70, 71, 500.0)])
+        self.assertEqual((stats['applied'], stats['rejected']), (2, 1))
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(70).balance, 91.5)
+        self.assertEqual(aa.get_account_info(71).balance, 58.5)
+        self.assertEqual(bt.read_checkpoint().records, 3)
+
+    def test_recover_replays_journal(self):
+        # died after the journal was written, before the records. the
+        # names are at 0 and after John's
+        self.__write_journal([['account', 70, 2, 90.0, 0, 'John', 'Doe'],
+                              ['account', 71, 2, 150.0, len('John,Doe\n'), 'Bob', 'Smith']])
+
+        Recover(self.dir).recover()
+        store = get_binary_store(self.dir)
+        self.assertEqual(store.read(70).balance, 90.0)
+        self.assertEqual(store.read(70).version, 2)
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, JOURNAL_FILENAME)), 0)
+        self.assertEqual(AccountActions(self.dir).get_bank_totals().balance, 90.0 + 150.0)
+
+    def test_unfinished_journal_is_dropped(self):
+        self.__write_journal([['account', 70, 2, 90.0, 0, 'John', 'Doe']], False)
+        # the next commit finds it first
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.deposit(self.two_id, 1.0), 51.0)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 100.0)
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, JOURNAL_FILENAME)), 0)
+
+    def test_sub_cent_amounts(self):
+        # the balance is what the account file would have
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.deposit(self.one_id, 0.004), 100.004)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 100.004)
+        self.assertEqual(aa.withdraw(self.one_id, 0.004), 100.0)
+        self.assertEqual(get_binary_store(self.dir).read(self.one_id).balance, 100.0)
+
+    def test_cents_store_upgraded(self):
+        # a store and journal from when the balances were in cents
+        filename = os.path.join(self.dir, STORE_FILENAME)
+        f = open(filename + '.new', 'wb')
+        header = HEADER.pack(CENTS_STORE_MAGIC, CENTS_RECORD.size)
+        f.write(header + b'\0' * (HEADER_SIZE - len(header)))
+        for ac_id in range(72):
+            raw = (0, 0, 0, 0, 0)
+            if ac_id == 70:
+                raw = (FLAG_USED, 0, 1, 10050, 0)
+            elif ac_id == 71:
+                raw = (FLAG_USED, 0, 1, 5000, len('John,Doe\n'))
+            if raw[0] == FLAG_USED:
+                raw = (raw[0], record_crc(CENTS_RECORD, ac_id, raw), raw[2], raw[3], raw[4])
+            f.write(CENTS_RECORD.pack(*raw))
+        f.close()
+        os.rename(filename + '.new', filename)
+        self.__write_journal([['account', 71, 2, 4025, len('John,Doe\n'), 'Bob', 'Smith']],
+                             magic='DJNL1')
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 100.5)
+        self.assertEqual(open(filename, 'rb').read(len(CENTS_STORE_MAGIC)), b'DACC2\0\0\0')
+        Recover(self.dir).recover()
+        self.assertEqual(aa.get_account_info(self.two_id).balance, 40.25)
+        self.assertEqual(aa.deposit(self.two_id, 0.75), 41.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,143 @@
 # -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
 #
 # Constants
-import logging
 import os
+import time
+
+from my_logger import setup_logging
+from profiling import setup_profiling
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser
+
+# every data dir can carry a drovebank.cfg with a [drovebank] section
+# that selects the storage engine and its tuning knobs. a missing file
+# or missing option means the default below.
+CONFIG_FILENAME = 'drovebank.cfg'
+CONFIG_SECTION  = 'drovebank'
+CONFIG_DEFAULTS = {
+    # files: one <id>.txt per account updated with the tmp/old/rename cycle
+    # wal:   commits are appended to wal.log and checkpointed lazily
+    # binary: every account is a fixed size record in accounts.dat,
+    #        see binary_store.py
+    'storage': 'files',
+    # checkpoint the write ahead log once it grows past this many bytes
+    'wal_checkpoint_bytes': '1048576',
+    # share one fsync between the commits of every process on the dbdir
+    'group_commit': 'off',
+    # how long the group leader waits for more commits before the fsync
+    'group_commit_window_ms': '2',
+    # stop waiting as soon as this many commits are pending
+    'group_commit_max_ops': '32',
+    # lockfile: create <id>.lock with O_EXCL and poll until it is gone
+    # flock: kernel lock on <id>.lock, every process on the dbdir has to
+    # use the same backend
+    'lock_backend': 'lockfile',
+    # seconds to wait for a lock before LockTimeout, none waits forever
+    'lock_timeout': 'none',
+    # seconds between tries with the lockfile backend
+    'lock_poll_interval': '1.0',
+    # seconds a lock is good for. a waiter takes over a lock whose lease
+    # ran out even if its holder is alive (a long holder renews it), for
+    # holders on other hosts whose pid can't be looked at. none only
+    # takes over from holders that died
+    'lock_lease': 'none',
+    # deposits and withdraws commit without a lock file when nobody else
+    # has the account (storage = files only), see account_util.py
+    'optimistic': 'off',
+    # lost races of an optimistic commit before it takes the lock
+    'optimistic_retries': '2',
+    # flat:      account 1001 is <dbdir>/1001.txt
+    # sharded:   account 1001 is <dbdir>/00/00/10/01.txt
+    # migrating: migrate_layout.py is moving flat files to sharded, look
+    #            for the sharded file first
+    'layout': 'flat',
+    # parsed account records kept in the per process read cache, 0 is off
+    'read_cache_size': '1024',
+    # keep summary.dat (every account's name and balance and the totals)
+    # up to date on every commit for listings and totals
+    'summary': 'on',
+    # ids a process reserves from index.idx at a time when it creates
+    # accounts. 1 updates the index for every account
+    'id_block_size': '1',
+    # append every create, deposit, withdraw and transfer to the history
+    # segments under <dbdir>/history, see account_history.py
+    'history': 'on',
+    # accounts to a history shard. don't change it once there is history
+    'history_shard_size': '1000',
+    # records in a history segment before it is sealed
+    'history_segment_records': '65536',
+    # seconds between compactions of the sealed history segments in
+    # drovebank.py, 0 is off
+    'history_compact_interval': '3600',
+    # accounts bank_server.py keeps in memory
+    'server_cache_size': '100000',
+    # seconds between rewrites of <dbdir>/metrics.prom by drovebank.py and
+    # bank_server.py, 0 is off. see bank_metrics.py
+    'metrics_interval': '15',
+}
+
+# how often (seconds) a long lived process looks for config changes
+CONFIG_REFRESH_INTERVAL = 1.0
+
+# dbdir -> (time checked, mtime of cfg file, dict of options)
+_config_cache = {}
+
+def load_config(dbdir, refresh_interval=None):
+    path = os.path.join(dbdir, CONFIG_FILENAME)
+    now = time.time()
+    cached = _config_cache.get(dbdir)
+    if cached is not None and refresh_interval is not None:
+        if now - cached[0] < refresh_interval:
+            return cached[2]
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+
+    if cached is not None and cached[1] == mtime:
+        _config_cache[dbdir] = (now, mtime, cached[2])
+        return cached[2]
+
+    options = dict(CONFIG_DEFAULTS)
+    if mtime is not None:
+        parser = configparser.RawConfigParser()
+        parser.read(path)
+        if parser.has_section(CONFIG_SECTION):
+            for name, value in parser.items(CONFIG_SECTION):
+                options[name] = value.strip()
+    _config_cache[dbdir] = (now, mtime, options)
+    return options
+
+# writes the options to the dbdir config file. the file is written to
+# a tmp file and renamed so readers never see half a config.
+def write_config(dbdir, options):
+    parser = configparser.RawConfigParser()
+    parser.add_section(CONFIG_SECTION)
+    for name in sorted(options):
+        parser.set(CONFIG_SECTION, name, str(options[name]))
+    path = os.path.join(dbdir, CONFIG_FILENAME)
+    tmppath = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmppath, 'w')
+    parser.write(f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmppath, path)
+    clear_config_cache()
+
+def clear_config_cache():
+    _config_cache.clear()
 
 class DroveBankConstants:
 
     def __init__(self, dir=None):
-        logging.basicConfig(filename='drovebank.log', level=logging.DEBUG)
+        setup_logging()
+        # only if DROVEBANK_PROFILE asks for it
+        setup_profiling()
 
         # set the dir for the file
         if dir is not None:
@@ -52,3 +182,62 @@ class DroveBankConstants:
 
     def get_dbdir(self):
         return self.dbdir
+
+    # public
+    # returns a config option for the dbdir as a string
+    def get_config(self, name):
+        options = load_config(self.dbdir, CONFIG_REFRESH_INTERVAL)
+        return options.get(name, CONFIG_DEFAULTS.get(name))
+
+    def get_config_int(self, name):
+        return int(self.get_config(name))
+
+    def get_config_float(self, name):
+        value = self.get_config(name)
+        if value is None or value == '' or value.lower() == 'none':
+            return None
+        return float(value)
+
+    def get_config_bool(self, name):
+        value = self.get_config(name)
+        return value is not None and value.lower() in ('1', 'on', 'yes', 'true')
+
+    # public
+    # the storage engine for the dbdir: files, wal or binary
+    def get_storage(self):
+        return self.get_config('storage')
+
+    # public
+    # the account file layout: flat, sharded or migrating. the binary
+    # store has no account files, only their lock files, and those are
+    # flat
+    def get_layout(self):
+        if self.get_storage() == 'binary':
+            return 'flat'
+        return self.get_config('layout')
+
+    # public
+    # flat layout path of an account file: <dbdir>/<id>.txt
+    def flat_account_path(self, account_id):
+        return os.path.join(self.dbdir, "%s.txt" % account_id)
+
+    # public
+    # sharded layout path of an account file. the id is zero padded to
+    # eight digits and split in pairs, the first three pairs are
+    # directories. account 1001 is <dbdir>/00/00/10/01.txt
+    def sharded_account_path(self, account_id):
+        digits = "%08d" % int(account_id)
+        return os.path.join(self.dbdir, digits[:-6], digits[-6:-4], digits[-4:-2],
+                            digits[-2:] + ".txt")
+
+    # public
+    # returns the account id of an account file, or of one of its lock,
+    # tmp or old files, in either layout. None if it isn't an account file.
+    def account_id_from_path(self, path):
+        rel = os.path.relpath(path, self.dbdir)
+        parts = rel.split(os.sep)
+        prefix = parts[-1].split('.')[0].split('_')[0]
+        digits = ''.join(parts[:-1]) + prefix
+        if digits.isdigit() is False:
+            return None
+        return int(digits)
@@ -11,6 +11,15 @@ import argparse
 
 from account_create import AccountCreate
 from account_actions import AccountActions
+from account_session import AccountSession
+from atomic_write import LockError
+from bank_analytics import BankAnalytics
+from account_history import get_history, format_record
+from bank_client import BankClient, ServerError
+from bank_commands import BatchCommands, FORMATS
+from my_logger import setup_logging
+from profiling import add_profile_args, setup_profiling_args
+from bank_metrics import get_exporter
 
 # python doesn't have a switch statement so I
 # emulated one using
@@ -36,10 +45,18 @@ class switch(object):
 
 class DroveBank(AccountActions):
 
-    def __init__(self, dir=None):
+    def __init__(self, dir=None, server=None):
         AccountActions.__init__(self, dir)
-        self.client_list_dirty = True
-        self.client_list = []
+        self.page_size = 20
+
+        # with a server every account call is a request to it, the dbdir
+        # is the server's business
+        self.client = None
+        self.bank = self
+        if server is not None:
+            self.client = BankClient(server)
+            self.bank = self.client
+            return
 
         #  create the index file
         if os.path.exists(self.dbdir) is False:
@@ -64,37 +81,85 @@ class DroveBank(AccountActions):
 
         self.__print_main_menu_text()
 
+        # sealed history segments are merged in the background
+        if self.client is None and self.get_config_bool('history'):
+            get_history(self.dbdir).start_compactor()
+        if self.client is None:
+            get_exporter(self.dbdir).start()
+
         while should_exit is False:
             command = raw_input('Command [toplevel]: ')
-            for case in switch(command):
-                if case('e'):
-                    should_exit = True
-                    print "Bye!"
-                    break
-                if case('q'):
-                    should_exit = True
-                    print "Bye!"
-                    break
-                if case('h'):
-                    self.__print_main_menu_text()
-                    break
-                if case('l'):
-                    self.__print_accounts()
-                    break
-                if case('c'):
-                    self.__create_account()
-                    break
-                if case('w'):
-                    self.__withdraw()
-                    break
-                if case('d'):
-                    self.__deposit()
-                    break
-                if case('t'):
-                    self.__transfer()
-                    break
-                if case():
-                    print "Unknown command %s" % (command)
+            try:
+                should_exit = self.__run_command(command)
+            except LockError as e:
+                # the account is busy or was left locked by a dead
+                # process. tell the user and go back to the menu.
+                logging.error("DB0070 %s", e)
+                print "The account is locked, try again later: %s" % e
+            except ServerError as e:
+                logging.error("DB0079 %s", e)
+                print "The bank server can't be reached: %s" % e
+
+    # public
+    # runs the commands of a file (bank_commands.py) without the menu,
+    # results to out. returns the number of commands that failed. without
+    # a server every command goes through one AccountSession
+    def run_batch(self, infile, out, fmt='jsonl', pipeline=False):
+        bank = creator = self.client
+        exporter = None
+        if self.client is None:
+            bank = AccountSession(self.dbdir)
+            creator = AccountCreate(self.dbdir)
+            exporter = get_exporter(self.dbdir)
+            exporter.start()
+        ok, failed = BatchCommands(bank, creator, out, fmt).run(infile, pipeline)
+        # a short batch is over before the first rewrite
+        if exporter is not None and exporter.thread is not None:
+            exporter.write()
+        return failed
+
+    # runs one top level command. returns True when it is time to exit
+    def __run_command(self, command):
+        should_exit = False
+        for case in switch(command):
+            if case('e'):
+                should_exit = True
+                print "Bye!"
+                break
+            if case('q'):
+                should_exit = True
+                print "Bye!"
+                break
+            if case('h'):
+                self.__print_main_menu_text()
+                break
+            if case('l'):
+                self.__print_accounts()
+                break
+            if case('c'):
+                self.__create_account()
+                break
+            if case('w'):
+                self.__withdraw()
+                break
+            if case('d'):
+                self.__deposit()
+                break
+            if case('t'):
+                self.__transfer()
+                break
+            if case('s'):
+                self.__print_totals()
+                break
+            if case('r'):
+                self.__print_report()
+                break
+            if case('a'):
+                self.__print_history()
+                break
+            if case():
+                print "Unknown command %s" % (command)
+        return should_exit
 
     def __create_account(self):
         print "Adding a client"
@@ -121,10 +186,9 @@ class DroveBank(AccountActions):
             aloop = False
 
         self.clear_errors()
-        ac = AccountCreate(self.dbdir)
-        # since we added an account we can't use the cached
-        # version.
-        self.client_list_dirty = True
+        ac = self.client
+        if ac is None:
+            ac = AccountCreate(self.dbdir)
         id = ac.create_account(fname, lname, balance)
 
         if id == -1:
@@ -151,7 +215,7 @@ class DroveBank(AccountActions):
 
             balance = self.__print_account_balance(ac_id)
             if balance == -1:
-                print ac.get_error_string()
+                print self.bank.get_error_string()
                 continue
             idloop = False
 
@@ -170,9 +234,9 @@ class DroveBank(AccountActions):
                 print "You can't withdraw more money than you have"
                 continue
 
-            new_balance = self.withdraw(ac_id, float(withdraw))
+            new_balance = self.bank.withdraw(ac_id, float(withdraw))
             if new_balance == -1:
-                print ac.get_error_string()
+                print self.bank.get_error_string()
             wloop = False
 
         print "New balance for id %s is %8.2f" % (ac_id, float(new_balance))
@@ -203,9 +267,9 @@ class DroveBank(AccountActions):
                 print "This field only accepts numbers"
                 continue
 
-            new_balance = self.deposit(ac_id, float(deposit))
+            new_balance = self.bank.deposit(ac_id, float(deposit))
             if new_balance == -1:
-                print ac.get_error_string()
+                print self.bank.get_error_string()
                 continue
             dloop = False
             print "New balance for id %s is %8.2f" % (ac_id, float(new_balance))
@@ -225,11 +289,11 @@ class DroveBank(AccountActions):
                 return
             from_balance = self.__print_account_balance(from_id)
             if from_balance == -1:
-                print self.get_error_string()
+                print self.bank.get_error_string()
                 continue
             to_balance = self.__print_account_balance(to_id)
             if to_balance == -1:
-                print self.get_error_string()
+                print self.bank.get_error_string()
                 continue
             print "Current Balances: %s = %8.2f to %s = %8.2f" % (from_id,
                                                             float(from_balance),
@@ -247,9 +311,9 @@ class DroveBank(AccountActions):
                 print "This field only accepts numbers"
                 continue
 
-            new_balance = self.transfer_money(from_id, to_id, float(amount))
-            if new_balance == -1:
-                print ac.get_error_string()
+            new_balance = self.bank.transfer_money(from_id, to_id, float(amount))
+            if new_balance is False:
+                print self.bank.get_error_string()
                 continue
             xloop = False
             fb = float(from_balance) - float(amount)
@@ -266,21 +330,82 @@ class DroveBank(AccountActions):
         print "\tt - transfer money between two accounts"
         print "\td - deposit money to an account"
         print "\tw - withdraw money from an account"
+        print "\ts - number of accounts and money in the bank"
+        print "\tr - report on the balances of every account"
+        print "\ta - the transaction history of an account"
         print "\th - prints this"
         print "\te - exit"
 
-    def __print_accounts(self):
-        if self.client_list_dirty is True:
-            self.client_list = self.print_accounts()
-            self.client_list_dirty = False
-        for line in self.client_list:
+    def __print_totals(self):
+        totals = self.bank.get_bank_totals()
+        print "Accounts: %d" % totals.count
+        print "Balance:  %8.2f" % totals.balance
+
+    def __print_report(self):
+        analytics = BankAnalytics(self.dbdir)
+        if self.client is not None:
+            report = self.client.report()
+        else:
+            report = analytics.report()
+        if report is None:
+            print self.bank.get_error_string()
+            return
+        for line in analytics.format_report(report):
             print line
 
+    def __print_history(self):
+        if self.client is None and self.get_config_bool('history') is False:
+            print "The history is turned off for this bank"
+            return
+        while True:
+            ac_id = raw_input('Account ID [history] : ')
+            if ac_id == 'q':
+                return
+            if self.isint(ac_id) is False:
+                print "account id must be an integer"
+                continue
+            break
+        print "Seq\tTime\t\t\tWhat\t\tOther\t    Amount\t   Balance"
+        if self.client is not None:
+            records = self.client.query_history(int(ac_id))
+        else:
+            records = get_history(self.dbdir).query(int(ac_id))
+        for record in records:
+            print format_record(record)
+
+    # prints the accounts a page at a time. cursors is the stack of the
+    # first ids of the pages we have seen so 'p' can go back.
+    def __print_accounts(self):
+        cursors = [None]
+        while True:
+            records, next_cursor = self.bank.list_accounts(cursors[-1], self.page_size)
+            print "ID\tName\tBalance"
+            for record in records:
+                print self.format_account(record)
+
+            if next_cursor is None and len(cursors) == 1:
+                return
+            choices = []
+            if next_cursor is not None:
+                choices.append("'n' next page")
+            if len(cursors) > 1:
+                choices.append("'p' previous page")
+            choices.append("'q' back to the main menu")
+            print ", ".join(choices)
+
+            command = raw_input('Command [list]: ')
+            if command == 'n' and next_cursor is not None:
+                cursors.append(next_cursor)
+            elif command == 'p' and len(cursors) > 1:
+                cursors.pop()
+            elif command == 'q':
+                return
+
     # returns the balance from the id
     def __print_account_balance(self, id):
-        ac_info = self.get_account_info(id)
+        ac_info = self.bank.get_account_info(id)
         if ac_info is None:
-            print self.get_error_string()
+            print self.bank.get_error_string()
             return -1
 
         balance = ac_info.balance
@@ -292,9 +417,35 @@ def main():
 
     parser = argparse.ArgumentParser(description='Drove Bank Client')
     parser.add_argument('-d', '--dir', help='data directory', default=None)
+    parser.add_argument('-s', '--server', help='use the bank_server.py at host:port or unix socket path',
+                        default=None)
+    parser.add_argument('-b', '--batch', help="run the commands of a file ('-' for stdin) and exit",
+                        default=None)
+    parser.add_argument('-f', '--format', help='batch results format', choices=FORMATS,
+                        default='jsonl')
+    parser.add_argument('-p', '--pipeline', help='read and check batch commands ahead of the commits',
+                        action='store_true')
+    parser.add_argument('--log-level', help='DEBUG, INFO, WARNING, ERROR or CRITICAL', default=None)
+    parser.add_argument('--log-file', help="log file, '-' for stderr", default=None)
+    add_profile_args(parser)
     args = parser.parse_args()
+    setup_logging(args.log_level, args.log_file)
+    setup_profiling_args(args)
     in_dir = args.dir
-    DroveBank(in_dir).run()
+    bank = DroveBank(in_dir, args.server)
+    if args.batch is None:
+        bank.run()
+        return
+
+    # exits 1 if a command failed
+    if args.batch == '-':
+        # a line at a time, a script can wait for each answer
+        failed = bank.run_batch(iter(sys.stdin.readline, ''), sys.stdout, args.format, args.pipeline)
+    else:
+        f = open(args.batch)
+        failed = bank.run_batch(f, sys.stdout, args.format, args.pipeline)
+        f.close()
+    sys.exit(1 if failed > 0 else 0)
 
 if __name__ == "__main__":
   main()
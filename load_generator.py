@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# puts production like load on a dbdir from several processes at once.
+#
+# every worker is a process of its own with its own AccountActions and
+# AccountCreate going to the files and lock files, like a drovebank.py
+# run per user would. a worker picks an op by the --mix weights
+#   get=50,deposit=20,withdraw=10,transfer=15,create=5
+# and the accounts by a Zipf distribution over the accounts of the
+# dbdir: the k-th hottest account is picked with a weight of 1/k^skew,
+# skew 0 is uniform. every worker has the same accounts hot so they
+# fight over the same locks.
+#
+# it runs for --seconds or until --ops ops are done (over all workers)
+# and reports for every op type the throughput, the p50/p99/p999
+# latency, the ones that failed (a withdraw of more than the balance,
+# ...) and the exceptions (LockTimeout, ...), and the share of the op
+# time that was spent waiting for locks (from bank_metrics in every
+# worker).
+#
+# --workers and --skew take lists, every combination is run in turn to
+# see how the lock design scales, one line each:
+#   ./load_generator.py -d /dev/shm/bank --accounts 10000 -w 1,2,4,8 -z 0,1.2 -t 10
+#
+# the dbdir is made and loaded with --accounts accounts if it has none.
+#
+import os
+import sys
+import json
+import time
+import array
+import bisect
+import random
+import shutil
+import argparse
+import multiprocessing
+
+from account_util import AccountUtil
+from account_actions import AccountActions
+from account_create import AccountCreate
+from bank_metrics import snapshot, clear_metrics
+from lock_set import get_lock_stats
+from drove_bank_constants import write_config
+
+OPS = ('get', 'deposit', 'withdraw', 'transfer', 'create')
+DEFAULT_MIX = 'get=50,deposit=20,withdraw=10,transfer=15,create=5'
+
+# seconds a worker waits for the others before it starts
+START_TIMEOUT = 60
+
+# ops a worker does between looks at the clock
+CLOCK_EVERY = 16
+
+# picks account ids by a Zipf distribution of their ranks. the ranks
+# are given to the ids in a shuffled order made from perm_seed so every
+# process with the same seed has the same hot accounts
+class ZipfPicker(object):
+
+    def __init__(self, ids, skew, rng, perm_seed=0):
+        self.ids = list(ids)
+        random.Random(perm_seed).shuffle(self.ids)
+        self.rng = rng
+        self.cdf = []
+        total = 0.0
+        for rank in range(1, len(self.ids) + 1):
+            total += 1.0 / rank ** skew
+            self.cdf.append(total)
+        self.total = total
+
+    def pick(self):
+        index = bisect.bisect_left(self.cdf, self.rng.random() * self.total)
+        return self.ids[min(index, len(self.ids) - 1)]
+
+    # two different accounts
+    def pick_pair(self):
+        first = self.pick()
+        second = self.pick()
+        while second == first and len(self.ids) > 1:
+            second = self.pick()
+        return first, second
+
+class LoadGenerator(object):
+
+    def __init__(self, dbdir, mix=DEFAULT_MIX, seed=0):
+        self.dbdir = dbdir
+        self.mix = parse_mix(mix)
+        self.seed = seed
+
+    # public
+    # makes the dbdir with count accounts if it has none. returns the ids
+    def prepare(self, count, balance=1000000.0, storage=None):
+        if os.path.isdir(self.dbdir) is False:
+            os.makedirs(self.dbdir)
+            if storage is not None:
+                write_config(self.dbdir, {'storage': storage})
+        index = os.path.join(self.dbdir, 'index.idx')
+        if os.path.exists(index) is False:
+            f = open(index, 'w')
+            f.write('0\n')
+            f.close()
+        last = AccountUtil(self.dbdir).get_last_account_id()
+        if last > 0:
+            return range(1, last + 1)
+        return AccountCreate(self.dbdir).create_accounts(
+            [('Load%d' % n, 'Test%d' % n, balance) for n in range(count)])
+
+    # public
+    # runs workers processes for seconds or ops ops. returns the report
+    def run(self, ids, workers=4, skew=1.0, seconds=None, ops=None):
+        if seconds is None and ops is None:
+            seconds = 10.0
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        go = multiprocessing.Event()
+        procs = []
+        for number in range(workers):
+            worker_ops = None
+            if ops is not None:
+                worker_ops = ops // workers + (1 if number < ops % workers else 0)
+            proc = multiprocessing.Process(target=_worker, name='load-%d' % number,
+                                           args=(self.dbdir, number, self.mix, ids, skew, self.seed,
+                                                 seconds, worker_ops, ready, go, results))
+            proc.daemon = True
+            proc.start()
+            procs.append(proc)
+        for proc in procs:
+            ready.get(timeout=START_TIMEOUT)
+        start = time.time()
+        go.set()
+        # the results have to be read before the join, a process doesn't
+        # exit with its queue full
+        outcomes = [results.get() for proc in procs]
+        elapsed = time.time() - start
+        for proc in procs:
+            proc.join()
+        return self.__report(outcomes, workers, skew, elapsed)
+
+    # private
+    # merges what the workers did
+    def __report(self, outcomes, workers, skew, elapsed):
+        report = {'workers': workers, 'skew': skew, 'seconds': elapsed, 'ops': {}}
+        lock_seconds = 0.0
+        every = []
+        for op in OPS:
+            latencies = array.array('d')
+            failed = 0
+            errors = {}
+            for outcome in outcomes:
+                done = outcome['ops'].get(op)
+                if done is None:
+                    continue
+                latencies.fromstring(done['latencies'])
+                failed += done['failed']
+                for name, n in done['errors'].items():
+                    errors[name] = errors.get(name, 0) + n
+            if len(latencies) == 0:
+                continue
+            latencies = sorted(latencies)
+            every.extend(latencies)
+            report['ops'][op] = {'count': len(latencies), 'per_second': len(latencies) / elapsed,
+                                 'p50_ms': percentile(latencies, 50) * 1e3,
+                                 'p99_ms': percentile(latencies, 99) * 1e3,
+                                 'p999_ms': percentile(latencies, 99.9) * 1e3,
+                                 'failed': failed, 'errors': errors}
+        for outcome in outcomes:
+            lock_seconds += outcome['lock_seconds']
+        every.sort()
+        op_seconds = sum(every)
+        report['count'] = len(every)
+        report['per_second'] = len(every) / elapsed
+        report['p50_ms'] = percentile(every, 50) * 1e3
+        report['p99_ms'] = percentile(every, 99) * 1e3
+        report['p999_ms'] = percentile(every, 99.9) * 1e3
+        report['lock_wait_share'] = lock_seconds / op_seconds if op_seconds > 0 else 0.0
+        report['lockset'] = {}
+        for outcome in outcomes:
+            for name, n in outcome['lockset'].items():
+                report['lockset'][name] = report['lockset'].get(name, 0) + n
+        return report
+
+# the body of a worker process
+def _worker(dbdir, number, mix, ids, skew, seed, seconds, ops, ready, go, results):
+    # the lock set counters came over from the parent with the fork
+    clear_metrics()
+    lockset_before = get_lock_stats()
+    rng = random.Random(seed * 1000 + number)
+    picker = ZipfPicker(ids, skew, rng, seed)
+    aa = AccountActions(dbdir)
+    ac = AccountCreate(dbdir)
+    weights = []
+    total = 0
+    for op, weight in mix:
+        total += weight
+        weights.append(total)
+    done = dict((op, {'latencies': array.array('d'), 'failed': 0, 'errors': {}}) for op, weight in mix)
+
+    ready.put(number)
+    go.wait(START_TIMEOUT)
+    deadline = None if seconds is None else time.time() + seconds
+    count = 0
+    while True:
+        if ops is not None and count >= ops:
+            break
+        if deadline is not None and count % CLOCK_EVERY == 0 and time.time() >= deadline:
+            break
+        count += 1
+        op = mix[bisect.bisect_right(weights, rng.random() * total)][0]
+        record = done[op]
+        start = time.time()
+        try:
+            if op == 'get':
+                ok = aa.get_account_info(picker.pick()) is not None
+            elif op == 'deposit':
+                ok = aa.deposit(picker.pick(), 1.0) != -1
+            elif op == 'withdraw':
+                ok = aa.withdraw(picker.pick(), 1.0) != -1
+            elif op == 'transfer':
+                from_id, to_id = picker.pick_pair()
+                ok = aa.transfer_money(from_id, to_id, 1.0) is not False
+            else:
+                ok = ac.create_account('Load', 'Created%d' % number, 0.0) != -1
+        except Exception as e:
+            name = e.__class__.__name__
+            record['errors'][name] = record['errors'].get(name, 0) + 1
+            ok = True
+        record['latencies'].append(time.time() - start)
+        if ok is False:
+            record['failed'] += 1
+
+    numbers = snapshot()
+    lock_seconds = sum([histogram['sum'] for histogram in
+                        numbers['histograms'].get('drovebank_lock_wait_seconds', {}).values()])
+    lockset = dict((name, n - lockset_before[name]) for name, n in get_lock_stats().items())
+    for record in done.values():
+        record['latencies'] = record['latencies'].tostring()
+    results.put({'ops': done, 'lock_seconds': lock_seconds, 'lockset': lockset})
+
+# [(op, weight)] of a mix like get=50,deposit=20
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        if part.strip() == '':
+            continue
+        op, weight = part.split('=')
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError("unknown op %s in the mix" % op)
+        if float(weight) > 0:
+            mix.append((op, float(weight)))
+    if len(mix) == 0:
+        raise ValueError("the mix has no ops")
+    return mix
+
+# the pct percentile of sorted values
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0.0
+    index = int(len(values) * pct / 100.0)
+    return values[min(index, len(values) - 1)]
+
+def main():
+  parser = argparse.ArgumentParser(description='multi process load on a dbdir')
+  parser.add_argument('-d', '--dir', help='data directory, made if it is not there', required=True)
+  parser.add_argument('-a', '--accounts', help='accounts to load a new dbdir with', type=int, default=10000)
+  parser.add_argument('-w', '--workers', help='worker processes, a list runs each', default='4')
+  parser.add_argument('-z', '--skew', help='Zipf skew of the account picks, 0 is uniform, a list runs each',
+                      default='1.0')
+  parser.add_argument('-m', '--mix', help='op weights', default=DEFAULT_MIX)
+  parser.add_argument('-t', '--seconds', help='seconds of each run', type=float, default=None)
+  parser.add_argument('-n', '--ops', help='ops of each run over all workers', type=int, default=None)
+  parser.add_argument('--storage', help='storage engine of a new dbdir', default=None)
+  parser.add_argument('--seed', help='seed of the picks and the hot accounts', type=int, default=0)
+  parser.add_argument('--fresh', help='remove the dbdir first', action='store_true')
+  parser.add_argument('-j', '--json', help="write the reports to this file ('-' for stdout)", default=None)
+  parser.add_argument('-v', '--verbose', help='a line for every op of every run', action='store_true')
+  args = parser.parse_args()
+
+  if args.fresh and os.path.exists(args.dir):
+    shutil.rmtree(args.dir)
+  generator = LoadGenerator(args.dir, args.mix, args.seed)
+  ids = generator.prepare(args.accounts, storage=args.storage)
+  out = sys.stderr if args.json == '-' else sys.stdout
+  print >>out, "%d accounts, mix %s" % (len(ids), args.mix)
+  print >>out, "%7s %5s %10s %9s %9s %9s %8s %7s %7s" % ('workers', 'skew', 'ops/s', 'p50 ms', 'p99 ms',
+                                                        'p999 ms', 'lock %', 'failed', 'errors')
+  reports = []
+  for skew in [float(value) for value in args.skew.split(',')]:
+    for workers in [int(value) for value in args.workers.split(',')]:
+      report = generator.run(ids, workers, skew, args.seconds, args.ops)
+      reports.append(report)
+      ops = report['ops'].values()
+      print >>out, "%7d %5.2f %10.1f %9.2f %9.2f %9.2f %7.1f%% %7d %7d" % (
+        workers, skew, report['per_second'], report['p50_ms'], report['p99_ms'], report['p999_ms'],
+        report['lock_wait_share'] * 100, sum([op['failed'] for op in ops]),
+        sum([sum(op['errors'].values()) for op in ops]))
+      if args.verbose:
+        for name in OPS:
+          op = report['ops'].get(name)
+          if op is not None:
+            print >>out, "    %-9s %10.1f %9.2f %9.2f %9.2f %8s %7d %7d" % (
+              name, op['per_second'], op['p50_ms'], op['p99_ms'], op['p999_ms'], '',
+              op['failed'], sum(op['errors'].values()))
+  if args.json == '-':
+    json.dump(reports, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+  elif args.json is not None:
+    f = open(args.json, 'w')
+    json.dump(reports, f, indent=2, sort_keys=True)
+    f.close()
+
+if __name__ == "__main__":
+  main()
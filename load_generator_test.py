@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for load_generator.py
+#
+import unittest
+import os
+import random
+import shutil
+
+from load_generator import LoadGenerator, ZipfPicker, parse_mix, percentile
+from account_actions import AccountActions
+
+class LoadGenerator_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'load_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def tearDown(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+
+    def test_zipf(self):
+        ids = range(1, 101)
+        uniform = ZipfPicker(ids, 0.0, random.Random(1), 7)
+        picks = [uniform.pick() for n in range(10000)]
+        self.assertTrue(max([picks.count(ac_id) for ac_id in ids]) < 200)
+
+        skewed = ZipfPicker(ids, 2.0, random.Random(2), 7)
+        picks = [skewed.pick() for n in range(10000)]
+        hottest = max(ids, key=picks.count)
+        # 1/zeta(2) of the picks go to the hottest account
+        self.assertTrue(5500 < picks.count(hottest) < 6600)
+
+        # the same accounts are hot in every picker with the seed
+        other = ZipfPicker(ids, 2.0, random.Random(3), 7)
+        self.assertEqual(other.ids[0], hottest)
+        pair = skewed.pick_pair()
+        self.assertNotEqual(pair[0], pair[1])
+
+    def test_mix(self):
+        self.assertEqual(parse_mix('get=1, deposit=3,withdraw=0'), [('get', 1.0), ('deposit', 3.0)])
+        self.assertRaises(ValueError, parse_mix, 'fly=1')
+        self.assertRaises(ValueError, parse_mix, 'get=0')
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 3)
+        self.assertEqual(percentile([1, 2, 3, 4], 99.9), 4)
+
+    def test_run(self):
+        generator = LoadGenerator(self.dir, 'get=2,deposit=2,withdraw=1,transfer=2,create=1', seed=5)
+        ids = generator.prepare(50, 100.0)
+        self.assertEqual(len(ids), 50)
+        report = generator.run(ids, workers=2, skew=1.0, ops=201)
+        self.assertEqual(report['count'], 201)
+        self.assertEqual(sum([op['count'] for op in report['ops'].values()]), 201)
+        self.assertEqual(sorted(report['ops']), ['create', 'deposit', 'get', 'transfer', 'withdraw'])
+        self.assertEqual(sum([sum(op['errors'].values()) for op in report['ops'].values()]), 0)
+        self.assertTrue(0.0 <= report['lock_wait_share'] <= 1.0)
+        # a transfer takes its locks before it looks at the balance
+        self.assertEqual(report['lockset']['acquires'], report['ops']['transfer']['count'])
+        self.assertTrue(report['p50_ms'] <= report['p99_ms'] <= report['p999_ms'])
+
+        # the money is all there, the creates added none
+        deposits = report['ops']['deposit']
+        withdraws = report['ops']['withdraw']
+        self.assertEqual(AccountActions(self.dir).get_bank_totals().balance,
+                         5000.0 + (deposits['count'] - deposits['failed'])
+                         - (withdraws['count'] - withdraws['failed']))
+        # a dbdir with accounts isn't loaded again
+        self.assertEqual(len(generator.prepare(50)), 50 + report['ops']['create']['count'])
+
+if __name__ == '__main__':
+    unittest.main()
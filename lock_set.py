@@ -0,0 +1,143 @@
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# takes the locks of several AtomicWrites (the two accounts of a
+# transfer) without deadlocking.
+#
+# every process takes the locks of a set in the same order, sorted by
+# lock file path, so two transfers between the same accounts in opposite
+# directions queue up on the first lock instead of each holding one and
+# waiting for the other.
+#
+# the first lock is waited for since nothing is held yet. the rest are
+# only tried, if one is busy everything is given back and we back off for
+# a random, growing, time and start again. that way a set never sits on
+# one account while it waits for another. the whole thing gives up with
+# LockTimeout at the deadline.
+#
+import time
+import random
+import logging
+import threading
+
+from atomic_write import LockTimeout
+
+# longest back off between tries, seconds
+MAX_BACKOFF = 0.05
+
+# process wide counters
+#   acquires:    lock sets taken
+#   contended:   sets that found one of their locks busy at least once
+#   reordered:   sets asked for in a different order than they were taken
+#   saved:       sets that were reordered and contended. taken in the
+#                order asked for these are the ones that could deadlock
+#   backoffs:    times a set gave its locks back to wait
+#   timeouts:    sets that hit the deadline
+_stats = {'acquires': 0, 'contended': 0, 'reordered': 0, 'saved': 0,
+          'backoffs': 0, 'timeouts': 0}
+_stats_lock = threading.Lock()
+
+def get_lock_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+class LockSet(object):
+
+    def __init__(self, members=None):
+        self.members = []
+        self.held = []
+        for member in members or []:
+            self.add(member)
+
+    # public
+    # adds an AtomicWrite whose file name is set
+    def add(self, member):
+        for other in self.members:
+            if other.get_lockfilename() == member.get_lockfilename():
+                raise ValueError("lock %s is in the set twice" % member.get_lockfilename())
+        self.members.append(member)
+
+    # public
+    # takes every lock of the set. waits at most timeout seconds (the
+    # lock_timeout config of the first member when not given, forever
+    # when that is none) then raises LockTimeout holding nothing.
+    def acquire(self, timeout=None):
+        if len(self.members) == 0:
+            return
+        ordered = sorted(self.members, key=lambda m: m.get_lockfilename())
+        if timeout is None:
+            timeout = ordered[0].get_config_float('lock_timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        reordered = ordered != self.members
+        contended = False
+        backoff = 0.001
+        while True:
+            try:
+                busy = self.__try_acquire(ordered, deadline)
+            except LockTimeout:
+                _count('timeouts')
+                raise
+            if busy is None:
+                break
+            contended = True
+            _count('backoffs')
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                _count('timeouts')
+                logging.warning("LS0082 timed out waiting for lock %s", busy.get_lockfilename())
+                raise LockTimeout("timed out waiting for lock %s" % busy.get_lockfilename())
+            wait = random.uniform(0, backoff)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            logging.debug("LS0088 lock %s is busy, back off %.4f sec", busy.get_lockfilename(), wait)
+            time.sleep(wait)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+        _count('acquires')
+        if contended:
+            _count('contended')
+        if reordered:
+            _count('reordered')
+            if contended:
+                _count('saved')
+
+    # public
+    # pushes out the lease of every lock held, for a holder that keeps
+    # them longer than lock_lease
+    def renew(self):
+        for member in self.held:
+            member.renew_lock()
+
+    # public
+    # gives the locks back, last taken first
+    def release(self):
+        while len(self.held) > 0:
+            self.held.pop().unlock_file()
+
+    # private
+    # one pass over the locks in order. returns None with all of them
+    # held, or the busy member with none of them held.
+    def __try_acquire(self, ordered, deadline):
+        try:
+            first = ordered[0]
+            if deadline is None:
+                first.lock_file()
+            else:
+                first.lock_file(max(deadline - time.time(), 0))
+            self.held.append(first)
+            for member in ordered[1:]:
+                if member.try_lock_file() is False:
+                    self.release()
+                    return member
+                self.held.append(member)
+        except:
+            self.release()
+            raise
+        return None
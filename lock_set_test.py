@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for LockSet
+#
+import unittest
+import os
+import time
+import shutil
+from threading import Thread
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from atomic_write import AtomicWrite, LockTimeout, parse_lock_owner
+from drove_bank_constants import write_config
+from lock_set import LockSet, get_lock_stats
+
+class LockSet_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'lockset_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+        ac = AccountCreate(self.dir)
+        self.one_id = ac.create_account('John', 'Doe', 1000.0)
+        self.one_file = ac.get_account_file()
+        self.two_id = ac.create_account('Bob', 'Smith', 1000.0)
+        self.two_file = ac.get_account_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def transfer_worker(self, from_id, to_id, count):
+        aa = AccountActions(self.dir)
+        for i in range(count):
+            if aa.transfer_money(from_id, to_id, 1.0) is True:
+                self.done.append(1)
+
+    def __opposite_transfers(self):
+        before = get_lock_stats()
+        self.done = []
+        threads = [Thread(target=self.transfer_worker, args=(self.one_id, self.two_id, 25)),
+                   Thread(target=self.transfer_worker, args=(self.two_id, self.one_id, 25))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(60)
+            self.assertFalse(t.is_alive())
+        after = get_lock_stats()
+        self.assertEqual(len(self.done), 50)
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 1000.0)
+        self.assertEqual(aa.get_account_info(self.two_id).balance, 1000.0)
+        self.assertEqual(after['acquires'] - before['acquires'], 50)
+        # one of the two directions is always taken backwards
+        self.assertEqual(after['reordered'] - before['reordered'], 25)
+
+    # transfers both ways between the same accounts finish
+    def test_opposite_transfers_flock(self):
+        write_config(self.dir, {'lock_backend': 'flock', 'lock_timeout': '30'})
+        self.__opposite_transfers()
+
+    def test_opposite_transfers_lockfile(self):
+        write_config(self.dir, {'lock_poll_interval': '0.01', 'lock_timeout': '30'})
+        self.__opposite_transfers()
+
+    def test_timeout_holds_nothing(self):
+        write_config(self.dir, {'lock_backend': 'flock'})
+        busy = AtomicWrite(self.dir, self.two_file)
+        busy.lock_file()
+
+        locks = LockSet([AtomicWrite(self.dir, self.two_file), AtomicWrite(self.dir, self.one_file)])
+        timeouts = get_lock_stats()['timeouts']
+        self.assertRaises(LockTimeout, locks.acquire, 0.2)
+        self.assertEqual(get_lock_stats()['timeouts'], timeouts + 1)
+
+        # the free account wasn't left locked
+        one = AtomicWrite(self.dir, self.one_file)
+        self.assertTrue(one.try_lock_file())
+        one.unlock_file()
+        busy.unlock_file()
+
+        locks.acquire(0.2)
+        self.assertFalse(one.try_lock_file())
+        locks.release()
+
+    def test_renew(self):
+        write_config(self.dir, {'lock_lease': '30'})
+        locks = LockSet([AtomicWrite(self.dir, self.one_file), AtomicWrite(self.dir, self.two_file)])
+        locks.acquire()
+        before = [parse_lock_owner(open(aw.get_lockfilename()).read()).expires for aw in locks.held]
+        time.sleep(0.01)
+        locks.renew()
+        after = [parse_lock_owner(open(aw.get_lockfilename()).read()).expires for aw in locks.held]
+        self.assertTrue(after[0] > before[0] and after[1] > before[1])
+        locks.release()
+
+    def test_same_account_twice(self):
+        aa = AccountActions(self.dir)
+        self.assertFalse(aa.transfer_money(self.one_id, self.one_id, 1.0))
+        self.assertRaises(ValueError, LockSet,
+                          [AtomicWrite(self.dir, self.one_file), AtomicWrite(self.dir, self.one_file)])
+
+if __name__ == '__main__':
+    unittest.main()
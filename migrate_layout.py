@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of AccountUtil
+#
+# moves a flat dbdir (<id>.txt) to the sharded layout (00/00/10/01.txt)
+# while drovebank.py processes keep running against it.
+#
+#  1. the config is set to layout = migrating. every process looks for
+#     the sharded file first and locks accounts in their sharded dir.
+#  2. we wait for every process to pick up the config change.
+#  3. the flat files are moved batch_size at a time. each one is moved
+#     under its account lock with a single rename. the last id moved is
+#     written to layout.migrate so a killed run picks up where it stopped.
+#  4. the config is set to layout = sharded.
+#
+import os
+import re
+import time
+import errno
+import logging
+import argparse
+
+from account_util import AccountUtil
+from drove_bank_constants import load_config, write_config
+from drove_bank_constants import CONFIG_DEFAULTS, CONFIG_REFRESH_INTERVAL
+from write_ahead_log import get_wal
+
+class MigrateLayout(AccountUtil):
+
+    def __init__(self, dir=None):
+        AccountUtil.__init__(self, dir)
+        self.progress_filename = os.path.join(self.dbdir, 'layout.migrate')
+        self.flat_pattern = re.compile('^(\d+)\.txt$')
+        self.moved = 0
+
+    # public
+    # migrates the whole dbdir. returns the number of accounts moved
+    def migrate(self, batch_size=1000, pause=0.1, settle=None):
+        if self.get_layout() == 'sharded':
+            logging.info("ML0042 %s is already sharded", self.dbdir)
+            return 0
+        self.start(settle)
+
+        last_id = self.read_progress()
+        ids = [ac_id for ac_id in self.flat_account_ids() if ac_id > last_id]
+        while len(ids) > 0:
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                self.migrate_batch(batch)
+                self.write_progress(batch[-1])
+                logging.info("ML0053 migrated %d accounts up to %s", self.moved, batch[-1])
+                time.sleep(pause)
+            # anything made flat while we worked (a process that hadn't
+            # seen the config yet) gets another pass
+            ids = self.flat_account_ids()
+
+        self.finish()
+        return self.moved
+
+    # public
+    # switches the dbdir to the migrating layout and waits settle seconds
+    # so every running process will have seen it
+    def start(self, settle=None):
+        if self.get_layout() == 'migrating':
+            return
+        if settle is None:
+            settle = CONFIG_REFRESH_INTERVAL * 2
+        self.__set_layout('migrating')
+        time.sleep(settle)
+
+    # public
+    # all the files are moved, switch to the sharded layout
+    def finish(self):
+        self.__set_layout('sharded')
+        if os.path.exists(self.progress_filename):
+            os.remove(self.progress_filename)
+        logging.info("ML0079 %s is now sharded, %d accounts moved", self.dbdir, self.moved)
+
+    # public
+    # moves one batch of accounts
+    def migrate_batch(self, ids):
+        # with the write ahead log a file can't move while the log still
+        # has content for its flat name, the checkpoint would write the
+        # flat file back
+        wal = None
+        if self.get_storage() == 'wal':
+            wal = get_wal(self.dbdir)
+            wal.checkpoint()
+
+        for ac_id in ids:
+            self.migrate_account(ac_id, wal)
+
+    # public
+    # moves one account from its flat file to its sharded file under the
+    # account lock
+    def migrate_account(self, ac_id, wal=None):
+        flat = self.flat_account_path(ac_id)
+        sharded = self.sharded_account_path(ac_id)
+        self.__make_dir(os.path.dirname(sharded))
+
+        if os.path.exists(flat) is False:
+            return False
+        self.filename = flat
+        self.make_tmp_filenames()
+        self.lock_file()
+        try:
+            # lock_file follows the file if it has already been moved
+            if self.filename != flat:
+                return False
+            if wal is not None and wal.lookup(flat) is not None:
+                wal.checkpoint()
+            os.rename(flat, sharded)
+            self.moved += 1
+            logging.debug("ML0114 moved %s to %s", flat, sharded)
+        finally:
+            self.unlock_file()
+        return True
+
+    # public
+    # the account ids that still have a flat file, in id order
+    def flat_account_ids(self):
+        ids = []
+        for fn in os.listdir(self.dbdir):
+            m = self.flat_pattern.match(fn)
+            if m is not None:
+                ids.append(int(m.group(1)))
+        ids.sort()
+        return ids
+
+    def read_progress(self):
+        if os.path.exists(self.progress_filename) is False:
+            return -1
+        f = open(self.progress_filename, 'r')
+        last_id = f.readline()
+        f.close()
+        return int(last_id.strip())
+
+    def write_progress(self, last_id):
+        tmpname = self.progress_filename + ".tmp"
+        f = open(tmpname, 'w')
+        f.write("%s\n" % last_id)
+        f.flush()
+        f.close()
+        os.rename(tmpname, self.progress_filename)
+
+    def __set_layout(self, layout):
+        options = {}
+        for name, value in load_config(self.dbdir).items():
+            if CONFIG_DEFAULTS.get(name) != value:
+                options[name] = value
+        options['layout'] = layout
+        write_config(self.dbdir, options)
+        logging.info("ML0149 layout of %s set to %s", self.dbdir, layout)
+
+    def __make_dir(self, shard_dir):
+        try:
+            os.makedirs(shard_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def main():
+  parser = argparse.ArgumentParser(description='move a flat data directory to the sharded layout')
+  parser.add_argument('-d', '--dir', help='data directory', default=None)
+  parser.add_argument('-b', '--batch', help='accounts moved per step', type=int, default=1000)
+  parser.add_argument('-p', '--pause', help='seconds to sleep between steps', type=float, default=0.1)
+  args = parser.parse_args()
+  moved = MigrateLayout(args.dir).migrate(args.batch, args.pause)
+  print "moved %d accounts" % moved
+
+if __name__ == "__main__":
+  main()
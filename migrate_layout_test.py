@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for the sharded layout and MigrateLayout
+#
+import unittest
+import os
+import shutil
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import write_config, load_config
+from migrate_layout import MigrateLayout
+from recover import Recover
+
+class MigrateLayout_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'layout_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('998\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __make_accounts(self, count):
+        ac = AccountCreate(self.dir)
+        return [ac.create_account('John', 'Doe%d' % i, 100.0) for i in range(count)]
+
+    def test_sharded_path(self):
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.sharded_account_path(1),
+                         os.path.join(self.dir, '00', '00', '00', '01.txt'))
+        self.assertEqual(aa.sharded_account_path(1001),
+                         os.path.join(self.dir, '00', '00', '10', '01.txt'))
+        self.assertEqual(aa.account_id_from_path(aa.sharded_account_path(1001)), 1001)
+        self.assertEqual(aa.account_id_from_path(os.path.join(self.dir, '1001_ABCDEFGH.txt.xtmp')), 1001)
+        self.assertEqual(aa.account_id_from_path(os.path.join(self.dir, 'index.idx')), None)
+
+    def test_sharded_actions(self):
+        write_config(self.dir, {'layout': 'sharded'})
+        one, two = self.__make_accounts(2)
+        self.assertEqual(one, 999)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, '00', '00', '09', '99.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, '00', '00', '10', '00.txt')))
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.deposit(one, 10.0), 110.0)
+        self.assertTrue(aa.transfer_money(one, two, 60.0))
+        self.assertEqual(aa.get_account_info(one).balance, 50.0)
+        self.assertEqual(aa.get_account_info(two).balance, 160.0)
+        self.assertEqual(len(aa.print_accounts()), 3)
+
+    def test_sharded_recover(self):
+        write_config(self.dir, {'layout': 'sharded'})
+        one, two = self.__make_accounts(2)
+        aa = AccountActions(self.dir)
+        one_file = aa.get_account_filename(one)
+
+        # a transfer that died after step 1 on one side only
+        tmpfile = one_file[:-4] + '_AAAAAAAA.txt.xtmp'
+        shutil.copy2(one_file, tmpfile)
+        lockfile = one_file[:-4] + '.lock'
+        open(lockfile, 'w').close()
+
+        r = Recover(self.dir)
+        pairs = r.find_pairs()
+        self.assertEqual(pairs['AAAAAAAA'], set([one]))
+        r.recover()
+        self.assertFalse(os.path.exists(tmpfile))
+        self.assertFalse(os.path.exists(lockfile))
+        self.assertEqual(aa.get_account_info(one).balance, 100.0)
+
+    def test_migrate(self):
+        ids = self.__make_accounts(5)
+        aa = AccountActions(self.dir)
+        aa.deposit(ids[0], 5.0)
+
+        ml = MigrateLayout(self.dir)
+        ml.start(settle=0)
+        # halfway through both layouts are in use
+        ml.migrate_batch(ids[:2])
+        self.assertEqual(aa.get_account_info(ids[0]).balance, 105.0)
+        self.assertTrue(aa.transfer_money(ids[0], ids[4], 5.0))
+        self.assertEqual(aa.deposit(ids[4], 1.0), 106.0)
+
+        # new accounts go straight to the sharded layout
+        new_id = AccountCreate(self.dir).create_account('Jane', 'Doe', 1.0)
+        self.assertEqual(aa.get_account_filename(new_id), aa.sharded_account_path(new_id))
+
+        moved = ml.migrate(batch_size=2, pause=0)
+        self.assertEqual(moved, 5)
+        self.assertEqual(load_config(self.dir)['layout'], 'sharded')
+        self.assertEqual(ml.flat_account_ids(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'layout.migrate')))
+
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(ids[0]).balance, 100.0)
+        self.assertEqual(aa.get_account_info(ids[4]).balance, 106.0)
+        self.assertEqual(len(aa.print_accounts()), 7)
+
+    def test_migrate_wal(self):
+        write_config(self.dir, {'storage': 'wal'})
+        ids = self.__make_accounts(3)
+        aa = AccountActions(self.dir)
+        aa.deposit(ids[1], 7.0)
+
+        MigrateLayout(self.dir).migrate(batch_size=10, pause=0, settle=0)
+        self.assertEqual(load_config(self.dir)['storage'], 'wal')
+        self.assertEqual(AccountActions(self.dir).get_account_info(ids[1]).balance, 107.0)
+        self.assertFalse(os.path.exists(aa.flat_account_path(ids[1])))
+
+if __name__ == '__main__':
+    unittest.main()
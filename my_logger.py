@@ -1,12 +1,244 @@
 # -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
-from logging import Logger
+#
+# the logging setup of every drovebank process. DroveBankConstants calls
+# setup_logging, the first call in a process wins.
+#
+# a log call doesn't write the file. the record goes on a queue (merged
+# with its args so the caller can change them afterwards) and a writer
+# thread takes whatever has piled up, formats it and appends it to the
+# file with one write, so the commit path never waits on the disk or on
+# another process's append. if the queue is full the record is dropped
+# and counted, the writer logs how many were lost.
+#
+# the level, the file and the format are per process, from the args of
+# the first setup_logging or else the environment:
+#   DROVEBANK_LOG_LEVEL   DEBUG (default), INFO, WARNING, ERROR, CRITICAL
+#   DROVEBANK_LOG_FILE    drovebank.log (default), - for stderr
+#   DROVEBANK_LOG_FORMAT  compact (default) or text (the old
+#                         LEVEL:root:message lines)
+#
+# a compact line is tab separated
+#   time  level  pid  thread  code  message
+#   1760781600.123  DEBUG  4242  MainThread  AU0040  deposit to 17 ...
+# code is the message code (AU0040, XFER0044, ...) the message starts
+# with, - if there is none. parse_line splits one back into a LogLine.
+#
+import os
+import re
+import sys
+import atexit
+import logging
+import threading
+import Queue
+from collections import namedtuple
 
-class MyLogger(Logger):
+LOG_FILENAME = 'drovebank.log'
+LOG_FORMATS = ('compact', 'text')
 
-    def __init__(self):
-        Logger.__init__(self)
+# records waiting for the writer before they are dropped
+LOG_QUEUE_SIZE = 10000
 
+# records the writer puts in one write
+LOG_BATCH = 512
 
+# seconds the exit handler waits for the writer to finish
+LOG_FLUSH_TIMEOUT = 5.0
 
+# a message code, letters then four digits, at the start of a message
+# and a space or a colon after it
+CODE_RE = re.compile(r'([A-Z]+[0-9]{4})[ :]')
 
-}
+LogLine = namedtuple('LogLine', 'time level pid thread code message')
+
+# the handler on the root logger once logging is set up
+_handler = None
+_setup_mutex = threading.Lock()
+
+# sets up the logging of the process if it isn't yet. returns the
+# QueueHandler
+def setup_logging(level=None, filename=None, fmt=None):
+    global _handler
+    if _handler is not None:
+        return _handler
+    with _setup_mutex:
+        if _handler is not None:
+            return _handler
+        if level is None:
+            level = os.environ.get('DROVEBANK_LOG_LEVEL', 'DEBUG')
+        if filename is None:
+            filename = os.environ.get('DROVEBANK_LOG_FILE', LOG_FILENAME)
+        if fmt is None:
+            fmt = os.environ.get('DROVEBANK_LOG_FORMAT', 'compact')
+        if isinstance(level, basestring):
+            level = logging.getLevelName(level.upper())
+            if not isinstance(level, int):
+                level = logging.DEBUG
+        if fmt == 'text':
+            formatter = logging.Formatter(logging.BASIC_FORMAT)
+        else:
+            formatter = CompactFormatter()
+
+        handler = QueueHandler(LogWriter(filename, formatter))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(level)
+        _handler = handler
+        atexit.register(handler.close)
+        return handler
+
+# the LogLine of a compact line, None for anything else
+def parse_line(line):
+    fields = line.rstrip('\n').split('\t', 5)
+    if len(fields) != 6:
+        return None
+    try:
+        return LogLine(float(fields[0]), fields[1], int(fields[2]), fields[3],
+                       None if fields[4] == '-' else fields[4], fields[5])
+    except ValueError:
+        return None
+
+class CompactFormatter(logging.Formatter):
+
+    def format(self, record):
+        message = record.getMessage()
+        match = CODE_RE.match(message)
+        if match is None:
+            code = '-'
+        else:
+            code = match.group(1)
+            message = message[match.end():]
+        if record.exc_text:
+            message = "%s %s" % (message, record.exc_text)
+        message = message.replace('\t', ' ').replace('\n', '\\n')
+        return "%.3f\t%s\t%d\t%s\t%s\t%s" % (record.created, record.levelname, record.process,
+                                             record.threadName, code, message)
+
+# puts records on the writer's queue. python 2 has no
+# logging.handlers.QueueHandler
+class QueueHandler(logging.Handler):
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.dropped = 0
+
+    def emit(self, record):
+        # a forked child has the queue but not the thread
+        if self.writer.pid != os.getpid():
+            self.writer = self.writer.restart()
+        try:
+            # the message and traceback are made now, the args and the
+            # traceback objects may not last until the writer gets to them
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            # after the exit handler stopped the writer (atexit calls
+            # that log) the record is written here
+            if self.writer.stopping:
+                self.writer.write([record])
+                return
+            self.writer.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            self.writer.dropped = self.dropped
+        except Exception:
+            self.handleError(record)
+
+    # waits for the writer to write what is queued
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.stop()
+        logging.Handler.close(self)
+
+class LogWriter(threading.Thread):
+
+    def __init__(self, filename, formatter):
+        threading.Thread.__init__(self, name='log-writer')
+        self.daemon = True
+        self.filename = filename
+        self.formatter = formatter
+        self.queue = Queue.Queue(LOG_QUEUE_SIZE)
+        self.pid = os.getpid()
+        self.dropped = 0
+        self.reported = 0
+        self.stopping = False
+        self.fd = None
+        self.fd_mutex = threading.Lock()
+        self.start()
+
+    # a new writer for the same file, for a forked child
+    def restart(self):
+        return LogWriter(self.filename, self.formatter)
+
+    # public
+    # returns once every record queued before the call is written
+    def flush(self, timeout=LOG_FLUSH_TIMEOUT):
+        if self.is_alive() is False or threading.current_thread() is self:
+            return
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except Queue.Full:
+            return
+        done.wait(timeout)
+
+    def stop(self):
+        if self.is_alive() is False:
+            return
+        self.stopping = True
+        self.flush()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.write(batch)
+            if self.stopping and self.queue.empty():
+                break
+
+    # formats the records of a batch and appends them in one write. the
+    # Events of flush are set once what came before them is out
+    def write(self, batch):
+        lines = []
+        events = []
+        for item in batch:
+            if isinstance(item, logging.LogRecord):
+                try:
+                    lines.append(self.formatter.format(item) + '\n')
+                except Exception:
+                    pass
+            else:
+                events.append(item)
+        if self.dropped > self.reported:
+            lines.append(self.formatter.format(logging.makeLogRecord(
+                {'msg': "LOG0190 %d log records dropped, the queue was full"
+                        % (self.dropped - self.reported),
+                 'levelno': logging.WARNING, 'levelname': 'WARNING'})) + '\n')
+            self.reported = self.dropped
+        if len(lines) > 0:
+            try:
+                with self.fd_mutex:
+                    self.__append(''.join(lines))
+            except (IOError, OSError) as e:
+                sys.stderr.write("log writer: can't write %s: %s\n" % (self.filename, e))
+        for event in events:
+            event.set()
+
+    # private
+    def __append(self, data):
+        if self.fd is None:
+            if self.filename == '-':
+                self.fd = 2
+            else:
+                self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        while len(data) > 0:
+            written = os.write(self.fd, data)
+            data = data[written:]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for the queue logging of my_logger.py
+#
+import unittest
+import os
+import time
+import shutil
+import logging
+import threading
+
+import my_logger
+from my_logger import QueueHandler, LogWriter, CompactFormatter, parse_line
+
+class MyLogger_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'logger_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        self.filename = os.path.join(self.dir, 'test.log')
+        self.handlers = []
+
+    def tearDown(self):
+        for logger, handler in self.handlers:
+            logger.removeHandler(handler)
+            handler.close()
+        shutil.rmtree(self.dir)
+
+    def __logger(self, name, formatter=None):
+        handler = QueueHandler(LogWriter(self.filename, formatter or CompactFormatter()))
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.handlers.append((logger, handler))
+        return logger, handler
+
+    def __lines(self):
+        f = open(self.filename)
+        lines = f.readlines()
+        f.close()
+        return lines
+
+    def test_compact(self):
+        logger, handler = self.__logger('logger_test.compact')
+        accounts = [17]
+        logger.debug("AU0040 deposit to %s of %s", accounts, 5.0)
+        # the record was made when it was logged
+        accounts.append(18)
+        logger.warning("no code\there")
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            logger.exception("XFER0044 failed")
+        handler.flush()
+
+        lines = [parse_line(line) for line in self.__lines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].code, 'AU0040')
+        self.assertEqual(lines[0].message, 'deposit to [17] of 5.0')
+        self.assertEqual(lines[0].level, 'DEBUG')
+        self.assertEqual(lines[0].pid, os.getpid())
+        self.assertEqual(lines[0].thread, threading.current_thread().name)
+        self.assertEqual(lines[1].code, None)
+        self.assertEqual(lines[1].message, 'no code here')
+        self.assertEqual(lines[2].code, 'XFER0044')
+        self.assertTrue(lines[2].message.startswith('failed Traceback'))
+        self.assertTrue('ValueError: bad' in lines[2].message)
+        self.assertEqual(parse_line('INFO:root:AU0040 old style\n'), None)
+
+    def test_text(self):
+        logger, handler = self.__logger('logger_test.text', logging.Formatter(logging.BASIC_FORMAT))
+        logger.info("AC0059 created %d", 3)
+        handler.flush()
+        self.assertEqual(self.__lines(), ['INFO:logger_test.text:AC0059 created 3\n'])
+
+    def test_threads(self):
+        logger, handler = self.__logger('logger_test.threads')
+        def work(n):
+            for i in range(200):
+                logger.debug("TL%04d line %d", n, i)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        handler.close()
+
+        lines = [parse_line(line) for line in self.__lines()]
+        self.assertEqual(len(lines), 800)
+        for n in range(4):
+            mine = [int(line.message.split()[1]) for line in lines if line.code == 'TL%04d' % n]
+            self.assertEqual(mine, range(200))
+
+        # once the writer is stopped the records are written straight away
+        logger.info("TL0099 after close")
+        self.assertEqual(parse_line(self.__lines()[-1]).code, 'TL0099')
+
+    def test_full_queue(self):
+        size = my_logger.LOG_QUEUE_SIZE
+        my_logger.LOG_QUEUE_SIZE = 1
+        try:
+            writer = LogWriter(self.filename, CompactFormatter())
+        finally:
+            my_logger.LOG_QUEUE_SIZE = size
+        handler = QueueHandler(writer)
+        for i in range(1000):
+            handler.handle(logging.makeLogRecord({'msg': "FQ0001 record %d" % i}))
+        while writer.queue.empty() is False:
+            time.sleep(0.01)
+        handler.handle(logging.makeLogRecord({'msg': "FQ0002 last"}))
+        handler.close()
+
+        lines = [parse_line(line) for line in self.__lines()]
+        self.assertTrue(handler.dropped > 0)
+        self.assertEqual(len([line for line in lines if line.code == 'FQ0001']) + handler.dropped, 1000)
+        self.assertTrue('LOG0190' in [line.code for line in lines])
+
+if __name__ == '__main__':
+    unittest.main()
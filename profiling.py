@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# opt in profiling of any drovebank process, turned on from the
+# environment or the --profile flags of drovebank.py, recover.py,
+# bank_server.py and batch_transfer.py (the flags win). the modes, a
+# comma separated list
+#   process   cProfile of the main thread from start to exit
+#   ops       cProfile of every Nth call of the named ops (the ones
+#             bank_metrics.timed wraps: deposit, withdraw, transfer, get,
+#             create, recover), in whatever thread they run
+#   sample    a thread that takes the stacks of every other thread every
+#             few milliseconds, for the threads cProfile doesn't see
+#
+#   DROVEBANK_PROFILE           the modes, off when not set
+#   DROVEBANK_PROFILE_DIR       where the dumps go, ./profiles
+#   DROVEBANK_PROFILE_OPS       ops for ops mode, deposit,withdraw,transfer
+#   DROVEBANK_PROFILE_EVERY     N, 100
+#   DROVEBANK_PROFILE_INTERVAL  seconds between samples, 0.005
+#
+# at exit a process writes <prog>.<pid>.process.pstats, <prog>.<pid>.ops.pstats
+# and <prog>.<pid>.sample.txt (one "stack;of;frames count" line per stack,
+# the collapsed format flame graph tools read) to the dir.
+#
+#   ./profiling.py -p profiles (-k ops) (-s cumulative) (-n 30) (-o all.pstats)
+#
+# merges the dumps of every process into one report.
+#
+import os
+import sys
+import glob
+import atexit
+import pstats
+import cProfile
+import logging
+import argparse
+import threading
+from StringIO import StringIO
+
+MODES = ('process', 'ops', 'sample')
+KINDS = ('process', 'ops', 'sample')
+
+DEFAULT_DIR = 'profiles'
+DEFAULT_OPS = 'deposit,withdraw,transfer'
+DEFAULT_EVERY = 100
+DEFAULT_INTERVAL = 0.005
+
+# the Profiler of the process once profiling is set up, None when it is
+# off. bank_metrics.timed looks at it on every call
+op_profiler = None
+
+_profiler = None
+_setup_mutex = threading.Lock()
+
+# turns profiling on if modes (or DROVEBANK_PROFILE) asks for it. the
+# first call in a process wins. returns the Profiler or None
+def setup_profiling(modes=None, dir=None, ops=None, every=None, interval=None):
+    global _profiler, op_profiler
+    if _profiler is not None:
+        return _profiler
+    with _setup_mutex:
+        if _profiler is not None:
+            return _profiler
+        if modes is None:
+            modes = os.environ.get('DROVEBANK_PROFILE', '')
+        modes = [mode.strip() for mode in modes.split(',') if mode.strip()]
+        if len(modes) == 0:
+            return None
+        for mode in modes:
+            if mode not in MODES:
+                logging.error("PR0063 unknown profile mode %s", mode)
+                return None
+        if dir is None:
+            dir = os.environ.get('DROVEBANK_PROFILE_DIR', DEFAULT_DIR)
+        if ops is None:
+            ops = os.environ.get('DROVEBANK_PROFILE_OPS', DEFAULT_OPS)
+        if every is None:
+            every = int(os.environ.get('DROVEBANK_PROFILE_EVERY', DEFAULT_EVERY))
+        if interval is None:
+            interval = float(os.environ.get('DROVEBANK_PROFILE_INTERVAL', DEFAULT_INTERVAL))
+
+        profiler = Profiler(modes, dir, [op.strip() for op in ops.split(',') if op.strip()],
+                            every, interval)
+        profiler.start()
+        _profiler = profiler
+        if 'ops' in modes:
+            op_profiler = profiler
+        atexit.register(profiler.dump)
+        logging.info("PR0078 profiling %s to %s", ','.join(modes), dir)
+        return profiler
+
+# the --profile flags of an entry point
+def add_profile_args(parser):
+    parser.add_argument('--profile', help='profile modes: process, ops, sample (or DROVEBANK_PROFILE)',
+                        default=None)
+    parser.add_argument('--profile-dir', help='dir of the profile dumps', default=None)
+    parser.add_argument('--profile-ops', help='ops profiled by the ops mode', default=None)
+    parser.add_argument('--profile-every', help='profile every Nth call of an op', type=int, default=None)
+
+# setup_profiling from the parsed --profile flags
+def setup_profiling_args(args):
+    return setup_profiling(args.profile, args.profile_dir, args.profile_ops, args.profile_every)
+
+class Profiler(object):
+
+    def __init__(self, modes, dir, ops, every=DEFAULT_EVERY, interval=DEFAULT_INTERVAL):
+        self.modes = modes
+        self.dir = dir
+        self.ops = set(ops)
+        self.every = max(every, 1)
+        self.interval = interval
+        self.pid = os.getpid()
+        self.process = None
+        # op -> calls so far
+        self.calls = dict((op, 0) for op in self.ops)
+        self.calls_mutex = threading.Lock()
+        # every thread's Profile for the ops, a Profile is used by one
+        # thread only
+        self.local = threading.local()
+        self.op_profiles = []
+        self.samples = {}
+        self.sampler = None
+        self.stopping = threading.Event()
+
+    # public
+    def start(self):
+        if 'process' in self.modes:
+            self.process = cProfile.Profile()
+            self.process.enable()
+        if 'sample' in self.modes:
+            self.sampler = threading.Thread(target=self.__sample, name='profile-sampler')
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    # public
+    # calls method, under the thread's Profile if it is the every-th
+    # call of op
+    def call(self, op, method, args, kwargs):
+        if op not in self.ops:
+            return method(*args, **kwargs)
+        with self.calls_mutex:
+            self.calls[op] += 1
+            profile_it = self.calls[op] % self.every == 0
+        if profile_it is False:
+            return method(*args, **kwargs)
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = cProfile.Profile()
+            self.local.profile = profile
+            with self.calls_mutex:
+                self.op_profiles.append(profile)
+        return profile.runcall(method, *args, **kwargs)
+
+    # public
+    # writes the dumps. returns their paths
+    def dump(self):
+        # a forked child has its parent's profiler but not its calls
+        if os.getpid() != self.pid:
+            return []
+        if os.path.isdir(self.dir) is False:
+            os.makedirs(self.dir)
+        prefix = os.path.join(self.dir, "%s.%d" % (program_name(), self.pid))
+        paths = []
+        if self.process is not None:
+            self.process.disable()
+            paths.append(self.__dump_stats([self.process], prefix + '.process.pstats'))
+            self.process.enable()
+        with self.calls_mutex:
+            profiles = list(self.op_profiles)
+        if len(profiles) > 0:
+            paths.append(self.__dump_stats(profiles, prefix + '.ops.pstats'))
+        if self.sampler is not None:
+            self.stopping.set()
+            self.sampler.join()
+            self.sampler = None
+            with self.calls_mutex:
+                samples = dict(self.samples)
+            f = open(prefix + '.sample.txt', 'w')
+            for stack in sorted(samples):
+                f.write("%s %d\n" % (stack, samples[stack]))
+            f.close()
+            paths.append(prefix + '.sample.txt')
+        logging.info("PR0163 profiles written: %s", ', '.join(paths))
+        return paths
+
+    # private
+    def __dump_stats(self, profiles, path):
+        stats = pstats.Stats(profiles[0], stream=StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        return path
+
+    # the sampler thread. a sample is the stack of every other thread
+    # from its outermost frame in, as module.py:function;...
+    def __sample(self):
+        me = threading.current_thread().ident
+        while self.stopping.wait(self.interval) is False:
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self.calls_mutex:
+                for stack in stacks:
+                    self.samples[stack] = self.samples.get(stack, 0) + 1
+
+# the name of the running script, drovebank for drovebank.py
+def program_name():
+    name = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+    return name or 'python'
+
+# one pstats.Stats of the kind (process or ops) dumps in dir. None if
+# there are none
+def merge_stats(dir, kind='ops', stream=None):
+    paths = sorted(glob.glob(os.path.join(dir, '*.%s.pstats' % kind)))
+    if len(paths) == 0:
+        return None
+    stats = pstats.Stats(paths[0], stream=stream or sys.stdout)
+    for path in paths[1:]:
+        stats.add(path)
+    return stats
+
+# the samples of every sample dump in dir, stack -> count
+def merge_samples(dir):
+    samples = {}
+    for path in sorted(glob.glob(os.path.join(dir, '*.sample.txt'))):
+        f = open(path)
+        for line in f:
+            stack, n = line.rstrip('\n').rsplit(' ', 1)
+            samples[stack] = samples.get(stack, 0) + int(n)
+        f.close()
+    return samples
+
+def main():
+  parser = argparse.ArgumentParser(description='merge the profile dumps of drovebank processes')
+  parser.add_argument('-p', '--dir', help='dir of the dumps', default=DEFAULT_DIR)
+  parser.add_argument('-k', '--kind', help='which dumps', choices=KINDS, default='ops')
+  parser.add_argument('-s', '--sort', help='pstats sort key', default='cumulative')
+  parser.add_argument('-n', '--lines', help='lines of the report', type=int, default=30)
+  parser.add_argument('-o', '--output', help='write the merged pstats (or samples) here', default=None)
+  args = parser.parse_args()
+
+  if args.kind == 'sample':
+    samples = merge_samples(args.dir)
+    if len(samples) == 0:
+      print "no sample dumps in %s" % args.dir
+      sys.exit(1)
+    # the time of a function is the samples it is on the stack of, self
+    # is the ones it is at the top of
+    total = sum(samples.values())
+    inclusive = {}
+    own = {}
+    for stack, n in samples.items():
+      frames = stack.split(';')
+      for frame in set(frames):
+        inclusive[frame] = inclusive.get(frame, 0) + n
+      own[frames[-1]] = own.get(frames[-1], 0) + n
+    print "%d samples" % total
+    print "%8s %8s  %s" % ('total %', 'self %', 'function')
+    for frame in sorted(inclusive, key=lambda frame: -inclusive[frame])[:args.lines]:
+      print "%7.1f%% %7.1f%%  %s" % (inclusive[frame] * 100.0 / total, own.get(frame, 0) * 100.0 / total,
+                                     frame)
+    if args.output is not None:
+      f = open(args.output, 'w')
+      for stack in sorted(samples):
+        f.write("%s %d\n" % (stack, samples[stack]))
+      f.close()
+    return
+
+  stats = merge_stats(args.dir, args.kind)
+  if stats is None:
+    print "no %s dumps in %s" % (args.kind, args.dir)
+    sys.exit(1)
+  if args.output is not None:
+    stats.dump_stats(args.output)
+  stats.sort_stats(args.sort).print_stats(args.lines)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for profiling.py
+#
+import unittest
+import os
+import sys
+import time
+import shutil
+import pstats
+import subprocess
+import threading
+from StringIO import StringIO
+
+import profiling
+from profiling import Profiler, merge_stats, merge_samples
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import clear_config_cache
+
+class Profiling_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'profiling_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        self.profile_dir = os.path.join(self.dir, 'profiles')
+        self.db_dir = os.path.join(self.dir, 'db')
+        os.mkdir(self.db_dir)
+        f = open(os.path.join(self.db_dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+        clear_config_cache()
+
+    def tearDown(self):
+        profiling.op_profiler = None
+        shutil.rmtree(self.dir)
+
+    def __functions(self, stats):
+        return [function for filename, line, function in stats.stats]
+
+    def test_ops(self):
+        ac = AccountCreate(self.db_dir)
+        one = ac.create_account('John', 'Doe', 100.0)
+        two = ac.create_account('Jane', 'Doe', 100.0)
+
+        profiler = Profiler(['ops'], self.profile_dir, ['deposit', 'transfer'], every=3)
+        profiler.start()
+        profiling.op_profiler = profiler
+        aa = AccountActions(self.db_dir)
+        for n in range(6):
+            aa.deposit(one, 1.0)
+        aa.withdraw(one, 1.0)
+        aa.transfer_money(one, two, 1.0)
+        # deposits on another thread go to a Profile of their own
+        worker = threading.Thread(target=lambda: [aa.deposit(two, 1.0) for n in range(3)])
+        worker.start()
+        worker.join()
+        profiling.op_profiler = None
+
+        self.assertEqual(profiler.calls, {'deposit': 9, 'transfer': 1})
+        self.assertEqual(len(profiler.op_profiles), 2)
+        self.assertEqual(aa.get_account_info(one).balance, 104.0)
+
+        paths = profiler.dump()
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(paths[0].endswith('.%d.ops.pstats' % os.getpid()))
+        stats = pstats.Stats(paths[0], stream=StringIO())
+        functions = self.__functions(stats)
+        self.assertTrue('deposit' in functions)
+        self.assertFalse('withdraw' in functions)
+        self.assertFalse('transfer_money' in functions)
+        # the three profiled deposits
+        deposits = [value for key, value in stats.stats.items() if key[2] == 'deposit']
+        self.assertEqual(sum([value[1] for value in deposits]), 3)
+
+        # a second process's dump merges in
+        shutil.copy(paths[0], os.path.join(self.profile_dir, 'other.1.ops.pstats'))
+        merged = merge_stats(self.profile_dir, 'ops', StringIO())
+        deposits = [value for key, value in merged.stats.items() if key[2] == 'deposit']
+        self.assertEqual(sum([value[1] for value in deposits]), 6)
+        self.assertEqual(merge_stats(self.profile_dir, 'process'), None)
+
+    def test_sample(self):
+        profiler = Profiler(['sample'], self.profile_dir, [], interval=0.001)
+        profiler.start()
+        stop = time.time() + 0.2
+        while time.time() < stop:
+            sum(range(100))
+        paths = profiler.dump()
+        self.assertEqual(len(paths), 1)
+        samples = merge_samples(self.profile_dir)
+        self.assertTrue(sum(samples.values()) > 0)
+        self.assertTrue([stack for stack in samples if 'profiling_test.py:test_sample' in stack])
+        self.assertEqual(profiler.sampler, None)
+
+    def test_env(self):
+        # recover.py under DROVEBANK_PROFILE dumps the whole process at exit
+        env = dict(os.environ)
+        env.update({'DROVEBANK_PROFILE': 'process', 'DROVEBANK_PROFILE_DIR': self.profile_dir})
+        here = os.path.dirname(os.path.abspath(profiling.__file__))
+        subprocess.check_call([sys.executable, os.path.join(here, 'recover.py'), '-d', self.db_dir],
+                              env=env, stdout=open(os.devnull, 'w'), cwd=self.dir)
+        dumps = os.listdir(self.profile_dir)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith('recover.') and dumps[0].endswith('.process.pstats'))
+        self.assertTrue('recover' in self.__functions(merge_stats(self.profile_dir, 'process', StringIO())))
+
+if __name__ == '__main__':
+    unittest.main()
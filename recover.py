@@ -16,7 +16,15 @@ import argparse
 
 from account_util import AccountUtil
 from account_actions import AccountActions
-from atomic_write import AtomicWrite
+from account_create import AccountCreate, RESERVATION_PATTERN
+from atomic_write import AtomicWrite, pid_alive
+from write_ahead_log import get_wal
+from binary_store import get_binary_store
+from account_summary import get_summary
+from account_history import get_history
+from recovery_catalog import RecoveryCatalog
+from bank_metrics import timed
+from profiling import add_profile_args, setup_profiling_args
 from collections import namedtuple
 
 class Recover(AccountActions):
@@ -25,94 +33,214 @@ class Recover(AccountActions):
         AccountActions.__init__(self, dir)
 
     # public
-    # transfers money from one account to another.
-    # returns True on success False on failue
-    # error string can be retrieved using get_error_string
+    # recovers the dbdir after a crash. the dbdir is catalogued once and
+    # every step looks its files up in the catalog. returns the stats of
+    # the run, how long it took and what it found.
+    @timed('recover')
     def recover(self):
-        self.__recover_transfers()
-        self.recover_write()
+        start = time.time()
+        catalog = RecoveryCatalog(self.dbdir).scan()
 
-    def __recover_transfers(self):
-        pair_hash = self.find_pairs()
+        transfers = self.__recover_transfers(catalog)
+
+        # find_pairs left the transfer suffixes set
+        self.set_tmp_suffix("tmp")
+        self.set_old_suffix("old")
+        self.recover_write(catalog)
+
+        # the binary store writes the commit that was in its journal again
+        if self.get_storage() == 'binary':
+            get_binary_store(self.dbdir).recover()
+
+        # an optimistic commit that died before it finished its history
+        # has no lock file, its .pend file says where the records are
+        pending = self.__recover_optimistic_history(catalog)
+
+        # an optimistic commit that died before its rename never touched
+        # the account file
+        for entry in catalog.get_optimistic_files():
+            logging.info("RCVR0049 removing unfinished optimistic commit %s", entry.path)
+            self.__safe_os_remove(entry.path)
+
+        # an account that was never created. its id is used up.
+        for atmp in catalog.get_create_files():
+            logging.info("RCVR0042 removing unfinished account file %s", atmp)
+            self.__safe_os_remove(atmp)
+
+        # blocks of ids whose process died. the ids without an account
+        # file go back to the index or are skipped. the blocks of running
+        # processes are left to them.
+        reservations = catalog.get_reservations()
+        if len(reservations) > 0:
+            ac = AccountCreate(self.dbdir)
+            for rsv in reservations:
+                ac.recover_reservation(rsv)
+
+        # with the write ahead log the deposits, withdraws and transfers
+        # never made tmp/old files. the above only clears lock files (and
+        # anything left from before the dbdir was switched to the log),
+        # the log tail is replayed into the data files here.
+        if self.get_storage() == 'wal':
+            get_wal(self.dbdir).recover()
+
+        # a crash between a commit and its summary update leaves the
+        # summary behind. the account files are right now so read it back.
+        if self.get_config_bool('summary'):
+            get_summary(self.dbdir).rebuild(self.iter_account_files)
+
+        # the history records of the commits that were going on are kept
+        # if the commit went through and voided if it didn't
+        voided = 0
+        if self.get_config_bool('history'):
+            voided = get_history(self.dbdir).recover(self.__history_accounts(catalog),
+                                                     self.__current_balance)
+
+        stats = catalog.get_stats()
+        stats['catalog_seconds'] = stats.pop('seconds')
+        stats['transfers'] = transfers
+        stats['history_voided'] = voided
+        stats['history_pending'] = pending
+        stats['seconds'] = time.time() - start
+        logging.info("RCVR0064 recovered %s in %.3f seconds: %d entries in %d dirs "
+                     "catalogued in %.3f seconds, %d lock files, %d transfers",
+                     self.dbdir, stats['seconds'], stats['entries'], stats['dirs'],
+                     stats['catalog_seconds'], stats['locks'], transfers)
+        return stats
+
+    # public
+    # recovers the accounts of the lock files in catalog while the rest
+    # of the bank runs, for a lock_file that found its holder died
+    # (atomic_write.py). catalog only has the files of those accounts and
+    # the other accounts of their transfers, and the caller holds their
+    # locks. their unfinished writes are finished or undone, their summary
+    # records and history brought up to date and the lock files removed.
+    # returns the accounts.
+    def recover_locks(self, catalog):
+        # the lock files go last, once they do someone else can commit
+        self.__recover_transfers(catalog, True)
+        self.set_tmp_suffix("tmp")
+        self.set_old_suffix("old")
+        self.recover_write(catalog, True)
+
+        if self.get_storage() == 'binary':
+            get_binary_store(self.dbdir).recover()
+
+        accounts = set(key for key, lockfile in catalog.get_locks() if isinstance(key, int))
+        if self.get_config_bool('summary'):
+            for ac_id in sorted(accounts):
+                try:
+                    info = self.read_account_file(self.get_account_filename(ac_id), False)
+                except (IOError, OSError, ValueError, IndexError):
+                    continue
+                self.update_summary([(ac_id, info.fname, info.lname, info.balance)])
+        if self.get_config_bool('history'):
+            get_history(self.dbdir).recover(accounts, self.__current_balance)
+
+        for key, lockfile in catalog.get_locks():
+            logging.info("RCVR0093 removing lock file %s", lockfile)
+            self.__safe_os_remove(lockfile)
+        return accounts
+
+    # private
+    # the accounts a crash can have left pending history records for: the
+    # locked ones, the optimistic commits, the ones being created and the
+    # last ids handed out
+    def __history_accounts(self, catalog):
+        accounts = set(key for key, lockfile in catalog.get_locks() if isinstance(key, int))
+        accounts.update(entry.key for entry in catalog.get_optimistic_files() if isinstance(entry.key, int))
+        for atmp in catalog.get_create_files():
+            accounts.add(self.account_id_from_path(atmp))
+        ac = AccountCreate(self.dbdir)
+        for rsv in catalog.get_reservations():
+            m = RESERVATION_PATTERN.match(os.path.basename(rsv))
+            pid = ac.get_reservation_pid(rsv)
+            if m is not None and (pid is None or pid_alive(pid) is False):
+                accounts.update(range(int(m.group(1)), int(m.group(2)) + 1))
+        last_id = self.get_last_account_id()
+        if last_id is not None:
+            accounts.add(last_id)
+        accounts.discard(None)
+        return accounts
+
+    # private
+    # settles the history records of the .pend files in catalog: kept if
+    # the rename went through, voided if the .otmp file of the commit is
+    # still there. a .pend file cut short was written before the rename,
+    # its account is left to the balance check of the history recovery.
+    # returns the number of .pend files.
+    def __recover_optimistic_history(self, catalog):
+        not_renamed = set((entry.key, entry.transid) for entry in catalog.get_optimistic_files())
+        entries = catalog.get_pending_files()
+        for entry in entries:
+            try:
+                pending = self.load_pending(entry.path)
+            except (ValueError, IOError, OSError) as e:
+                logging.warning("RCVR0150 unreadable history marker %s: %s", entry.path, e)
+                pending = None
+            if pending is not None and self.get_config_bool('history'):
+                if (entry.key, entry.transid) in not_renamed:
+                    logging.info("RCVR0155 voiding the history of unfinished commit %s", entry.path)
+                    get_history(self.dbdir).void(pending)
+                else:
+                    logging.info("RCVR0158 keeping the history of optimistic commit %s", entry.path)
+                    get_history(self.dbdir).finish(pending)
+            self.__safe_os_remove(entry.path)
+        return len(entries)
+
+    # private
+    # the balance of an account after the recovery, None if it isn't there
+    def __current_balance(self, ac_id):
+        try:
+            return self.read_account_file(self.get_account_filename(ac_id)).balance
+        except (IOError, OSError):
+            return None
+
+    # returns the number of transfers recovered. keep_locks leaves the
+    # lock files
+    def __recover_transfers(self, catalog, keep_locks=False):
+        pair_hash = self.find_pairs(catalog)
         for transid, pset in pair_hash.iteritems():
 
             # look for sole survior (should only happen
             # if crashed in the middle of step 4
             if len(pset) == 1:
-                self.__handle_sole_pset(transid, pset)
+                self.__handle_sole_pset(transid, pset, catalog, keep_locks)
                 continue
 
-            plist = list(pset)
-            lockfile_1 = self.__make_lock_filename(plist[0])
-            lockfile_2 = self.__make_lock_filename(plist[1])
+            # a transfer has two files, a batch (batch_transfer.py) one
+            # per account and its checkpoint file
+            lockfiles = [self.__make_lock_filename(key) for key in pset]
 
-            # AccountActions.recover_transfer will clean up
+            # AccountActions.recover_transaction will clean up
             # this transfer
             aa = AccountActions(self.dbdir)
-            aa.recover_transfer(lockfile_1, lockfile_2)
+            aa.recover_transaction(lockfiles, catalog, transid, keep_locks)
+        return len(pair_hash)
 
 
-    # find the pairs of transactions
-    def find_pairs(self):
+    # find the pairs of transactions: transid -> set of the keys (account
+    # ids, or <dir>/<prefix> for other files) with xtmp or xold files of it
+    def find_pairs(self, catalog=None):
         self.set_tmp_suffix("xtmp")
         self.set_old_suffix("xold")
 
-        pair_hash = {}
-        p = re.compile('(^\d+\w)(\w{8})')
-
-        tmpfile = None
-        tmpfiletest = "*." + self.tmpsuffix
-        for tfile in self.ffind(tmpfiletest, self.dbdir):
-            tmpfile = tfile
-            basename = os.path.basename(tmpfile)
-
-            # use regex to extract transid and pid
-            m = p.match(basename)
-            transid = m.group(2)
-            pid = int(m.group(1).replace("_", ""))
-            logging.debug("RCVR0050 tfile = %s pid = %s transid = %s", tfile, pid, transid)
-
-            # build pairs of pids using a set
-            if transid in pair_hash:
-                pset = pair_hash[transid]
-                if pid not in pset:
-                    pset.add(pid)
-            else:
-                pset = set()
-                pset.add(pid)
-                pair_hash[transid] = pset
-
-
-        # if we didn't find any tmp files look for old files
-        # else use the matching old file
-        oldfile = None
-        oldfiletest = "*." + self.oldsuffix
-        for ofile in self.ffind(oldfiletest, self.dbdir):
-            oldfile = ofile
-            basename = os.path.basename(oldfile)
-
-            # use regex to extract transid and pid
-            m = p.match(basename)
-            transid = m.group(2)
-            pid = int(m.group(1).replace("_", ""))
-
-            # build pairs of pids using a set
-            logging.debug("RCVR0072 ofile = %s pid = %s transid = %s", ofile, pid, transid)
-            if transid in pair_hash:
-                pset = pair_hash[transid]
-                if pid not in pset:
-                    pset.add(pid)
-            else:
-                pset = set()
-                pset.add(pid)
-                pair_hash[transid] = pset
-
+        if catalog is None:
+            catalog = RecoveryCatalog(self.dbdir).scan()
+        pair_hash = catalog.get_transfers()
+        for transid, pset in pair_hash.iteritems():
+            logging.debug("RCVR0050 transid = %s pids = %s", transid, sorted(pset))
         return pair_hash
 
     # there be private utility functions down here.
     def __make_lock_filename(self, pid):
-        basename = "%d.lock" % pid
-        fname = os.path.join(self.dbdir, basename)
+        if isinstance(pid, int) is False:
+            # not an account, the lock is next to the file
+            return "%s.%s" % (pid, self.locksuffix)
+        if self.get_layout() == 'flat':
+            filename = self.flat_account_path(pid)
+        else:
+            filename = self.sharded_account_path(pid)
+        fname = self.get_lock_path(filename)
 
         logging.debug("RCVR0103 making lock filename %s", fname)
 
@@ -122,28 +250,30 @@ class Recover(AccountActions):
         if os.path.exists(filename) is True:
             os.remove(filename)
 
-    def __handle_sole_pset(self, transid, pset):
+    def __handle_sole_pset(self, transid, pset, catalog, keep_locks=False):
         pid = list(pset)[0]
-        logging.debug("RCVR011 handle sole pset %s %d", transid, pid)
+        logging.debug("RCVR011 handle sole pset %s %s", transid, pid)
 
         lockfile = self.__make_lock_filename(pid)
 
-        oldbase = "%d_%s.txt.xold" % (pid, transid)
-        oldfile = os.path.join(self.dbdir, oldbase)
-
-        tmpbase = "%d_%s.txt.xtmp" % (pid, transid)
-        tmpfile = os.path.join(self.dbdir, tmpbase)
-
-        self.__safe_os_remove(tmpfile)
-        self.__safe_os_remove(oldfile)
-        self.__safe_os_remove(lockfile)
+        # the tmp files sit next to the data file, which may still be
+        # flat while the layout is migrating
+        for entry in catalog.get_intermediates(pid, transid=transid):
+            if entry.suffix in ('xtmp', 'xold'):
+                self.__safe_os_remove(entry.path)
+        if keep_locks is False:
+            self.__safe_os_remove(lockfile)
 
 def main():
   parser = argparse.ArgumentParser(description='recover db from system crash')
   parser.add_argument('-d', '--dir', help='data directory', default=None)
+  add_profile_args(parser)
   args = parser.parse_args()
+  setup_profiling_args(args)
   in_dir = args.dir
-  Recover(in_dir).recover()
+  stats = Recover(in_dir).recover()
+  print "recovered in %.3f seconds (%d entries catalogued in %.3f seconds, %d lock files, %d transfers)" % (
+    stats['seconds'], stats['entries'], stats['catalog_seconds'], stats['locks'], stats['transfers'])
 
 if __name__ == "__main__":
   main()
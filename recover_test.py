@@ -2,8 +2,15 @@
 import unittest
 import os
 import time
+import shutil
 
 from recover import Recover
+from account_util import AccountUtil
+from account_actions import AccountActions
+from account_create import AccountCreate
+from account_history import get_history, KIND_TRANSFER_OUT, KIND_WITHDRAW
+from drove_bank_constants import write_config, clear_config_cache
+from bank_metrics import snapshot
 
 class AccountCreate_Test(unittest.TestCase):
 
@@ -71,5 +78,76 @@ class AccountCreate_Test(unittest.TestCase):
         for transid, pset in pair_hash.iteritems():
             self.assertTrue( (len(pset) < 3) )
 
+# a lock_file that finds the holder of the lock died recovers just that
+# account, and the other one of its transfer
+class RecoverLocks_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'recover_locks_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('0\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        clear_config_cache()
+
+    # a transfer from one to two that dies before move count + 1 of its
+    # commit
+    def __die_in_transfer(self, one, two, count):
+        pid = os.fork()
+        if pid == 0:
+            moves = []
+            move = shutil.move
+            def dying_move(src, dst):
+                if len(moves) == count:
+                    os._exit(1)
+                move(src, dst)
+                moves.append(dst)
+            shutil.move = dying_move
+            AccountActions(self.dir).transfer_money(one, two, 10.0)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    def __recovered(self):
+        return snapshot()['counters'].get('drovebank_stale_locks_total', {}).get((('result', 'recovered'),), 0)
+
+    def __run(self, backend):
+        write_config(self.dir, {'lock_backend': backend, 'lock_timeout': '5', 'lock_poll_interval': '0.05'})
+        ac = AccountCreate(self.dir)
+        one = ac.create_account('John', 'Doe', 100.0)
+        two = ac.create_account('Jane', 'Doe', 100.0)
+
+        # both old files are there and one tmp is in place, the transfer
+        # is finished
+        self.__die_in_transfer(one, two, 3)
+        self.assertTrue([fn for fn in os.listdir(self.dir) if fn.endswith('.lock')])
+        recovered = self.__recovered()
+        start = time.time()
+        self.assertEqual(AccountUtil(self.dir).deposit(two, 5.0), 115.0)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(self.__recovered(), recovered + 1)
+        aa = AccountActions(self.dir)
+        self.assertEqual(aa.get_account_info(one).balance, 90.0)
+        self.assertEqual(aa.get_bank_totals().balance, 205.0)
+        self.assertEqual([record.kind for record in get_history(self.dir).query(one)][-1], KIND_TRANSFER_OUT)
+
+        # died before any move, the transfer never happened
+        self.__die_in_transfer(one, two, 0)
+        self.assertEqual(AccountUtil(self.dir).withdraw(one, 5.0), 85.0)
+        self.assertEqual(aa.get_bank_totals().balance, 200.0)
+        self.assertEqual([record.kind for record in get_history(self.dir).query(one)][-1], KIND_WITHDRAW)
+        self.assertEqual(sorted(fn for fn in os.listdir(self.dir) if fn.endswith('tmp') or fn.endswith('old')
+                                or fn.endswith('.lock')), [])
+
+    def test_lockfile(self):
+        self.__run('lockfile')
+
+    def test_flock(self):
+        self.__run('flock')
+
 if __name__ == '__main__':
     unittest.main()
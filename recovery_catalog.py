@@ -0,0 +1,273 @@
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of DroveBankConstants
+#
+# a catalog of everything a crash can leave in a dbdir, made with one
+# pass over the directory (and the shard directories under it). recovery
+# looks files up here instead of walking the dbdir again for every lock
+# file it finds.
+#
+# every file is filed under a key: the account id for an account file
+# (flat or sharded), otherwise <dir>/<prefix>, i.e. <dbdir>/index for
+# index.idx. for a key the catalog has
+#   - the data files:     1001.txt, index.idx
+#   - the lock files:     1001.lock
+#   - the intermediates:  1001_<transid>.txt.tmp, .old, .xtmp and .xold
+# and for the whole dbdir the transfers (transid -> keys with xtmp/xold
+# files), the half created accounts (*.atmp), the id reservations
+# (index_<lo>_<hi>.rsv), the optimistic commits that never got to
+# their rename (1001_<transid>.txt.otmp) and the optimistic commits
+# whose history was never finished (1001_<transid>.txt.pend).
+#
+# the catalog isn't kept up to date as recovery removes files, check a
+# file still exists before acting on it.
+#
+import os
+import re
+import time
+import logging
+from collections import namedtuple
+
+from drove_bank_constants import DroveBankConstants
+
+# os.scandir is in python 3.5, the scandir package has it for older
+# pythons. without either every name that could be a shard dir is
+# stat'd.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# <prefix>_<transid><suffix>.<kind> i.e. 1001_AB12CD34.txt.xtmp
+INTERMEDIATE_PATTERN = re.compile('^(.+)_([A-Za-z0-9]{8})(\.[^.]+)\.(tmp|old|xtmp|xold|otmp|pend)$')
+
+# the suffixes of a data file
+DATA_SUFFIXES = ('.txt', '.idx')
+
+# a tmp/old/xtmp/xold file. datafile is the file it was made from
+Intermediate = namedtuple('Intermediate', 'path key transid suffix datafile')
+
+class RecoveryCatalog(DroveBankConstants):
+
+    def __init__(self, dir=None):
+        DroveBankConstants.__init__(self, dir)
+        self.data = {}
+        self.locks = {}
+        self.intermediates = {}
+        self.transfers = {}
+        self.creates = []
+        self.reservations = []
+        self.optimistic = []
+        self.pending = []
+        self.entries = 0
+        self.dirs = 0
+        self.seconds = 0.0
+
+    # public
+    # catalogs the dbdir. returns self
+    def scan(self):
+        start = time.time()
+        self.__scan_dir(self.dbdir)
+        self.seconds = time.time() - start
+        logging.info("CAT0064 catalogued %d entries in %d dirs of %s in %.3f seconds",
+                     self.entries, self.dirs, self.dbdir, self.seconds)
+        return self
+
+    # public
+    # catalogs only the files of the data files in filenames: the data,
+    # lock and intermediate files next to each, one listing of each dir.
+    # for the recovery of one lock while the bank runs. returns self
+    def scan_files(self, filenames):
+        start = time.time()
+        prefixes = {}
+        for filename in filenames:
+            dirpath, name = os.path.split(filename)
+            prefixes.setdefault(dirpath, set()).add(name.split('.')[0])
+        for dirpath in sorted(prefixes):
+            self.dirs += 1
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                continue
+            for name in names:
+                self.entries += 1
+                m = INTERMEDIATE_PATTERN.match(name)
+                if m is not None:
+                    prefix = m.group(1)
+                else:
+                    prefix = name.split('.')[0]
+                if prefix in prefixes[dirpath]:
+                    self.__add_file(dirpath, name)
+        self.seconds = time.time() - start
+        return self
+
+    # public
+    # a catalog of only the files of keys, and the transfers between them
+    def restrict(self, keys):
+        result = RecoveryCatalog(self.dbdir)
+        for key in keys:
+            if key in self.data:
+                result.data[key] = list(self.data[key])
+            if key in self.locks:
+                result.locks[key] = list(self.locks[key])
+            if key in self.intermediates:
+                result.intermediates[key] = list(self.intermediates[key])
+        for transid, transfer_keys in self.transfers.items():
+            if transfer_keys & set(keys):
+                result.transfers[transid] = transfer_keys & set(keys)
+        result.optimistic = [entry for entry in self.optimistic if entry.key in keys]
+        result.pending = [entry for entry in self.pending if entry.key in keys]
+        result.entries = self.entries
+        result.dirs = self.dirs
+        result.seconds = self.seconds
+        return result
+
+    # public
+    # list of (key, lock file) in key order
+    def get_locks(self):
+        result = []
+        for key in sorted(self.locks):
+            for lockfile in self.locks[key]:
+                result.append((key, lockfile))
+        return result
+
+    # public
+    # the intermediates of a key, optionally only one kind (tmp, old,
+    # xtmp or xold) and one transaction
+    def get_intermediates(self, key, suffix=None, transid=None):
+        result = []
+        for entry in self.intermediates.get(key, []):
+            if suffix is not None and entry.suffix != suffix:
+                continue
+            if transid is not None and entry.transid != transid:
+                continue
+            result.append(entry)
+        return result
+
+    # public
+    # the data files of a key. while the layout is migrating an account
+    # can have a flat and a sharded one
+    def get_data_files(self, key):
+        return list(self.data.get(key, []))
+
+    # public
+    # transid -> set of the keys with xtmp or xold files of it
+    def get_transfers(self):
+        result = {}
+        for transid, ids in self.transfers.items():
+            result[transid] = set(ids)
+        return result
+
+    # public
+    # the tmp files of accounts that were never created
+    def get_create_files(self):
+        return list(self.creates)
+
+    # public
+    # the id reservations (account_create.py) of processes that died
+    def get_reservations(self):
+        return sorted(self.reservations)
+
+    # public
+    # the Intermediates of optimistic commits that died before their
+    # rename. they have no lock file
+    def get_optimistic_files(self):
+        return list(self.optimistic)
+
+    # public
+    # the Intermediates of the history markers of optimistic commits that
+    # died before they finished their history. with the otmp file of the
+    # same transid the rename never happened
+    def get_pending_files(self):
+        return list(self.pending)
+
+    # public
+    # the key of a data, lock or intermediate file
+    def key_for(self, path):
+        dirpath, name = os.path.split(path)
+        m = INTERMEDIATE_PATTERN.match(name)
+        if m is not None:
+            prefix = m.group(1)
+        else:
+            prefix = name.split('.')[0]
+        return self.__key(dirpath, prefix)
+
+    def get_stats(self):
+        locks = 0
+        for lockfiles in self.locks.values():
+            locks += len(lockfiles)
+        return {'entries': self.entries, 'dirs': self.dirs, 'locks': locks,
+                'transfers': len(self.transfers), 'creates': len(self.creates),
+                'reservations': len(self.reservations), 'optimistic': len(self.optimistic),
+                'pending': len(self.pending),
+                'seconds': self.seconds}
+
+    # private
+    # catalogs one dir and the shard dirs (all digits) under it
+    def __scan_dir(self, path):
+        self.dirs += 1
+        subdirs = []
+        for name, is_dir in self.__list_dir(path):
+            self.entries += 1
+            if is_dir:
+                if name.isdigit():
+                    subdirs.append(name)
+                continue
+            self.__add_file(path, name)
+        for name in subdirs:
+            self.__scan_dir(os.path.join(path, name))
+
+    # private
+    # generator of (name, is a dir) for the entries of path
+    def __list_dir(self, path):
+        if scandir is not None:
+            for entry in scandir(path):
+                yield entry.name, entry.is_dir(follow_symlinks=False)
+            return
+        for name in os.listdir(path):
+            # only a name that is all digits can be a shard dir
+            yield name, name.isdigit() and os.path.isdir(os.path.join(path, name))
+
+    # private
+    # files one name
+    def __add_file(self, dirpath, name):
+        path = os.path.join(dirpath, name)
+
+        m = INTERMEDIATE_PATTERN.match(name)
+        if m is not None:
+            prefix, transid, suffix, kind = m.groups()
+            key = self.__key(dirpath, prefix)
+            entry = Intermediate(path, key, transid, kind,
+                                 os.path.join(dirpath, prefix + suffix))
+            if kind == 'otmp':
+                self.optimistic.append(entry)
+                return
+            if kind == 'pend':
+                self.pending.append(entry)
+                return
+            self.intermediates.setdefault(key, []).append(entry)
+            if kind in ('xtmp', 'xold'):
+                self.transfers.setdefault(transid, set()).add(key)
+            return
+
+        prefix, suffix = os.path.splitext(name)
+        if suffix == '.lock':
+            self.locks.setdefault(self.__key(dirpath, prefix), []).append(path)
+        elif suffix == '.atmp':
+            self.creates.append(path)
+        elif suffix == '.rsv':
+            self.reservations.append(path)
+        elif suffix in DATA_SUFFIXES:
+            self.data.setdefault(self.__key(dirpath, prefix), []).append(path)
+
+    # private
+    # the account id if the file belongs to an account, <dir>/<prefix>
+    # if not
+    def __key(self, dirpath, prefix):
+        ac_id = self.account_id_from_path(os.path.join(dirpath, prefix))
+        if ac_id is not None:
+            return ac_id
+        return os.path.join(dirpath, prefix)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for RecoveryCatalog
+#
+import unittest
+import os
+import shutil
+
+from recovery_catalog import RecoveryCatalog
+from recover import Recover
+
+class RecoveryCatalog_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        self.dir = os.path.join(os.getcwd(), 'catalog_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+
+        self.filelist = [
+            "index.idx",
+            "70.txt", "70.lock", "70_AAAAAAAA.txt.tmp", "70_AAAAAAAA.txt.old",
+            "71.txt", "71.lock", "71_BBBBBBBB.txt.xtmp",
+            "72.txt.atmp",
+            "wal.log",
+            # account 1001 in the sharded layout
+            os.path.join("00", "00", "10", "01.txt"),
+            os.path.join("00", "00", "10", "01.lock"),
+            os.path.join("00", "00", "10", "01_BBBBBBBB.txt.xold"),
+        ]
+        os.makedirs(os.path.join(self.dir, "00", "00", "10"))
+        # not a shard, never looked at
+        os.mkdir(os.path.join(self.dir, "backup"))
+        self.filelist.append(os.path.join("backup", "99.lock"))
+        for fname in self.filelist:
+            self.__write_data_to_file(os.path.join(self.dir, fname), 'John,Doe,1.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __write_data_to_file(self, fname, content):
+        f = open(fname, 'w')
+        f.write(content)
+        f.flush()
+        f.close()
+
+    def test_scan(self):
+        catalog = RecoveryCatalog(self.dir).scan()
+
+        locks = dict(catalog.get_locks())
+        self.assertEqual(sorted(locks.keys()), [70, 71, 1001])
+        self.assertEqual(catalog.get_data_files(1001),
+                         [os.path.join(self.dir, "00", "00", "10", "01.txt")])
+
+        tmps = catalog.get_intermediates(70, 'tmp')
+        self.assertEqual(len(tmps), 1)
+        self.assertEqual(tmps[0].transid, 'AAAAAAAA')
+        self.assertEqual(tmps[0].datafile, os.path.join(self.dir, "70.txt"))
+        self.assertEqual(len(catalog.get_intermediates(70)), 2)
+
+        # a transfer between a flat and a sharded account
+        self.assertEqual(catalog.get_transfers(), {'BBBBBBBB': set([71, 1001])})
+        self.assertEqual(catalog.get_create_files(), [os.path.join(self.dir, "72.txt.atmp")])
+        self.assertEqual(catalog.key_for(os.path.join(self.dir, "index.lock")),
+                         os.path.join(self.dir, "index"))
+
+        stats = catalog.get_stats()
+        # every file and dir in the dbdir and the shards, not backup/99.lock
+        self.assertEqual(stats['entries'], len(self.filelist) - 1 + 4)
+        self.assertEqual(stats['dirs'], 4)
+
+    def test_recover_uses_catalog(self):
+        stats = Recover(self.dir).recover()
+        self.assertEqual(stats['transfers'], 1)
+        self.assertEqual(stats['locks'], 3)
+        self.assertTrue(stats['seconds'] >= stats['catalog_seconds'])
+
+        # only the data files are left
+        left = []
+        for subdir, dirs, files in os.walk(self.dir):
+            for fn in files:
+                left.append(os.path.relpath(os.path.join(subdir, fn), self.dir))
+        self.assertEqual(sorted(left),
+                         sorted(["index.idx", "70.txt", "71.txt", "wal.log", "summary.dat", "summary.undo",
+                                 os.path.join("00", "00", "10", "01.txt"),
+                                 os.path.join("backup", "99.lock")]))
+
+if __name__ == '__main__':
+    unittest.main()
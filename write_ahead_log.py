@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# sub class of DroveBankConstants.
+#
+# Write ahead log storage engine. Used when the dbdir config says
+# storage = wal.
+#
+# Every committed change is one line appended to <dbdir>/wal.log
+#
+#   DWAL1 <generation>                       <- header, first line
+#   <crc32 hex> <json list of [file, content]>
+#
+# A commit is one append plus one fsync. The data files are only brought
+# up to date by checkpoint(), which applies the latest content of every
+# file in the log, then swaps in an empty log with the next generation.
+# Until then readers have to ask lookup() before they read a data file.
+#
+# The log is shared by every process on the dbdir, appends are
+# serialized with flock on the log file itself.
+#
+# With group_commit = on the fsync is shared. A committer appends without
+# syncing and then waits for <dbdir>/wal.sync to say its record is
+# durable. The first waiter to get the flock on wal.sync is the leader,
+# it waits up to group_commit_window_ms (or until group_commit_max_ops
+# records are pending), does one fsync for everyone and writes the
+# durable offset into wal.sync. The rest wake up, see they are covered
+# and return without an fsync of their own.
+#
+import os
+import json
+import zlib
+import fcntl
+import time
+import logging
+import threading
+
+from drove_bank_constants import DroveBankConstants
+
+WAL_FILENAME = 'wal.log'
+SYNC_FILENAME = 'wal.sync'
+# wal.sync holds "<generation> <durable offset>\n" in fixed width hex
+SYNC_FORMAT = "%016x %016x\n"
+SYNC_SIZE = 34
+WAL_MAGIC = 'DWAL1'
+# suffix of the tmp files a checkpoint renames over the data files
+WAL_TMP_SUFFIX = 'wtmp'
+
+# dbdir -> WriteAheadLog. the tail index is expensive to build so there
+# is only one per dbdir per process.
+_wal_registry = {}
+_wal_registry_lock = threading.Lock()
+
+def get_wal(dbdir):
+    key = os.path.abspath(dbdir)
+    with _wal_registry_lock:
+        wal = _wal_registry.get(key)
+        if wal is None:
+            wal = WriteAheadLog(key)
+            _wal_registry[key] = wal
+        return wal
+
+class WriteAheadLog(DroveBankConstants):
+
+    def __init__(self, dir=None):
+        DroveBankConstants.__init__(self, dir)
+        self.wal_filename = os.path.join(self.dbdir, WAL_FILENAME)
+
+        # the tail index. relative filename -> latest content for every
+        # record of generation tail_gen (log inode tail_ino) up to byte
+        # tail_offset
+        self.tail = {}
+        self.tail_gen = None
+        self.tail_ino = None
+        self.tail_offset = 0
+
+        # append fd, the inode and generation it was opened on
+        self.fd = None
+        self.fd_ino = None
+        self.fd_gen = None
+
+        # group commit marker
+        self.sync_filename = os.path.join(self.dbdir, SYNC_FILENAME)
+        self.sync_fd = None
+        self.pid = os.getpid()
+
+        self.mutex = threading.RLock()
+        # threads of this process line up here before the wal.sync flock,
+        # a flock is per open file so it doesn't keep out our own threads
+        self.sync_mutex = threading.Lock()
+        self.stats = {'appends': 0, 'syncs': 0, 'checkpoints': 0, 'torn': 0,
+                      'groups': 0, 'group_acks': 0}
+
+    # public
+    # appends one record holding every (filename, content) pair in writes
+    # and makes it durable. all the writes are applied or none are.
+    # returns the offset of the end of the record.
+    def commit(self, writes):
+        record = self.__encode(writes)
+        group = self.get_config_bool('group_commit')
+        with self.mutex:
+            fd = self.__lock_log()
+            try:
+                end = self.__append(fd, record)
+                gen = self.fd_gen
+                if group is False:
+                    os.fsync(fd)
+                    self.stats['syncs'] += 1
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+        # don't hold the mutex while we wait, the other threads need to
+        # get their records into the group
+        if group is True:
+            self.__wait_durable(gen, end)
+
+        with self.mutex:
+            self.__maybe_checkpoint(end)
+        return end
+
+    # public
+    # returns the latest committed content for filename or None if the
+    # log has nothing for it and the data file is current
+    def lookup(self, filename):
+        rel = self.__relname(filename)
+        with self.mutex:
+            self.__refresh_tail()
+            return self.tail.get(rel)
+
+    # public
+    # applies every record in the log to the data files and starts a new
+    # generation. safe to call while other processes are committing.
+    def checkpoint(self):
+        with self.mutex:
+            fd = self.__lock_log()
+            try:
+                self.__checkpoint_locked(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    # public
+    # called by recover.py. replays the log tail into the data files. a
+    # torn record at the end of the log (crash during the append) was
+    # never acknowledged and is dropped.
+    def recover(self):
+        if os.path.exists(self.wal_filename) is False:
+            return
+        logging.info("WAL0101:RECOVER replaying log %s", self.wal_filename)
+        self.checkpoint()
+
+        # a checkpoint that died part way leaves tmp files behind. the
+        # replay above has rewritten those data files so just drop them.
+        for subdir, dirs, files in os.walk(self.dbdir):
+            for fn in files:
+                if fn.endswith("." + WAL_TMP_SUFFIX):
+                    logging.info("WAL0109:RECOVER removing checkpoint tmp file %s", fn)
+                    os.remove(os.path.join(subdir, fn))
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    # private
+    # opens (or reopens) the log for append and takes the flock. a
+    # checkpoint renames a new log over the old one, so after the lock
+    # is held make sure it is still the live file.
+    def __lock_log(self):
+        self.__check_fork()
+        while True:
+            if self.fd is None:
+                self.__create_log()
+                self.fd = os.open(self.wal_filename, os.O_RDWR | os.O_APPEND)
+                self.fd_ino = os.fstat(self.fd).st_ino
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                live_ino = os.stat(self.wal_filename).st_ino
+            except OSError:
+                live_ino = None
+            if live_ino == self.fd_ino:
+                if self.fd_gen is None:
+                    self.fd_gen = self.__read_gen(self.fd)
+                return self.fd
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+            self.fd_gen = None
+
+    # private
+    # a forked child shares the open files of the parent and with them
+    # the flocks. drop them so the child gets locks of its own.
+    def __check_fork(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.fd = None
+        self.fd_ino = None
+        self.fd_gen = None
+        self.sync_fd = None
+
+    # private
+    # reads the generation out of the log header
+    def __read_gen(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        vals = os.read(fd, 64).split(b'\n')[0].split()
+        return int(vals[1])
+
+    # private
+    # makes an empty generation 0 log if there isn't one. link fails if
+    # another process got there first which is fine.
+    def __create_log(self):
+        if os.path.exists(self.wal_filename):
+            return
+        tmpname = "%s.%d.new" % (self.wal_filename, os.getpid())
+        self.__write_header(tmpname, 0)
+        try:
+            os.link(tmpname, self.wal_filename)
+        except OSError:
+            pass
+        os.remove(tmpname)
+
+    def __write_header(self, filename, gen):
+        f = open(filename, 'w')
+        f.write("%s %d\n" % (WAL_MAGIC, gen))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    # private
+    # appends the record. caller holds the flock. if the last writer
+    # crashed part way through a record the log won't end in a newline,
+    # cut the torn bytes off first so the new record starts on its own line.
+    def __append(self, fd, record):
+        size = os.fstat(fd).st_size
+        os.lseek(fd, size - 1, os.SEEK_SET)
+        if os.read(fd, 1) != b'\n':
+            self.__truncate_torn(fd, size)
+        os.write(fd, record)
+        self.stats['appends'] += 1
+        return os.fstat(fd).st_size
+
+    def __truncate_torn(self, fd, size):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, size)
+        keep = data.rfind(b'\n') + 1
+        logging.warning("WAL0163 dropping %d torn bytes at the end of %s",
+                        size - keep, self.wal_filename)
+        os.ftruncate(fd, keep)
+        self.stats['torn'] += 1
+
+    def __maybe_checkpoint(self, end):
+        if end < self.get_config_int('wal_checkpoint_bytes'):
+            return
+        fd = self.__lock_log()
+        try:
+            # someone else may have checkpointed while we waited
+            if os.fstat(fd).st_size >= self.get_config_int('wal_checkpoint_bytes'):
+                self.__checkpoint_locked(fd)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    # private
+    # caller holds the flock so no one can append while we work
+    def __checkpoint_locked(self, fd):
+        self.__refresh_tail()
+        gen = self.tail_gen
+        if gen is None:
+            gen = 0
+
+        # step 1 bring every data file up to date. each file is replaced
+        # with a rename so a reader sees the old or new content.
+        for rel, content in self.tail.items():
+            filename = os.path.join(self.dbdir, rel)
+            tmpname = "%s.%d.%s" % (filename, os.getpid(), WAL_TMP_SUFFIX)
+            f = open(tmpname, 'w')
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmpname, filename)
+        self.__sync_dir()
+
+        # step 2 swap in an empty log. until the rename the old log is
+        # still complete so a crash here just replays it again.
+        tmpname = "%s.%d.new" % (self.wal_filename, os.getpid())
+        self.__write_header(tmpname, gen + 1)
+        os.rename(tmpname, self.wal_filename)
+        self.__sync_dir()
+
+        # everything up to the new generation is in the data files now
+        if self.get_config_bool('group_commit'):
+            self.__write_durable(gen + 1, 0)
+
+        logging.debug("WAL0213 checkpointed %d files, generation now %d",
+                      len(self.tail), gen + 1)
+        self.stats['checkpoints'] += 1
+        self.tail = {}
+        self.tail_gen = None
+        self.tail_ino = None
+        self.tail_offset = 0
+
+    # private
+    # group commit. returns once the record of generation gen ending at
+    # offset end is on disk, either from our own fsync or another one.
+    def __wait_durable(self, gen, end):
+        if self.__is_durable(gen, end):
+            self.stats['group_acks'] += 1
+            return
+        with self.sync_mutex:
+            sfd = self.__get_sync_fd()
+            fcntl.flock(sfd, fcntl.LOCK_EX)
+            try:
+                # the leader we queued behind may have covered us
+                if self.__is_durable(gen, end):
+                    self.stats['group_acks'] += 1
+                    return
+                self.__lead_group(gen)
+            finally:
+                fcntl.flock(sfd, fcntl.LOCK_UN)
+
+    # private
+    # we hold the wal.sync flock. give the other committers the window
+    # to append, then one fsync covers all of them.
+    def __lead_group(self, gen):
+        window = self.get_config_float('group_commit_window_ms') / 1000.0
+        max_ops = self.get_config_int('group_commit_max_ops')
+
+        fd = os.open(self.wal_filename, os.O_RDONLY)
+        try:
+            if self.__read_gen(fd) != gen:
+                # a checkpoint has written our record to the data files
+                return
+            durable_gen, durable_end = self.__read_durable()
+            if durable_gen != gen:
+                durable_end = 0
+            deadline = time.time() + window
+            while time.time() < deadline:
+                if self.__pending_ops(fd, durable_end) >= max_ops:
+                    break
+                time.sleep(0.0002)
+            size = os.fstat(fd).st_size
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.__write_durable(gen, size)
+        self.stats['syncs'] += 1
+        self.stats['groups'] += 1
+
+    # counts the records appended after offset
+    def __pending_ops(self, fd, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, 1 << 20).count(b'\n')
+
+    def __is_durable(self, gen, end):
+        durable_gen, durable_end = self.__read_durable()
+        if durable_gen is None:
+            return False
+        return durable_gen > gen or (durable_gen == gen and durable_end >= end)
+
+    def __get_sync_fd(self):
+        self.__check_fork()
+        if self.sync_fd is None:
+            self.sync_fd = os.open(self.sync_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        return self.sync_fd
+
+    # returns (generation, offset) or (None, None) if wal.sync is empty
+    # or caught half written
+    def __read_durable(self):
+        with self.mutex:
+            sfd = self.__get_sync_fd()
+            os.lseek(sfd, 0, os.SEEK_SET)
+            data = os.read(sfd, SYNC_SIZE)
+        vals = data.split()
+        if len(data) != SYNC_SIZE or len(vals) != 2:
+            return None, None
+        try:
+            return int(vals[0], 16), int(vals[1], 16)
+        except ValueError:
+            return None, None
+
+    def __write_durable(self, gen, end):
+        with self.mutex:
+            sfd = self.__get_sync_fd()
+            os.lseek(sfd, 0, os.SEEK_SET)
+            os.write(sfd, (SYNC_FORMAT % (gen, end)).encode('ascii'))
+
+    def __sync_dir(self):
+        dfd = os.open(self.dbdir, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+    # private
+    # reads any records appended since the last refresh into the tail
+    # index. starts over when the generation changes.
+    def __refresh_tail(self):
+        try:
+            f = open(self.wal_filename, 'rb')
+        except IOError:
+            self.tail = {}
+            self.tail_gen = None
+            self.tail_ino = None
+            self.tail_offset = 0
+            return
+        try:
+            header = f.readline()
+            vals = header.split()
+            if len(vals) != 2 or vals[0] != WAL_MAGIC.encode('ascii'):
+                logging.critical("WAL0235 %s is not a write ahead log", self.wal_filename)
+                raise IOError("bad write ahead log header in %s" % self.wal_filename)
+            gen = int(vals[1])
+            ino = os.fstat(f.fileno()).st_ino
+            if gen != self.tail_gen or ino != self.tail_ino:
+                self.tail = {}
+                self.tail_gen = gen
+                self.tail_ino = ino
+                self.tail_offset = len(header)
+            f.seek(self.tail_offset)
+            data = f.read()
+        finally:
+            f.close()
+
+        pos = 0
+        while True:
+            nl = data.find(b'\n', pos)
+            if nl == -1:
+                # incomplete record, either being written or torn
+                break
+            writes = self.__decode(data[pos:nl])
+            if writes is None:
+                break
+            for rel, content in writes:
+                self.tail[rel] = content
+            pos = nl + 1
+        self.tail_offset += pos
+
+    def __relname(self, filename):
+        return os.path.relpath(filename, self.dbdir)
+
+    def __encode(self, writes):
+        payload = json.dumps([[self.__relname(fn), content] for fn, content in writes],
+                             separators=(',', ':'))
+        payload = payload.encode('utf-8')
+        crc = zlib.crc32(payload) & 0xffffffff
+        return ("%08x " % crc).encode('ascii') + payload + b'\n'
+
+    # returns the list of writes or None if the line fails its checksum
+    def __decode(self, line):
+        try:
+            crc = int(line[:8], 16)
+        except ValueError:
+            return None
+        payload = line[9:]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            logging.warning("WAL0277 bad checksum in %s at offset %d",
+                            self.wal_filename, self.tail_offset)
+            return None
+        return [(_native(rel), _native(content))
+                for rel, content in json.loads(payload.decode('utf-8'))]
+
+# json hands back unicode, the rest of the code works with plain str
+def _native(value):
+    if isinstance(value, str):
+        return value
+    return value.encode('utf-8')
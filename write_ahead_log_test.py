@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- mode: python; python-indent-offset: 4; indent-tabs-mode: nil; -*-
+#
+# unit tests for WriteAheadLog
+#
+import unittest
+import os
+import shutil
+from threading import Thread
+
+from account_actions import AccountActions
+from account_create import AccountCreate
+from drove_bank_constants import write_config
+from recover import Recover
+from write_ahead_log import get_wal
+
+class WriteAheadLog_Test(unittest.TestCase):
+
+    # setup
+    def setUp(self):
+        # the log is configured per dbdir so these tests get their own
+        self.dir = os.path.join(os.getcwd(), 'wal_test_dir')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        write_config(self.dir, {'storage': 'wal'})
+
+        f = open(os.path.join(self.dir, 'index.idx'), 'w')
+        f.write('69\n')
+        f.close()
+
+        ac = AccountCreate(self.dir)
+        self.one_id = ac.create_account('John', 'Doe', 100.0)
+        self.one_file = ac.get_account_file()
+        self.two_id = ac.create_account('Bob', 'Smith', 100.0)
+        self.two_file = ac.get_account_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def __read_file(self, fname):
+        f = open(fname, 'r')
+        content = f.readline()
+        f.close()
+        return content
+
+    def test_deposit_goes_to_log(self):
+        aa = AccountActions(self.dir)
+        balance = aa.deposit(self.one_id, 50.0)
+        self.assertEqual(balance, 150.0)
+
+        # the data file is only updated at the checkpoint
+        self.assertEqual(self.__read_file(self.one_file), 'John,Doe,100.0\n')
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 150.0)
+
+        # no tmp or old files were made
+        for fn in os.listdir(self.dir):
+            self.assertFalse(fn.endswith('.tmp') or fn.endswith('.old'))
+
+    def test_transfer_is_one_record(self):
+        aa = AccountActions(self.dir)
+        wal = get_wal(self.dir)
+        appends = wal.get_stats()['appends']
+        self.assertTrue(aa.transfer_money(self.one_id, self.two_id, 25.0))
+        self.assertEqual(wal.get_stats()['appends'], appends + 1)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 75.0)
+        self.assertEqual(aa.get_account_info(self.two_id).balance, 125.0)
+
+        # not enough money leaves both accounts alone and unlocked
+        self.assertFalse(aa.transfer_money(self.one_id, self.two_id, 500.0))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, '%s.lock' % self.one_id)))
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 75.0)
+
+    def test_checkpoint(self):
+        aa = AccountActions(self.dir)
+        aa.withdraw(self.one_id, 40.0)
+        get_wal(self.dir).checkpoint()
+
+        self.assertEqual(self.__read_file(self.one_file), 'John,Doe,60.0\n')
+        header = self.__read_file(os.path.join(self.dir, 'wal.log'))
+        self.assertEqual(header, 'DWAL1 1\n')
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 60.0)
+
+    def test_recover_replays_tail(self):
+        aa = AccountActions(self.dir)
+        aa.deposit(self.two_id, 10.0)
+
+        # crash in the middle of the next append
+        f = open(os.path.join(self.dir, 'wal.log'), 'a')
+        f.write('0badf00d ["%s.txt","John,Doe,99' % self.one_id)
+        f.close()
+
+        # the torn record was never acknowledged
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 100.0)
+
+        Recover(self.dir).recover()
+        self.assertEqual(self.__read_file(self.two_file), 'Bob,Smith,110.0\n')
+        self.assertEqual(self.__read_file(self.one_file), 'John,Doe,100.0\n')
+
+    def test_torn_tail_is_cut_on_append(self):
+        aa = AccountActions(self.dir)
+        aa.deposit(self.two_id, 1.0)
+        torn = get_wal(self.dir).get_stats()['torn']
+        f = open(os.path.join(self.dir, 'wal.log'), 'a')
+        f.write('0badf00d ["%s.txt"' % self.one_id)
+        f.close()
+
+        self.assertEqual(aa.deposit(self.one_id, 1.0), 101.0)
+        self.assertEqual(get_wal(self.dir).get_stats()['torn'], torn + 1)
+        self.assertEqual(aa.get_account_info(self.one_id).balance, 101.0)
+
+    # worker for the group commit test. one account per thread so the
+    # account locks never make the threads wait on each other
+    def deposit_worker(self, account_id, count):
+        aa = AccountActions(self.dir)
+        for i in range(count):
+            aa.deposit(account_id, 1.0)
+
+    def test_group_commit(self):
+        write_config(self.dir, {'storage': 'wal', 'group_commit': 'on',
+                                'group_commit_window_ms': '5',
+                                'group_commit_max_ops': '4'})
+        ac = AccountCreate(self.dir)
+        ids = [ac.create_account('Group', 'Member%d' % i, 0.0) for i in range(4)]
+
+        wal = get_wal(self.dir)
+        before = wal.get_stats()
+        threads = [Thread(target=self.deposit_worker, args=(ac_id, 10)) for ac_id in ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        after = wal.get_stats()
+
+        aa = AccountActions(self.dir)
+        for ac_id in ids:
+            self.assertEqual(aa.get_account_info(ac_id).balance, 10.0)
+
+        # every commit was acknowledged but they shared the fsyncs
+        commits = after['appends'] - before['appends']
+        syncs = after['syncs'] - before['syncs']
+        self.assertEqual(commits, 40)
+        self.assertTrue(syncs < commits)
+        self.assertEqual(after['groups'] - before['groups'], syncs)
+
+        # the durable offset covers the whole log
+        durable = open(os.path.join(self.dir, 'wal.sync')).read().split()
+        self.assertEqual(int(durable[1], 16),
+                         os.path.getsize(os.path.join(self.dir, 'wal.log')))
+
+if __name__ == '__main__':
+    unittest.main()